@@ -0,0 +1,101 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Runs CPU-bound cryptographic work off of the IOLoop.
+
+Hashing a password (PBKDF2 with 1000 SHA512 iterations) takes tens of
+milliseconds, during which the IOLoop cannot service any other request. A burst
+of logins therefore stalls every request on the server. CryptoExecutor runs
+such work on a small, bounded pool of worker threads shared by the whole
+process, and returns a Future that can be yielded from a coroutine:
+
+  pwd_hash = yield crypto_executor.Run(password_util.HashPassword, password, salt)
+
+The IOLoop still competes with the workers for the GIL, but is scheduled
+every few milliseconds rather than being blocked for the duration of the
+computation.
+
+Work should be self-contained: functions must not touch IOLoop state or
+objects shared with the IOLoop thread other than their arguments.
+
+  CryptoExecutor: bounded worker pool that completes futures on the IOLoop.
+  Run(): submits work to the shared CryptoExecutor instance.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import sys
+import time
+
+from concurrent import futures
+from tornado import options
+from tornado.concurrent import TracebackFuture
+from tornado.ioloop import IOLoop
+from viewfinder.backend.base import counters
+
+options.define('crypto_workers', default=4, help='number of threads used for CPU-bound cryptographic work')
+
+_queue_depth = counters.define_total('viewfinder.crypto.queue_depth',
+                                     'Number of cryptographic tasks waiting for or running on a worker.')
+_avg_wait_time = counters.define_average('viewfinder.crypto.avg_wait_time',
+                                         'Average seconds a cryptographic task waits for a worker.')
+_avg_run_time = counters.define_average('viewfinder.crypto.avg_run_time',
+                                        'Average seconds to run a cryptographic task on a worker.')
+
+
+class CryptoExecutor(object):
+  """Bounded pool of worker threads for CPU-bound cryptographic work. Submit returns a
+  Future which is always completed on the submitting thread's IOLoop, so counters and
+  callbacks are only ever touched from the IOLoop.
+  """
+  _instance = None
+
+  def __init__(self, max_workers=None):
+    self._executor = futures.ThreadPoolExecutor(max_workers or options.options.crypto_workers)
+
+  @staticmethod
+  def Instance():
+    if CryptoExecutor._instance is None:
+      CryptoExecutor._instance = CryptoExecutor()
+    return CryptoExecutor._instance
+
+  @staticmethod
+  def SetInstance(executor):
+    CryptoExecutor._instance = executor
+
+  def Submit(self, fn, *args, **kwargs):
+    """Runs fn(*args, **kwargs) on a worker thread. Returns a Future that resolves to the
+    result of the call, or to the exception that it raised.
+    """
+    future = TracebackFuture()
+    io_loop = IOLoop.current()
+    submit_time = time.time()
+
+    def _Run():
+      start_time = time.time()
+      try:
+        result, exc_info = fn(*args, **kwargs), None
+      except Exception:
+        result, exc_info = None, sys.exc_info()
+      io_loop.add_callback(_OnComplete, start_time, time.time(), result, exc_info)
+
+    def _OnComplete(start_time, end_time, result, exc_info):
+      _queue_depth.decrement()
+      _avg_wait_time.add(start_time - submit_time)
+      _avg_run_time.add(end_time - start_time)
+      if exc_info is not None:
+        future.set_exc_info(exc_info)
+      else:
+        future.set_result(result)
+
+    _queue_depth.increment()
+    self._executor.submit(_Run)
+    return future
+
+  def Shutdown(self):
+    """Waits for submitted work to complete and stops the worker threads."""
+    self._executor.shutdown(wait=True)
+
+
+def Run(fn, *args, **kwargs):
+  """Runs fn(*args, **kwargs) on the shared CryptoExecutor. See CryptoExecutor.Submit."""
+  return CryptoExecutor.Instance().Submit(fn, *args, **kwargs)
@@ -120,8 +120,12 @@ def InitAndRun(run_callback, shutdown_callback=None, init_db=True, server_loggin
 
     io_loop.run_sync(partial(_Init, init_db=init_db, server_logging=server_logging))
 
-    # Run.
-    io_loop.run_sync(partial(_InvokeCallback, run_callback))
+    # Run. A signal stops the ioloop, which makes run_sync raise TimeoutError; that is a clean
+    # shutdown, so still invoke the shutdown callback.
+    try:
+      io_loop.run_sync(partial(_InvokeCallback, run_callback))
+    except ioloop.TimeoutError:
+      pass
 
     # Shutdown.
     if shutdown_callback is not None:
@@ -17,6 +17,7 @@ import time
 import validictory
 
 from functools import partial
+from viewfinder.backend.base import counters, schema_compiler
 
 # The client uses the Unicode separator char class, but the Python re module does not support
 # that, so just approximate.
@@ -222,10 +223,32 @@ class Message(object):
     "self.schema" field.
     """
     assert schema, "A schema must be provided in order to validate."
+    extra_fields = schema_compiler.ALLOW_EXTRA_FIELDS if allow_extra_fields else schema_compiler.REJECT_EXTRA_FIELDS
     try:
-      validictory.validate(self.dict, schema)
-      if not allow_extra_fields:
-        self._FindExtraFields(self.dict, schema, True)
+      validate = schema_compiler.CompileSchema(schema, extra_fields)
+      if validate is not None:
+        validate(self.dict)
+      else:
+        validictory.validate(self.dict, schema)
+        if not allow_extra_fields:
+          self._FindExtraFields(self.dict, schema, True)
+      self.schema = schema
+    except Exception as e:
+      raise BadMessageException(e.message), None, sys.exc_info()[2]
+
+  def ValidateAndSanitize(self, schema):
+    """Equivalent to Validate(schema, allow_extra_fields=True) followed by Sanitize(), but
+    makes only a single pass over the message when the schema can be compiled.
+    """
+    assert schema, "A schema must be provided in order to validate."
+    validate = schema_compiler.CompileSchema(schema, schema_compiler.REMOVE_EXTRA_FIELDS)
+    if validate is None:
+      self.Validate(schema, allow_extra_fields=True)
+      self.Sanitize()
+      return
+
+    try:
+      validate(self.dict)
       self.schema = schema
     except Exception as e:
       raise BadMessageException(e.message), None, sys.exc_info()[2]
@@ -249,22 +272,15 @@ class Message(object):
 
       migrators = sorted(REQUIRED_MIGRATORS + [MyMigrator(), MyOtherMigrator()])
 
+    The migrators that apply are looked up in a cached MigrationPlan.
+    Adjacent migrators that only rename or remove fields are fused into
+    a single walk of the message, and the callback chain is only entered
+    for migrators that do not complete synchronously (e.g. because they
+    need to query the database).
+
     When the migration is completed, "callback" is invoked with the
     message as its only parameter.
     """
-    def _OnMigrate(intermediate_version):
-      """Called each time a migrator has been applied; keep invoking Migrate
-      until the final migrate version is reached.
-      """
-      self.version = intermediate_version
-
-      # Update the version header to be the target version.
-      if intermediate_version >= Message.ADD_HEADERS_VERSION:
-        self.dict['headers']['version'] = intermediate_version
-
-      # Continue migrating.
-      self.Migrate(client, migrate_version, callback, migrators)
-
     assert migrate_version >= MIN_SUPPORTED_MESSAGE_VERSION
     assert migrate_version <= MAX_MESSAGE_VERSION
 
@@ -278,35 +294,65 @@ class Message(object):
       callback(self)
       return
 
-    # Migrate the message version to the target version.
-    migrator_count = len(migrators)
-    if self.version < migrate_version:
-      for i in xrange(migrator_count):
-        migrator = migrators[i]
-        assert i == 0 or migrators[i - 1].migrate_version < migrator.migrate_version
-
-        # Break if we reach a migrator that is above the desired version.
-        if migrator.migrate_version > migrate_version:
-          break
+    _migrations.increment()
+    plan = MigrationPlan.Get(migrators, self.version, migrate_version)
+    self._ExecutePlan(client, plan, 0, callback)
 
-        if self.version < migrator.migrate_version:
-          migrator.MigrateForward(client, self, partial(_OnMigrate, migrator.migrate_version))
-          return
-    else:
-      for i in xrange(migrator_count, 0, -1):
-        migrator = migrators[i - 1]
-        assert i == migrator_count or migrators[i].migrate_version > migrator.migrate_version
+  def _ExecutePlan(self, client, plan, index, callback):
+    """Applies the steps of "plan" to this message, starting with the step at "index". Steps
+    that complete synchronously are applied in a loop. If a step completes asynchronously,
+    execution resumes from its callback.
+    """
+    while index < len(plan.steps):
+      step = plan.steps[index]
+      index += 1
+      start = time.time()
+
+      if step.visitor is not None:
+        self.Visit(step.visitor)
+        self._OnMigrateStep(step, start)
+        continue
 
-        # Break if we reach migrators that are below the desired version.
-        if migrator.migrate_version <= migrate_version:
-          break
+      # Detect whether the migrator invokes its callback before returning.
+      state = {'returned': False, 'completed': False}
+
+      def _OnMigrate(step, start, index):
+        self._OnMigrateStep(step, start)
+        if state['returned']:
+          self._ExecutePlan(client, plan, index, callback)
+        else:
+          state['completed'] = True
+
+      if step.forward:
+        step.migrator.MigrateForward(client, self, partial(_OnMigrate, step, start, index))
+      else:
+        step.migrator.MigrateBackward(client, self, partial(_OnMigrate, step, start, index))
+      state['returned'] = True
+
+      if not state['completed']:
+        _async_migrations.increment()
+        return
+
+    # Skip directly to target version, even if no migrators apply.
+    self._SetVersion(plan.to_version)
+    callback(self)
+
+  def _OnMigrateStep(self, step, start):
+    """Called each time a plan step has been applied in order to record its cost and update
+    the version of the message.
+    """
+    elapsed = (time.time() - start) / len(step.versions)
+    for version in step.versions:
+      _avg_migrate_time[version].add(elapsed)
+    self._SetVersion(step.result_version)
 
-        if self.version >= migrator.migrate_version:
-          migrator.MigrateBackward(client, self, partial(_OnMigrate, migrator.migrate_version - 1))
-          return
+  def _SetVersion(self, version):
+    """Sets the version of the message, including the version header if the message has one."""
+    self.version = version
 
-    # No migrators apply, so skip directly to target version.
-    _OnMigrate(migrate_version)
+    # Update the version header to be the target version.
+    if version >= Message.ADD_HEADERS_VERSION:
+      self.dict['headers']['version'] = version
 
   def Visit(self, visitor):
     """Recursively visit the fields of the message in a depth-first
@@ -443,6 +489,19 @@ class MessageMigrator(object):
     """
     raise NotImplementedError()
 
+  def ForwardVisitor(self):
+    """Migrators that only need to rename or remove fields wherever they
+    occur in the message can return a Message.Visit handler that does so,
+    instead of implementing MigrateForward. Adjacent visitor migrators are
+    fused into a single walk of the message. Handlers must depend only on
+    the field name, and not on the contents of the field value.
+    """
+    return None
+
+  def BackwardVisitor(self):
+    """The MigrateBackward counterpart of ForwardVisitor."""
+    return None
+
   def __cmp__(self, other):
     """Migrators are compared to one another by "migrate_version", which
     imposes a total ordering of migrators.
@@ -451,6 +510,97 @@ class MessageMigrator(object):
     return cmp(self.migrate_version, other.migrate_version)
 
 
+class MigrationPlan(object):
+  """The ordered steps that migrate a message between two versions using
+  a particular list of migrators. Each step either applies one migrator,
+  or applies the fused visitors of several adjacent migrators in one walk
+  of the message. Plans are cached by migrator list and versions, so the
+  applicable migrators are only found once for each method and client
+  version.
+  """
+  _MAX_CACHED_PLANS = 1000
+
+  # Maps (migrator ids, from version, to version) => (migrators, plan). The migrators are kept
+  # in the value so that their ids cannot be reused while the entry exists.
+  _cache = {}
+
+  class Step(object):
+    def __init__(self, forward, migrator=None, visitors=None, versions=None, result_version=None):
+      self.forward = forward
+      self.migrator = migrator
+      self.visitors = visitors
+      self.visitor = MigrationPlan._FuseVisitors(visitors) if visitors else None
+      self.versions = versions
+      self.result_version = result_version
+
+  def __init__(self, migrators, from_version, to_version):
+    self.from_version = from_version
+    self.to_version = to_version
+    self.steps = []
+
+    for i, migrator in enumerate(migrators):
+      assert i == 0 or migrators[i - 1].migrate_version < migrator.migrate_version
+
+    forward = from_version < to_version
+    if forward:
+      applicable = [(m, m.ForwardVisitor(), m.migrate_version) for m in migrators
+                    if from_version < m.migrate_version <= to_version]
+    else:
+      applicable = [(m, m.BackwardVisitor(), m.migrate_version - 1) for m in reversed(migrators)
+                    if to_version < m.migrate_version <= from_version]
+
+    for migrator, visitor, result_version in applicable:
+      if visitor is None:
+        self.steps.append(MigrationPlan.Step(forward, migrator=migrator, versions=[migrator.migrate_version],
+                                             result_version=result_version))
+      elif self.steps and self.steps[-1].visitor is not None:
+        # Fuse with the previous visitor step.
+        prev_step = self.steps[-1]
+        self.steps[-1] = MigrationPlan.Step(forward, visitors=prev_step.visitors + [visitor],
+                                            versions=prev_step.versions + [migrator.migrate_version],
+                                            result_version=result_version)
+      else:
+        self.steps.append(MigrationPlan.Step(forward, visitors=[visitor], versions=[migrator.migrate_version],
+                                             result_version=result_version))
+
+  @staticmethod
+  def Get(migrators, from_version, to_version):
+    """Returns the cached plan for migrating from "from_version" to "to_version" using
+    "migrators", creating it if necessary.
+    """
+    key = (tuple(id(m) for m in migrators), from_version, to_version)
+    entry = MigrationPlan._cache.get(key)
+    if entry is None:
+      if len(MigrationPlan._cache) >= MigrationPlan._MAX_CACHED_PLANS:
+        MigrationPlan._cache.clear()
+      entry = (list(migrators), MigrationPlan(migrators, from_version, to_version))
+      MigrationPlan._cache[key] = entry
+    return entry[1]
+
+  @staticmethod
+  def _FuseVisitors(visitors):
+    """Returns a single Message.Visit handler that applies each of "visitors" in turn to
+    each field.
+    """
+    if len(visitors) == 1:
+      return visitors[0]
+
+    def _Visit(key, value):
+      result = None
+      for visitor in visitors:
+        visitor_result = visitor(key, value)
+        if visitor_result is None:
+          continue
+        result = visitor_result
+        if len(visitor_result) != 2:
+          # Field was removed, so no other visitor can see it.
+          return result
+        key, value = visitor_result
+      return result
+
+    return _Visit
+
+
 class AddHeadersMigrator(MessageMigrator):
   """Migrator that adds a headers object to the message. The headers object
   contains a single required "version" field.
@@ -481,26 +631,34 @@ class RenameEventMigrator(MessageMigrator):
   def __init__(self):
     MessageMigrator.__init__(self, Message.RENAME_EVENT_VERSION)
 
-  def MigrateForward(self, client, message, callback):
-    """Visit all fields in the message and replace event fields with episode fields."""
+  def ForwardVisitor(self):
+    """Replace event fields with episode fields."""
     def _ReplaceEventWithEpisode(key, value):
       if RenameEventMigrator._EPISODE_TO_EVENT.has_key(key):
         raise BadMessageException('Episode fields should not appear in older messages.')
       episode = RenameEventMigrator._EVENT_TO_EPISODE.get(key, None)
       return (episode, value) if episode else None
 
-    message.Visit(_ReplaceEventWithEpisode)
-    callback()
+    return _ReplaceEventWithEpisode
 
-  def MigrateBackward(self, client, message, callback):
-    """Visit all fields in the message and replace episode fields with event fields."""
+  def BackwardVisitor(self):
+    """Replace episode fields with event fields."""
     def _ReplaceEpisodeWithEvent(key, value):
       if RenameEventMigrator._EVENT_TO_EPISODE.has_key(key):
         raise BadMessageException('Event fields should not appear in newer messages.')
       event = RenameEventMigrator._EPISODE_TO_EVENT.get(key, None)
       return (event, value) if event else None
 
-    message.Visit(_ReplaceEpisodeWithEvent)
+    return _ReplaceEpisodeWithEvent
+
+  def MigrateForward(self, client, message, callback):
+    """Visit all fields in the message and replace event fields with episode fields."""
+    message.Visit(self.ForwardVisitor())
+    callback()
+
+  def MigrateBackward(self, client, message, callback):
+    """Visit all fields in the message and replace episode fields with event fields."""
+    message.Visit(self.BackwardVisitor())
     callback()
 
 
@@ -1018,3 +1176,12 @@ message with a version that is less than this version, it will return an
 error. This version will be increased as we drop support for older message
 formats.
 """
+
+_migrations = counters.define_rate('viewfinder.message.migrations_per_min',
+                                   'Messages migrated to a different version per minute.', 60)
+_async_migrations = counters.define_rate('viewfinder.message.async_migrations_per_min',
+                                         'Message migration steps that completed asynchronously per minute.', 60)
+_avg_migrate_time = {version: counters.define_average('viewfinder.message.avg_migrate_time.v%d' % version,
+                                                      'Average seconds to migrate a message across version %d.' %
+                                                      version)
+                     for version in xrange(Message.ADD_HEADERS_VERSION, MAX_MESSAGE_VERSION + 1)}
@@ -78,8 +78,8 @@ import urllib2
 
 from Crypto.Protocol.KDF import PBKDF2
 from os.path import expanduser
-from tornado import ioloop, options
-from viewfinder.backend.base import base_options
+from tornado import gen, ioloop, options
+from viewfinder.backend.base import base_options, crypto_executor
 
 import secrets, util
 
@@ -301,6 +301,18 @@ def VerifyPassword(user, cleartext_pwd):
     raise OTPException("Entered username/password invalid")
 
 
+@gen.coroutine
+def VerifyPasswordAsync(user, cleartext_pwd):
+  """Like VerifyPassword, but hashes `cleartext_pwd` on the crypto
+  executor so that the IOLoop is not blocked.
+  """
+  expected = GetPassword(user)
+  hashed = yield crypto_executor.Run(_HashPassword, cleartext_pwd, expected['version'],
+                                     expected.get('salt'))
+  if hashed != expected['hashed']:
+    raise OTPException("Entered username/password invalid")
+
+
 def VerifyPasswordCLI(user):
   """Command-line interface to VerifyPassword, for testing purposes."""
   print "Please enter your password:"
@@ -92,3 +92,30 @@ class RateLimiter(object):
     """Returns whether or not we will need to backoff. This does not increment the backoff counter."""
     self._Recompute()
     return self.available < 0.0
+
+
+class TokenBucket(object):
+  """Token bucket holding at most "burst" tokens, which is refilled at "rate" tokens per second.
+  Unlike RateLimiter, tokens are reserved ahead of time: a caller that finds the bucket empty
+  takes its tokens anyway and is told how long to wait before using them. Many concurrent
+  callers are therefore spaced out at exactly "rate", rather than all backing off for the same
+  interval and retrying together. "clock" returns the current time, and can be replaced by tests.
+  """
+
+  def __init__(self, rate, burst=None, clock=time.time):
+    assert rate > 0, rate
+    self._rate = float(rate)
+    self._burst = float(burst) if burst is not None else max(1.0, self._rate)
+    self._clock = clock
+    self._tokens = self._burst
+    self._last_time = clock()
+
+  def Reserve(self, tokens=1.0):
+    """Takes "tokens" from the bucket. Returns the number of seconds that the caller must wait
+    before using them, which is 0 if they were available right away.
+    """
+    now = self._clock()
+    self._tokens = min(self._burst, self._tokens + self._rate * (now - self._last_time))
+    self._last_time = now
+    self._tokens -= tokens
+    return 0.0 if self._tokens >= 0.0 else -self._tokens / self._rate
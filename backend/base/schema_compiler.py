@@ -0,0 +1,271 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Compiles JSON schemas into specialized validation functions.
+
+validictory interprets a schema node by node on every call: for each field
+it copies the schema dict, fills in defaults, and dispatches on every schema
+keyword by name. Message validation then walks the message a second time to
+find (and reject or remove) fields not present in the schema. For large
+responses, such as query_episodes, this is a significant CPU cost.
+
+CompileSchema instead walks the schema once and builds a tree of closures
+that validate a message and handle its extra fields in a single pass. The
+compiled function accepts and rejects exactly the messages that validictory
+(with its default options) accepts and rejects, and handles extra fields
+exactly as Message._FindExtraFields does:
+
+  ALLOW_EXTRA_FIELDS: extra fields are ignored.
+  REJECT_EXTRA_FIELDS: extra fields are a validation error.
+  REMOVE_EXTRA_FIELDS: extra fields are deleted from the message.
+
+Only the schema keywords used by Viewfinder schemas are compiled. Schemas
+that use any other keyword that validictory understands are not supported, in
+which case CompileSchema returns None and callers fall back to validictory.
+
+Compiled functions are cached by schema object, so schemas must not be
+modified once they have been compiled.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import re
+import validictory
+
+from collections import Mapping
+from decimal import Decimal
+
+ALLOW_EXTRA_FIELDS = 'allow'
+REJECT_EXTRA_FIELDS = 'reject'
+REMOVE_EXTRA_FIELDS = 'remove'
+
+_COMPILED_KEYWORDS = frozenset(['additionalProperties', 'blank', 'dependencies', 'description', 'enum', 'items',
+                                'maxItems', 'maxLength', 'minItems', 'minLength', 'pattern', 'properties',
+                                'required', 'title', 'type', 'uniqueItems'])
+
+_TYPE_CHECKS = {'string': lambda value: isinstance(value, basestring),
+                'integer': lambda value: type(value) in (int, long),
+                'number': lambda value: type(value) in (int, long, float, Decimal),
+                'boolean': lambda value: type(value) is bool,
+                'object': lambda value: isinstance(value, Mapping),
+                'array': lambda value: isinstance(value, (list, tuple)),
+                'null': lambda value: value is None,
+                'any': lambda value: True}
+
+# Maps (id(schema), extra_fields) => (schema, compiled function or None). The schema is kept
+# in the value so that its id cannot be reused while the entry exists.
+_compiled_cache = {}
+
+
+class SchemaValidationError(ValueError):
+  """Raised by a compiled schema function if the message is not valid."""
+  pass
+
+
+class _UnsupportedSchema(Exception):
+  """Raised during compilation if a schema uses a keyword that is not compiled."""
+  pass
+
+
+def CompileSchema(schema, extra_fields=ALLOW_EXTRA_FIELDS):
+  """Returns a function which validates a message against "schema", handling extra fields
+  according to "extra_fields". The function raises SchemaValidationError if the message is
+  invalid. Returns None if the schema uses features that are not supported by the compiler.
+  """
+  key = (id(schema), extra_fields)
+  entry = _compiled_cache.get(key)
+  if entry is None:
+    try:
+      validate = _CompileNode(schema, extra_fields, 'message')
+    except _UnsupportedSchema:
+      validate = None
+    entry = (schema, validate)
+    _compiled_cache[key] = entry
+  return entry[1]
+
+
+def _Error(message, *args):
+  raise SchemaValidationError(message % args)
+
+
+def _CompileNode(schema, extra_fields, name):
+  """Compiles "schema" into a function which validates a single value that is present in
+  its parent. Required fields and dependencies are checked by the parent object's function.
+  """
+  if not isinstance(schema, dict):
+    raise _UnsupportedSchema()
+  for keyword in schema:
+    if keyword not in _COMPILED_KEYWORDS and hasattr(validictory.SchemaValidator, 'validate_' + keyword):
+      raise _UnsupportedSchema()
+    if keyword in ('optional', 'requires'):
+      raise _UnsupportedSchema()
+
+  schema_type = schema.get('type')
+  checks = []
+
+  # type
+  if schema_type is not None:
+    if isinstance(schema_type, basestring):
+      type_check = _TYPE_CHECKS.get(schema_type)
+      if type_check is None:
+        raise _UnsupportedSchema()
+    elif isinstance(schema_type, (list, tuple)) and all(t in _TYPE_CHECKS for t in schema_type):
+      type_checks = [_TYPE_CHECKS[t] for t in schema_type]
+      type_check = lambda value: any(check(value) for check in type_checks)
+    else:
+      raise _UnsupportedSchema()
+
+    def _CheckType(value):
+      if not type_check(value):
+        _Error('Value %r for field \'%s\' is not of type %s', value, name, schema_type)
+    checks.append(_CheckType)
+
+  # blank (validictory does not allow blank strings by default)
+  if not schema.get('blank', False):
+    def _CheckBlank(value):
+      if isinstance(value, basestring) and not value:
+        _Error('Value %r for field \'%s\' cannot be blank', value, name)
+    checks.append(_CheckBlank)
+
+  # enum
+  if 'enum' in schema:
+    options = schema['enum']
+
+    def _CheckEnum(value):
+      if value is not None and value not in options:
+        _Error('Value %r for field \'%s\' is not in the enumeration: %r', value, name, options)
+    checks.append(_CheckEnum)
+
+  # minLength, maxLength, minItems, maxItems
+  for keyword, compare in (('minLength', lambda n, limit: n < limit), ('minItems', lambda n, limit: n < limit),
+                           ('maxLength', lambda n, limit: n > limit), ('maxItems', lambda n, limit: n > limit)):
+    if keyword in schema:
+      def _CheckLength(value, keyword=keyword, compare=compare, limit=schema[keyword]):
+        if isinstance(value, (basestring, list, tuple)) and compare(len(value), limit):
+          _Error('Length of value %r for field \'%s\' violates %s %d', value, name, keyword, limit)
+      checks.append(_CheckLength)
+
+  # pattern
+  if 'pattern' in schema:
+    pattern = schema['pattern']
+
+    def _CheckPattern(value):
+      if isinstance(value, basestring) and not re.match(pattern, value):
+        _Error('Value %r for field \'%s\' does not match regular expression \'%s\'', value, name, pattern)
+    checks.append(_CheckPattern)
+
+  # uniqueItems
+  if schema.get('uniqueItems', False) is not False:
+    def _CheckUnique(value):
+      if not isinstance(value, (list, tuple)):
+        return
+      hashables = set()
+      unhashables = []
+      for item in value:
+        if isinstance(item, (list, dict)):
+          if item in unhashables:
+            _Error('Value %r for field \'%s\' is not unique', item, name)
+          unhashables.append(item)
+        else:
+          if item in hashables:
+            _Error('Value %r for field \'%s\' is not unique', item, name)
+          hashables.add(item)
+    checks.append(_CheckUnique)
+
+  # Message._FindExtraFields only recurses through nodes whose type is exactly 'object' or 'array'.
+  child_extra_fields = extra_fields if schema_type in ('object', 'array') else ALLOW_EXTRA_FIELDS
+
+  # properties, additionalProperties
+  if 'properties' in schema or 'additionalProperties' in schema:
+    checks.append(_CompileProperties(schema, extra_fields, child_extra_fields, name))
+
+  # items
+  if 'items' in schema:
+    if not isinstance(schema['items'], dict):
+      raise _UnsupportedSchema()
+    validate_item = _CompileNode(schema['items'], child_extra_fields, name + '[]')
+
+    def _CheckItems(value):
+      if isinstance(value, (list, tuple)):
+        for item in value:
+          validate_item(item)
+    checks.append(_CheckItems)
+
+  if len(checks) == 1:
+    return checks[0]
+
+  def _Validate(value):
+    for check in checks:
+      check(value)
+  return _Validate
+
+
+def _CompileProperties(schema, extra_fields, child_extra_fields, name):
+  """Compiles the "properties" and "additionalProperties" keywords of an object schema, along
+  with the handling of extra fields.
+  """
+  properties = schema.get('properties', {})
+  if not isinstance(properties, dict):
+    raise _UnsupportedSchema()
+
+  compiled_properties = []
+  for prop_name, prop_schema in properties.iteritems():
+    if prop_schema is None:
+      continue
+    if not isinstance(prop_schema, dict):
+      raise _UnsupportedSchema()
+    prop_extra_fields = child_extra_fields if prop_schema.get('type') in ('object', 'array') else ALLOW_EXTRA_FIELDS
+    dependencies = prop_schema.get('dependencies')
+    if isinstance(dependencies, basestring):
+      dependencies = [dependencies]
+    elif dependencies is not None and not isinstance(dependencies, (list, tuple, dict)):
+      raise _UnsupportedSchema()
+    compiled_properties.append((prop_name,
+                                _CompileNode(prop_schema, prop_extra_fields, prop_name),
+                                prop_schema.get('required', True),
+                                dependencies))
+
+  # Extra fields are handled only at nodes of type 'object' that list their properties.
+  handle_extra = 'properties' in schema and schema.get('type') == 'object' and extra_fields != ALLOW_EXTRA_FIELDS
+
+  additional = schema.get('additionalProperties')
+  if additional is True or 'additionalProperties' not in schema:
+    validate_additional = None
+  elif additional is False:
+    def validate_additional(value):
+      _Error('additional properties not defined by \'properties\' are not allowed in field \'%s\'', name)
+  elif isinstance(additional, dict):
+    validate_additional = _CompileNode(additional, ALLOW_EXTRA_FIELDS, name)
+  else:
+    raise _UnsupportedSchema()
+
+  def _CheckProperties(value):
+    if not isinstance(value, dict):
+      return
+
+    for prop_name, validate, required, dependencies in compiled_properties:
+      if prop_name in value:
+        prop_value = value[prop_name]
+        validate(prop_value)
+        if dependencies is not None and prop_value is not None:
+          if isinstance(dependencies, dict):
+            for k, v in dependencies.iteritems():
+              if k in value and v not in value:
+                _Error('Field \'%s\' is required by field \'%s\'', v, k)
+          else:
+            for dependency in dependencies:
+              if dependency not in value:
+                _Error('Field \'%s\' is required by field \'%s\'', dependency, prop_name)
+      elif required:
+        _Error('Required field \'%s\' is missing', prop_name)
+
+    if validate_additional is not None or handle_extra:
+      for k in value.keys():
+        if k not in properties:
+          if validate_additional is not None:
+            validate_additional(value[k])
+          if handle_extra:
+            if extra_fields == REJECT_EXTRA_FIELDS:
+              _Error('Message contains field "%s", which is not present in the schema.', k)
+            del value[k]
+
+  return _CheckProperties
@@ -0,0 +1,70 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests for CryptoExecutor.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import threading
+import time
+
+from tornado import gen
+from viewfinder.backend.base import crypto_executor
+from viewfinder.backend.base.testing import BaseTestCase
+
+
+class CryptoExecutorTestCase(BaseTestCase):
+  def setUp(self):
+    super(CryptoExecutorTestCase, self).setUp()
+    self._executor = crypto_executor.CryptoExecutor(max_workers=2)
+    crypto_executor.CryptoExecutor.SetInstance(self._executor)
+
+  def tearDown(self):
+    crypto_executor.CryptoExecutor.SetInstance(None)
+    self._executor.Shutdown()
+    super(CryptoExecutorTestCase, self).tearDown()
+
+  def testRun(self):
+    """Work runs on a worker thread, and its result is delivered on the IOLoop."""
+    main_thread = threading.current_thread()
+
+    @gen.coroutine
+    def _Test():
+      thread = yield crypto_executor.Run(threading.current_thread)
+      self.assertNotEqual(thread, main_thread)
+      results = yield [crypto_executor.Run(pow, 2, i) for i in xrange(10)]
+      self.assertEqual(results, [2 ** i for i in xrange(10)])
+      self.assertEqual(crypto_executor._queue_depth.get_total(), 0)
+
+    self.io_loop.run_sync(_Test)
+
+  def testException(self):
+    """Exceptions raised by the work are re-raised when the future is yielded."""
+    @gen.coroutine
+    def _Test():
+      try:
+        yield crypto_executor.Run(int, 'not an int')
+      except ValueError:
+        raise gen.Return(True)
+
+    self.assertTrue(self.io_loop.run_sync(_Test))
+
+  def testIOLoopNotBlocked(self):
+    """The IOLoop keeps running callbacks while work is in progress."""
+    ticks = []
+    event = threading.Event()
+
+    def _Tick():
+      ticks.append(time.time())
+      if len(ticks) < 5:
+        self.io_loop.add_callback(_Tick)
+      else:
+        event.set()
+
+    @gen.coroutine
+    def _Test():
+      self.io_loop.add_callback(_Tick)
+      yield crypto_executor.Run(event.wait, 5)
+
+    self.io_loop.run_sync(_Test)
+    self.assertEqual(len(ticks), 5)
@@ -8,7 +8,8 @@ __author__ = 'andy@emailscrubbed.com (Andy Kimball)'
 from copy import deepcopy
 from tornado.ioloop import IOLoop
 from viewfinder.backend.base import testing
-from viewfinder.backend.base.message import Message, MessageMigrator, BadMessageException, REQUIRED_MIGRATORS
+from viewfinder.backend.base.message import Message, MessageMigrator, MigrationPlan, BadMessageException
+from viewfinder.backend.base.message import REQUIRED_MIGRATORS, RENAME_EVENT
 
 class RenameTestMigrator(MessageMigrator):
   """Rename a field in the message."""
@@ -28,6 +29,18 @@ class RenameTestMigrator(MessageMigrator):
     IOLoop.current().add_callback(callback)
 
 
+class RenameSubScalarMigrator(MessageMigrator):
+  """Rename a field wherever it occurs in the message, using a visitor."""
+  def __init__(self):
+    MessageMigrator.__init__(self, Message.TEST_VERSION)
+
+  def ForwardVisitor(self):
+    return lambda key, value: ('renamed-sub-scalar', value) if key == 'sub-scalar' else None
+
+  def BackwardVisitor(self):
+    return lambda key, value: ('sub-scalar', value) if key == 'renamed-sub-scalar' else None
+
+
 class MessageTestCase(testing.BaseTestCase):
   SCHEMA_NO_VERSION = {
     'description': 'test schema',
@@ -238,6 +251,37 @@ class MessageTestCase(testing.BaseTestCase):
                                 migrate_version=Message.INITIAL_VERSION,
                                 migrators=[RenameTestMigrator()])
 
+  def testMigrationPlan(self):
+    """Test that visitor migrators are fused and that synchronous migrators complete without
+    returning to the IOLoop.
+    """
+    migrators = sorted(REQUIRED_MIGRATORS + [RenameSubScalarMigrator(), RENAME_EVENT])
+    plan = MigrationPlan.Get(migrators, Message.INITIAL_VERSION, Message.RENAME_EVENT_VERSION)
+    self.assertIs(plan, MigrationPlan.Get(migrators, Message.INITIAL_VERSION, Message.RENAME_EVENT_VERSION))
+    self.assertEqual([step.versions for step in plan.steps],
+                     [[Message.ADD_HEADERS_VERSION], [Message.TEST_VERSION, Message.RENAME_EVENT_VERSION]])
+
+    plan = MigrationPlan.Get(migrators, Message.RENAME_EVENT_VERSION, Message.ADD_HEADERS_VERSION)
+    self.assertEqual([step.versions for step in plan.steps], [[Message.RENAME_EVENT_VERSION, Message.TEST_VERSION]])
+
+    message_dict = deepcopy(MessageTestCase.MSG_NO_VERSION)
+    message_dict['sub-dict']['event_id'] = 'e1'
+    message = Message(message_dict)
+    results = []
+    message.Migrate(None, Message.RENAME_EVENT_VERSION, results.append, migrators)
+    self.assertEqual(results, [message])
+    self.assertEqual(message.dict['headers'], {'version': Message.RENAME_EVENT_VERSION})
+    self.assertEqual(message.dict['sub-dict']['renamed-sub-scalar'],
+                     MessageTestCase.MSG_NO_VERSION['sub-dict']['sub-scalar'])
+    self.assertEqual(message.dict['sub-dict']['episode_id'], 'e1')
+
+    results = []
+    message.Migrate(None, Message.INITIAL_VERSION, results.append, migrators)
+    self.assertEqual(results, [message])
+    self.assertEqual(message.version, Message.INITIAL_VERSION)
+    del message_dict['sub-dict']['event_id']
+    self.assertEqual(message.dict, MessageTestCase.MSG_NO_VERSION)
+
   def _TestMessage(self, message_dict, original_version=None, default_version=Message.INITIAL_VERSION,
                    min_supported_version=Message.INITIAL_VERSION, max_supported_version=Message.MAX_VERSION,
                    schema=None, allow_extra_fields=False, sanitize=False, migrate_version=None, migrators=None):
@@ -0,0 +1,196 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests that compiled schemas behave exactly like validictory and Message._FindExtraFields.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import random
+import unittest
+import validictory
+
+from copy import deepcopy
+from viewfinder.backend.base import schema_compiler
+from viewfinder.backend.base.message import Message, BadMessageException
+
+
+class SchemaFuzzer(object):
+  """Generates random messages that are mostly, but not always, valid according to a schema,
+  and checks that the compiled schema agrees with validictory on each one.
+  """
+  _STRINGS = ['', 'a', 'abc', u'\xe9t\xe9', 'x' * 300]
+  _SCALARS = [None, True, False, 0, 1, -5, 2 ** 40, 1.5, 'a', '', [], {}]
+
+  def __init__(self, seed=0, error_rate=0.05):
+    self._rand = random.Random(seed)
+    self._error_rate = error_rate
+
+  def CheckSchema(self, test_case, schema, num_messages=100):
+    """Generates "num_messages" messages for "schema" and checks each with CheckMessage."""
+    for _ in xrange(num_messages):
+      self.CheckMessage(test_case, schema, self.Generate(schema))
+
+  def CheckMessage(self, test_case, schema, message_dict):
+    """Checks that the compiled schema accepts "message_dict" if and only if validictory does, in
+    all three extra fields modes, and that it removes the same extra fields.
+    """
+    for extra_fields in (schema_compiler.ALLOW_EXTRA_FIELDS,
+                         schema_compiler.REJECT_EXTRA_FIELDS,
+                         schema_compiler.REMOVE_EXTRA_FIELDS):
+      validate = schema_compiler.CompileSchema(schema, extra_fields)
+      test_case.assertIsNotNone(validate)
+
+      expected = deepcopy(message_dict)
+      try:
+        validictory.validate(expected, schema)
+        if extra_fields != schema_compiler.ALLOW_EXTRA_FIELDS:
+          object.__new__(Message)._FindExtraFields(expected, schema,
+                                                   extra_fields == schema_compiler.REJECT_EXTRA_FIELDS)
+        expected_valid = True
+      except (ValueError, BadMessageException):
+        expected_valid = False
+
+      actual = deepcopy(message_dict)
+      try:
+        validate(actual)
+        actual_valid = True
+      except schema_compiler.SchemaValidationError:
+        actual_valid = False
+
+      test_case.assertEqual(expected_valid, actual_valid,
+                            'validictory %s %r in mode %s' %
+                            ('accepted' if expected_valid else 'rejected', message_dict, extra_fields))
+      if expected_valid:
+        test_case.assertEqual(expected, actual)
+
+  def Generate(self, schema):
+    """Returns a random value for "schema"."""
+    if self._Chance():
+      return self._rand.choice(SchemaFuzzer._SCALARS)
+
+    if 'enum' in schema and not self._Chance():
+      return self._rand.choice(schema['enum'])
+
+    schema_type = schema.get('type', 'any')
+    if isinstance(schema_type, list):
+      schema_type = self._rand.choice(schema_type)
+
+    if schema_type == 'object':
+      value = {}
+      for name, prop_schema in schema.get('properties', {}).iteritems():
+        required = prop_schema.get('required', True)
+        if (required and not self._Chance()) or (not required and self._rand.random() < 0.5):
+          value[name] = self.Generate(prop_schema)
+      if self._Chance():
+        value['extra'] = self._rand.choice(SchemaFuzzer._SCALARS)
+      return value
+    elif schema_type == 'array':
+      items = [self.Generate(schema.get('items', {})) for _ in xrange(self._rand.randint(0, 3))]
+      if items and self._Chance():
+        items.append(deepcopy(items[0]))
+      return items
+    elif schema_type == 'string':
+      return self._rand.choice(SchemaFuzzer._STRINGS[1:] if not self._Chance() else SchemaFuzzer._STRINGS)
+    elif schema_type == 'integer':
+      return self._rand.choice([0, 1, 12345, 2 ** 40])
+    elif schema_type == 'number':
+      return self._rand.choice([0, 1.5, -3, 2 ** 40])
+    elif schema_type == 'boolean':
+      return self._rand.choice([True, False])
+    elif schema_type == 'null':
+      return None
+    return self._rand.choice(SchemaFuzzer._SCALARS)
+
+  def _Chance(self):
+    return self._rand.random() < self._error_rate
+
+
+class SchemaCompilerTestCase(unittest.TestCase):
+  SCHEMA = {
+    'description': 'test schema',
+    'type': 'object',
+    'properties': {
+      'headers': {
+        'type': 'object',
+        'properties': {
+          'version': {'type': 'integer'},
+          'synchronous': {'type': 'boolean', 'required': False},
+          },
+        },
+      'scalar': {'type': 'string', 'blank': True},
+      'choice': {'type': 'string', 'enum': ['a', 'abc'], 'required': False},
+      'nullable': {'type': ['string', 'null'], 'required': False},
+      'limited': {'type': 'string', 'maxLength': 3, 'required': False},
+      'dependent': {'type': 'number', 'required': False, 'dependencies': 'scalar'},
+      'attrs': {'type': 'object', 'required': False, 'properties': {}, 'additionalProperties': {}},
+      'list': {
+        'type': 'array',
+        'uniqueItems': True,
+        'maxItems': 3,
+        'items': {'type': 'any'},
+        },
+      'sub-dict': {
+        'description': 'nested dictionary',
+        'required': False,
+        'type': 'object',
+        'properties': {
+          'none': {'type': 'null'},
+          'sub-list': {
+            'type': 'array',
+            'items': {
+              'description': 'dictionary in list',
+              'type': 'object',
+              'properties': {
+                'value': {'type': 'number'},
+                },
+              },
+            },
+          'untyped': {
+            'required': False,
+            'type': ['object', 'null'],
+            'properties': {'value': {'type': 'integer'}},
+            },
+          },
+        },
+      },
+    }
+
+  def testParity(self):
+    """Compare compiled schema with validictory on random messages."""
+    SchemaFuzzer(seed=1).CheckSchema(self, SchemaCompilerTestCase.SCHEMA, num_messages=2000)
+
+  def testRemoveExtraFields(self):
+    """Extra fields are removed only where Message._FindExtraFields would remove them."""
+    message_dict = {'headers': {'version': 1, 'extra': 1},
+                    'scalar': '',
+                    'list': [],
+                    'extra': 1,
+                    'sub-dict': {'none': None,
+                                 'sub-list': [{'value': 1, 'extra': 1}],
+                                 'untyped': {'value': 1, 'extra': 1}}}
+    validate = schema_compiler.CompileSchema(SchemaCompilerTestCase.SCHEMA, schema_compiler.REMOVE_EXTRA_FIELDS)
+    validate(message_dict)
+    self.assertEqual(message_dict, {'headers': {'version': 1},
+                                    'scalar': '',
+                                    'list': [],
+                                    'sub-dict': {'none': None,
+                                                 'sub-list': [{'value': 1}],
+                                                 'untyped': {'value': 1, 'extra': 1}}})
+
+  def testRejectExtraFields(self):
+    """Extra fields are an error in reject mode."""
+    message = Message({'headers': {'version': 1}, 'scalar': 'a', 'list': [], 'extra': 1})
+    self.assertRaises(BadMessageException, message.Validate, SchemaCompilerTestCase.SCHEMA, False)
+    message.Validate(SchemaCompilerTestCase.SCHEMA, True)
+    message.ValidateAndSanitize(SchemaCompilerTestCase.SCHEMA)
+    self.assertNotIn('extra', message.dict)
+
+  def testUnsupported(self):
+    """Schemas with keywords that are not compiled fall back to validictory."""
+    schema = {'type': 'object', 'properties': {'value': {'type': 'integer', 'minimum': 1}}}
+    self.assertIsNone(schema_compiler.CompileSchema(schema))
+    Message({'value': 1}).Validate(schema)
+    self.assertRaises(BadMessageException, Message({'value': 0}).Validate, schema)
+    message = Message({'value': 1, 'extra': 1})
+    message.ValidateAndSanitize(schema)
+    self.assertEqual(message.dict, {'value': 1})
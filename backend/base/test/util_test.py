@@ -13,6 +13,7 @@ import time
 import unittest
 from datetime import date, timedelta
 from functools import partial
+from tornado import gen
 
 from viewfinder.backend.base import util, testing
 
@@ -366,6 +367,36 @@ class NestedBarrierTestCase(testing.BaseTestCase):
     self.assertTrue(level1_reached[0])
 
 
+class RunConcurrentlyTestCase(testing.BaseTestCase):
+  def testRunConcurrently(self):
+    """Test that results are ordered and that no more than "concurrency" calls are outstanding."""
+    outstanding = [0, 0]
+
+    @gen.coroutine
+    def _Double(value):
+      outstanding[0] += 1
+      outstanding[1] = max(outstanding[0], outstanding[1])
+      yield util.GenSleep(0.001 * (value % 3))
+      outstanding[0] -= 1
+      raise gen.Return(value * 2)
+
+    results = self._RunAsync(util.RunConcurrently, _Double, range(20), 4)
+    self.assertEqual(results, [value * 2 for value in range(20)])
+    self.assertEqual(outstanding, [0, 4])
+
+    self.assertEqual(self._RunAsync(util.RunConcurrently, _Double, [], 4), [])
+
+  def testException(self):
+    """Test that an exception raised by a call is raised to the caller."""
+    @gen.coroutine
+    def _Fail(value):
+      if value == 3:
+        raise ValueError('bad value')
+      raise gen.Return(value)
+
+    self.assertRaises(ValueError, self._RunAsync, util.RunConcurrently, _Fail, range(5), 2)
+
+
 class ParseHostPortTestCase(unittest.TestCase):
   def setUp(self):
     pass
@@ -457,6 +457,25 @@ class GenConstant(gen.YieldPoint):
     return self._constant
 
 
+@gen.coroutine
+def RunConcurrently(func, items, concurrency):
+  """Invokes "func" on each of "items", with at most "concurrency" invocations outstanding at
+  once. "func" must return something that can be yielded by a coroutine. A new invocation is
+  started as soon as any outstanding one completes. Returns the list of results, in the same
+  order as "items".
+  """
+  results = [None] * len(items)
+  remaining = iter(enumerate(items))
+
+  @gen.coroutine
+  def _Worker():
+    for index, item in remaining:
+      results[index] = yield func(item)
+
+  yield [_Worker() for _ in xrange(min(max(concurrency, 1), len(items)))]
+  raise gen.Return(results)
+
+
 def GenSleep(seconds):
   """Wait for a period of time without blocking. Used with the tornado.gen infrastructure."""
   io_loop = ioloop.IOLoop.current()
@@ -17,14 +17,24 @@ with the type of aggregation and metric stored:
   - shared by: 'sb' sum of all photos in shared viewpoints and episodes owned by this user
   - visible to: 'vt' sum of all photos in shared viewpoint (includes 'sb'). to get the
     real count of photos shared with this user but not shared by him, compute 'vt - sb:'
+
+The per-viewpoint visible-to entry and the per-user entries are updated by every operation that
+shares into a viewpoint, so concurrent operations contend for them: each update is a query followed
+by an update conditional on 'op_ids', which is retried from scratch on conflict. If --accounting_shards
+is set, updates to these entries are instead spread over that many shard rows, with sort keys
+'<sort_key>#<n>'. Each operation always updates the shard chosen by the hash of its operation id, so
+the shard's 'op_ids' still detects replays of the operation. Readers sum the entry row and its shard
+rows. Shard rows are periodically folded back into the entry row by CompactShards (see dbchk).
 """
 
 __author__ = 'marc@emailscrubbed.com (Marc Berhault)'
 
+import zlib
+
 from functools import partial
-from tornado import gen
-from viewfinder.backend.base import util
-from viewfinder.backend.db import vf_schema
+from tornado import gen, options
+from viewfinder.backend.base import counters, util
+from viewfinder.backend.db import db_client, vf_schema
 from viewfinder.backend.db.base import DBObject
 from viewfinder.backend.db.db_client import DBKey
 from viewfinder.backend.db.operation import Operation
@@ -32,6 +42,15 @@ from viewfinder.backend.db.photo import Photo
 from viewfinder.backend.db.user import User
 from viewfinder.backend.db.range_base import DBRangeObject
 
+options.define('accounting_shards', default=0,
+               help='number of shard rows over which updates to contended accounting entries are spread; 0 '
+                    'disables sharding. Operations in progress when this is changed may be applied twice')
+
+_apply_conflicts = counters.define_rate('viewfinder.accounting.apply_conflicts_per_min',
+                                        'Accounting updates retried because the entry was modified concurrently.', 60)
+_compactions = counters.define_rate('viewfinder.accounting.compactions_per_min',
+                                    'Accounting shard rows folded into their entry per minute.', 60)
+
 
 @DBObject.map_table_attributes
 class Accounting(DBRangeObject):
@@ -42,6 +61,13 @@ class Accounting(DBRangeObject):
   # Maximum op ids to keep.
   _MAX_APPLIED_OP_IDS = 10
 
+  # Maximum number of shards per entry. Compaction records for every shard of an entry must fit
+  # within the _MAX_APPLIED_OP_IDS op ids kept in the entry row.
+  _MAX_SHARDS = 8
+
+  # Separates the sort key of an entry from the index of one of its shards.
+  _SHARD_SEPARATOR = '#'
+
   # Types of accounting: each type has its own prefix used to build hash keys.
   VIEWPOINT_SIZE = 'vs'
   USER_SIZE = 'us'
@@ -51,6 +77,13 @@ class Accounting(DBRangeObject):
   SHARED_BY = 'sb'
   VISIBLE_TO = 'vt'
 
+  # (hash key prefix, sort key) of entries that are updated by many concurrent operations, and so
+  # are sharded if --accounting_shards is set.
+  _SHARDED_ENTRIES = frozenset([(VIEWPOINT_SIZE, VISIBLE_TO),
+                                (USER_SIZE, OWNED_BY),
+                                (USER_SIZE, SHARED_BY),
+                                (USER_SIZE, VISIBLE_TO)])
+
   _table = DBObject._schema.GetTable(vf_schema.ACCOUNTING)
 
   def __init__(self, hash_key=None, sort_key=None):
@@ -172,6 +205,63 @@ class Accounting(DBRangeObject):
     self.op_ids = ','.join(ids[-self._MAX_APPLIED_OP_IDS:])
     return False
 
+  def FindCompaction(self, compaction_id):
+    """Returns an accounting object with the stats recorded in 'op_ids' when the shard compaction
+    identified by 'compaction_id' was applied to this entry, or None if it has not been applied.
+    """
+    prefix = compaction_id + '='
+    for op_id in (self.op_ids.split(',') if self.op_ids is not None else []):
+      if op_id.startswith(prefix):
+        moved = Accounting()
+        moved.num_photos, moved.tn_size, moved.med_size, moved.full_size, moved.orig_size = \
+            [int(value) for value in op_id[len(prefix):].split('/')]
+        return moved
+    return None
+
+  @classmethod
+  def SplitSortKey(cls, sort_key):
+    """Returns a tuple of (entry sort key, shard index) for the sort key of an accounting row. The
+    shard index is None if the row is the entry row itself.
+    """
+    entry_key, separator, index = sort_key.partition(Accounting._SHARD_SEPARATOR)
+    return (entry_key, int(index)) if separator else (sort_key, None)
+
+  @classmethod
+  def GetEntryRange(cls, sort_key):
+    """Returns a range operator that selects the entry with 'sort_key' and all of its shards."""
+    return db_client.RangeOperator([sort_key, sort_key + Accounting._SHARD_SEPARATOR + '~'], 'BETWEEN')
+
+  @classmethod
+  def SumShards(cls, accountings):
+    """Folds the shard rows in 'accountings' into the entries they belong to. Returns a list with
+    one accounting object per entry, in order of first appearance, whose stats are the sum of the
+    entry row and its shard rows, and whose op_ids are those of the entry row. Stats that a
+    compaction has added to the entry row but not yet subtracted from the shard are counted once.
+    """
+    if not any(Accounting._SHARD_SEPARATOR in act.sort_key for act in accountings):
+      return list(accountings)
+
+    entries = []
+    entry_dict = {}
+    shards = []
+    for act in accountings:
+      entry_key, index = Accounting.SplitSortKey(act.sort_key)
+      entry = entry_dict.get((act.hash_key, entry_key))
+      if entry is None:
+        entry = entry_dict[(act.hash_key, entry_key)] = Accounting(act.hash_key, entry_key)
+        entries.append(entry)
+      entry.IncrementStatsFrom(act)
+      if index is None:
+        entry.op_ids = act.op_ids
+      else:
+        shards.append((entry, index, act))
+
+    for entry, index, shard in shards:
+      moved = entry.FindCompaction(Accounting._GetCompactionId(index, shard.shard_gen))
+      if moved is not None:
+        entry.DecrementStatsFrom(moved)
+    return entries
+
   @classmethod
   def CreateUserOwnedBy(cls, user_id):
     """Create an accounting object (USER_SIZE:<user_id>, OWNED_BY)."""
@@ -217,13 +307,19 @@ class Accounting(DBRangeObject):
 
   @classmethod
   def QueryViewpointVisibleTo(cls, client, viewpoint_id, callback, must_exist=True):
-    """Query for an accounting object (VIEWPOINT_SIZE:<vp_id>, VISIBLE_TO)."""
-    Accounting.Query(client,
-                     Accounting.VIEWPOINT_SIZE + ':' + viewpoint_id,
-                     Accounting.VISIBLE_TO,
-                     None,
-                     callback,
-                     must_exist=must_exist)
+    """Query for an accounting object (VIEWPOINT_SIZE:<vp_id>, VISIBLE_TO), summed over its shards."""
+    hash_key = Accounting.VIEWPOINT_SIZE + ':' + viewpoint_id
+
+    def _OnQuery(accountings):
+      if accountings:
+        callback(Accounting.SumShards(accountings)[0])
+      elif must_exist:
+        # Raises the same error as a query for the missing entry.
+        Accounting.Query(client, hash_key, Accounting.VISIBLE_TO, None, callback)
+      else:
+        callback(None)
+
+    Accounting.RangeQuery(client, hash_key, Accounting.GetEntryRange(Accounting.VISIBLE_TO), None, None, _OnQuery)
 
   @classmethod
   @gen.coroutine
@@ -232,21 +328,31 @@ class Accounting(DBRangeObject):
     entries, any of which may be None (eg: if data was not properly populated).
     """
     user_hash = '%s:%d' % (Accounting.USER_SIZE, user_id)
-    result = yield [gen.Task(Accounting.Query, client, user_hash, Accounting.OWNED_BY, None, must_exist=False),
-                    gen.Task(Accounting.Query, client, user_hash, Accounting.SHARED_BY, None, must_exist=False),
-                    gen.Task(Accounting.Query, client, user_hash, Accounting.VISIBLE_TO, None, must_exist=False)]
-    raise gen.Return(result)
+    accountings = yield gen.Task(Accounting.RangeQuery, client, user_hash, None, None, None)
+    entry_dict = dict((act.sort_key, act) for act in Accounting.SumShards(accountings))
+    raise gen.Return([entry_dict.get(Accounting.OWNED_BY),
+                      entry_dict.get(Accounting.SHARED_BY),
+                      entry_dict.get(Accounting.VISIBLE_TO)])
 
   @classmethod
   def ApplyAccounting(cls, client, accounting, callback):
     """Apply an accounting object. This involves a query to fetch stats and applied op ids,
-    check that this operation has not been applied, increment of values and Update.
+    check that this operation has not been applied, increment of values and Update. Updates
+    to sharded entries are applied to the shard chosen by the operation id instead.
     """
     op_id = Operation.GetCurrent().operation_id
     assert op_id is not None, 'accounting update outside an operation'
 
+    num_shards = Accounting._GetNumShards(accounting.hash_key, accounting.sort_key)
+    if num_shards > 0:
+      index = (zlib.crc32(op_id) & 0xffffffff) % num_shards
+      shard = Accounting(accounting.hash_key, Accounting._GetShardSortKey(accounting.sort_key, index))
+      shard.CopyStatsFrom(accounting)
+      accounting = shard
+
     def _OnException(accounting, type, value, traceback):
       # Entry was modified between Query and Update. Rerun the entire method.
+      _apply_conflicts.increment()
       Accounting.ApplyAccounting(client, accounting, callback)
 
     def _OnQueryAccounting(entry):
@@ -277,6 +383,117 @@ class Accounting(DBRangeObject):
 
     Accounting.Query(client, accounting.hash_key, accounting.sort_key, None, _OnQueryAccounting, must_exist=False)
 
+  @classmethod
+  @gen.coroutine
+  def CompactShards(cls, client, hash_key, sort_key):
+    """Folds the stats of each shard row of the (hash_key, sort_key) entry into the entry row,
+    leaving the shard rows zeroed. The sum of the entry and its shards is unchanged, so this can
+    run at any time, concurrently with operations that update the entry. Returns the number of
+    shard rows that were compacted.
+    """
+    shards = yield gen.Task(Accounting.RangeQuery,
+                            client,
+                            hash_key,
+                            db_client.RangeOperator([sort_key + Accounting._SHARD_SEPARATOR,
+                                                     sort_key + Accounting._SHARD_SEPARATOR + '~'], 'BETWEEN'),
+                            None,
+                            None,
+                            consistent_read=True)
+    num_compacted = 0
+    for shard in shards:
+      compacted = yield Accounting._CompactShard(client, hash_key, sort_key, shard)
+      if compacted:
+        num_compacted += 1
+    raise gen.Return(num_compacted)
+
+  @classmethod
+  @gen.coroutine
+  def _CompactShard(cls, client, hash_key, sort_key, shard):
+    """Folds the stats of a single shard row into its entry row, in two steps:
+      1. The shard's stats are added to the entry, and recorded in the entry's op_ids under a
+         compaction id made from the shard index and the shard's generation.
+      2. The recorded stats are subtracted from the shard, and its generation is incremented.
+
+    Each step is a conditional update that is retried on conflict. Between the two steps, readers
+    use the record to avoid counting the moved stats twice (see SumShards). If compaction stops
+    between the two steps, the next compaction of the shard finds the record in the entry, so
+    skips step 1 and subtracts exactly the stats that were added. Returns true if the shard was
+    compacted.
+    """
+    _, index = Accounting.SplitSortKey(shard.sort_key)
+    compacted = False
+    while True:
+      generation = shard.shard_gen or 0
+      compaction_id = Accounting._GetCompactionId(index, generation)
+      entry = yield gen.Task(Accounting.Query, client, hash_key, sort_key, None, must_exist=False, consistent_read=True)
+      moved = entry.FindCompaction(compaction_id) if entry is not None else None
+
+      if moved is None:
+        if shard.IsZero():
+          raise gen.Return(compacted)
+
+        moved = Accounting()
+        moved.CopyStatsFrom(shard)
+        record = '%s=%d/%d/%d/%d/%d' % (compaction_id, moved.num_photos, moved.tn_size, moved.med_size,
+                                        moved.full_size, moved.orig_size)
+        try:
+          if entry is None:
+            entry = Accounting(hash_key, sort_key)
+            entry.CopyStatsFrom(moved)
+            entry.op_ids = record
+            yield gen.Task(entry.Update, client, replace=False)
+          else:
+            prev_op_ids = entry.op_ids
+            entry.IsOpDuplicate(record)
+            entry.IncrementStatsFrom(moved)
+            yield gen.Task(entry.Update, client, expected={'op_ids': prev_op_ids or False})
+        except Exception:
+          # Entry was modified concurrently; start over.
+          _apply_conflicts.increment()
+          continue
+
+      # Add the compaction id to the shard's op_ids so that any operation that queried the shard
+      # before this update fails its own conditional update and retries.
+      prev_op_ids = shard.op_ids
+      shard.IsOpDuplicate(compaction_id)
+      shard.DecrementStatsFrom(moved)
+      shard.shard_gen = generation + 1
+      try:
+        expected = {'op_ids': prev_op_ids or False, 'shard_gen': generation or False}
+        yield gen.Task(shard.Update, client, expected=expected)
+      except Exception:
+        # Shard was modified concurrently; re-query it and start over.
+        _apply_conflicts.increment()
+        shard = yield gen.Task(Accounting.Query, client, hash_key, shard.sort_key, None, consistent_read=True)
+        continue
+
+      # If this completed an earlier compaction, fold in anything added to the shard since.
+      _compactions.increment()
+      compacted = True
+
+  @classmethod
+  def _GetCompactionId(cls, index, generation):
+    """Returns the id under which compaction 'generation' of shard 'index' is recorded in the
+    op_ids of the entry row.
+    """
+    return 'c%d.%d' % (index, generation or 0)
+
+  @classmethod
+  def _GetNumShards(cls, hash_key, sort_key):
+    """Returns the number of shards over which updates to the entry are spread, or 0 if updates
+    are applied to the entry row.
+    """
+    if options.options.accounting_shards <= 0:
+      return 0
+    if (hash_key.split(':', 1)[0], sort_key) not in Accounting._SHARDED_ENTRIES:
+      return 0
+    return min(options.options.accounting_shards, Accounting._MAX_SHARDS)
+
+  @classmethod
+  def _GetShardSortKey(cls, sort_key, index):
+    """Returns the sort key of shard 'index' of the entry with 'sort_key'."""
+    return '%s%s%d' % (sort_key, Accounting._SHARD_SEPARATOR, index)
+
 
 class AccountingAccumulator(object):
   """Facilitates collection and application of accounting deltas.
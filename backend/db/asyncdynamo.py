@@ -21,7 +21,10 @@ Copyright (c) 2012 bit.ly. All rights reserved.
 import sys
 assert sys.version_info >= (2, 7), "run this with python2.7"
 
+import base64
 import functools
+import hashlib
+import hmac
 import json
 import logging
 import time
@@ -32,6 +35,7 @@ from boto.connection import AWSAuthConnection
 from boto.exception import DynamoDBResponseError
 from boto.provider import Provider
 from collections import deque
+from email.utils import formatdate
 from tornado import httpclient, ioloop
 from tornado.httpclient import HTTPRequest
 from viewfinder.backend.base.exceptions import DBProvisioningExceededError, DBLimitExceededError, DBConditionalCheckFailedError
@@ -39,6 +43,56 @@ from viewfinder.backend.base.exceptions import DBProvisioningExceededError, DBLi
 PENDING_SESSION_TOKEN_UPDATE = "this is not your session token"
 
 
+class RequestSigner(object):
+  """Signs DynamoDB requests with the same AWS3 signature as boto's
+  HmacAuthV3HTTPHandler, for one set of credentials. Everything in
+  the string to sign except the date, target and body depends only on
+  the credentials, so it is computed once, as are the keyed HMAC and
+  the authorization header prefix. The date header only changes once a
+  second, so it is formatted once a second.
+  """
+
+  def __init__(self, host, provider):
+    self.access_key = provider.access_key
+    self.secret_key = provider.secret_key
+    self.security_token = provider.security_token
+    self._hmac = hmac.new(self.secret_key, digestmod=hashlib.sha256)
+    self._prefix = 'POST\n/\n\nhost:%s\nx-amz-date:' % host
+    if self.security_token:
+      self._token_line = '\nx-amz-security-token:%s' % self.security_token
+      signed_headers = 'Host;X-Amz-Date;X-Amz-Security-Token;X-Amz-Target'
+    else:
+      self._token_line = ''
+      signed_headers = 'Host;X-Amz-Date;X-Amz-Target'
+    self._auth_prefix = 'AWS3 AWSAccessKeyId=%s,Algorithm=HmacSHA256,SignedHeaders=%s,Signature=' % \
+        (self.access_key, signed_headers)
+    self._date_secs = None
+    self._date = None
+
+  def matches(self, provider):
+    """Returns True if the signer was created for the provider's current credentials."""
+    return (provider.access_key == self.access_key and provider.secret_key == self.secret_key and
+            provider.security_token == self.security_token)
+
+  def add_auth(self, headers, body, now=None):
+    """Adds the date, session token and authorization headers to the
+    headers of a request, which must already include its X-Amz-Target.
+    """
+    now = int(now if now is not None else time.time())
+    if now != self._date_secs:
+      self._date = formatdate(now, usegmt=True)
+      self._date_secs = now
+
+    headers['X-Amz-Date'] = self._date
+    if self.security_token:
+      headers['X-Amz-Security-Token'] = self.security_token
+    string_to_sign = ''.join([self._prefix, self._date, self._token_line,
+                              '\nx-amz-target:', headers['X-Amz-Target'], '\n\n', body])
+    digest = self._hmac.copy()
+    digest.update(hashlib.sha256(string_to_sign).digest())
+    headers['X-Amzn-Authorization'] = self._auth_prefix + base64.b64encode(digest.digest())
+
+
 class AsyncDynamoDB(AWSAuthConnection):
   """The main class for asynchronous connections to DynamoDB.
 
@@ -46,6 +100,13 @@ class AsyncDynamoDB(AWSAuthConnection):
   than one is ok), parametrized with the user's access key and secret
   key. Make calls with make_request or the helper methods, and
   AsyncDynamoDB will maintain session tokens in the background.
+
+  Requests are sent through an HTTP client dedicated to DynamoDB,
+  which allows up to "max_clients" concurrent requests. With the curl
+  client that is configured in production, each of its handles keeps
+  its connection to DynamoDB alive between requests, so that requests
+  do not pay for a new TLS handshake, and do not wait behind (or crowd
+  out) the S3 and other requests made through the shared client.
   """
 
   DefaultHost = 'dynamodb.us-east-1.amazonaws.com'
@@ -74,7 +135,8 @@ class AsyncDynamoDB(AWSAuthConnection):
   def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
                is_secure=True, port=None, proxy=None, proxy_port=None,
                host=None, debug=0, session_token=None,
-               authenticate_requests=True, validate_cert=True, max_sts_attempts=3):
+               authenticate_requests=True, validate_cert=True, max_sts_attempts=3,
+               max_clients=None):
     if not host:
       host = self.DefaultHost
     self.validate_cert = validate_cert
@@ -88,6 +150,9 @@ class AsyncDynamoDB(AWSAuthConnection):
     self.sts = AsyncAwsSts(aws_access_key_id, aws_secret_access_key)
     assert (isinstance(max_sts_attempts, int) and max_sts_attempts >= 0)
     self.max_sts_attempts = max_sts_attempts
+    self.max_clients = max_clients
+    self._http_client = None
+    self._signer = None
 
   def _init_session_token_cb(self, error=None):
     if error:
@@ -152,18 +217,18 @@ class AsyncDynamoDB(AWSAuthConnection):
       if callable(callback):
         return callback()
 
-  def make_request(self, action, body='', callback=None, object_hook=None):
+  def make_request(self, action, body='', callback=None, object_hook=None, object_pairs_hook=None):
     """Make an asynchronous HTTP request to DynamoDB. Callback should
-    operate on the decoded json response (with object hook applied, of
-    course). It should also accept an error argument, which will be a
-    boto.exception.DynamoDBResponseError.
+    operate on the decoded json response (with object hook or object
+    pairs hook applied, of course). It should also accept an error
+    argument, which will be a boto.exception.DynamoDBResponseError.
 
     If there is not a valid session token, this method will ensure
     that a new one is fetched and cache the request when it is
     retrieved.
     """
-    this_request = functools.partial(self.make_request, action=action,
-                                     body=body, callback=callback, object_hook=object_hook)
+    this_request = functools.partial(self.make_request, action=action, body=body, callback=callback,
+                                     object_hook=object_hook, object_pairs_hook=object_pairs_hook)
     if self.authenticate_requests and self.provider.security_token in [None, PENDING_SESSION_TOKEN_UPDATE]:
       # we will not be able to complete this request because we do not have a valid session token.
       # queue it and try to get a new one. _update_session_token will ensure that only one request
@@ -181,21 +246,39 @@ class AsyncDynamoDB(AWSAuthConnection):
     headers = {'X-Amz-Target' : '%s_%s.%s' % (self.ServiceName, self.Version, action),
                'Content-Type' : 'application/x-amz-json-1.0',
                'Content-Length' : str(len(body))}
-    request = HTTPRequest('https://%s' % self.host,
+    if self.authenticate_requests:
+      self._get_signer().add_auth(headers, body) # add signature to headers of the request
+    request = HTTPRequest('%s://%s/' % (self.protocol, self.server_name()),
                           method='POST',
                           headers=headers,
                           body=body,
                           validate_cert=self.validate_cert)
-    request.path = '/' # Important! set the path variable for signing by boto. '/' is the path for all dynamodb requests
-    if self.authenticate_requests:
-      self._auth_handler.add_auth(request) # add signature to headers of the request
 
-    http_client = httpclient.AsyncHTTPClient()
-    http_client.fetch(request, functools.partial(
+    self._get_http_client().fetch(request, functools.partial(
       self._finish_make_request, callback=callback, orig_request=this_request,
-      token_used=self.provider.security_token, object_hook=object_hook))
+      token_used=self.provider.security_token, object_hook=object_hook, object_pairs_hook=object_pairs_hook))
 
-  def _finish_make_request(self, response, callback, orig_request, token_used, object_hook=None):
+  def _get_signer(self):
+    """Returns the request signer for the current credentials, which
+    change whenever a new session token is fetched.
+    """
+    if self._signer is None or not self._signer.matches(self.provider):
+      self._signer = RequestSigner(self.host, self.provider)
+    return self._signer
+
+  def _get_http_client(self):
+    """Returns the HTTP client dedicated to DynamoDB requests, which is
+    created on first use so that it is an instance of the configured
+    AsyncHTTPClient class, bound to the current IOLoop.
+    """
+    io_loop = ioloop.IOLoop.current()
+    if self._http_client is None or self._http_client.io_loop is not io_loop:
+      kwargs = {'max_clients': self.max_clients} if self.max_clients else {}
+      self._http_client = httpclient.AsyncHTTPClient(io_loop=io_loop, force_instance=True, **kwargs)
+    return self._http_client
+
+  def _finish_make_request(self, response, callback, orig_request, token_used, object_hook=None,
+                           object_pairs_hook=None):
     """Check for errors and decode the json response (in the tornado
     response body), then pass on to orig callback.  This method also
     contains some of the logic to handle reacquiring session tokens.
@@ -204,7 +287,7 @@ class AsyncDynamoDB(AWSAuthConnection):
       assert response.error, 'How can there be no response body and no error? Response: %s' % response
       raise DynamoDBResponseError(response.error.code, response.error.message, None)
 
-    json_response = json.loads(response.body, object_hook=object_hook)
+    json_response = json.loads(response.body, object_hook=object_hook, object_pairs_hook=object_pairs_hook)
     if response.error:
       aws_error_type = None
       try:
@@ -10,6 +10,7 @@ See DBHashObject and DBRangeObject.
 
 __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
+from copy import deepcopy
 from functools import partial
 import logging
 
@@ -97,10 +98,11 @@ class DBObject(object):
                    if c.Get() is not None])
 
   def _Clone(self):
-    # Construct new instance of this type and transfer raw in-memory column values.
+    # Construct new instance of this type and copy raw in-memory column values. Some values, such
+    # as the layered sets of set columns, are mutable, so must not be shared with the clone.
     o = type(self)()
     for n, col in self._columns.items():
-      o._columns[n]._value = col._value
+      o._columns[n]._value = deepcopy(col._value)
     return o
 
   def _IsModified(self, name):
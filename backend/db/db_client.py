@@ -33,6 +33,17 @@ options.define('localdb_num_versions', default=20,
                help='number of previous versions of the database to maintain')
 options.define('localdb_reset', default=False,
                help='reset all existing database files')
+options.define('localdb_engine', default='dict',
+               help='storage engine for the local datastore: "dict" or "sorted" (see local_storage.py)')
+options.define('localdb_throttle', default=False,
+               help='enforce the provisioned read and write throughput of each local datastore table, '
+               'as DynamoDB does (see local_throughput.py)')
+options.define('localdb_burst_secs', default=300.0,
+               help='seconds of unused provisioned throughput that a local datastore table can save up for bursts')
+options.define('localdb_latency_ms', default=0.0,
+               help='median latency injected into each local datastore response')
+options.define('localdb_latency_dist', default='fixed',
+               help='distribution of injected local datastore latency: "fixed", "exponential" or "lognormal"')
 
 options.define('readonly_db', default=False, help='Read-only database')
 
@@ -61,7 +61,9 @@ class Device(DBRangeObject):
   _table = DBObject._schema.GetTable(vf_schema.DEVICE)
 
   _ALLOCATION = 1
-  _allocator = IdAllocator(id_type=_table.range_key_col.name, allocation=_ALLOCATION)
+  _MAX_ALLOCATION = 31
+  _allocator = IdAllocator(id_type=_table.range_key_col.name, allocation=_ALLOCATION,
+                           max_allocation=_MAX_ALLOCATION)
 
   _sys_obj_allocator = IdAllocator(id_type='system-object-id', allocation=_ALLOCATION)
   """Used to allocate ids for objects created by the system (e.g.
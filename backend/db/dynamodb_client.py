@@ -3,7 +3,11 @@
 """Client access to DynamoDB backend.
 
 The client marshals and unmarshals Viewfinder schema objects and
-parameters to/from the DynamoDB JSON-encoded format.
+parameters to/from the DynamoDB JSON-encoded format. Responses are
+unmarshalled as they are decoded: DecodeDynamoValues is passed to the
+JSON decoder as its object_pairs_hook, so that each typed value, such as
+{"N": "42"}, is replaced by the value itself as soon as it is parsed,
+rather than decoded into a dict to be converted in a second pass.
 
   DynamoDBClient
 """
@@ -16,9 +20,9 @@ import logging
 import time
 
 from boto.exception import DynamoDBResponseError
-from collections import namedtuple
+from collections import deque, namedtuple
 from functools import partial
-from tornado import gen, ioloop, stack_context
+from tornado import gen, ioloop, options, stack_context
 from viewfinder.backend.base import secrets, util, counters, rate_limiter
 from viewfinder.backend.base.exceptions import DBProvisioningExceededError, DBLimitExceededError
 from viewfinder.backend.base.util import ConvertToString, ConvertToNumber
@@ -40,6 +44,9 @@ kPerThrottleLostCapacityFraction = 0.1
 # Minimum amount of time between rate adjustments, in seconds.
 kMinRateAdjustmentPeriod = 1.0
 
+options.define('dynamodb_max_connections', default=100,
+               help='maximum number of concurrent DynamoDB requests, each on a kept-alive connection')
+
 
 DynDBRequest = namedtuple('DynDBRequest', ['method', 'request', 'op', 'execute_cb', 'finish_cb'])
 
@@ -51,6 +58,27 @@ _throttles_per_min = counters.define_rate('viewfinder.dynamodb.throttles_per_min
 # In addition to these counters, each RequestQueue may setup an extra two (one for QPS, one for backoff).
 
 
+def _DecodeNumberSet(dyn_value):
+  return set([ConvertToNumber(dv) for dv in dyn_value])
+
+# Maps DynamoDB value type to the function that converts a value of that type for use with viewfinder schema.
+_VALUE_DECODERS = {'S': lambda dyn_value: dyn_value, 'N': ConvertToNumber, 'SS': set, 'NS': _DecodeNumberSet}
+
+
+def DecodeDynamoValues(pairs):
+  """JSON object_pairs_hook that decodes a DynamoDB response object. An object with a single
+  member named by a value type is a typed value, and is converted to a python data structure for
+  use with viewfinder schema. Any other object is returned as a dict. No column key is the name of
+  a value type (see DynamoDBClient.__init__), so an item is never mistaken for a typed value.
+  """
+  if len(pairs) == 1:
+    dyn_type, dyn_value = pairs[0]
+    decoder = _VALUE_DECODERS.get(dyn_type, None)
+    if decoder is not None:
+      return decoder(dyn_value)
+  return dict(pairs)
+
+
 class RequestQueue(object):
   """Manages the complexity of tracking successes and failures and
   estimating backoff delays for a request queue.
@@ -176,6 +204,15 @@ class RequestScheduler(object):
   indicating that provisioned throughput is being exceeded, requests
   are placed into priority queues and throttled to just under the
   maximum sustainable rate.
+
+  At most --dynamodb_max_connections requests are in flight at once,
+  which is also the size of the HTTP client's connection pool. Queues
+  that have requests ready to send when the limit is reached wait for
+  in-flight requests to finish, so that their requests are still sent
+  in priority order, rather than in the order in which they would
+  otherwise queue within the HTTP client. Waiting queues are resumed
+  in the same order as after a pause: table reads, then table writes,
+  then the control plane.
   """
   _READ_ONLY_METHODS = ('ListTables', 'DescribeTable', 'GetItem', 'Query', 'Scan', 'BatchGetItem')
 
@@ -187,8 +224,17 @@ class RequestScheduler(object):
     self._cp_read_only_queue = RequestQueue('ControlPlane', False, 'Control Plane R/O', 100)
     self._cp_mutate_queue = RequestQueue('ControlPlane', True, 'Control Plane Mutate', 1)
     self._paused = False
+    self._max_in_flight = options.options.dynamodb_max_connections
+    self._num_in_flight = 0
+    # Queues that stopped sending requests because the maximum number of requests was in flight.
+    self._waiting_queues = deque()
+    # Order in which waiting queues are resumed, the same as in _Resume.
+    self._resume_ranks = dict([(q, 0) for q in self._read_queues.values()] +
+                              [(q, 1) for q in self._write_queues.values()] +
+                              [(q, 2) for q in (self._cp_read_only_queue, self._cp_mutate_queue)])
     self._asyncdynamo = AsyncDynamoDB(secrets.GetSecret('aws_access_key_id'),
-                                      secrets.GetSecret('aws_secret_access_key'))
+                                      secrets.GetSecret('aws_secret_access_key'),
+                                      max_clients=self._max_in_flight)
 
   def Schedule(self, method, request, callback):
     """Creates a DynamoDB request to API call 'method' with JSON
@@ -222,6 +268,7 @@ class RequestScheduler(object):
     thrown during execution, it can be re-raised to the appropriate caller.
     """
     def _OnResponse(start_time, json_response):
+      self._FinishRequest()
       if dyn_req.method in ('BatchGetItem',):
         consumed_units = next(json_response.get('Responses').itervalues()).get('ConsumedCapacityUnits', 1)
       else:
@@ -234,6 +281,7 @@ class RequestScheduler(object):
       dyn_req.finish_cb(json_response)
 
     def _OnException(type, value, tb):
+      self._FinishRequest()
       if type in (DBProvisioningExceededError, DBLimitExceededError):
         # Retry on DynamoDB throttling errors. Report the failure to the queue so that it will backoff the
         # requests/sec rate.
@@ -259,7 +307,8 @@ class RequestScheduler(object):
 
     logging.debug('sending %s (%d bytes) dynamodb request' % (dyn_req.method, len(dyn_req.request)))
     with util.MonoBarrier(partial(_OnResponse, time.time()), on_exception=partial(_OnException)) as b:
-      self._asyncdynamo.make_request(dyn_req.method, json.dumps(dyn_req.request), b.Callback())
+      self._asyncdynamo.make_request(dyn_req.method, json.dumps(dyn_req.request), b.Callback(),
+                                     object_pairs_hook=DecodeDynamoValues)
 
   def _ProcessQueue(self, queue):
     """If the queue is not empty and adequate provisioning is expected,
@@ -271,11 +320,30 @@ class RequestScheduler(object):
       return
 
     while not queue.IsEmpty() and not queue.NeedsBackoff():
+      if self._num_in_flight >= self._max_in_flight:
+        # _FinishRequest resumes the queue, so there is no need for a timeout.
+        if queue not in self._waiting_queues:
+          self._waiting_queues.append(queue)
+        return
+
       dyn_req = queue.Pop()
+      self._num_in_flight += 1
       dyn_req.execute_cb(dyn_req)
 
     queue.ResetTimeout(partial(self._ProcessQueue, queue))
 
+  def _FinishRequest(self):
+    """Called when an in-flight request has finished, successfully or not. Resumes queues that
+    were waiting for a request to finish: table reads, then table writes, then the control plane.
+    Queues of the same kind are resumed in the order in which they started waiting. A resumed
+    queue that uses up the free requests waits again behind the other queues of its kind.
+    """
+    self._num_in_flight -= 1
+    while self._waiting_queues and self._num_in_flight < self._max_in_flight:
+      queue = min(self._waiting_queues, key=self._resume_ranks.get)
+      self._waiting_queues.remove(queue)
+      self._ProcessQueue(queue)
+
   def _Pause(self):
     """Pauses all queue processing. No requests will be sent until
     _Resume() is invoked.
@@ -305,6 +373,11 @@ class DynamoDBClient(DBClient):
     self._read_only = read_only
     self._scheduler = RequestScheduler(schema)
 
+    # Responses are decoded by DecodeDynamoValues, which requires that no column key is the name of a value type.
+    for table_def in schema.GetTables():
+      for col_def in table_def.GetColumns(all_columns=True):
+        assert col_def.key not in _VALUE_DECODERS, (table_def.name, col_def.key)
+
   def Shutdown(self):
     pass
 
@@ -372,7 +445,7 @@ class DynamoDBClient(DBClient):
       if 'Item' not in response:
         callback(None)
       else:
-        callback(GetResult(attributes=self._FromDynamoAttributes(table_def, response['Item']),
+        callback(GetResult(attributes=response['Item'],
                            read_units=response['ConsumedCapacityUnits']))
 
     request = self._GetBaseRequest(table_def, key)
@@ -433,7 +506,7 @@ class DynamoDBClient(DBClient):
           dyn_key['RangeKeyElement'] = dyn_attrs[table_def.range_key_col.key]
 
         key = self._FromDynamoKey(table_def, dyn_key)
-        key_result_dict[key] = self._FromDynamoAttributes(table_def, dyn_attrs)
+        key_result_dict[key] = dyn_attrs
 
       read_units += response['Responses'][table_def.name_in_db]['ConsumedCapacityUnits']
 
@@ -454,7 +527,7 @@ class DynamoDBClient(DBClient):
     table_def = self._schema.GetTable(table)
 
     def _OnPutItem(response):
-      callback(PutResult(return_values=self._FromDynamoAttributes(table_def, response.get('Attributes', None)),
+      callback(PutResult(return_values=response.get('Attributes', None),
                          write_units=response['ConsumedCapacityUnits']))
 
     # Add key values to the attributes map, in accordance with DynamoDB requirements.
@@ -475,7 +548,7 @@ class DynamoDBClient(DBClient):
     table_def = self._schema.GetTable(table)
 
     def _OnDeleteItem(response):
-      callback(DeleteResult(return_values=self._FromDynamoAttributes(table_def, response.get('Attributes', None)),
+      callback(DeleteResult(return_values=response.get('Attributes', None),
                             write_units=response['ConsumedCapacityUnits']))
 
     request = self._GetBaseRequest(table_def, key)
@@ -492,7 +565,7 @@ class DynamoDBClient(DBClient):
     table_def = self._schema.GetTable(table)
 
     def _OnUpdateItem(response):
-      callback(UpdateResult(return_values=self._FromDynamoAttributes(table_def, response.get('Attributes', None)),
+      callback(UpdateResult(return_values=response.get('Attributes', None),
                             write_units=response['ConsumedCapacityUnits']))
 
     request = self._GetBaseRequest(table_def, key)
@@ -510,7 +583,7 @@ class DynamoDBClient(DBClient):
 
     def _OnQuery(response):
       callback(QueryResult(count=response['Count'],
-                           items=[self._FromDynamoAttributes(table_def, item) for item in response.get('Items', [])],
+                           items=response.get('Items', []),
                            last_key=self._FromDynamoKey(table_def, response.get('LastEvaluatedKey', None)),
                            read_units=response['ConsumedCapacityUnits']))
 
@@ -539,7 +612,7 @@ class DynamoDBClient(DBClient):
 
     def _OnScan(response):
       callback(ScanResult(count=response['Count'],
-                          items=[self._FromDynamoAttributes(table_def, item) for item in response['Items']],
+                          items=response['Items'],
                           last_key=self._FromDynamoKey(table_def, response.get('LastEvaluatedKey', None)),
                           read_units=response['ConsumedCapacityUnits']))
 
@@ -580,19 +653,11 @@ class DynamoDBClient(DBClient):
     return {'TableName': table_def.name_in_db, 'Key': self._ToDynamoKey(table_def, key)}
 
   def _FromDynamoKey(self, table_def, dyn_key):
-    """Converts a DynamoDB key into a DBKey named tuple, using the value
-    types defined in the table key definition.
-    """
+    """Converts a decoded DynamoDB key into a DBKey named tuple."""
     if dyn_key is None:
       return None
-    value_type, value = dyn_key['HashKeyElement'].items()[0]
-    hash_key = self._FromDynamoValue(table_def.hash_key_col, value_type, value)
-    if table_def.range_key_col:
-      value_type, value = dyn_key['RangeKeyElement'].items()[0]
-      range_key = self._FromDynamoValue(table_def.range_key_col, value_type, value)
-    else:
-      range_key = None
-    return DBKey(hash_key, range_key)
+    range_key = dyn_key['RangeKeyElement'] if table_def.range_key_col else None
+    return DBKey(dyn_key['HashKeyElement'], range_key)
 
   def _ToDynamoKey(self, table_def, key):
     """Converts from a DBKey named tuple into a DynamoDB key."""
@@ -602,20 +667,6 @@ class DynamoDBClient(DBClient):
       dyn_key['RangeKeyElement'] = self._ToDynamoValue(table_def.range_key_col, key.range_key)
     return dyn_key
 
-  def _FromDynamoAttributes(self, table_def, dyn_attrs):
-    """Converts attributes as reported by DynamoDB into a dictionary
-    of key/value pairs. This verifies at each step that the value
-    types are in agreement, and converts from a list to a set for value
-    types 'SS' and 'NS'.
-    """
-    if dyn_attrs is None:
-      return None
-    attrs = dict()
-    for k, v in dyn_attrs.items():
-      value_type, value = v.items()[0]
-      attrs[k] = self._FromDynamoValue(table_def.GetColumnByKey(k), value_type, value)
-    return attrs
-
   def _ToDynamoAttributes(self, table_def, attrs):
     """Converts attributes from schema datamodel to a dictionary
     appropriate for use with DynamoDB JSON request protocol.
@@ -652,20 +703,6 @@ class DynamoDBClient(DBClient):
         dyn_exp[k] = {'Value': self._ToDynamoValue(table_def.GetColumnByKey(k), v)}
     return dyn_exp
 
-  def _FromDynamoValue(self, col_def, dyn_type, dyn_value):
-    """Converts a dynamo value to a python data structure for use with
-    viewfinder schema.
-    """
-    assert col_def.value_type == dyn_type, '%s != %s' % (col_def.value_type, dyn_type)
-    if col_def.value_type == 'N':
-      return ConvertToNumber(dyn_value)
-    elif col_def.value_type == 'NS':
-      return set([ConvertToNumber(dv) for dv in dyn_value])
-    elif col_def.value_type == 'SS':
-      return set([dv for dv in dyn_value])
-    else:
-      return dyn_value
-
   def _ToDynamoValue(self, col_def, v):
     """Converts a value to a representation appropriate for passing as a
     JSON-encoded value to DynamoDB.
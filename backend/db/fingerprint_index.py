@@ -0,0 +1,242 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Near-duplicate photo detection over image fingerprints.
+
+A perceptual image fingerprint (see clients/shared/ImageIndex.cc and
+experimental/imagefingerprint) is a list of one or more 160-bit terms; two
+fingerprints are near-duplicates if the minimum hamming distance between any
+pair of their terms is small (<= 12 bits gives solid confirmation).
+
+FingerprintIndex uses multi-index hashing: each 160-bit term is split into
+"num_chunks" disjoint bit ranges, and each range is stored in its own hash
+table. By the pigeonhole principle, two terms within hamming distance
+"max_distance" must agree to within max_distance // num_chunks bits on at
+least one chunk, so a query only needs to probe the buckets within that
+(small) radius of each of its chunks. With 7 chunks of ~23 bits and a radius
+of 1, a query probes 7 * 24 buckets regardless of the size of the index,
+instead of comparing against every fingerprint sharing a 12-bit tag.
+
+Terms are stored as packed integers so that distance is a single xor and
+popcount, and candidates are de-duplicated per query before any distance is
+computed.
+
+  FingerprintIndex: incremental add/remove/query index.
+  ParseFingerprint: parses the 'hex:hex:...' fingerprint text format.
+  AssetFingerprintToTerms: converts a UserPhoto asset fingerprint into index terms.
+"""
+
+__author__ = 'ben@emailscrubbed.com (Ben Darnell)'
+
+import itertools
+
+
+FINGERPRINT_BITS = 160
+"""Number of bits in each fingerprint term."""
+
+DEFAULT_MAX_DISTANCE = 12
+"""Matches kMatchThreshold in ImageIndex.cc; accuracy is not guaranteed for larger distances."""
+
+DEFAULT_NUM_CHUNKS = 7
+"""Number of hash tables. Each chunk is probed within a radius of max_distance // num_chunks."""
+
+_ASSET_FINGERPRINT_PREFIX = 'a/#'
+_SHA1_FINGERPRINT_PREFIX = 'N'
+
+
+def _PopCount(value):
+  """Returns the number of bits set in "value"."""
+  return bin(value).count('1')
+
+
+def Distance(terms1, terms2):
+  """Returns the minimum hamming distance between any term in "terms1" and any
+  term in "terms2".
+  """
+  best = FINGERPRINT_BITS
+  for t1 in terms1:
+    for t2 in terms2:
+      dist = _PopCount(t1 ^ t2)
+      if dist < best:
+        if dist == 0:
+          return 0
+        best = dist
+  return best
+
+
+def ParseFingerprint(fingerprint):
+  """Parses a fingerprint in the colon-separated hex format produced by
+  fingerprint_directory.py (one 40-character hex string per term) into a
+  tuple of packed integer terms. Raises ValueError if the string is malformed.
+  """
+  terms = []
+  for term in fingerprint.strip().split(':'):
+    if len(term) != FINGERPRINT_BITS / 4:
+      raise ValueError('fingerprint term "%s" is not %d hex characters' % (term, FINGERPRINT_BITS / 4))
+    terms.append(int(term, 16))
+  return tuple(terms)
+
+
+def AssetFingerprintToTerms(asset_fingerprint):
+  """Converts a fingerprint-only asset key, as returned by
+  UserPhoto.AssetKeyToFingerprint, into a tuple of index terms. Returns None
+  if the fingerprint is not in a recognized format.
+
+  Current clients send 'N' + the hex SHA1 of the asset thumbnail, which is a
+  single 160-bit term: such fingerprints only ever match at distance 0 (an
+  exact duplicate), since unrelated SHA1 values are essentially never within
+  12 bits of each other. Perceptual fingerprints in the colon-separated hex
+  format match near-duplicates as well.
+  """
+  if asset_fingerprint is None or not asset_fingerprint.startswith(_ASSET_FINGERPRINT_PREFIX):
+    return None
+  fingerprint = asset_fingerprint[len(_ASSET_FINGERPRINT_PREFIX):]
+  if fingerprint.startswith(_SHA1_FINGERPRINT_PREFIX):
+    fingerprint = fingerprint[len(_SHA1_FINGERPRINT_PREFIX):]
+  try:
+    return ParseFingerprint(fingerprint)
+  except ValueError:
+    return None
+
+
+class FingerprintIndex(object):
+  """Multi-index hash table over packed fingerprint terms. Fingerprints are
+  added incrementally with an arbitrary key, and queries return the keys of all
+  indexed fingerprints within "max_distance" of the query fingerprint.
+
+  Adding different fingerprints under the same key indexes all of them, and a
+  query may then return the key more than once. Adding a fingerprint that is
+  already indexed under the key has no effect.
+  """
+  def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, num_chunks=DEFAULT_NUM_CHUNKS, bits=FINGERPRINT_BITS):
+    assert 0 < num_chunks <= bits, num_chunks
+    self._max_distance = max_distance
+    self._radius = max_distance // num_chunks
+
+    # Split the term into num_chunks contiguous (shift, mask) ranges of nearly equal width, and
+    # precompute the xor masks which enumerate all chunk values within the probe radius.
+    self._chunks = []
+    self._probes = []
+    shift = 0
+    for i in xrange(num_chunks):
+      width = bits // num_chunks + (1 if i < bits % num_chunks else 0)
+      self._chunks.append((shift, (1 << width) - 1))
+      self._probes.append(self._ProbeMasks(width, self._radius))
+      shift += width
+    assert shift == bits, shift
+
+    # Each table maps a chunk value to either a single entry id or a list of entry ids. Most
+    # buckets hold a single entry, so this saves a list allocation per bucket.
+    self._tables = [{} for _ in xrange(num_chunks)]
+    # Keys and terms of each entry, by entry id. Both are None once the entry is removed.
+    self._keys = []
+    self._terms = []
+    # Maps key => list of ids of the entries added under that key.
+    self._key_entries = {}
+    self._num_entries = 0
+
+  def __len__(self):
+    return self._num_entries
+
+  @property
+  def max_distance(self):
+    return self._max_distance
+
+  def Add(self, key, terms):
+    """Adds the fingerprint "terms" (a sequence of packed integers) to the index under "key"."""
+    terms = tuple(terms)
+    entry_ids = self._key_entries.setdefault(key, [])
+    if any(self._terms[entry_id] == terms for entry_id in entry_ids):
+      return
+
+    entry_id = len(self._keys)
+    self._keys.append(key)
+    self._terms.append(terms)
+    entry_ids.append(entry_id)
+    self._num_entries += 1
+    for term in terms:
+      for table, (shift, mask) in zip(self._tables, self._chunks):
+        chunk = (term >> shift) & mask
+        bucket = table.get(chunk)
+        if bucket is None:
+          table[chunk] = entry_id
+        elif type(bucket) is list:
+          if bucket[-1] != entry_id:
+            bucket.append(entry_id)
+        elif bucket != entry_id:
+          table[chunk] = [bucket, entry_id]
+
+  def Remove(self, key):
+    """Removes all fingerprints added under "key" from the index."""
+    for entry_id in self._key_entries.pop(key, []):
+      for term in self._terms[entry_id]:
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+          chunk = (term >> shift) & mask
+          bucket = table.get(chunk)
+          if type(bucket) is list:
+            if entry_id in bucket:
+              bucket.remove(entry_id)
+              if len(bucket) == 1:
+                table[chunk] = bucket[0]
+          elif bucket == entry_id:
+            del table[chunk]
+      self._keys[entry_id] = None
+      self._terms[entry_id] = None
+      self._num_entries -= 1
+
+  def Query(self, terms, max_distance=None):
+    """Returns a list of (key, distance) tuples for all indexed fingerprints within
+    "max_distance" (default: the index's max_distance) of "terms", ordered by distance.
+    """
+    max_distance = self._max_distance if max_distance is None else max_distance
+    assert max_distance <= self._max_distance, \
+        'index only guarantees accuracy for distance <= %d' % self._max_distance
+    results = []
+    for entry_id in self._Candidates(terms):
+      dist = Distance(terms, self._terms[entry_id])
+      if dist <= max_distance:
+        results.append((self._keys[entry_id], dist))
+    results.sort(key=lambda r: r[1])
+    return results
+
+  def IterNearDuplicatePairs(self, min_distance=0, max_distance=None):
+    """Yields (key1, key2, distance) for every pair of indexed fingerprints within
+    [min_distance, max_distance] of each other. Each pair is yielded once, with key1
+    being the earlier-added fingerprint.
+    """
+    max_distance = self._max_distance if max_distance is None else max_distance
+    assert min_distance <= max_distance <= self._max_distance, (min_distance, max_distance)
+    for entry_id, terms in enumerate(self._terms):
+      if terms is None:
+        continue
+      for other_id in self._Candidates(terms):
+        if other_id < entry_id:
+          dist = Distance(terms, self._terms[other_id])
+          if min_distance <= dist <= max_distance:
+            yield (self._keys[other_id], self._keys[entry_id], dist)
+
+  def _Candidates(self, terms):
+    """Returns the set of entry ids sharing at least one chunk, to within the probe radius,
+    with any of "terms".
+    """
+    candidates = set()
+    for term in terms:
+      for table, (shift, mask), probes in zip(self._tables, self._chunks, self._probes):
+        chunk = (term >> shift) & mask
+        for probe in probes:
+          bucket = table.get(chunk ^ probe)
+          if bucket is None:
+            continue
+          elif type(bucket) is list:
+            candidates.update(bucket)
+          else:
+            candidates.add(bucket)
+    return candidates
+
+  @classmethod
+  def _ProbeMasks(cls, width, radius):
+    """Returns the list of xor masks of "width" bits with at most "radius" bits set."""
+    masks = [0]
+    for num_bits in xrange(1, radius + 1):
+      for bits in itertools.combinations(xrange(width), num_bits):
+        masks.append(sum(1 << b for b in bits))
+    return masks
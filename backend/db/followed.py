@@ -11,17 +11,34 @@ together, with the ordering within the group undefined. This
 enables "query_followed" to return viewpoints in rough order, but
 without paying a high cost for keeping the index maintained.
 
+An operation may update the same Followed row more than once. For
+example, adding followers creates a Followed row for each new follower,
+and the notification that follows updates the rows of all followers,
+including the ones just created. While an operation executes under
+Followed.CoalesceUpdates, the rows it has already written are remembered,
+so that repeated puts or deletes of the same row are skipped. Writes are
+never deferred, since NotificationManager relies on the Followed rows
+being written before the viewpoint's "last_updated" attribute is
+committed. Skipped writes are counted in
+viewfinder.followed.writes_saved_per_min.
+
   Followed: sorts viewpoints in reverse order of last update.
 """
 
 __authors__ = ['andy@emailscrubbed.com (Andy Kimball)']
 
+from contextlib import contextmanager
 from tornado import gen
-from viewfinder.backend.base import constants, util
+from viewfinder.backend.base import constants, counters, util
 from viewfinder.backend.db import db_client, vf_schema
 from viewfinder.backend.db.base import DBObject
+from viewfinder.backend.db.operation import Operation
 from viewfinder.backend.db.range_base import DBRangeObject
 
+_writes_saved = counters.define_rate('viewfinder.followed.writes_saved_per_min',
+                                     'Followed writes skipped because the operation already made them per minute.',
+                                     60)
+
 
 @DBObject.map_table_attributes
 class Followed(DBRangeObject):
@@ -30,6 +47,10 @@ class Followed(DBRangeObject):
 
   _table = DBObject._schema.GetTable(vf_schema.FOLLOWED)
 
+  # Maps operation_id => {(user_id, viewpoint_id, date_updated) => True if the current execution
+  # of the operation put the row, False if it deleted it}.
+  _op_writes = {}
+
   def __init__(self, user_id=None, sort_key=None):
     super(Followed, self).__init__()
     self.user_id = user_id
@@ -44,6 +65,20 @@ class Followed(DBRangeObject):
     prefix = util.CreateSortKeyPrefix(Followed._TruncateToDay(timestamp), randomness=False, reverse=True)
     return prefix + viewpoint_id
 
+  @classmethod
+  @contextmanager
+  def CoalesceUpdates(cls, operation_id):
+    """Remembers the Followed rows written by UpdateDateUpdated while operation "operation_id"
+    executes, so that later updates within the operation skip writes it has already made. The
+    rows are forgotten on exit, since a later execution of the operation cannot assume that
+    they are still in the database.
+    """
+    Followed._op_writes[operation_id] = {}
+    try:
+      yield
+    finally:
+      del Followed._op_writes[operation_id]
+
   @classmethod
   @gen.engine
   def UpdateDateUpdated(cls, client, user_id, viewpoint_id, old_timestamp, new_timestamp, callback):
@@ -60,19 +95,36 @@ class Followed(DBRangeObject):
 
       # Only update (and possibly delete) if old and new values are not the same.
       if old_date_updated != new_date_updated:
-        # Insert the new followed record.
-        followed = Followed(user_id, Followed.CreateSortKey(viewpoint_id, new_date_updated))
-        followed.date_updated = new_date_updated
-        followed.viewpoint_id = viewpoint_id
-        yield gen.Task(followed.Update, client)
+        op_writes = Followed._GetOpWrites()
+
+        # Insert the new followed record, unless the current operation already has.
+        if op_writes.get((user_id, viewpoint_id, new_date_updated)) is True:
+          _writes_saved.increment()
+        else:
+          followed = Followed(user_id, Followed.CreateSortKey(viewpoint_id, new_date_updated))
+          followed.date_updated = new_date_updated
+          followed.viewpoint_id = viewpoint_id
+          yield gen.Task(followed.Update, client)
+          op_writes[(user_id, viewpoint_id, new_date_updated)] = True
 
         # Delete the previous followed record, if it exists.
         if old_date_updated is not None:
-          followed = Followed(user_id, Followed.CreateSortKey(viewpoint_id, old_date_updated))
-          yield gen.Task(followed.Delete, client)
+          if op_writes.get((user_id, viewpoint_id, old_date_updated)) is False:
+            _writes_saved.increment()
+          else:
+            followed = Followed(user_id, Followed.CreateSortKey(viewpoint_id, old_date_updated))
+            yield gen.Task(followed.Delete, client)
+            op_writes[(user_id, viewpoint_id, old_date_updated)] = False
 
     callback()
 
+  @classmethod
+  def _GetOpWrites(cls):
+    """Returns the rows written by the executing operation, or an empty dict that is discarded
+    if no operation is executing under CoalesceUpdates.
+    """
+    return Followed._op_writes.get(Operation.GetCurrent().operation_id, {})
+
   @classmethod
   def _TruncateToDay(cls, timestamp):
     """Truncate timestamp to day boundary."""
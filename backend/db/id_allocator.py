@@ -4,9 +4,15 @@
 
 An instance of IdAllocator is created by specifying the id-allocation key.
 This is typically a table name (e.g. 'users'), though can be
-any arbitrary key. Each instance maintains a block of sequential IDs. The
-size of the block can be controlled at instantiation but defaults to
-IdAllocator._DEFAULT_ALLOCATION.
+any arbitrary key. Each instance maintains a block of sequential IDs,
+allocated from the id_allocator table with an atomic ADD.
+
+The size of each block adapts to the rate at which IDs are consumed: an
+exponentially weighted moving average of that rate is kept, and each block
+is sized to last roughly IdAllocator._BLOCK_SECS, within the bounds given
+at instantiation. So that NextId rarely waits on the database, the next
+block is prefetched once the current block runs low, and is held until the
+current block is exhausted.
 
 Allocation of IDs starts at _START_ID (default is 1).
 
@@ -17,32 +23,52 @@ __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
 import logging
 import struct
+import time
 import zlib
 
 from collections import deque
 from functools import partial
 
-from viewfinder.backend.base import util
+from viewfinder.backend.base import counters, util
 from viewfinder.backend.db import db_client, vf_schema
 from viewfinder.backend.db.base import DBObject
 from viewfinder.backend.db.hash_base import DBHashObject
 
+_waits = counters.define_rate('viewfinder.id_allocator.waits_per_min',
+                              'Ids requested while no allocated id was available per minute.', 60)
+_block_size = counters.define_average('viewfinder.id_allocator.avg_block_size',
+                                      'Average number of ids in each block allocated from the id_allocator table.')
+_wasted_ids = counters.define_total('viewfinder.id_allocator.wasted_ids',
+                                    'Number of allocated ids that were never used because the server shut down.')
+
 
 @DBObject.map_table_attributes
 class IdAllocator(DBHashObject):
   """Viewfinder ID allocator."""
-  __slots__ = ['_allocation', '_next_id_key', '_cur_id', '_last_id',
-               '_allocation_pending', '_waiters']
+  __slots__ = ['_allocation', '_min_allocation', '_max_allocation', '_next_id_key', '_cur_id', '_last_id',
+               '_next_block', '_allocation_pending', '_waiters', '_generation', '_rate', '_num_requested',
+               '_last_allocate_time']
 
   _START_ID = 1
   _DEFAULT_ALLOCATION = 7
+  _DEFAULT_MAX_ALLOCATION = 1009
+
+  _BLOCK_SECS = 10.0
+  """Blocks are sized to hold the number of ids expected to be requested in this many seconds."""
+
+  _RATE_WEIGHT = 0.3
+  """Weight of the most recent sample in the moving average of the id request rate."""
+
+  _LOW_WATER_FRACTION = 0.25
+  """The next block is prefetched once this fraction of the current block remains."""
 
   _table = DBObject._schema.GetTable(vf_schema.ID_ALLOCATOR)
   _instances = list()
 
-  def __init__(self, id_type=None, allocation=None):
-    """Allocates a block of 'allocation' IDs from the 'id_allocator'
-    table.
+  def __init__(self, id_type=None, allocation=None, max_allocation=None):
+    """Allocates blocks of between 'allocation' and 'max_allocation' IDs
+    from the 'id_allocator' table. If 'allocation' is specified but
+    'max_allocation' is not, every block has 'allocation' IDs.
 
     Specify allocation as a prime number to make it less likely that
     two allocating servers are handing out numbers with synchronized
@@ -52,33 +78,58 @@ class IdAllocator(DBHashObject):
     """
     super(IdAllocator, self).__init__()
     self.id_type = id_type
-    self._allocation = allocation or IdAllocator._DEFAULT_ALLOCATION
+    if allocation is None:
+      self._min_allocation = IdAllocator._DEFAULT_ALLOCATION
+      self._max_allocation = max_allocation or IdAllocator._DEFAULT_MAX_ALLOCATION
+    else:
+      self._min_allocation = allocation
+      self._max_allocation = max_allocation or allocation
+    assert self._min_allocation <= self._max_allocation, (self._min_allocation, self._max_allocation)
     self._next_id_key = self._table.GetColumn('next_id').key
-    self._cur_id = IdAllocator._START_ID
-    self._last_id = IdAllocator._START_ID
-    self._allocation_pending = False
     self._waiters = deque()
+    self._generation = 0
+    self.Reset()
     # Add to the global instance list so we can reset from unittest setup.
     IdAllocator._instances.append(self)
 
   def Reset(self):
+    """Forgets all allocated ids. A prefetch that is still pending is ignored when it completes."""
     assert len(self._waiters) == 0, self._waiters
-    assert not self._allocation_pending
+    self._generation += 1
+    self._allocation = self._min_allocation
     self._cur_id = IdAllocator._START_ID
     self._last_id = IdAllocator._START_ID
+    self._next_block = None
     self._allocation_pending = False
+    self._rate = None
+    self._num_requested = 0
+    self._last_allocate_time = None
+
+  def Shutdown(self):
+    """Records the ids that were allocated but will never be used, and forgets them."""
+    num_unused = self._last_id - self._cur_id
+    if self._next_block is not None:
+      num_unused += self._next_block[1] - self._next_block[0]
+    if num_unused > 0:
+      logging.info('%d allocated %s IDs unused at shutdown' % (num_unused, self.id_type))
+      _wasted_ids.increment(num_unused)
+    self._cur_id = self._last_id
+    self._next_block = None
 
   def NextId(self, client, callback):
-    """Executes callback with the value of _cur_id++. If _cur_id is None or
-    _cur_id == _last_id, allocates a new block from the 'id_allocator' table.
+    """Executes callback with the value of _cur_id++. If the current block
+    is exhausted and no block has been prefetched, allocates a new block
+    from the 'id_allocator' table.
     """
-    if self._allocation_pending:
-      self._waiters.append(partial(self._AllocateId, callback))
-    elif self._cur_id == self._last_id:
-      self._waiters.append(partial(self._AllocateId, callback))
-      self._AllocateIds(client)
-    else:
+    self._num_requested += 1
+    if len(self._waiters) == 0 and self._NextBlockReady():
       self._AllocateId(callback)
+      self._MaybePrefetch(client)
+    else:
+      _waits.increment()
+      self._waiters.append(partial(self._AllocateId, callback))
+      if not self._allocation_pending:
+        self._AllocateIds(client)
 
   def _AllocateId(self, callback, type=None, value=None, traceback=None):
     """Invokes callback with a new id from the sequence; if type, value or
@@ -91,39 +142,90 @@ class IdAllocator(DBHashObject):
     self._cur_id += 1
     callback(new_id)
 
+  def _NextBlockReady(self):
+    """Returns true if an id is available, switching to the prefetched
+    block if the current block is exhausted.
+    """
+    if self._cur_id == self._last_id and self._next_block is not None:
+      self._cur_id, self._last_id = self._next_block
+      self._next_block = None
+    return self._cur_id < self._last_id
+
+  def _MaybePrefetch(self, client):
+    """Starts allocating the next block if the current block has fallen
+    to its low-water mark and no block is prefetched or pending.
+    """
+    if self._allocation_pending or self._next_block is not None:
+      return
+    low_water = max(1, int(self._allocation * IdAllocator._LOW_WATER_FRACTION))
+    if self._last_id - self._cur_id <= low_water:
+      self._AllocateIds(client)
+
   def _ProcessWaiters(self):
     """Iterates over list of waiters, returning new ids from the
     allocation stream. Returns true if all waiters were processed;
     false otherwise.
     """
-    while len(self._waiters) and self._cur_id < self._last_id:
+    while len(self._waiters) and self._NextBlockReady():
       self._waiters.popleft()()
     return len(self._waiters) == 0
 
+  def _UpdateAllocation(self):
+    """Updates the moving average of the id request rate with the ids
+    requested since the last allocation, and sizes the next block to
+    last _BLOCK_SECS at that rate.
+    """
+    now = time.time()
+    if self._last_allocate_time is not None:
+      elapsed = max(now - self._last_allocate_time, 0.001)
+      sample = self._num_requested / elapsed
+      if self._rate is None:
+        self._rate = sample
+      else:
+        self._rate = IdAllocator._RATE_WEIGHT * sample + (1 - IdAllocator._RATE_WEIGHT) * self._rate
+      target = int(self._rate * IdAllocator._BLOCK_SECS)
+      self._allocation = min(self._max_allocation, max(self._min_allocation, target))
+    self._last_allocate_time = now
+    self._num_requested = 0
+
   def _AllocateIds(self, client):
     """Allocates the next batch of IDs. On success, processes all
     pending waiters. If there are more waiters than ids, re-allocates.
-    Otherwise, resets _allocation_pending.
+    Otherwise, prefetches the following block if the new block is
+    already at its low-water mark.
     """
-    assert self._cur_id == self._last_id, (self._cur_id, self._last_id)
+    assert self._next_block is None, self._next_block
+    self._UpdateAllocation()
+    allocation = self._allocation
+    generation = self._generation
 
     def _OnAllocate(result):
-      self._last_id = result.return_values[self._next_id_key]
-      if self._last_id <= IdAllocator._START_ID:
-        self._cur_id = self._last_id
+      if generation != self._generation:
+        return
+      last_id = result.return_values[self._next_id_key]
+      first_id = max(IdAllocator._START_ID, last_id - allocation)
+      if first_id >= last_id:
         return self._AllocateIds(client)
-      self._cur_id = max(IdAllocator._START_ID, self._last_id - self._allocation)
-      assert self._cur_id < self._last_id, 'cur id %d >= allocated last id %d' % \
-          (self._cur_id, self._last_id)
       logging.debug("allocated %d %s IDs (%d-%d)" %
-                    (self._allocation, self.id_type, self._cur_id, self._last_id))
+                    (last_id - first_id, self.id_type, first_id, last_id))
+      _block_size.add(last_id - first_id)
+
+      self._allocation_pending = False
+      if self._cur_id == self._last_id:
+        self._cur_id, self._last_id = first_id, last_id
+      else:
+        self._next_block = (first_id, last_id)
+
       if not self._ProcessWaiters():
         self._AllocateIds(client)
       else:
-        self._allocation_pending = False
+        self._MaybePrefetch(client)
 
     def _OnError(type, value, traceback):
+      if generation != self._generation:
+        return
       logging.error('failed to allocate new id; returning waiters...', exc_info=(type, value, traceback))
+      self._allocation_pending = False
       while len(self._waiters):
         self._waiters.popleft()(type, value, traceback)
 
@@ -131,7 +233,7 @@ class IdAllocator(DBHashObject):
     with util.MonoBarrier(_OnAllocate, on_exception=_OnError) as b:
       client.UpdateItem(table=self._table.name, key=self.GetKey(),
                         attributes={self._next_id_key:
-                                    db_client.UpdateAttr(value=self._allocation, action='ADD')},
+                                    db_client.UpdateAttr(value=allocation, action='ADD')},
                         return_values='UPDATED_NEW', callback=b.Callback())
 
   @staticmethod
@@ -150,3 +252,9 @@ class IdAllocator(DBHashObject):
     for id_alloc in IdAllocator._instances:
       id_alloc.Reset()
 
+  @classmethod
+  def ShutdownAll(cls):
+    """Records the ids allocated by all ID allocators that will never be used."""
+    for id_alloc in IdAllocator._instances:
+      id_alloc.Shutdown()
+
@@ -78,6 +78,9 @@ class Identity(DBHashObject):
 
   _table = DBObject._schema.GetTable(vf_schema.IDENTITY)
 
+  _bound_hooks = []
+  """Functions invoked with the key of each identity that is bound to a user on this server."""
+
   def __init__(self, key=None, user_id=None):
     """Creates a new identity with the specified key."""
     super(Identity, self).__init__()
@@ -179,6 +182,7 @@ class Identity(DBHashObject):
     identity.authority = 'Viewfinder'
 
     yield gen.Task(identity.Update, client)
+    Identity.NotifyBound(identity_key)
 
     # Update all contacts that refer to this identity.
     yield identity._RewriteContacts(client, timestamp)
@@ -335,6 +339,21 @@ class Identity(DBHashObject):
     yield identity._RewriteContacts(client, timestamp)
     yield gen.Task(identity.Delete, client)
 
+  @staticmethod
+  def AddBoundHook(hook):
+    """Registers "hook" to be invoked with an identity key each time that identity is bound to a
+    user on this server.
+    """
+    Identity._bound_hooks.append(hook)
+
+  @staticmethod
+  def NotifyBound(identity_key):
+    """Invokes the hooks registered with AddBoundHook for "identity_key". Must be called after
+    the identity has been bound to a user.
+    """
+    for hook in Identity._bound_hooks:
+      hook(identity_key)
+
   @classmethod
   def GetDescription(cls, identity_key):
     """Returns a description of the specified identity key suitable for UI display."""
@@ -0,0 +1,161 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Bulk resolution of identity keys to users.
+
+Clients resolve entire address books, which can hold thousands of identities,
+most of which do not belong to Viewfinder users. Querying each Identity and
+then each User individually costs two round trips per identity. The
+IdentityResolver instead:
+
+  - de-duplicates the requested identity keys
+  - skips keys recently found to be unregistered (the "negative cache")
+  - fetches the remaining identities with BatchQuery, in chunks of at most
+    _BATCH_SIZE keys (the DynamoDB BatchGetItem limit), issued concurrently
+  - fetches the bound users in the same way
+
+The negative cache only holds identities that either do not exist or are not
+bound to a user, and entries expire after --identity_negative_cache_secs. An
+identity that is registered, linked, merged or bound to a prospective user on
+this server is invalidated immediately (see Identity.AddBoundHook); one bound
+on another server may continue to resolve as unregistered until its entry
+expires. Callers that act on the absence of a user (e.g. by allocating a
+prospective user) must pass use_negative_cache=False.
+
+  IdentityResolver: resolves batches of identity keys to (Identity, User) tuples.
+"""
+
+__author__ = 'ben@emailscrubbed.com (Ben Darnell)'
+
+import time
+
+from collections import OrderedDict
+from tornado import gen, options
+from viewfinder.backend.base import counters
+from viewfinder.backend.db.db_client import DBKey
+from viewfinder.backend.db.identity import Identity
+from viewfinder.backend.db.user import User
+
+options.define('identity_negative_cache_secs', default=30.0,
+               help='seconds for which an unregistered identity is remembered by the identity resolver')
+options.define('identity_negative_cache_size', default=100000,
+               help='maximum number of unregistered identities remembered by the identity resolver')
+
+_identities_resolved = counters.define_rate('viewfinder.identity_resolver.identities_per_min',
+                                            'Identity keys resolved per minute.', 60)
+_negative_cache_hits = counters.define_rate('viewfinder.identity_resolver.negative_cache_hits_per_min',
+                                            'Identity keys answered from the negative cache per minute.', 60)
+_batch_requests = counters.define_rate('viewfinder.identity_resolver.batch_requests_per_min',
+                                       'Identity and user batch queries issued per minute.', 60)
+
+# An identity that is bound to a user may have been remembered as unregistered.
+Identity.AddBoundHook(lambda identity_key: IdentityResolver.Instance().Invalidate(identity_key))
+
+
+class IdentityResolver(object):
+  """Resolves identity keys to (Identity, User) tuples using batched queries. A single
+  instance is shared by the server so that the negative cache is shared across requests.
+  """
+  _BATCH_SIZE = 100
+  """Maximum number of keys in a single BatchQuery."""
+
+  _instance = None
+
+  def __init__(self, negative_ttl=None, max_negative=None):
+    self._negative_ttl = options.options.identity_negative_cache_secs if negative_ttl is None else negative_ttl
+    self._max_negative = options.options.identity_negative_cache_size if max_negative is None else max_negative
+    # Maps identity key => expiration time, in insertion order so that the oldest entries can be
+    # evicted first.
+    self._negative = OrderedDict()
+
+  @staticmethod
+  def Instance():
+    if IdentityResolver._instance is None:
+      IdentityResolver._instance = IdentityResolver()
+    return IdentityResolver._instance
+
+  @staticmethod
+  def SetInstance(resolver):
+    IdentityResolver._instance = resolver
+
+  def Invalidate(self, identity_key):
+    """Removes "identity_key" from the negative cache, if present. Called when the identity is
+    bound to a user.
+    """
+    self._negative.pop(identity_key, None)
+
+  @gen.coroutine
+  def ResolveIdentities(self, client, identity_keys, use_negative_cache=True):
+    """Resolves each key in "identity_keys" to an (identity, user) tuple. Returns a list of the
+    same length as "identity_keys". "identity" is None if the identity does not exist, and
+    "user" is None if the identity is not bound to an existing user. If "use_negative_cache"
+    is True, identities recently found to be unregistered may be returned as (None, None)
+    without being queried.
+    """
+    _identities_resolved.increment(len(identity_keys))
+    now = time.time()
+
+    unique_keys = []
+    seen = set()
+    for identity_key in identity_keys:
+      if identity_key in seen:
+        continue
+      seen.add(identity_key)
+      if use_negative_cache and self._IsNegative(identity_key, now):
+        _negative_cache_hits.increment()
+        continue
+      unique_keys.append(identity_key)
+
+    identities = yield self._BatchQuery(client, Identity, unique_keys)
+    ident_map = dict(zip(unique_keys, identities))
+
+    user_ids = list({identity.user_id for identity in identities
+                     if identity is not None and identity.user_id is not None})
+    users = yield self._BatchQuery(client, User, user_ids)
+    user_map = dict(zip(user_ids, users))
+
+    for identity_key, identity in ident_map.iteritems():
+      if identity is None or user_map.get(identity.user_id) is None:
+        self._AddNegative(identity_key, now)
+
+    results = []
+    for identity_key in identity_keys:
+      identity = ident_map.get(identity_key)
+      user = user_map.get(identity.user_id) if identity is not None else None
+      results.append((identity, user))
+
+    raise gen.Return(results)
+
+  @gen.coroutine
+  def _BatchQuery(self, client, cls, hash_keys):
+    """Queries objects of type "cls" by "hash_keys", in concurrent batches of at most
+    _BATCH_SIZE keys. Returns a list of the same length, with None for missing objects.
+    """
+    if not hash_keys:
+      raise gen.Return([])
+
+    tasks = []
+    for i in xrange(0, len(hash_keys), IdentityResolver._BATCH_SIZE):
+      db_keys = [DBKey(hash_key, None) for hash_key in hash_keys[i:i + IdentityResolver._BATCH_SIZE]]
+      tasks.append(gen.Task(cls.BatchQuery, client, db_keys, None, must_exist=False))
+    _batch_requests.increment(len(tasks))
+
+    batches = yield tasks
+    raise gen.Return([obj for batch in batches for obj in batch])
+
+  def _IsNegative(self, identity_key, now):
+    expires = self._negative.get(identity_key)
+    if expires is None:
+      return False
+    if expires <= now:
+      del self._negative[identity_key]
+      return False
+    return True
+
+  def _AddNegative(self, identity_key, now):
+    if self._negative_ttl <= 0 or self._max_negative <= 0:
+      return
+    self._negative.pop(identity_key, None)
+    self._negative[identity_key] = now + self._negative_ttl
+    while len(self._negative) > self._max_negative:
+      self._negative.popitem(last=False)
+
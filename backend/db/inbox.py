@@ -0,0 +1,186 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Inbox relation.
+
+QueryFollowed builds its response by querying the Followed table for a page
+of viewpoints, and then querying the Viewpoint and Follower records of every
+viewpoint in the page. The Inbox relation materializes the first page of
+that response for each user. It holds the Followed sort key and the
+metadata dict of each viewpoint in the page, so that the page can be
+returned after reading a single item.
+
+Every change to a viewpoint or follower that QueryFollowed reports also
+creates a notification for the user. An inbox is stamped with the id of the
+user's last notification at the time it was built. It is current only as
+long as that is still the user's last notification, and only if it was
+written in the current format (Inbox.VERSION). Otherwise QueryFollowed falls
+back to the Followed, Viewpoint and Follower queries, and rebuilds the inbox
+from their results.
+
+Inboxes are maintained incrementally by NotificationManager._NotifyFollowers.
+After creating a follower's notification, it calls Inbox.ApplyNotification.
+If the inbox was current as of the follower's previous notification, then
+the viewpoint's entry is replaced (or inserted, or moved, if its Followed
+sort key has changed), and the inbox is re-stamped with the new notification
+id. The write is conditioned on the previous stamp, so that notifications
+applied out of order leave the inbox stale rather than wrong. Notifications
+created elsewhere, such as by update_follower, also leave the inbox stale,
+to be rebuilt by the next QueryFollowed. Removed followers are not notified
+when their Followed records change, so their inboxes are deleted instead.
+
+Enabled with --materialize_inbox.
+
+  Inbox: materialized first page of the viewpoints followed by a user.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import bisect
+import logging
+
+from tornado import gen, options
+from viewfinder.backend.base import counters, util
+from viewfinder.backend.db import vf_schema
+from viewfinder.backend.db.base import DBObject
+from viewfinder.backend.db.followed import Followed
+from viewfinder.backend.db.hash_base import DBHashObject
+from viewfinder.backend.db.notification import Notification
+
+options.define('materialize_inbox', default=False,
+               help='serve the first page of query_followed from a materialized inbox, maintained by notifications')
+
+_fallbacks = counters.define_rate('viewfinder.inbox.fallbacks_per_min',
+                                  'QueryFollowed requests that could not be served from the inbox per minute.',
+                                  60)
+
+
+@DBObject.map_table_attributes
+class Inbox(DBHashObject):
+  """Viewfinder inbox data object."""
+  __slots__ = []
+
+  _table = DBObject._schema.GetTable(vf_schema.INBOX)
+
+  VERSION = 1
+  """Format of the page; inboxes written in any other format are rebuilt."""
+
+  _MAX_ENTRIES = 200
+  """Largest number of entries in a materialized page."""
+
+  _MAX_PAGE_SIZE = 64000
+  """Largest serialized page that is materialized. DynamoDB has a limit of 64KB per item."""
+
+  def __init__(self, user_id=None):
+    super(Inbox, self).__init__()
+    self.user_id = user_id
+
+  def GetEntries(self):
+    """Returns the list of [sort_key, metadata_dict] entries in the page, in Followed order."""
+    return self.page['entries']
+
+  @classmethod
+  @gen.coroutine
+  def QueryCurrent(cls, client, user_id, limit):
+    """Returns a tuple of the user's inbox, and the id of the user's last notification. The inbox
+    is None if it is not current, or if it does not hold a first page of "limit" viewpoints.
+    """
+    inbox, last_notification = yield [gen.Task(Inbox.Query, client, user_id, None, must_exist=False),
+                                      Notification.QueryLast(client, user_id)]
+    last_notification_id = last_notification.notification_id if last_notification is not None else 0
+
+    if (inbox is None or inbox.version != Inbox.VERSION or inbox.notification_id != last_notification_id or
+        inbox.page_limit != limit):
+      _fallbacks.increment()
+      inbox = None
+
+    raise gen.Return((inbox, last_notification_id))
+
+  @classmethod
+  @gen.coroutine
+  def Build(cls, client, user_id, notification_id, limit, followed, viewpoints, followers):
+    """Writes the first page of "limit" viewpoints followed by the user, given the "followed"
+    records returned by the Followed query for the page, and the viewpoint and follower of each.
+    "notification_id" must have been read before the page was queried. The inbox is not written
+    if the page is too large, or if a viewpoint is missing.
+    """
+    if any(viewpoint is None for viewpoint in viewpoints):
+      return
+
+    inbox = Inbox(user_id)
+    inbox.version = Inbox.VERSION
+    inbox.notification_id = notification_id
+    inbox.page_limit = limit
+    if not inbox._SetPage([[f.sort_key, viewpoint.MakeMetadataDict(follower)]
+                           for f, viewpoint, follower in zip(followed, viewpoints, followers)],
+                          limit is None or len(followed) < limit):
+      return
+
+    yield gen.Task(inbox.Update, client)
+
+  @classmethod
+  @gen.coroutine
+  def Invalidate(cls, client, user_id):
+    """Deletes the user's inbox, so that it is rebuilt by the next QueryFollowed. Used when the
+    user's Followed records change without a notification being created for the user.
+    """
+    inbox = Inbox(user_id)
+    yield gen.Task(inbox.Delete, client)
+
+  @classmethod
+  @gen.coroutine
+  def ApplyNotification(cls, client, user_id, notification_id, viewpoint, follower):
+    """Brings the user's inbox up-to-date with notification "notification_id", which reports a
+    change to "viewpoint" or to the user's "follower" record. Does nothing if the inbox was not
+    current as of the previous notification.
+    """
+    inbox = yield gen.Task(Inbox.Query, client, user_id, None, must_exist=False)
+    if inbox is None or inbox.version != Inbox.VERSION or inbox.notification_id != notification_id - 1:
+      return
+
+    sort_key = Followed.CreateSortKey(viewpoint.viewpoint_id, viewpoint.last_updated)
+    if not inbox._ApplyViewpoint(sort_key, viewpoint.MakeMetadataDict(follower)):
+      return
+
+    prev_notification_id = inbox.notification_id
+    inbox.notification_id = notification_id
+    try:
+      yield gen.Task(inbox.Update, client, expected={'notification_id': prev_notification_id})
+    except Exception as e:
+      # Inbox was rebuilt or maintained concurrently, so leave it to be rebuilt if it is now stale.
+      logging.info('inbox of user %d was modified concurrently: %s' % (user_id, e))
+
+  def _ApplyViewpoint(self, sort_key, metadata_dict):
+    """Replaces the entry of the viewpoint in "metadata_dict", moving it to "sort_key". Returns
+    False if the viewpoint moved out of the page, in which case the page can no longer be
+    maintained, since the viewpoint that takes its place is unknown.
+    """
+    viewpoint_id = metadata_dict['viewpoint_id']
+    entries = [entry for entry in self.page['entries'] if entry[1]['viewpoint_id'] != viewpoint_id]
+    was_present = len(entries) < len(self.page['entries'])
+    complete = self.page['complete']
+
+    # A viewpoint that sorts after the last entry of an incomplete page is not in the page.
+    if not complete and entries and sort_key > entries[-1][0]:
+      if was_present:
+        return False
+    else:
+      keys = [entry[0] for entry in entries]
+      entries.insert(bisect.bisect_left(keys, sort_key), [sort_key, metadata_dict])
+
+      # Inserting into a full page pushes out its last entry.
+      if self.page_limit is not None and len(entries) > self.page_limit:
+        entries.pop()
+        complete = False
+
+    return self._SetPage(entries, complete)
+
+  def _SetPage(self, entries, complete):
+    """Sets the page to "entries". Returns False, leaving the page unchanged, if the page would
+    have more than _MAX_ENTRIES entries or would serialize to more than _MAX_PAGE_SIZE bytes.
+    """
+    page = {'entries': entries, 'complete': complete}
+    if len(entries) > Inbox._MAX_ENTRIES or len(util.ToCanonicalJSON(page)) > Inbox._MAX_PAGE_SIZE:
+      return False
+
+    self.page = page
+    return True
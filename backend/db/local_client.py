@@ -4,41 +4,60 @@
 
 Implements the DBClient interface identically (or as near as possible)
 to the behavior expected from DynamoDB but using in-memory python data
-structures for storage.
+structures for storage. Each table is kept in a storage engine object,
+chosen with --localdb_engine (see local_storage.py). Provisioned
+throughput and response latency can be simulated with --localdb_throttle
+and --localdb_latency_ms (see local_throughput.py).
 """
 
 __author__ = ['spencer@emailscrubbed.com (Spencer Kimball)',
               'andy@emailscrubbed.com (Andy Kimball)']
 
 from functools import partial
-from bisect import bisect_left, bisect_right
 import copy
 import time
 
+from tornado import options
 from tornado.ioloop import IOLoop
 from viewfinder.backend.base.exceptions import DBConditionalCheckFailedError
 from db_client import DBClient, DBKey, ListTablesResult, CreateTableResult, DescribeTableResult, DeleteTableResult, GetResult, PutResult, DeleteResult, UpdateResult, QueryResult, ScanResult, BatchGetResult, TableSchema, UpdateAttr
 
-from viewfinder.backend.db import local_persist
+from viewfinder.backend.db import local_persist, local_storage
+from viewfinder.backend.db.local_throughput import ThroughputSimulator
 
 class LocalClient(DBClient):
   """Local client for testing.
 
-  - Datastore: dictionary of name => (HashTable, RangeTable)
-    - HashTable: dictionary of hash_key => Item
-      - Item: dictionary of attribute => value
-    - RangeTable: dictionary of hash_key => dictionary of range_key => Item
-      - Item: dictionary of attribute => value
+  - Datastore: dictionary of name => table storage engine object, which
+    holds the table's items keyed by hash key (and range key)
+    - Item: dictionary of attribute => value
+
+  "engine" names the storage engine of new tables, and defaults to
+  --localdb_engine. "simulator" is a ThroughputSimulator that throttles
+  requests and delays responses, and defaults to the one configured by
+  the --localdb_* options, if any.
   """
   _MUTATING_RESULTS = [CreateTableResult, DeleteTableResult, PutResult, DeleteResult, UpdateResult]
 
-  def __init__(self, schema, read_only=False):
+  def __init__(self, schema, read_only=False, engine=None, simulator=None):
     self._schema = schema
     self._read_only = read_only
+    self._table_cls = local_storage.ENGINES[engine or options.options.localdb_engine]
+    self._simulator = simulator or ThroughputSimulator.FromOptions()
     self._tables = {}
     self._table_schemas = {}
     self._persist = local_persist.DBPersist(self._tables, self._table_schemas)
 
+    # Tables loaded by the persistence layer may have been stored by an earlier version, as
+    # nested dictionaries, or by a different engine.
+    for table, data in self._tables.items():
+      if isinstance(data, dict):
+        data = local_storage.DictTable(self._table_schemas[table], data)
+      if not isinstance(data, self._table_cls):
+        self._tables[table] = self._table_cls(self._table_schemas[table])
+        for hash_key, range_key, item in data.IterScan(None):
+          self._tables[table].Put(hash_key, range_key, item)
+
   def Shutdown(self):
     """Shutdown persistence on process exit."""
     self._persist.Shutdown()
@@ -54,10 +73,10 @@ class LocalClient(DBClient):
     assert not self._read_only, 'Received "CreateTable" request on read-only database'
 
     assert table not in self._tables, 'table %s already exists' % table
-    self._tables[table] = dict()
     schema = TableSchema(create_time=time.time(), hash_key_schema=hash_key_schema,
                          range_key_schema=range_key_schema, read_units=read_units,
                          write_units=write_units, status='CREATING')
+    self._tables[table] = self._table_cls(schema)
     self._table_schemas[table] = self._NewSchemaStatus(schema, 'ACTIVE')
     result = CreateTableResult(schema=schema)
     return self._HandleCallback(callback, result)
@@ -75,30 +94,29 @@ class LocalClient(DBClient):
   def DescribeTable(self, table, callback):
     assert table in self._tables, 'table %s does not exist' % table
     result = DescribeTableResult(schema=self._table_schemas[table],
-                                 count=self._GetTableSize(table), size_bytes=None)
+                                 count=self._tables[table].ItemCount(),
+                                 size_bytes=self._tables[table].SizeBytes())
     return self._HandleCallback(callback, result)
 
   def GetItem(self, table, key, callback, attributes, must_exist=True,
               consistent_read=False):
     self._CheckKey(table, key, True if must_exist else None, None)
-    if key.hash_key not in self._tables[table]:
-      return self._HandleCallback(callback, None)
-    item = self._tables[table][key.hash_key]
-    if key.range_key is not None:
-      if key.range_key not in item:
-        return self._HandleCallback(callback, None)
-      item = item[key.range_key]
-    result = GetResult(attributes=self._GetAttributes(item, attributes), read_units=1)
-    return self._HandleCallback(callback, result)
+    self._AdmitRequest(table, False)
+    self._ConsumeUnits(table, False, 1 if consistent_read else 0.5)
+    return self._HandleCallback(callback, self._LookupItem(table, key, attributes))
 
   def BatchGetItem(self, batch_dict, callback, must_exist=True):
     assert len(batch_dict) == 1, 'BatchGetItem currently supports only a single table'
     table_name, (keys, attributes, consistent_read) = next(batch_dict.iteritems())
 
+    for key in keys:
+      self._CheckKey(table_name, key, True if must_exist else None, None)
+    self._AdmitRequest(table_name, False)
+    self._ConsumeUnits(table_name, False, len(keys) * (1 if consistent_read else 0.5))
+
     result_items = []
     for key in keys:
-      result = self.GetItem(table_name, key, None, attributes,
-                            must_exist=must_exist, consistent_read=consistent_read)
+      result = self._LookupItem(table_name, key, attributes)
       result_items.append(result.attributes if result is not None else None)
 
     result = {table_name: BatchGetResult(items=result_items, read_units=len(keys))}
@@ -108,6 +126,7 @@ class LocalClient(DBClient):
     assert not self._read_only, 'Received "PutItem" request on read-only database'
 
     self._CheckKey(table, key, None, expected)
+    self._AdmitWrite(table)
     item = self._GetItem(table, key)
     # Make sure to add the keys as attributes.
     schema = self._table_schemas[table]
@@ -115,6 +134,7 @@ class LocalClient(DBClient):
     if key.range_key is not None:
       attributes[schema.range_key_schema.name] = key.range_key
     return_attrs = self._UpdateItem(item, attributes, expected, return_values)
+    self._tables[table].Put(key.hash_key, key.range_key, item)
     result = PutResult(return_values=return_attrs, write_units=1)
     return self._HandleCallback(callback, result)
 
@@ -123,15 +143,17 @@ class LocalClient(DBClient):
     assert not self._read_only, 'Received "DeleteItem" request on read-only database'
 
     self._CheckKey(table, key, None, expected)
+    self._AdmitWrite(table)
     item = self._GetItem(table, key)
     return_attrs = self._UpdateItem(item, None, expected, return_values)
-    self._GetItem(table, key, delete=True)
+    self._tables[table].Delete(key.hash_key, key.range_key)
     result = DeleteResult(return_values=return_attrs, write_units=1)
     return self._HandleCallback(callback, result)
 
   def UpdateItem(self, table, key, callback, attributes, expected=None, return_values=None):
     self._CheckKey(table, key, None, expected)
     assert not self._read_only, 'Received "UpdateItem" request on read-only database'
+    self._AdmitWrite(table)
 
     if len(attributes) == 0:
       # If an UpdateItem request has a valid key but no additional attributes, DynamoDB returns
@@ -146,6 +168,7 @@ class LocalClient(DBClient):
     if key.range_key is not None:
       attributes[schema.range_key_schema.name] = key.range_key
     return_attrs = self._UpdateItem(item, attributes, expected, return_values)
+    self._tables[table].Put(key.hash_key, key.range_key, item)
     result = UpdateResult(return_values=return_attrs, write_units=1)
     return self._HandleCallback(callback, result)
 
@@ -155,86 +178,84 @@ class LocalClient(DBClient):
     schema = self._table_schemas[table]
     assert schema.range_key_schema, 'schema has no range key'
     self._CheckKeyType(table, schema.hash_key_schema, 'hash key', hash_key)
-    range_dict = self._tables[table].get(hash_key, {})
-    keys = sorted(range_dict.keys())
+    self._AdmitRequest(table, False)
+    min_units = 1 if consistent_read else 0.5
+    store = self._tables[table]
     if count:
       assert not attributes, 'cannot specify attributes and count=True'
+      num_keys = store.CountRange(hash_key)
       # TODO(spencer): determine what the read-units ought to be here.
-      result = QueryResult(count=len(keys), items=[], last_key=None,
-                           read_units=(len(keys) + 1023) / 1024)
+      result = QueryResult(count=num_keys, items=[], last_key=None,
+                           read_units=(num_keys + 1023) / 1024)
+      self._ConsumeUnits(table, False, max(result.read_units, min_units))
       return self._HandleCallback(callback, result)
 
-    # Handle range operator.
+    # Handle range operator. Each bound is either None or a (key, inclusive) tuple.
+    lower = upper = None
     if range_operator:
       key = range_operator.key[0]
       if range_operator.op == 'EQ':
-        i = bisect_left(keys, key)
-        keys = keys[i:i + 1] if i != len(keys) and keys[i] == key else []
+        lower = upper = (key, True)
       elif range_operator.op == 'LT':
-        i = bisect_left(keys, key)
-        keys = keys[0:i] if i else []
+        upper = (key, False)
       elif range_operator.op == 'LE':
-        i = bisect_right(keys, key)
-        keys = keys[0:i] if i else []
+        upper = (key, True)
       elif range_operator.op == 'GT':
-        i = bisect_right(keys, key)
-        keys = keys[i:] if i != len(keys) else []
+        lower = (key, False)
       elif range_operator.op == 'GE':
-        i = bisect_left(keys, key)
-        keys = keys[i:] if i != len(keys) else []
+        lower = (key, True)
       elif range_operator.op == 'BEGINS_WITH':
-        keys = [v for v in keys if v.startswith(key)]
+        lower = (key, True)
+        prefix_bound = local_storage.PrefixUpperBound(key)
+        upper = (prefix_bound, False) if prefix_bound is not None else None
       elif range_operator.op == 'BETWEEN':
-        s = bisect_left(keys, key)
-        e = bisect_right(keys, range_operator.key[1])
-        if s < len(keys) and e > 0:
-          keys = keys[s:e]
-        else:
-          keys = []
+        lower = (key, True)
+        upper = (range_operator.key[1], True)
 
     # Skip everything before (or after) excl_start_key if given.
     if excl_start_key is not None:
       assert excl_start_key.range_key != '', 'empty start key not supported (same as DynamoDB)'
       self._CheckKeyType(table, schema.range_key_schema, 'start key', excl_start_key.range_key)
       if scan_forward:
-        i = bisect_right(keys, excl_start_key.range_key)
-        keys = keys[i:] if i != len(keys) else []
-      else:
-        i = bisect_left(keys, excl_start_key.range_key)
-        keys = keys[0:i] if i else []
-    # Reverse keys if scanning backwards.
-    if not scan_forward:
-      keys.reverse()
+        if lower is None or excl_start_key.range_key >= lower[0]:
+          lower = (excl_start_key.range_key, False)
+      elif upper is None or excl_start_key.range_key <= upper[0]:
+        upper = (excl_start_key.range_key, False)
+
     # Limit size of results.
-    if limit is not None and limit < len(keys):
-      keys = keys[0:limit]
-      last_key = DBKey(hash_key=hash_key, range_key=keys[-1]) if len(keys) > 0 else None
-    else:
-      last_key = None
+    range_items = []
+    last_key = None
+    for k, range_item in store.IterRange(hash_key, lower, upper, scan_forward):
+      if limit is not None and len(range_items) == limit:
+        last_key = DBKey(hash_key=hash_key, range_key=range_items[-1][0]) if range_items else None
+        break
+      range_items.append((k, range_item))
 
     bytes_read = 0
     items = []
-    for k in keys:
-      item = self._GetAttributes(range_dict[k], attributes)
+    for k, range_item in range_items:
+      item = self._GetAttributes(range_item, attributes)
       if item:
         items.append(item)
         bytes_read += len(k) if isinstance(k, (str, unicode)) else 8
         bytes_read += sum([len(a) + (len(d) if isinstance(d, (str, unicode)) else 8) for a, d in item.items()])
 
     read_units = (bytes_read / (1 if consistent_read else 2) + 1023) / 1024
-    result = QueryResult(count=len(keys), items=items, last_key=last_key, read_units=read_units)
+    result = QueryResult(count=len(range_items), items=items, last_key=last_key, read_units=read_units)
+    self._ConsumeUnits(table, False, max(read_units, min_units))
     return self._HandleCallback(callback, result)
 
   def Scan(self, table, callback, attributes, limit=None, excl_start_key=None, scan_filter=None):
-    """Moves sequentially through entire table until 'excl_start_key'
-    is located. Then iterates, passing each item through the
-    conditions of 'scan_filter', accumulating up to 'limit' results.
+    """Iterates through the table from 'excl_start_key', passing each
+    item through the conditions of 'scan_filter', accumulating up to
+    'limit' results. The storage engine determines the order of items,
+    and how quickly 'excl_start_key' is located.
     """
     assert limit is None or limit > 0, limit
+    self._AdmitRequest(table, False)
     items = []
     last_key = None
     bytes_read = 0
-    found = False
 
     def _FilterItem(item):
       """Returns whether the item passes the conditions of
@@ -268,44 +289,26 @@ class LocalClient(DBClient):
               return False
       return True
 
-    for hash_key, value in self._tables[table].items():
-      # Iterate until we find last processed exclusive start key hash value.
-      # These aren't in sorted order, so we just iterate until we find start
-      # hash key before starting the scan.
-      if not found and excl_start_key and excl_start_key.hash_key != hash_key:
-        continue
-      else:
-        found = True
-      # Handle composite-key scan.
-      if self._table_schemas[table].range_key_schema:
-        keys = sorted(value.keys())
-        if excl_start_key and excl_start_key.hash_key == hash_key:
-          assert excl_start_key.range_key != '', 'empty start key not supported (same as DynamoDB)'
-          i = bisect_right(keys, excl_start_key.range_key)
-          keys = keys[i:] if i != len(keys) else []
-        for key in keys:
-          bytes_read += sum([len(a) + (len(d) if isinstance(d, (str, unicode)) else 8) for a, d in value[key].items()])
-          if _FilterItem(value[key]):
-            item = self._GetAttributes(value[key], attributes)
-            if item:
-              items.append(item)
-          if len(items) == limit:
-            last_key = DBKey(hash_key=hash_key, range_key=key)
-            break
-      else:
-        if not excl_start_key or excl_start_key.hash_key != hash_key:
-          bytes_read += sum([len(a) + (len(d) if isinstance(d, (str, unicode)) else 8) for a, d in value.items()])
-          if _FilterItem(value):
-            item = self._GetAttributes(value, attributes)
-            if item:
-              items.append(item)
-          if limit is not None and len(items) == limit:
-            if hash_key != self._tables[table].keys()[-1]:
-              last_key = DBKey(hash_key=hash_key, range_key=None)
-            break
+    if excl_start_key and self._table_schemas[table].range_key_schema:
+      assert excl_start_key.range_key != '', 'empty start key not supported (same as DynamoDB)'
+
+    scan_iter = self._tables[table].IterScan(excl_start_key)
+    for hash_key, range_key, value in scan_iter:
+      bytes_read += sum([len(a) + (len(d) if isinstance(d, (str, unicode)) else 8) for a, d in value.items()])
+      if _FilterItem(value):
+        item = self._GetAttributes(value, attributes)
+        if item:
+          items.append(item)
+      if limit is not None and len(items) == limit:
+        # A scan of a composite-key table always returns the last key; a scan of a hash-key table
+        # returns it only if more items follow.
+        if range_key is not None or next(scan_iter, None) is not None:
+          last_key = DBKey(hash_key=hash_key, range_key=range_key)
+        break
 
     read_units = (bytes_read / 2 + 1023) / 1024
     result = ScanResult(count=len(items), items=items, last_key=last_key, read_units=read_units)
+    self._ConsumeUnits(table, False, max(read_units, 0.5))
     return self._HandleCallback(callback, result)
 
   def AddTimeout(self, deadline_secs, callback):
@@ -332,9 +335,9 @@ class LocalClient(DBClient):
     assert key.hash_key is not None, 'need hash key: %s' % repr(key)
     self._CheckKeyType(table, schema.hash_key_schema, 'hash key', key.hash_key)
     if must_exist == True:
-      assert key.hash_key in self._tables[table], 'key %s does not exist' % key.hash_key
+      assert self._tables[table].ContainsHashKey(key.hash_key), 'key %s does not exist' % key.hash_key
     elif must_exist == False and schema.range_key_schema == None:
-      if key.hash_key in self._tables[table]:
+      if self._tables[table].ContainsHashKey(key.hash_key):
         raise DBConditionalCheckFailedError('key %s already exists' % key.hash_key)
 
     if key.range_key is not None:
@@ -342,10 +345,10 @@ class LocalClient(DBClient):
       self._CheckKeyType(table, schema.range_key_schema, 'range key', key.range_key)
 
       if must_exist == True:
-        assert key.range_key in self._tables[table][key.hash_key], \
+        assert self._tables[table].Get(key.hash_key, key.range_key) is not None, \
             'range key %s does not exist' % key.range_key
-      elif must_exist == False and key.hash_key in self._tables[table]:
-        if key.range_key in self._tables[table][key.hash_key]:
+      elif must_exist == False:
+        if self._tables[table].Get(key.hash_key, key.range_key) is not None:
           raise DBConditionalCheckFailedError('range key %s already exists' % key.range_key)
 
     else:
@@ -373,26 +376,22 @@ class LocalClient(DBClient):
                        write_units=schema.write_units,
                        status=new_status)
 
-  def _GetItem(self, table, key, delete=False):
-    """Fetches the item from the store by table & key. If 'delete',
-    deletes the item.
+  def _LookupItem(self, table, key, attributes):
+    """Returns a GetResult with the named 'attributes' of the item, or
+    None if it does not exist.
     """
-    if key.range_key is not None:
-      if key.hash_key not in self._tables[table]:
-        self._tables[table][key.hash_key] = dict()
-      if key.range_key not in self._tables[table][key.hash_key]:
-        self._tables[table][key.hash_key][key.range_key] = dict()
-      if not delete:
-        return self._tables[table][key.hash_key][key.range_key]
-      else:
-        del self._tables[table][key.hash_key][key.range_key]
-    else:
-      if not delete:
-        if key.hash_key not in self._tables[table]:
-          self._tables[table][key.hash_key] = dict()
-        return self._tables[table][key.hash_key]
-      else:
-        del self._tables[table][key.hash_key]
+    item = self._tables[table].Get(key.hash_key, key.range_key)
+    if item is None:
+      return None
+    return GetResult(attributes=self._GetAttributes(item, attributes), read_units=1)
+
+  def _GetItem(self, table, key):
+    """Fetches the item from the store by table & key, or returns a
+    new, empty item if it does not exist. Changes to the item must be
+    written back with the table's Put method.
+    """
+    item = self._tables[table].Get(key.hash_key, key.range_key)
+    return item if item is not None else dict()
 
   def _GetAttributes(self, item, attributes):
     """Gets the list of named 'attributes' from the item. If an
@@ -474,24 +473,42 @@ class LocalClient(DBClient):
 
     return return_attrs
 
+  def _AdmitRequest(self, table, is_write):
+    """If throughput is simulated, raises DBProvisioningExceededError
+    if 'table' has no read (or if 'is_write', write) capacity left.
+    """
+    if self._simulator is not None:
+      self._simulator.Admit(table, self._GetProvisionedUnits(table, is_write), is_write)
+
+  def _AdmitWrite(self, table):
+    """Admits a write, which consumes one unit whether or not it
+    succeeds.
+    """
+    self._AdmitRequest(table, True)
+    self._ConsumeUnits(table, True, 1)
+
+  def _ConsumeUnits(self, table, is_write, units):
+    """If throughput is simulated, takes 'units' from the read (or if
+    'is_write', write) capacity of 'table'.
+    """
+    if self._simulator is not None:
+      self._simulator.Consume(table, self._GetProvisionedUnits(table, is_write), is_write, units)
+
+  def _GetProvisionedUnits(self, table, is_write):
+    schema = self._table_schemas[table]
+    return schema.write_units if is_write else schema.read_units
+
   def _HandleCallback(self, callback, result):
     """If callback is not None, runs asynchronously; otherwise, runs
-    synchronously.
+    synchronously. If latency is simulated, the callback is delayed.
     """
     if any(isinstance(result, rt) for rt in LocalClient._MUTATING_RESULTS):
       self._persist.MarkDirty()
     if callback:
-      IOLoop.current().add_callback(partial(callback, result))
+      latency = self._simulator.GetLatency() if self._simulator is not None else 0
+      if latency > 0:
+        IOLoop.current().add_timeout(time.time() + latency, partial(callback, result))
+      else:
+        IOLoop.current().add_callback(partial(callback, result))
     else:
       return result
-
-  def _GetTableSize(self, table):
-    """Computes the number of elements in the table. If the table
-    schema has a composite key, iterates over each hash key to compute
-    the full length.
-    """
-    schema = self._table_schemas[table]
-    if schema.range_key_schema:
-      return sum([len(rd) for rd in self._tables[table].values()])
-    else:
-      return len(self._tables[table])
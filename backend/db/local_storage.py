@@ -0,0 +1,402 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Storage engines for the local datastore emulation.
+
+LocalClient (see local_client.py) keeps each table in a storage engine
+object, chosen with --localdb_engine:
+
+  - "dict": each table is a dictionary of hash_key => item, or of
+    hash_key => dictionary of range_key => item. Items are stored as
+    python dictionaries. Queries sort the range keys of the hash key on
+    each call, and scans iterate hash keys in dictionary order, so a
+    scan must walk the table from the beginning to find its
+    "excl_start_key". This is the original engine, and remains the
+    default.
+
+  - "sorted": keys are kept in sorted pages of at most _MAX_PAGE_SIZE
+    keys, in the manner of the leaves of a B-tree. Lookups, inserts,
+    deletes and the start of each query or scan page take O(log n).
+    Items are encoded with marshal, with the key attributes removed,
+    which takes a fraction of the memory of a dictionary per item. The
+    engine keeps an exact count of items and of stored bytes, which
+    LocalClient returns from DescribeTable. Suited to using LocalClient
+    as a stand-in for DynamoDB in load tests with millions of items.
+
+Both engines implement the same interface. Bounds passed to IterRange are
+either None or a (key, inclusive) tuple. Items returned by the "dict"
+engine are the stored dictionaries themselves, whereas the "sorted" engine
+returns a new dictionary on each call, so callers must always write back
+a modified item with Put. A table must not be modified while a query or
+scan iterator is in use.
+
+  DictTable: table stored as nested python dictionaries.
+  SortedTable: table stored as sorted pages of encoded items.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import marshal
+import sys
+
+from bisect import bisect_left, bisect_right
+
+
+class DictTable(object):
+  """Table stored as nested python dictionaries."""
+  def __init__(self, schema, data=None):
+    self._has_range = schema.range_key_schema is not None
+    self._data = data if data is not None else {}
+
+  def Get(self, hash_key, range_key):
+    """Returns the item with the given key, or None if it does not exist."""
+    if self._has_range:
+      return self._data.get(hash_key, {}).get(range_key)
+    return self._data.get(hash_key)
+
+  def Put(self, hash_key, range_key, item):
+    """Stores "item" under the given key, replacing any existing item."""
+    if self._has_range:
+      self._data.setdefault(hash_key, {})[range_key] = item
+    else:
+      self._data[hash_key] = item
+
+  def Delete(self, hash_key, range_key):
+    """Deletes the item with the given key, if it exists."""
+    if self._has_range:
+      self._data.get(hash_key, {}).pop(range_key, None)
+    else:
+      self._data.pop(hash_key, None)
+
+  def ContainsHashKey(self, hash_key):
+    return hash_key in self._data
+
+  def CountRange(self, hash_key):
+    """Returns the number of items with the given hash key."""
+    return len(self._data.get(hash_key, {}))
+
+  def IterRange(self, hash_key, lower, upper, forward):
+    """Yields (range_key, item) for each item with the given hash key and a range key between
+    "lower" and "upper", in ascending order if "forward" is true, else in descending order.
+    """
+    range_dict = self._data.get(hash_key, {})
+    keys = sorted(range_dict.keys())
+    start = 0 if lower is None else (bisect_left if lower[1] else bisect_right)(keys, lower[0])
+    end = len(keys) if upper is None else (bisect_right if upper[1] else bisect_left)(keys, upper[0])
+    keys = keys[start:end]
+    if not forward:
+      keys.reverse()
+    for key in keys:
+      yield key, range_dict[key]
+
+  def IterScan(self, excl_start_key):
+    """Yields (hash_key, range_key, item) for each item in the table that follows
+    "excl_start_key". Iterates over hash keys in dictionary order, so must skip every hash
+    key before that of "excl_start_key".
+    """
+    found = excl_start_key is None
+    for hash_key, value in self._data.items():
+      if not found:
+        if excl_start_key.hash_key != hash_key:
+          continue
+        found = True
+        if not self._has_range:
+          continue
+        keys = sorted(value.keys())
+        keys = keys[bisect_right(keys, excl_start_key.range_key):]
+      elif self._has_range:
+        keys = sorted(value.keys())
+
+      if self._has_range:
+        for key in keys:
+          yield hash_key, key, value[key]
+      else:
+        yield hash_key, None, value
+
+  def ItemCount(self):
+    if self._has_range:
+      return sum([len(rd) for rd in self._data.values()])
+    return len(self._data)
+
+  def SizeBytes(self):
+    """Not tracked by this engine."""
+    return None
+
+
+class SortedTable(object):
+  """Table stored as sorted pages of items encoded with marshal. Tables with a range key map
+  each hash key to a sorted map of its range keys.
+  """
+  def __init__(self, schema):
+    self._has_range = schema.range_key_schema is not None
+    self._hash_key_name = schema.hash_key_schema.name
+    self._range_key_name = schema.range_key_schema.name if self._has_range else None
+    self._items = _SortedMap()
+    self._count = 0
+    self._size_bytes = 0
+
+  def Get(self, hash_key, range_key):
+    """Returns a new dictionary holding the item with the given key, or None if it does not
+    exist.
+    """
+    if self._has_range:
+      range_map = self._items.Get(hash_key)
+      data = range_map.Get(range_key) if range_map is not None else None
+    else:
+      data = self._items.Get(hash_key)
+    return self._Decode(hash_key, range_key, data) if data is not None else None
+
+  def Put(self, hash_key, range_key, item):
+    """Encodes and stores "item" under the given key, replacing any existing item."""
+    data = self._Encode(item)
+    if self._has_range:
+      range_map = self._items.Get(hash_key)
+      if range_map is None:
+        range_map = _SortedMap()
+        self._items.Set(hash_key, range_map)
+      old_data = range_map.Set(range_key, data)
+    else:
+      old_data = self._items.Set(hash_key, data)
+    self._Account(hash_key, range_key, old_data, -1)
+    self._Account(hash_key, range_key, data, 1)
+
+  def Delete(self, hash_key, range_key):
+    """Deletes the item with the given key, if it exists."""
+    if self._has_range:
+      range_map = self._items.Get(hash_key)
+      if range_map is None:
+        return
+      old_data = range_map.Pop(range_key)
+      if not range_map:
+        self._items.Pop(hash_key)
+    else:
+      old_data = self._items.Pop(hash_key)
+    self._Account(hash_key, range_key, old_data, -1)
+
+  def ContainsHashKey(self, hash_key):
+    return self._items.Get(hash_key) is not None
+
+  def CountRange(self, hash_key):
+    """Returns the number of items with the given hash key."""
+    range_map = self._items.Get(hash_key)
+    return len(range_map) if range_map is not None else 0
+
+  def IterRange(self, hash_key, lower, upper, forward):
+    """Yields (range_key, item) for each item with the given hash key and a range key between
+    "lower" and "upper", in ascending order if "forward" is true, else in descending order.
+    """
+    range_map = self._items.Get(hash_key)
+    if range_map is not None:
+      for range_key, data in range_map.Iter(lower, upper, forward):
+        yield range_key, self._Decode(hash_key, range_key, data)
+
+  def IterScan(self, excl_start_key):
+    """Yields (hash_key, range_key, item) for each item in the table that follows
+    "excl_start_key", in key order.
+    """
+    lower = None
+    if excl_start_key is not None:
+      lower = (excl_start_key.hash_key, False)
+      if self._has_range:
+        # Finish the hash key on which the previous scan page stopped.
+        for range_key, item in self.IterRange(excl_start_key.hash_key, (excl_start_key.range_key, False), None, True):
+          yield excl_start_key.hash_key, range_key, item
+
+    for hash_key, value in self._items.Iter(lower, None, True):
+      if self._has_range:
+        for range_key, data in value.Iter(None, None, True):
+          yield hash_key, range_key, self._Decode(hash_key, range_key, data)
+      else:
+        yield hash_key, None, self._Decode(hash_key, None, value)
+
+  def ItemCount(self):
+    return self._count
+
+  def SizeBytes(self):
+    """Returns the number of bytes taken by the keys and encoded items of the table."""
+    return self._size_bytes
+
+  def _Encode(self, item):
+    """Encodes "item" without its key attributes, which are restored from the key by _Decode."""
+    attrs = dict(item)
+    attrs.pop(self._hash_key_name, None)
+    if self._has_range:
+      attrs.pop(self._range_key_name, None)
+    return marshal.dumps(attrs, 2)
+
+  def _Decode(self, hash_key, range_key, data):
+    item = marshal.loads(data)
+    item[self._hash_key_name] = hash_key
+    if self._has_range:
+      item[self._range_key_name] = range_key
+    return item
+
+  def _Account(self, hash_key, range_key, data, sign):
+    """Adds (or if "sign" is -1, subtracts) the item encoded as "data" to the count and size
+    of the table.
+    """
+    if data is not None:
+      self._count += sign
+      self._size_bytes += sign * (len(data) + _KeySize(hash_key) + (_KeySize(range_key) if self._has_range else 0))
+
+
+def _KeySize(key):
+  """Returns the number of bytes taken by a key: the UTF-8 length of a string, or 8 bytes for
+  a number.
+  """
+  if isinstance(key, unicode):
+    return len(key.encode('utf-8'))
+  elif isinstance(key, str):
+    return len(key)
+  return 8
+
+
+def PrefixUpperBound(prefix):
+  """Returns the smallest string that is greater than every string that begins with "prefix",
+  or None if there is no such string.
+  """
+  max_ord = sys.maxunicode if isinstance(prefix, unicode) else 0xff
+  to_char = unichr if isinstance(prefix, unicode) else chr
+  while prefix:
+    last_ord = ord(prefix[-1])
+    if last_ord < max_ord:
+      return prefix[:-1] + to_char(last_ord + 1)
+    prefix = prefix[:-1]
+  return None
+
+
+class _SortedMap(object):
+  """Map whose keys are kept in sorted order, in pages of at most _MAX_PAGE_SIZE keys. The
+  first key of each page is kept in "_fences", which is searched to find the page that holds
+  a key. Inserting into a page shifts at most _MAX_PAGE_SIZE entries, and a full page is split
+  in two.
+  """
+  __slots__ = ['_fences', '_keys', '_values', '_len']
+
+  _MAX_PAGE_SIZE = 512
+
+  def __init__(self):
+    self._fences = []
+    self._keys = []
+    self._values = []
+    self._len = 0
+
+  def __len__(self):
+    return self._len
+
+  def Get(self, key):
+    """Returns the value of "key", or None if it is not in the map."""
+    if not self._fences:
+      return None
+    page = self._FindPage(key)
+    keys = self._keys[page]
+    i = bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+      return self._values[page][i]
+    return None
+
+  def Set(self, key, value):
+    """Sets the value of "key", returning its previous value, or None if it was not in the map."""
+    if not self._fences:
+      self._fences.append(key)
+      self._keys.append([key])
+      self._values.append([value])
+      self._len += 1
+      return None
+
+    page = self._FindPage(key)
+    keys = self._keys[page]
+    values = self._values[page]
+    i = bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+      old_value = values[i]
+      values[i] = value
+      return old_value
+
+    keys.insert(i, key)
+    values.insert(i, value)
+    self._len += 1
+    if i == 0:
+      self._fences[page] = key
+
+    if len(keys) > _SortedMap._MAX_PAGE_SIZE:
+      half = len(keys) // 2
+      self._keys.insert(page + 1, keys[half:])
+      self._values.insert(page + 1, values[half:])
+      self._fences.insert(page + 1, keys[half])
+      del keys[half:]
+      del values[half:]
+    return None
+
+  def Pop(self, key):
+    """Removes "key", returning its value, or None if it was not in the map."""
+    if not self._fences:
+      return None
+    page = self._FindPage(key)
+    keys = self._keys[page]
+    i = bisect_left(keys, key)
+    if i == len(keys) or keys[i] != key:
+      return None
+
+    value = self._values[page].pop(i)
+    del keys[i]
+    self._len -= 1
+    if not keys:
+      del self._fences[page]
+      del self._keys[page]
+      del self._values[page]
+    elif i == 0:
+      self._fences[page] = keys[0]
+    return value
+
+  def Iter(self, lower, upper, forward):
+    """Yields (key, value) for each key between "lower" and "upper", each of which is either
+    None or a (key, inclusive) tuple. Keys are in ascending order if "forward" is true, else in
+    descending order.
+    """
+    if not self._fences:
+      return
+
+    if forward:
+      if lower is None:
+        page, i = 0, 0
+      else:
+        page = self._FindPage(lower[0])
+        i = (bisect_left if lower[1] else bisect_right)(self._keys[page], lower[0])
+      while page < len(self._keys):
+        keys = self._keys[page]
+        values = self._values[page]
+        while i < len(keys):
+          key = keys[i]
+          if upper is not None and (key > upper[0] or (key == upper[0] and not upper[1])):
+            return
+          yield key, values[i]
+          i += 1
+        page += 1
+        i = 0
+    else:
+      if upper is None:
+        page = len(self._keys) - 1
+        i = len(self._keys[page]) - 1
+      else:
+        page = self._FindPage(upper[0])
+        i = (bisect_right if upper[1] else bisect_left)(self._keys[page], upper[0]) - 1
+      while page >= 0:
+        keys = self._keys[page]
+        values = self._values[page]
+        while i >= 0:
+          key = keys[i]
+          if lower is not None and (key < lower[0] or (key == lower[0] and not lower[1])):
+            return
+          yield key, values[i]
+          i -= 1
+        page -= 1
+        if page >= 0:
+          i = len(self._keys[page]) - 1
+
+  def _FindPage(self, key):
+    """Returns the index of the page that holds "key", if the key is in the map."""
+    return max(bisect_right(self._fences, key) - 1, 0)
+
+
+ENGINES = {'dict': DictTable, 'sorted': SortedTable}
+"""Maps each --localdb_engine name to its table class."""
@@ -0,0 +1,116 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Provisioned throughput simulation for the local datastore.
+
+DynamoDB limits the rate at which each table can be read and written to
+its provisioned read and write capacity units per second. Unused capacity
+is saved up, for at most 300 seconds, and can be spent in bursts. A
+request that arrives when a table has no capacity left fails with a
+ProvisionedThroughputExceededException, which asyncdynamo turns into a
+DBProvisioningExceededError. Once admitted, a request consumes capacity
+according to the size of the items it reads or writes, even if that takes
+the table's balance below zero.
+
+The ThroughputSimulator gives LocalClient the same behavior, using the
+read_units and write_units of each table in the schema. It also injects
+latency into each response, drawn from a fixed, exponential or log-normal
+distribution, or from any function passed in. Both the clock and the
+random number generator can be supplied, so that load tests of capacity
+settings and of the code that handles throttling can be run locally and
+deterministically.
+
+Enabled with --localdb_throttle and --localdb_latency_ms.
+
+  ThroughputSimulator: per-table provisioned throughput and response latency.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import math
+import random
+import time
+
+from tornado import options
+from viewfinder.backend.base import counters
+from viewfinder.backend.base.exceptions import DBProvisioningExceededError
+from viewfinder.backend.base.rate_limiter import TokenBucket
+
+_throttles = counters.define_rate('viewfinder.localdb.throttles_per_min',
+                                  'Local datastore requests rejected for exceeding provisioned throughput per minute.',
+                                  60)
+
+
+class ThroughputSimulator(object):
+  """Enforces the provisioned throughput of each table, and computes the latency of each
+  response. "latency_func" returns the latency of a response in seconds; if None, there is no
+  added latency. If "throttle" is false, only latency is simulated.
+  """
+  THROTTLE_MESSAGE = ('The level of configured provisioned throughput for the table was exceeded. '
+                      'Consider increasing your provisioning level with the UpdateTable API')
+  """Message of the error returned by DynamoDB when a request is throttled."""
+
+  _LOGNORMAL_SIGMA = 0.5
+  """Shape of the log-normal latency distribution; larger values give a longer tail."""
+
+  def __init__(self, throttle=True, burst_secs=300.0, latency_func=None, clock=time.time):
+    self._throttle = throttle
+    self._burst_secs = burst_secs
+    self._latency_func = latency_func
+    self._clock = clock
+    # Maps (table name, is_write) => TokenBucket of capacity units.
+    self._buckets = {}
+
+  @staticmethod
+  def FromOptions():
+    """Returns a simulator configured by the --localdb_* options, or None if neither throttling
+    nor latency is enabled.
+    """
+    latency_func = ThroughputSimulator.MakeLatencyFunc(options.options.localdb_latency_ms / 1000.0,
+                                                       options.options.localdb_latency_dist)
+    if not options.options.localdb_throttle and latency_func is None:
+      return None
+    return ThroughputSimulator(throttle=options.options.localdb_throttle,
+                               burst_secs=options.options.localdb_burst_secs,
+                               latency_func=latency_func)
+
+  @staticmethod
+  def MakeLatencyFunc(median_secs, dist, rand=None):
+    """Returns a function that draws latencies with median "median_secs" from the distribution
+    named by "dist", using "rand" (or a generator with a fixed seed), or None if "median_secs"
+    is zero.
+    """
+    if median_secs <= 0:
+      return None
+
+    rand = rand or random.Random(0)
+    if dist == 'fixed':
+      return lambda: median_secs
+    elif dist == 'exponential':
+      return lambda: rand.expovariate(math.log(2) / median_secs)
+    elif dist == 'lognormal':
+      return lambda: rand.lognormvariate(math.log(median_secs), ThroughputSimulator._LOGNORMAL_SIGMA)
+    assert False, 'unknown latency distribution "%s"' % dist
+
+  def Admit(self, table, units_per_sec, is_write):
+    """Raises DBProvisioningExceededError if "table" has no read (or if "is_write", write)
+    capacity left. "units_per_sec" is the table's provisioned throughput.
+    """
+    if self._throttle and self._GetBucket(table, units_per_sec, is_write).Reserve(0.0) > 0:
+      _throttles.increment()
+      raise DBProvisioningExceededError(ThroughputSimulator.THROTTLE_MESSAGE)
+
+  def Consume(self, table, units_per_sec, is_write, units):
+    """Takes the "units" consumed by an admitted request from the table's capacity."""
+    if self._throttle:
+      self._GetBucket(table, units_per_sec, is_write).Reserve(units)
+
+  def GetLatency(self):
+    """Returns the number of seconds by which to delay the next response."""
+    return self._latency_func() if self._latency_func is not None else 0.0
+
+  def _GetBucket(self, table, units_per_sec, is_write):
+    bucket = self._buckets.get((table, is_write))
+    if bucket is None:
+      bucket = TokenBucket(units_per_sec, burst=units_per_sec * self._burst_secs, clock=self._clock)
+      self._buckets[(table, is_write)] = bucket
+    return bucket
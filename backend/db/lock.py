@@ -29,27 +29,42 @@ Note that even though the Lock class can *detect* that a lock has been
 abandoned, it cannot actually *release* those locks, as only code with
 specific knowledge of a particular resource type can do that safely.
 
-TODO(Andy): Add a LockManager class which offers callers a way to
-            register for notifications when locks of a particular
-            resource type have been abandoned. The LockManager would
-            periodically scan the Lock table to find abandoned locks.
+The LockManager keeps track of the locks held by this process:
+
+  - Rather than each lock arming its own timer, all locks with
+    abandonment detection are renewed together by a single periodic
+    sweep every LOCK_RENEWAL_SECS.
+  - A caller that acquires a lock through the LockManager and finds it
+    held by another coroutine in this process can wait for it to be
+    released. The lock is then handed off with a single conditional
+    write that changes its owner, rather than a delete by the releaser
+    followed by a query and create by the acquirer. If any other agent
+    tried to acquire the lock in the meantime, the handoff fails and the
+    lock is released and acquired through the database as usual.
+  - Callers can register a handler for abandoned locks of a particular
+    resource type, which is invoked for each abandoned lock found by
+    ScanAbandoned.
+  - Acquire latency, failures and handoffs are tracked per resource type.
 
   Lock: control concurrent access to resources
+  LockManager: renews, hands off and tracks the locks held by this process
 """
 
 __authors__ = ['spencer@emailscrubbed.com (Spencer Kimball)',
                'andy@emailscrubbed.com (Andy Kimball)']
 
+import bisect
 import logging
 import random
 import sys
 import time
 
-from datetime import timedelta
+from collections import deque
 from functools import partial
-from tornado import gen
+from tornado import gen, stack_context
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
-from viewfinder.backend.base import util
+from viewfinder.backend.base import counters, util
 from viewfinder.backend.base.exceptions import LockFailedError
 from viewfinder.backend.db import vf_schema, db_client
 from viewfinder.backend.db.base import DBObject
@@ -66,7 +81,7 @@ class Lock(DBHashObject):
   attribute and a periodic renewal to detect cases where the owner
   has failed and will not be able to call Release.
   """
-  __slots__ = ['_unique_id', '_is_released', '_timeout', '_renewing']
+  __slots__ = ['_unique_id', '_is_released', '_renewing']
 
   _table = DBObject._schema.GetTable(vf_schema.LOCK)
 
@@ -94,7 +109,6 @@ class Lock(DBHashObject):
     self.lock_id = lock_id
     self._GenerateOwnerId() if owner_id is None else self._SetOwnerId(owner_id)
     self._is_released = False
-    self._timeout = None
     self._renewing = False
 
   @classmethod
@@ -146,7 +160,13 @@ class Lock(DBHashObject):
     process. If the expiration is not continually renewed, then the
     lock will expire and be considered abandoned.
     """
-    Lock._TryAcquire(client, resource_type, resource_id, callback,
+    start = time.time()
+
+    def _OnAcquire(lock, status):
+      LockManager._GetStats(resource_type).Add(time.time() - start, status)
+      callback(lock, status)
+
+    Lock._TryAcquire(client, resource_type, resource_id, _OnAcquire,
                      resource_data=resource_data, detect_abandonment=detect_abandonment,
                      owner_id=owner_id)
 
@@ -331,10 +351,9 @@ class Lock(DBHashObject):
 
   def _StopRenewal(self):
     """Stops renewing this lock's expiration on a periodic basis."""
-    if self._timeout is not None:
-      IOLoop.current().remove_timeout(self._timeout)
-      self._timeout = None
-    self._renewing = False
+    if self._renewing:
+      self._renewing = False
+      LockManager.Instance()._RemoveRenewal(self)
 
   def _IsOwnedBy(self, owner_id):
     """Compares against Lock.owner_id."""
@@ -386,26 +405,313 @@ class Lock(DBHashObject):
   def _Renew(self, client):
     """Continually renews the lock by updating its expiration on a regular
     interval. As long as the expiration is in the future, the lock is not
-    considered to be abandoned.
+    considered to be abandoned. Renewals of all locks held by this process
+    are made together by the LockManager.
     """
-    def _OnException(type, value, tb):
-      """If failure occurs during renewal, just abandon the lock."""
-      logging.error('failure trying to renew lock "%s"', exc_info=(type, value, tb))
+    self._renewing = True
+    LockManager.Instance()._AddRenewal(client, self)
 
-    def _OnRenewalTimeout():
-      self._timeout = None
-      if not self._renewing:
-        return
-      logging.info('renewing lock: %s' % self)
 
-      with util.Barrier(_ScheduleNextRenew, on_exception=_OnException) as b:
-        self.expiration = time.time() + Lock.ABANDONMENT_SECS
-        self.Update(client, b.Callback())
+class _HeldLock(object):
+  """A lock held by a coroutine in this process, along with the coroutines waiting for it."""
+  __slots__ = ['lock', 'waiters']
+
+  def __init__(self, lock):
+    self.lock = lock
+    self.waiters = deque()
+
+
+class _LockWaiter(object):
+  """A coroutine waiting for a lock held in this process. "future" is resolved with the lock
+  if it is handed off, or with None if the waiter should acquire it through the database.
+  """
+  __slots__ = ['owner_id', 'resource_data', 'detect_abandonment', 'future']
+
+  def __init__(self, owner_id, resource_data, detect_abandonment):
+    self.owner_id = owner_id
+    self.resource_data = resource_data
+    self.detect_abandonment = detect_abandonment
+    self.future = Future()
+
+
+class _AcquireStats(object):
+  """Acquire statistics for a single lock resource type. Latencies are kept in a histogram
+  with buckets bounded by _LATENCY_BOUNDS_MS, and also reported to counters.
+  """
+  _LATENCY_BOUNDS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+
+  def __init__(self, resource_type):
+    self.num_acquires = 0
+    self.num_failures = 0
+    self.num_handoffs = 0
+    self.latency_counts = [0] * (len(_AcquireStats._LATENCY_BOUNDS_MS) + 1)
+    prefix = 'viewfinder.lock.%s' % resource_type
+    self._avg_latency = counters.define_average(prefix + '.avg_acquire_secs',
+                                                'Average time in seconds to acquire a "%s" lock.' % resource_type)
+    self._failures = counters.define_rate(prefix + '.acquire_failures_per_min',
+                                          'Failed attempts to acquire a "%s" lock per minute.' % resource_type, 60)
+    self._handoffs = counters.define_rate(prefix + '.handoffs_per_min',
+                                          '"%s" locks handed off within this process per minute.' % resource_type, 60)
+
+  def Add(self, latency, status, handed_off=False):
+    if status == Lock.FAILED_TO_ACQUIRE_LOCK:
+      self.num_failures += 1
+      self._failures.increment()
+    else:
+      self.num_acquires += 1
+    if handed_off:
+      self.num_handoffs += 1
+      self._handoffs.increment()
+
+    self._avg_latency.add(latency)
+    self.latency_counts[bisect.bisect_left(_AcquireStats._LATENCY_BOUNDS_MS, latency * 1000)] += 1
+
+  def AsDict(self):
+    bounds = ['<=%dms' % bound for bound in _AcquireStats._LATENCY_BOUNDS_MS]
+    bounds.append('>%dms' % _AcquireStats._LATENCY_BOUNDS_MS[-1])
+    return {'acquires': self.num_acquires,
+            'failures': self.num_failures,
+            'handoffs': self.num_handoffs,
+            'latency': zip(bounds, self.latency_counts)}
+
+
+class LockManager(object):
+  """Renews, hands off and tracks the locks held by this process. There is a single instance
+  per process, accessed via LockManager.Instance().
+  """
+  _RENEWAL_CONCURRENCY = 20
+  """Maximum number of lock renewals in flight at once during a renewal sweep."""
+
+  _SCAN_LIMIT = 100
+  """Maximum number of abandoned locks returned by each scan request."""
+
+  _instance = None
+
+  # Acquire statistics by resource type. Module-wide, since counters can only be defined once.
+  _stats = {}
+
+  def __init__(self):
+    # Maps id(lock) => (client, lock) for each lock being renewed.
+    self._renewals = {}
+    self._renewal_timeout = None
+    self._renewal_deadline = None
+    self._renewal_io_loop = None
+
+    # Maps lock_id => _HeldLock for each lock acquired via Acquire and not yet released.
+    self._held = {}
+
+    # Maps resource type => list of abandoned lock handlers.
+    self._abandoned_handlers = {}
+
+  @staticmethod
+  def Instance():
+    if LockManager._instance is None:
+      LockManager._instance = LockManager()
+    return LockManager._instance
+
+  @staticmethod
+  def SetInstance(lock_manager):
+    LockManager._instance = lock_manager
+
+  @gen.coroutine
+  def Acquire(self, client, resource_type, resource_id, owner_id=None, resource_data=None,
+              detect_abandonment=False, wait_secs=0):
+    """Acquires a lock in the same way as Lock.TryAcquire, returning a (lock, status) tuple. If
+    the lock is held by a different owner in this process, waits up to "wait_secs" for it to be
+    released, and takes it over from the releaser. If the handoff fails or the wait times out,
+    tries to acquire the lock through the database. Locks acquired by this method must be
+    released by LockManager.Release.
+    """
+    start = time.time()
+    lock_id = Lock.ConstructLockId(resource_type, resource_id)
+    held = self._held.get(lock_id)
+
+    lock = None
+    if held is not None and wait_secs > 0 and (owner_id is None or held.lock.owner_id != owner_id):
+      waiter = _LockWaiter(owner_id, resource_data, detect_abandonment)
+      held.waiters.append(waiter)
+      with stack_context.NullContext():
+        timeout = IOLoop.current().add_timeout(start + wait_secs, partial(self._OnWaitTimeout, held, waiter))
+      lock = yield waiter.future
+      IOLoop.current().remove_timeout(timeout)
+
+    if lock is not None:
+      status = Lock.ACQUIRED_LOCK
+      LockManager._GetStats(resource_type).Add(time.time() - start, status, handed_off=True)
+    else:
+      results = yield gen.Task(Lock.TryAcquire, client, resource_type, resource_id, resource_data=resource_data,
+                               detect_abandonment=detect_abandonment, owner_id=owner_id)
+      lock, status = results.args
+
+    if status != Lock.FAILED_TO_ACQUIRE_LOCK:
+      held = self._held.get(lock_id)
+      if held is None:
+        self._held[lock_id] = _HeldLock(lock)
+      else:
+        held.lock = lock
+
+    raise gen.Return((lock, status))
+
+  @gen.coroutine
+  def Release(self, client, lock):
+    """Releases a lock acquired by Acquire. If another coroutine is waiting for the lock, hands
+    it off to that coroutine instead of deleting it.
+    """
+    held = self._held.get(lock.lock_id)
+    waiters = []
+    if held is not None and held.lock is lock:
+      if held.waiters:
+        waiter = held.waiters.popleft()
+        new_lock = yield self._HandOff(client, lock, waiter)
+        if new_lock is not None:
+          held.lock = new_lock
+          waiter.future.set_result(new_lock)
+          return
+        waiters.append(waiter)
+
+      del self._held[lock.lock_id]
+      waiters.extend(held.waiters)
+      held.waiters.clear()
 
-    def _ScheduleNextRenew():
-      if not self._renewing:
+    try:
+      yield lock.Release(client)
+    finally:
+      # Another agent has tried to acquire the lock, or no one is waiting for it, so it has been released through
+      # the database. Any waiters compete for it with other agents.
+      for waiter in waiters:
+        waiter.future.set_result(None)
+
+  def ForgetHeld(self, owner_id):
+    """Forgets the locks that "owner_id" acquired via Acquire and did not release, e.g. because
+    the operation that acquired them failed. Coroutines waiting for a handoff of those locks stop
+    waiting, and try the database instead. The locks are left in the database, so that the owner
+    can acquire them again when it is retried.
+    """
+    for lock_id, held in self._held.items():
+      if held.lock.owner_id == owner_id:
+        logging.warning('forgetting "%s" lock that was not released by its owner' % held.lock)
+        del self._held[lock_id]
+        waiters = list(held.waiters)
+        held.waiters.clear()
+        for waiter in waiters:
+          waiter.future.set_result(None)
+
+  def RegisterAbandonedHandler(self, resource_type, handler):
+    """Registers "handler" to be invoked with each abandoned lock of type "resource_type" found
+    by ScanAbandoned.
+    """
+    self._abandoned_handlers.setdefault(resource_type, []).append(handler)
+
+  @gen.coroutine
+  def ScanAbandoned(self, client):
+    """Scans the Lock table for abandoned locks, and invokes the handlers registered for the
+    resource type of each. Returns the number of abandoned locks found.
+    """
+    num_abandoned = 0
+    last_key = None
+    while True:
+      locks, last_key = yield gen.Task(Lock.ScanAbandoned, client, limit=LockManager._SCAN_LIMIT,
+                                       excl_start_key=last_key)
+      for lock in locks:
+        num_abandoned += 1
+        resource_type, _ = Lock.DeconstructLockId(lock.lock_id)
+        for handler in self._abandoned_handlers.get(resource_type, []):
+          with util.ExceptionBarrier(util.LogExceptionCallback):
+            handler(lock)
+
+      if last_key is None:
+        raise gen.Return(num_abandoned)
+
+  def GetAcquireStats(self):
+    """Returns a dict mapping each lock resource type to its acquire statistics: the number of
+    acquires, failures and handoffs, and a histogram of acquire latencies.
+    """
+    return dict((resource_type, stats.AsDict()) for resource_type, stats in LockManager._stats.iteritems())
+
+  @gen.coroutine
+  def _HandOff(self, client, lock, waiter):
+    """Transfers "lock" to "waiter" by updating its owner, provided no other agent has tried to
+    acquire it. Returns the waiter's lock, or None if the handoff failed.
+    """
+    new_lock = lock._Clone()
+    if waiter.owner_id is None:
+      new_lock._GenerateOwnerId()
+    else:
+      new_lock._SetOwnerId(waiter.owner_id)
+    new_lock.resource_data = waiter.resource_data
+    new_lock.expiration = time.time() + Lock.ABANDONMENT_SECS if waiter.detect_abandonment else None
+    new_lock.acquire_failures = None
+
+    # Stop renewing the lock first, since a renewal by the previous owner would fail once the owner changes.
+    lock._StopRenewal()
+    expected_acquire_failures = False if lock.acquire_failures is None else lock.acquire_failures
+    try:
+      yield gen.Task(new_lock.Update, client, expected={'owner_id': lock.owner_id,
+                                                        'acquire_failures': expected_acquire_failures})
+    except Exception:
+      logging.info('handoff of "%s" lock failed; releasing it instead: %s' % (lock, sys.exc_info()[1]))
+      raise gen.Return(None)
+
+    lock._is_released = True
+    if waiter.detect_abandonment:
+      new_lock._Renew(client)
+    raise gen.Return(new_lock)
+
+  def _OnWaitTimeout(self, held, waiter):
+    """Stops waiting for a lock held in this process, and tries the database instead."""
+    if waiter in held.waiters:
+      held.waiters.remove(waiter)
+      waiter.future.set_result(None)
+
+  def _AddRenewal(self, client, lock):
+    """Renews "lock" in each renewal sweep until _RemoveRenewal is called."""
+    self._renewals[id(lock)] = (client, lock)
+    self._ArmRenewal(time.time() + Lock.LOCK_RENEWAL_SECS)
+
+  def _RemoveRenewal(self, lock):
+    self._renewals.pop(id(lock), None)
+
+  def _ArmRenewal(self, deadline):
+    """Ensures that the next renewal sweep happens no later than "deadline"."""
+    io_loop = IOLoop.current()
+    if self._renewal_timeout is not None:
+      if self._renewal_io_loop is io_loop and self._renewal_deadline <= deadline:
         return
-      self._timeout = IOLoop.current().add_timeout(timedelta(seconds=Lock.LOCK_RENEWAL_SECS), _OnRenewalTimeout)
+      self._renewal_io_loop.remove_timeout(self._renewal_timeout)
 
-    self._renewing = True
-    _ScheduleNextRenew()
+    # The timer belongs to the manager rather than to whichever caller happened to arm it.
+    with stack_context.NullContext():
+      self._renewal_timeout = io_loop.add_timeout(deadline, self._OnRenewalTimeout)
+    self._renewal_deadline = deadline
+    self._renewal_io_loop = io_loop
+
+  @gen.coroutine
+  def _OnRenewalTimeout(self):
+    """Renews the expiration of every lock, and schedules the next sweep."""
+    self._renewal_timeout = None
+    next_deadline = time.time() + Lock.LOCK_RENEWAL_SECS
+    yield util.RunConcurrently(self._RenewOne, self._renewals.values(), LockManager._RENEWAL_CONCURRENCY)
+    if self._renewals:
+      self._ArmRenewal(next_deadline)
+
+  @gen.coroutine
+  def _RenewOne(self, client_lock):
+    client, lock = client_lock
+    if not lock._renewing:
+      return
+
+    logging.info('renewing lock: %s' % lock)
+    lock.expiration = time.time() + Lock.ABANDONMENT_SECS
+    try:
+      yield gen.Task(lock.Update, client, expected={'owner_id': lock.owner_id})
+    except Exception:
+      # The lock is abandoned if renewals keep failing.
+      if lock._renewing:
+        logging.exception('failure trying to renew lock "%s"' % lock)
+
+  @staticmethod
+  def _GetStats(resource_type):
+    stats = LockManager._stats.get(resource_type)
+    if stats is None:
+      stats = LockManager._stats[resource_type] = _AcquireStats(resource_type)
+    return stats
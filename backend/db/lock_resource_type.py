@@ -21,4 +21,5 @@ class LockResourceType:
   """
   Job       = 'job'   # Resource id is job name (dbchk, get_logs, etc...).
   Operation = 'op'    # Resource id is user that initiated operation.
+  Server    = 'srv'   # Resource id is the server's op routing address (see op_router.py).
   Viewpoint = 'vp'    # Resource id is the viewpoint id.
@@ -177,6 +177,7 @@ class Photo(DBHashObject):
 
     if user_photo is not None:
       yield user_photo.Update(client)
+      user_photo.AddToCachedFingerprintIndex()
 
   @classmethod
   @gen.coroutine
@@ -42,7 +42,7 @@ import struct
 from collections import namedtuple
 from functools import partial
 from tornado import options
-from viewfinder.backend.base import base64hex, secrets, util
+from viewfinder.backend.base import base64hex, crypto_executor, secrets, util
 from viewfinder.backend.db import db_client, indexers
 
 options.define('delete_vestigial', default=False, help='deletes vestigial tables')
@@ -372,6 +372,12 @@ class _DelayedCrypt(object):
     crypter = _CryptValue._GetCrypter()
     return json.loads(crypter.Decrypt(self._encrypted_value))
 
+  def DecryptAsync(self):
+    """Returns a Future for the decrypted value. Decryption runs on the crypto executor, off
+    of the IOLoop.
+    """
+    return crypto_executor.Run(self.Decrypt)
+
   def __eq__(self, other):
     """Returns true if self._encrypted_value is equal to the other's _encrypted_value."""
     if isinstance(other, _DelayedCrypt):
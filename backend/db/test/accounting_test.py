@@ -9,6 +9,7 @@ import logging
 import time
 import unittest
 
+from tornado import options
 from viewfinder.backend.base.testing import async_test
 from viewfinder.backend.db.accounting import Accounting
 from viewfinder.backend.db.operation import Operation
@@ -71,3 +72,96 @@ class AccountingTestCase(DBBaseTestCase):
       assert accounting.num_photos == 3, 'num_photos: %d' % accounting.num_photos
 
     self.stop()
+
+  def testShardedApply(self):
+    """Verify that updates to sharded entries are spread over shards, summed by readers, and
+    applied only once per operation.
+    """
+    options.options.accounting_shards = 4
+    try:
+      act = Accounting.CreateViewpointVisibleTo('vp1')
+      act.num_photos = 1
+      act.tn_size = 10
+
+      for i in xrange(20):
+        with EnterOpContext(Operation(1, 'o%d' % i)):
+          self._RunAsync(Accounting.ApplyAccounting, self._client, act)
+          # Replay of the same operation is skipped.
+          self._RunAsync(Accounting.ApplyAccounting, self._client, act)
+
+      rows = self._RunAsync(Accounting.RangeQuery, self._client, act.hash_key, None, None, None)
+      self.assertTrue(len(rows) > 1)
+      self.assertTrue(all(Accounting.SplitSortKey(row.sort_key)[1] is not None for row in rows))
+
+      total = self._RunAsync(Accounting.QueryViewpointVisibleTo, self._client, 'vp1')
+      self.assertEqual(total.sort_key, Accounting.VISIBLE_TO)
+      self.assertEqual((total.num_photos, total.tn_size), (20, 200))
+
+      # Entries that are not contended are not sharded.
+      act = Accounting.CreateViewpointSharedBy('vp1', 1)
+      act.num_photos = 1
+      with EnterOpContext(Operation(1, 'o1')):
+        self._RunAsync(Accounting.ApplyAccounting, self._client, act)
+      self.assertIsNotNone(self._RunAsync(Accounting.QueryViewpointSharedBy, self._client, 'vp1', 1))
+    finally:
+      options.options.accounting_shards = 0
+
+  def testCompactShards(self):
+    """Verify that compaction folds shards into the entry row without changing its value."""
+    options.options.accounting_shards = 4
+    try:
+      act = Accounting.CreateUserVisibleTo(1)
+      act.num_photos = 1
+      for i in xrange(10):
+        with EnterOpContext(Operation(1, 'o%d' % i)):
+          self._RunAsync(Accounting.ApplyAccounting, self._client, act)
+
+      num_compacted = self._RunAsync(Accounting.CompactShards, self._client, act.hash_key, act.sort_key)
+      self.assertTrue(num_compacted > 0)
+      entry = self._RunAsync(Accounting.Query, self._client, act.hash_key, act.sort_key, None)
+      self.assertEqual(entry.num_photos, 10)
+      rows = self._RunAsync(Accounting.RangeQuery, self._client, act.hash_key,
+                            Accounting.GetEntryRange(act.sort_key), None, None)
+      self.assertTrue(all(row.IsZero() for row in rows if row.sort_key != act.sort_key))
+
+      # Compacting again has no effect.
+      self.assertEqual(self._RunAsync(Accounting.CompactShards, self._client, act.hash_key, act.sort_key), 0)
+
+      # Replays of operations applied before compaction are still skipped.
+      with EnterOpContext(Operation(1, 'o3')):
+        self._RunAsync(Accounting.ApplyAccounting, self._client, act)
+      with EnterOpContext(Operation(1, 'o10')):
+        self._RunAsync(Accounting.ApplyAccounting, self._client, act)
+      _, _, visible_to = self._RunAsync(Accounting.QueryUserAccounting, self._client, 1)
+      self.assertEqual(visible_to.num_photos, 11)
+    finally:
+      options.options.accounting_shards = 0
+
+  def testCompactionRecovery(self):
+    """Verify that a compaction that stopped after updating the entry row is completed using the
+    stats recorded in the entry row.
+    """
+    shard = Accounting(Accounting.USER_SIZE + ':1', Accounting.VISIBLE_TO + '#2')
+    shard.num_photos = 5
+    shard.op_ids = 'o1'
+    self._RunAsync(shard.Update, self._client)
+
+    # Compaction generation 0 has added 3 of the shard's photos to the entry row, but has not yet
+    # subtracted them from the shard. Readers count them once.
+    entry = Accounting(Accounting.USER_SIZE + ':1', Accounting.VISIBLE_TO)
+    entry.num_photos = 3
+    entry.op_ids = 'c2.0=3/0/0/0/0'
+    self._RunAsync(entry.Update, self._client)
+    _, _, visible_to = self._RunAsync(Accounting.QueryUserAccounting, self._client, 1)
+    self.assertEqual(visible_to.num_photos, 5)
+
+    # Compaction completes generation 0, then moves the rest of the shard in generation 1.
+    self.assertEqual(self._RunAsync(Accounting.CompactShards, self._client, entry.hash_key, entry.sort_key), 1)
+    _, _, visible_to = self._RunAsync(Accounting.QueryUserAccounting, self._client, 1)
+    self.assertEqual(visible_to.num_photos, 5)
+
+    shard = self._RunAsync(Accounting.Query, self._client, shard.hash_key, shard.sort_key, None)
+    self.assertEqual(shard.shard_gen, 2)
+    self.assertTrue(shard.IsZero())
+    entry = self._RunAsync(Accounting.Query, self._client, entry.hash_key, entry.sort_key, None)
+    self.assertEqual(entry.num_photos, 5)
@@ -0,0 +1,52 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests for asynchronous DynamoDB connection.
+"""
+
+__author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
+
+import hashlib
+import unittest
+
+from boto.auth import HmacAuthV3HTTPHandler
+from boto.connection import HTTPRequest
+from boto.provider import Provider
+from viewfinder.backend.db.asyncdynamo import AsyncDynamoDB, RequestSigner
+
+
+class RequestSignerTestCase(unittest.TestCase):
+  def testSignature(self):
+    """Verify that requests are signed as boto signs them, with and without a session token."""
+    for session_token in ['session-token', None]:
+      provider = Provider('aws', 'access-key', 'secret-key', session_token)
+      signer = RequestSigner(AsyncDynamoDB.DefaultHost, provider)
+      for action, body in [('GetItem', '{"TableName": "Test"}'), ('Query', '{"TableName": "Test", "Limit": 10}')]:
+        headers = {'X-Amz-Target': 'DynamoDB_20111205.%s' % action,
+                   'Content-Type': 'application/x-amz-json-1.0',
+                   'Content-Length': str(len(body))}
+        signer.add_auth(headers, body, now=1357000000)
+        self.assertEqual(headers['X-Amz-Date'], 'Tue, 01 Jan 2013 00:26:40 GMT')
+        self._VerifySignature(provider, headers, body)
+
+  def testCredentialChange(self):
+    """Verify that a signer only matches the credentials it was created for."""
+    provider = Provider('aws', 'access-key', 'secret-key', 'session-token')
+    signer = RequestSigner(AsyncDynamoDB.DefaultHost, provider)
+    self.assertTrue(signer.matches(provider))
+    provider.security_token = 'new-session-token'
+    self.assertFalse(signer.matches(provider))
+
+  def _VerifySignature(self, provider, headers, body):
+    """Signs a copy of the request with boto's handler, and compares its signature."""
+    handler = HmacAuthV3HTTPHandler(AsyncDynamoDB.DefaultHost, None, provider)
+    unsigned_headers = dict(headers)
+    del unsigned_headers['X-Amzn-Authorization']
+    request = HTTPRequest('POST', 'https', AsyncDynamoDB.DefaultHost, 443, '/', None, {}, unsigned_headers, body)
+    string_to_sign, headers_to_sign = handler.string_to_sign(request)
+    signature = handler.sign_string(hashlib.sha256(string_to_sign).digest())
+
+    auth_fields = dict(field.split('=', 1) for field in headers['X-Amzn-Authorization'][len('AWS3 '):].split(','))
+    self.assertEqual(auth_fields['AWSAccessKeyId'], provider.access_key)
+    self.assertEqual(auth_fields['Algorithm'], handler.algorithm())
+    self.assertEqual(sorted(auth_fields['SignedHeaders'].split(';')), sorted(headers_to_sign))
+    self.assertEqual(auth_fields['Signature'], signature)
@@ -24,6 +24,7 @@ from viewfinder.backend.db.photo import Photo
 from viewfinder.backend.db.post import Post
 from viewfinder.backend.db.test.db_validator import DBValidator
 from viewfinder.backend.db.tools import dbchk
+from viewfinder.backend.db.updated_viewpoint import UpdatedViewpoint
 from viewfinder.backend.db.viewpoint import Viewpoint
 from viewfinder.backend.op.notification_manager import NotificationManager
 
@@ -51,6 +52,8 @@ class DbChkTestCase(DBBaseTestCase):
     options.options.viewpoints = []
     options.options.repair = False
     options.options.email = 'dbchk@emailscrubbed.com'
+    options.options.incremental = False
+    options.options.incremental_lookback_hours = 7 * 24
 
     super(DbChkTestCase, self).tearDown()
 
@@ -191,6 +194,62 @@ class DbChkTestCase(DBBaseTestCase):
     self.assertEqual(prev_runs[2]['stats.dbchk.visited_viewpoints'], 0)
 
 
+  def testIncremental(self):
+    """Test checking the viewpoints in the updated viewpoint feed."""
+    self._CreateTestViewpoint('vp1', self._user.user_id, [])
+    self._CreateTestViewpoint('vp2', self._user.user_id, [])
+    now = time.time()
+    for vp_id in ['vp1', 'vp2', 'vp1']:
+      self._RunAsync(UpdatedViewpoint.Record, self._client, vp_id, now)
+    self._RunAsync(UpdatedViewpoint.Record, self._client, 'vp2', now - constants.SECONDS_PER_HOUR)
+
+    # Check both buckets concurrently; vp2 is only checked once.
+    self._RunAsync(self._checker.CheckUpdatedViewpoints, now - constants.SECONDS_PER_HOUR, now + 1, concurrency=4)
+    self.assertEqual(self._checker._num_visited_viewpoints, 2)
+
+    corruption_text = \
+      '  ---- viewpoint vp1 ----\n' \
+      '  empty viewpoint (1 instance)\n' \
+      '\n' \
+      '  ---- viewpoint vp2 ----\n' \
+      '  empty viewpoint (1 instance)\n' \
+      '\n' \
+      'python dbchk.py --devbox --repair=True --viewpoints=vp1,vp2'
+
+    self.assertEqual(self._checker._email_args['text'],
+                     'Found corruption(s) in database:\n\n%s' % corruption_text)
+
+    # Checked rows were consumed.
+    for timestamp in [now, now - constants.SECONDS_PER_HOUR]:
+      bucket_start = UpdatedViewpoint.GetBucketStart(timestamp)
+      self.assertEqual(self._RunAsync(UpdatedViewpoint.QueryBucket, self._client, bucket_start), [])
+
+    # Incremental run with no previous run checks only the viewpoints left in the feed.
+    self._RunAsync(UpdatedViewpoint.Record, self._client, 'vp1', now)
+    self._RunDbChk({'incremental': True, 'incremental_lookback_hours': 1})
+
+    job = Job(self._client, 'dbchk')
+    prev_runs = self._RunAsync(job.FindPreviousRuns, status=Job.STATUS_SUCCESS)
+    self.assertEqual(len(prev_runs), 1)
+    self.assertEqual(prev_runs[0]['stats.full_scan'], False)
+    self.assertEqual(prev_runs[0]['stats.dbchk.visited_viewpoints'], 1)
+    self.assertGreater(prev_runs[0]['stats.feed_end'], now)
+
+  def testTrimUpdatedViewpoints(self):
+    """Test trimming old rows from the updated viewpoint feed."""
+    now = time.time()
+    old_timestamp = now - 8 * constants.SECONDS_PER_DAY
+    self._RunAsync(UpdatedViewpoint.Record, self._client, 'vp1', now)
+    for vp_id in ['vp1', 'vp2']:
+      self._RunAsync(UpdatedViewpoint.Record, self._client, vp_id, old_timestamp)
+
+    num_trimmed = self._RunAsync(self._checker.TrimUpdatedViewpoints, now - constants.SECONDS_PER_WEEK)
+    self.assertEqual(num_trimmed, 2)
+    self.assertEqual(self._RunAsync(UpdatedViewpoint.QueryBucket, self._client,
+                                    UpdatedViewpoint.GetBucketStart(old_timestamp)), [])
+    updated_vps = self._RunAsync(UpdatedViewpoint.QueryBucket, self._client, UpdatedViewpoint.GetBucketStart(now))
+    self.assertEqual([updated_vp.viewpoint_id for updated_vp in updated_vps], ['vp1'])
+
   def testEmptyViewpoints(self):
     """Verifies detection of empty viewpoint records."""
     def _Validate(viewpoint_id):
@@ -6,6 +6,7 @@
 
 __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
+import json
 import os
 import unittest
 
@@ -445,3 +446,17 @@ class DynamoDBReadOnlyClientTestCase(DBBaseTestCase):
     self.assertRaisesRegexp(AssertionError, 'request on read-only database', self._RunAsync,
                             self._client.UpdateItem, table=_table.name, key=DBKey(hash_key=1, range_key=2),
                             attributes={'num': 1})
+
+
+class DecodeDynamoValuesTestCase(unittest.TestCase):
+  def testDecode(self):
+    """Verify that typed values are decoded as the response is parsed."""
+    body = json.dumps({'Count': 1,
+                       'Items': [{'a1': {'N': '2'}, 'a2': {'S': 'str'}, 'a3': {'NS': ['1', '2.5']},
+                                  'a4': {'SS': ['x', 'y']}}],
+                       'LastEvaluatedKey': {'HashKeyElement': {'S': '1'}, 'RangeKeyElement': {'N': '2'}},
+                       'ConsumedCapacityUnits': 0.5})
+    response = json.loads(body, object_pairs_hook=dynamodb_client.DecodeDynamoValues)
+    self.assertEqual(response['Items'], [{'a1': 2, 'a2': 'str', 'a3': set([1, 2.5]), 'a4': set(['x', 'y'])}])
+    self.assertEqual(response['LastEvaluatedKey'], {'HashKeyElement': '1', 'RangeKeyElement': 2})
+    self.assertEqual(response['ConsumedCapacityUnits'], 0.5)
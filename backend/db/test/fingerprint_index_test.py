@@ -0,0 +1,115 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests for FingerprintIndex.
+"""
+
+__author__ = 'ben@emailscrubbed.com (Ben Darnell)'
+
+import random
+import unittest
+
+from viewfinder.backend.db.fingerprint_index import AssetFingerprintToTerms, Distance, FingerprintIndex
+from viewfinder.backend.db.fingerprint_index import FINGERPRINT_BITS, ParseFingerprint
+
+
+class FingerprintIndexTestCase(unittest.TestCase):
+  def setUp(self):
+    self._random = random.Random(0)
+
+  def _RandomTerm(self):
+    return self._random.getrandbits(FINGERPRINT_BITS)
+
+  def _FlipBits(self, term, num_bits):
+    for bit in self._random.sample(xrange(FINGERPRINT_BITS), num_bits):
+      term ^= 1 << bit
+    return term
+
+  def testParseFingerprint(self):
+    """Verifies parsing of the colon-separated hex fingerprint format."""
+    term1 = 'e5ad400c2214088928ef8400dcfb87bb3059b742'
+    term2 = '0' * 39 + '1'
+    self.assertEqual(ParseFingerprint(term1), (int(term1, 16),))
+    self.assertEqual(ParseFingerprint('%s:%s\n' % (term1, term2)), (int(term1, 16), 1))
+    self.assertRaises(ValueError, ParseFingerprint, 'e5ad')
+    self.assertRaises(ValueError, ParseFingerprint, 'x' * 40)
+
+  def testAssetFingerprintToTerms(self):
+    """Verifies conversion of UserPhoto asset fingerprints."""
+    sha1 = 'e5ad400c2214088928ef8400dcfb87bb3059b742'
+    self.assertEqual(AssetFingerprintToTerms('a/#' + sha1), (int(sha1, 16),))
+    self.assertEqual(AssetFingerprintToTerms('a/#N' + sha1), (int(sha1, 16),))
+    self.assertIsNone(AssetFingerprintToTerms('a/#asset-key-1'))
+    self.assertIsNone(AssetFingerprintToTerms(sha1))
+    self.assertIsNone(AssetFingerprintToTerms(None))
+
+  def testDistance(self):
+    """Verifies the minimum distance over all term pairs."""
+    self.assertEqual(Distance([0b1011], [0b0000]), 3)
+    self.assertEqual(Distance([0b1011, 0b0111], [0b0000, 0b0110]), 1)
+    self.assertEqual(Distance([5], [5]), 0)
+
+  def testQuery(self):
+    """Verifies that queries find exactly the fingerprints within the maximum distance."""
+    index = FingerprintIndex()
+    terms = [self._RandomTerm() for _ in xrange(1000)]
+    for i, term in enumerate(terms):
+      index.Add(i, [term])
+    self.assertEqual(len(index), 1000)
+
+    for num_bits in xrange(0, 16):
+      query = self._FlipBits(terms[num_bits], num_bits)
+      expected = [(num_bits, num_bits)] if num_bits <= index.max_distance else []
+      self.assertEqual(index.Query([query]), expected)
+
+    # Narrower distance than the index maximum.
+    self.assertEqual(index.Query([self._FlipBits(terms[0], 5)], max_distance=4), [])
+
+  def testMultipleTerms(self):
+    """Verifies that any term of a multi-term fingerprint can match."""
+    index = FingerprintIndex()
+    term1, term2 = self._RandomTerm(), self._RandomTerm()
+    index.Add('a', [term1, term2])
+    index.Add('b', [self._RandomTerm()])
+    self.assertEqual(index.Query([self._RandomTerm(), self._FlipBits(term2, 7)]), [('a', 7)])
+
+  def testRemove(self):
+    """Verifies that removed fingerprints are no longer found, and others still are."""
+    index = FingerprintIndex()
+    base = self._RandomTerm()
+    index.Add('a', [base, self._RandomTerm()])
+    index.Add('b', [self._FlipBits(base, 2)])
+    index.Add('a', [self._FlipBits(base, 4)])
+    index.Add('c', [base])
+    self.assertEqual(len(index), 4)
+
+    index.Remove('a')
+    index.Remove('d')
+    self.assertEqual(len(index), 2)
+    self.assertEqual(index.Query([base]), [('c', 0), ('b', 2)])
+    self.assertEqual(sorted(index.IterNearDuplicatePairs()), [('b', 'c', 2)])
+
+    index.Add('a', [base])
+    self.assertEqual(sorted(key for key, _ in index.Query([base])), ['a', 'b', 'c'])
+
+  def testAddExisting(self):
+    """Verifies that adding a fingerprint already indexed under the same key has no effect."""
+    index = FingerprintIndex()
+    term = self._RandomTerm()
+    index.Add('a', [term])
+    index.Add('a', (term,))
+    index.Add('b', [term])
+    self.assertEqual(len(index), 2)
+    self.assertEqual(sorted(index.Query([term])), [('a', 0), ('b', 0)])
+
+  def testNearDuplicatePairs(self):
+    """Verifies that each near-duplicate pair is reported exactly once."""
+    index = FingerprintIndex()
+    base = self._RandomTerm()
+    index.Add('a', [base])
+    index.Add('b', [self._FlipBits(base, 3)])
+    index.Add('c', [self._RandomTerm()])
+    index.Add('d', [base])
+    pairs = sorted(index.IterNearDuplicatePairs())
+    self.assertEqual([(p[0], p[1]) for p in pairs], [('a', 'b'), ('a', 'd'), ('b', 'd')])
+    self.assertEqual(sorted(index.IterNearDuplicatePairs(min_distance=1)),
+                     [('a', 'b', 3), ('b', 'd', 3)])
@@ -0,0 +1,55 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests for Followed data object.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+from viewfinder.backend.base import constants, counters
+from viewfinder.backend.db.followed import Followed
+from viewfinder.backend.db.operation import Operation
+from viewfinder.backend.op.op_context import EnterOpContext
+
+from base_test import DBBaseTestCase
+
+_DAY = constants.SECONDS_PER_DAY
+
+
+class FollowedTestCase(DBBaseTestCase):
+  def testUpdateDateUpdated(self):
+    """Verify that the followed row is moved to the new day, and is not moved back."""
+    self._RunAsync(Followed.UpdateDateUpdated, self._client, 100, 'vp1', None, _DAY)
+    self._RunAsync(Followed.UpdateDateUpdated, self._client, 100, 'vp1', _DAY, 3 * _DAY)
+    self._RunAsync(Followed.UpdateDateUpdated, self._client, 100, 'vp1', 3 * _DAY, 2 * _DAY)
+    self.assertEqual(self._QueryDays(100), [3 * _DAY])
+
+  def testCoalesceUpdates(self):
+    """Verify that an operation does not repeat puts or deletes of the same followed row."""
+    saved = counters.counters['viewfinder.followed.writes_saved_per_min']
+    start_saved = saved.get_total()
+
+    op = Operation(1, 'o1')
+    with EnterOpContext(op):
+      with Followed.CoalesceUpdates(op.operation_id):
+        # Create the row of a new follower, then update the rows of all followers.
+        self._RunAsync(Followed.UpdateDateUpdated, self._client, 100, 'vp1', None, 2 * _DAY)
+        self._RunAsync(Followed.UpdateDateUpdated, self._client, 101, 'vp1', None, _DAY)
+        self._RunAsync(Followed.UpdateDateUpdated, self._client, 100, 'vp1', _DAY, 2 * _DAY)
+        self._RunAsync(Followed.UpdateDateUpdated, self._client, 101, 'vp1', _DAY, 2 * _DAY)
+        self.assertEqual(saved.get_total() - start_saved, 1)
+
+        # Repeat an update, as a restarted notification would.
+        self._RunAsync(Followed.UpdateDateUpdated, self._client, 101, 'vp1', _DAY, 2 * _DAY)
+        self.assertEqual(saved.get_total() - start_saved, 3)
+
+      # Outside of CoalesceUpdates, every update is written.
+      self._RunAsync(Followed.UpdateDateUpdated, self._client, 100, 'vp1', _DAY, 2 * _DAY)
+      self.assertEqual(saved.get_total() - start_saved, 3)
+
+    self.assertEqual(self._QueryDays(100), [2 * _DAY])
+    self.assertEqual(self._QueryDays(101), [2 * _DAY])
+
+  def _QueryDays(self, user_id):
+    """Returns the date_updated of each followed row of "user_id"."""
+    followed = self._RunAsync(Followed.RangeQuery, self._client, user_id, None, None, None)
+    return [f.date_updated for f in followed]
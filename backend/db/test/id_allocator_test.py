@@ -47,3 +47,48 @@ class IdAllocatorTestCase(DBBaseTestCase):
         [allocs[0].NextId(self._client, b1.Callback()) for i in xrange(num_ids)]
       with util.ArrayBarrier(b.Callback()) as b2:
         [allocs[1].NextId(self._client, b2.Callback()) for i in xrange(num_ids)]
+
+  def testAdaptiveBlockSize(self):
+    """Tests that blocks grow with the id request rate, within bounds."""
+    alloc = IdAllocator('type', 5, max_allocation=101)
+    ids = self._AllocateIds(alloc, 1000)
+    self.assertEqual(len(set(ids)), 1000)
+    self.assertEqual(alloc._allocation, 101)
+
+    alloc = IdAllocator('type', 13)
+    self._AllocateIds(alloc, 1000)
+    self.assertEqual(alloc._allocation, 13)
+
+  def testPrefetch(self):
+    """Tests that the next block is prefetched, so that ids are returned without waiting."""
+    alloc = IdAllocator('type', 7)
+    ids = self._AllocateIds(alloc, 5)
+
+    # The first block has reached its low-water mark; wait for the prefetch of the next block.
+    self.assertTrue(alloc._allocation_pending)
+    while alloc._allocation_pending:
+      self.io_loop.add_callback(self.stop)
+      self.wait()
+
+    # The remainder of the first block and all of the second are returned synchronously.
+    for _ in xrange(8):
+      alloc.NextId(self._client, ids.append)
+    self.assertEqual(len(set(ids)), 13)
+    self.assertEqual(ids, sorted(ids))
+
+    alloc.Shutdown()
+    self.assertEqual(alloc._cur_id, alloc._last_id)
+
+  def testResetPendingPrefetch(self):
+    """Tests that a prefetch that completes after a reset is ignored."""
+    alloc = IdAllocator('type', 7)
+    self._AllocateIds(alloc, 6)
+    self.assertTrue(alloc._allocation_pending)
+    alloc.Reset()
+    ids = self._AllocateIds(alloc, 10)
+    self.assertEqual(len(set(ids)), 10)
+
+  def _AllocateIds(self, alloc, num_ids):
+    with util.ArrayBarrier(self.stop) as b:
+      [alloc.NextId(self._client, b.Callback()) for i in xrange(num_ids)]
+    return self.wait()
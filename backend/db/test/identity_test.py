@@ -5,8 +5,12 @@
 
 __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
+import time
+
+from viewfinder.backend.base import util
 from viewfinder.backend.base.exceptions import InvalidRequestError
 from viewfinder.backend.db.identity import Identity
+from viewfinder.backend.db.identity_resolver import IdentityResolver
 
 from base_test import DBBaseTestCase
 
@@ -42,3 +46,15 @@ class IdentityTestCase(DBBaseTestCase):
     self.assertIn('scrubbed', repr(ident))
     self.assertNotIn('access_token1', repr(ident))
     self.assertNotIn('refresh_token1', repr(ident))
+
+  def testBoundInvalidatesResolver(self):
+    """Binding an identity to a user removes it from the resolver's negative cache."""
+    resolver = IdentityResolver()
+    IdentityResolver.SetInstance(resolver)
+    self.addCleanup(IdentityResolver.SetInstance, None)
+
+    resolver._AddNegative(IdentityTestCase.KEY, time.time())
+    self.assertTrue(resolver._IsNegative(IdentityTestCase.KEY, time.time()))
+    self._RunAsync(Identity.CreateProspective, self._client, IdentityTestCase.KEY, 1000,
+                   util.GetCurrentTimestamp())
+    self.assertFalse(resolver._IsNegative(IdentityTestCase.KEY, time.time()))
@@ -0,0 +1,125 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests for Inbox data object.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+from viewfinder.backend.base import constants
+from viewfinder.backend.db.followed import Followed
+from viewfinder.backend.db.follower import Follower
+from viewfinder.backend.db.inbox import Inbox
+from viewfinder.backend.db.viewpoint import Viewpoint
+
+from base_test import DBBaseTestCase
+
+_DAY = constants.SECONDS_PER_DAY
+
+
+class InboxTestCase(DBBaseTestCase):
+  def testBuild(self):
+    """Verify that a built inbox is current only for the page limit it was built with."""
+    self._BuildInbox(['vp3', 'vp2'], 2)
+
+    inbox, last_notification_id = self._RunAsync(Inbox.QueryCurrent, self._client, 100, 2)
+    self.assertEqual(last_notification_id, 0)
+    self.assertEqual(self._GetViewpointIds(inbox), ['vp3', 'vp2'])
+
+    inbox, _ = self._RunAsync(Inbox.QueryCurrent, self._client, 100, 10)
+    self.assertIsNone(inbox)
+
+  def testApplyNotification(self):
+    """Verify that notifications move viewpoints to the front of the page, and are only applied
+    in order.
+    """
+    self._BuildInbox(['vp3', 'vp2'], 2)
+
+    # Viewpoint that was not in the page is updated, pushing out the last viewpoint.
+    viewpoint, follower = self._MakeViewpoint('vp1', 4 * _DAY)
+    self._RunAsync(Inbox.ApplyNotification, self._client, 100, 1, viewpoint, follower)
+    inbox = self._RunAsync(Inbox.Query, self._client, 100, None)
+    self.assertEqual(inbox.notification_id, 1)
+    self.assertEqual(self._GetViewpointIds(inbox), ['vp1', 'vp3'])
+
+    # Viewpoint in the page is updated.
+    viewpoint, follower = self._MakeViewpoint('vp3', 5 * _DAY, title='new title')
+    self._RunAsync(Inbox.ApplyNotification, self._client, 100, 2, viewpoint, follower)
+    inbox = self._RunAsync(Inbox.Query, self._client, 100, None)
+    self.assertEqual(self._GetViewpointIds(inbox), ['vp3', 'vp1'])
+    self.assertEqual(inbox.GetEntries()[0][1]['title'], 'new title')
+
+    # Notification 3 was missed, so notification 4 is not applied.
+    viewpoint, follower = self._MakeViewpoint('vp2', 6 * _DAY)
+    self._RunAsync(Inbox.ApplyNotification, self._client, 100, 4, viewpoint, follower)
+    inbox = self._RunAsync(Inbox.Query, self._client, 100, None)
+    self.assertEqual(inbox.notification_id, 2)
+    self.assertEqual(self._GetViewpointIds(inbox), ['vp3', 'vp1'])
+
+  def testApplyToCompletePage(self):
+    """Verify that a complete page grows until it reaches the page limit."""
+    self._BuildInbox(['vp2'], 2)
+    inbox = self._RunAsync(Inbox.Query, self._client, 100, None)
+
+    viewpoint, follower = self._MakeViewpoint('vp1', 1 * _DAY)
+    self.assertTrue(inbox._ApplyViewpoint(Followed.CreateSortKey('vp1', _DAY), viewpoint.MakeMetadataDict(follower)))
+    self.assertEqual(self._GetViewpointIds(inbox), ['vp2', 'vp1'])
+    self.assertTrue(inbox.page['complete'])
+
+    viewpoint, follower = self._MakeViewpoint('vp3', 3 * _DAY)
+    self.assertTrue(inbox._ApplyViewpoint(Followed.CreateSortKey('vp3', 3 * _DAY),
+                                          viewpoint.MakeMetadataDict(follower)))
+    self.assertEqual(self._GetViewpointIds(inbox), ['vp3', 'vp2'])
+    self.assertFalse(inbox.page['complete'])
+
+    # A viewpoint that moves out of an incomplete page cannot be maintained.
+    self.assertFalse(inbox._ApplyViewpoint(Followed.CreateSortKey('vp2', 0), viewpoint.MakeMetadataDict(follower)))
+
+  def testPageSize(self):
+    """Verify that pages that would exceed the item size limit are not materialized."""
+    viewpoint, follower = self._MakeViewpoint('vp1', _DAY, title='x' * Inbox._MAX_PAGE_SIZE)
+    followed = Followed(100, Followed.CreateSortKey('vp1', _DAY))
+    self._RunAsync(Inbox.Build, self._client, 100, 0, 2, [followed], [viewpoint], [follower])
+    self.assertIsNone(self._RunAsync(Inbox.Query, self._client, 100, None, must_exist=False))
+
+    # An update that would grow the page too large leaves the inbox stale.
+    self._BuildInbox(['vp2'], 2)
+    self._RunAsync(Inbox.ApplyNotification, self._client, 100, 1, viewpoint, follower)
+    inbox = self._RunAsync(Inbox.Query, self._client, 100, None)
+    self.assertEqual(inbox.notification_id, 0)
+    self.assertEqual(self._GetViewpointIds(inbox), ['vp2'])
+
+  def testInvalidate(self):
+    """Verify that an invalidated inbox is no longer current."""
+    self._BuildInbox(['vp2'], 2)
+    self._RunAsync(Inbox.Invalidate, self._client, 100)
+    inbox, _ = self._RunAsync(Inbox.QueryCurrent, self._client, 100, 2)
+    self.assertIsNone(inbox)
+
+  def _BuildInbox(self, viewpoint_ids, limit):
+    """Builds the inbox of user 100 from viewpoints last updated on the day given by the digit
+    in their ids.
+    """
+    followed = []
+    viewpoints = []
+    followers = []
+    for viewpoint_id in viewpoint_ids:
+      viewpoint, follower = self._MakeViewpoint(viewpoint_id, int(viewpoint_id[-1]) * _DAY)
+      followed.append(Followed(100, Followed.CreateSortKey(viewpoint_id, viewpoint.last_updated)))
+      viewpoints.append(viewpoint)
+      followers.append(follower)
+
+    self._RunAsync(Inbox.Build, self._client, 100, 0, limit, followed, viewpoints, followers)
+
+  def _MakeViewpoint(self, viewpoint_id, last_updated, title=None):
+    """Returns a viewpoint last updated at "last_updated", and its follower for user 100."""
+    viewpoint = Viewpoint(viewpoint_id)
+    viewpoint.type = Viewpoint.EVENT
+    viewpoint.last_updated = last_updated
+    viewpoint.title = title
+    follower = Follower(100, viewpoint_id)
+    follower.labels = [Follower.CONTRIBUTE]
+    follower.viewed_seq = 0
+    return viewpoint, follower
+
+  def _GetViewpointIds(self, inbox):
+    return [metadata_dict['viewpoint_id'] for _, metadata_dict in inbox.GetEntries()]
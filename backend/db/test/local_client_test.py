@@ -6,11 +6,15 @@
 __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
 import random
+import time
 
 from tornado import options
+from viewfinder.backend.base.exceptions import DBProvisioningExceededError
 from viewfinder.backend.base.testing import async_test, BaseTestCase
 from viewfinder.backend.db.db_client import DBKey, DBKeySchema, UpdateAttr, BatchGetRequest, RangeOperator, ScanFilter
+from viewfinder.backend.db import local_storage
 from viewfinder.backend.db.local_client import LocalClient
+from viewfinder.backend.db.local_throughput import ThroughputSimulator
 from viewfinder.backend.db.schema import Schema, Table, Column, HashKeyColumn, RangeKeyColumn
 
 _hash_key_schema = DBKeySchema(name='test_hk', value_type='N')
@@ -55,6 +59,8 @@ test_SCHEMA = Schema([
 
 
 class LocalClientTestCase(BaseTestCase):
+  _ENGINE = 'dict'
+
   def setUp(self):
     """Sets up _client as a test emulation of DynamoDB. Creates the full
     database schema, a test user, and two devices (one for mobile, one
@@ -62,7 +68,7 @@ class LocalClientTestCase(BaseTestCase):
     """
     super(LocalClientTestCase, self).setUp()
     options.options.localdb_dir = ''
-    self._client = LocalClient(test_SCHEMA)
+    self._client = LocalClient(test_SCHEMA, engine=self._ENGINE)
     test_SCHEMA.VerifyOrCreate(self._client, self.stop)
     self.wait()
 
@@ -365,6 +371,29 @@ class LocalClientTestCase(BaseTestCase):
 
     self.stop()
 
+  def testScanPages(self):
+    """Scan a table a page at a time, and verify each item is returned exactly once."""
+    for table, range_keys in (('RangeTest', range(3)), ('LocalTest2', [None])):
+      exp_keys = set()
+      for h in xrange(10):
+        for r in range_keys:
+          self._client.PutItem(table, key=DBKey(hash_key=h, range_key=r), attributes={'attr1': h}, callback=None)
+          exp_keys.add((h, r))
+
+      keys = []
+      last_key = None
+      while True:
+        result = self._client.Scan(table=table, callback=None, attributes=None, limit=4, excl_start_key=last_key)
+        self.assertLessEqual(len(result.items), 4)
+        keys.extend((item['test_hk'], item.get('test_rk')) for item in result.items)
+        last_key = result.last_key
+        if last_key is None:
+          break
+
+      self.assertEqual(len(keys), len(exp_keys))
+      self.assertEqual(set(keys), exp_keys)
+      self.assertEqual(self._client.DescribeTable(table, callback=None).count, len(exp_keys))
+
   @async_test
   def testScanFilter(self):
     items = {}
@@ -398,6 +427,113 @@ class LocalClientTestCase(BaseTestCase):
     self.stop()
 
 
+class SortedLocalClientTestCase(LocalClientTestCase):
+  """Runs the LocalClient tests against the "sorted" storage engine."""
+  _ENGINE = 'sorted'
+
+  def testScanResume(self):
+    """Resume a scan from a key that has since been deleted."""
+    for h in xrange(3):
+      for r in xrange(3):
+        self._client.PutItem('RangeTest', key=DBKey(hash_key=h, range_key=r), attributes={'attr1': h}, callback=None)
+
+    result = self._client.Scan(table='RangeTest', callback=None, attributes=None, limit=4)
+    self.assertEqual(result.last_key, DBKey(hash_key=1, range_key=0))
+    for r in xrange(3):
+      self._client.DeleteItem('RangeTest', key=DBKey(hash_key=1, range_key=r), callback=None)
+    result = self._client.Scan(table='RangeTest', callback=None, attributes=None, excl_start_key=result.last_key)
+    self.assertEqual([(item['test_hk'], item['test_rk']) for item in result.items], [(2, 0), (2, 1), (2, 2)])
+
+  def testPages(self):
+    """Insert and delete random keys in pages small enough to be split and removed."""
+    local_storage._SortedMap._MAX_PAGE_SIZE = 4
+    try:
+      rand = random.Random(0)
+      exp_keys = set()
+      for _ in xrange(500):
+        r = rand.randint(0, 100)
+        if rand.random() < 0.7:
+          self._client.PutItem('RangeTest', key=DBKey(hash_key=1, range_key=r),
+                               attributes={'attr2': 'x' * r}, callback=None)
+          exp_keys.add(r)
+        else:
+          self._client.DeleteItem('RangeTest', key=DBKey(hash_key=1, range_key=r), callback=None)
+          exp_keys.discard(r)
+
+      result = self._client.Query('RangeTest', 1, None, callback=None, attributes=None)
+      self.assertEqual([item['test_rk'] for item in result.items], sorted(exp_keys))
+      self.assertTrue(all(item['attr2'] == 'x' * item['test_rk'] for item in result.items))
+      result = self._client.Query('RangeTest', 1, RangeOperator([50], 'LT'), callback=None, attributes=None,
+                                  scan_forward=False, limit=5)
+      self.assertEqual([item['test_rk'] for item in result.items], sorted(k for k in exp_keys if k < 50)[::-1][:5])
+
+      describe = self._client.DescribeTable('RangeTest', callback=None)
+      self.assertEqual(describe.count, len(exp_keys))
+      self.assertGreater(describe.size_bytes, sum(exp_keys))
+    finally:
+      local_storage._SortedMap._MAX_PAGE_SIZE = 512
+
+
+class LocalThroughputClientTestCase(BaseTestCase):
+  def setUp(self):
+    """Creates a local client that enforces provisioned throughput, with one second of burst
+    capacity, using a clock controlled by the test.
+    """
+    super(LocalThroughputClientTestCase, self).setUp()
+    options.options.localdb_dir = ''
+    self._now = 1000.0
+    simulator = ThroughputSimulator(burst_secs=1, clock=lambda: self._now)
+    self._client = LocalClient(test_SCHEMA, simulator=simulator)
+    self._RunAsync(test_SCHEMA.VerifyOrCreate, self._client)
+
+  def testThrottleWrites(self):
+    """Writes beyond the provisioned throughput fail, without being applied."""
+    # LocalTest2 has 5 write units; a request is admitted as long as any capacity is left.
+    for i in xrange(6):
+      self._client.PutItem('LocalTest2', DBKey(i, None), None, {'num': i})
+    self.assertRaisesRegexp(DBProvisioningExceededError, 'provisioned throughput', self._client.PutItem,
+                            'LocalTest2', DBKey(6, None), None, {'num': 6})
+    self.assertRaises(DBProvisioningExceededError, self._client.UpdateItem,
+                      'LocalTest2', DBKey(0, None), None, {'num': 7})
+    self.assertIsNone(self._client.GetItem('LocalTest2', DBKey(6, None), None, None, must_exist=False))
+    self.assertEqual(self._client.GetItem('LocalTest2', DBKey(0, None), None, ['num']).attributes, {'num': 0})
+
+    # Capacity is restored over time.
+    self._now += 0.2
+    self._client.PutItem('LocalTest2', DBKey(6, None), None, {'num': 6})
+
+  def testThrottleReads(self):
+    """Eventually consistent reads consume half as much capacity as consistent reads."""
+    # LocalTest2 has 10 read units.
+    for _ in xrange(11):
+      self._client.GetItem('LocalTest2', DBKey(1, None), None, None, must_exist=False, consistent_read=True)
+    self.assertRaises(DBProvisioningExceededError, self._client.Scan, 'LocalTest2', None, None)
+
+    # Unused capacity accumulates up to the burst limit.
+    self._now += 2
+    for _ in xrange(21):
+      self._client.GetItem('LocalTest2', DBKey(1, None), None, None, must_exist=False)
+    self.assertRaises(DBProvisioningExceededError, self._client.Scan, 'LocalTest2', None, None)
+
+    # Each table has its own capacity.
+    self._client.Query('LocalTest', 1, None, None, None)
+
+  def testLatency(self):
+    """Responses are delayed by the simulated latency."""
+    client = LocalClient(test_SCHEMA, simulator=ThroughputSimulator(throttle=False, latency_func=lambda: 0.1))
+    self._RunAsync(test_SCHEMA.VerifyOrCreate, client)
+    start = time.time()
+    self._RunAsync(client.GetItem, 'LocalTest2', DBKey(1, None), attributes=None, must_exist=False)
+    self.assertGreaterEqual(time.time() - start, 0.1)
+
+    # Latency distributions have the requested median.
+    for dist in ('fixed', 'exponential', 'lognormal'):
+      latency_func = ThroughputSimulator.MakeLatencyFunc(0.01, dist, random.Random(0))
+      latencies = sorted(latency_func() for _ in xrange(2001))
+      self.assertAlmostEqual(latencies[1000], 0.01, delta=0.001)
+    self.assertIsNone(ThroughputSimulator.MakeLatencyFunc(0, 'fixed'))
+
+
 class LocalReadOnlyClientTestCase(BaseTestCase):
   def setUp(self):
     """Creates a read-only local client.
@@ -11,7 +11,7 @@ from datetime import timedelta
 from functools import partial
 from base_test import DBBaseTestCase
 from viewfinder.backend.base.exceptions import LockFailedError
-from viewfinder.backend.db.lock import Lock
+from viewfinder.backend.db.lock import Lock, LockManager
 
 
 class LockTestCase(DBBaseTestCase):
@@ -191,6 +191,107 @@ class LockTestCase(DBBaseTestCase):
     # Now, read it to demonstrate that it hasn't been released.
     lock3 = self._RunAsync(Lock.Query, self._client, lock.lock_id, None)
 
+  def testBatchedRenewal(self):
+    """Test that a single renewal sweep keeps several locks from being abandoned."""
+    Lock.ABANDONMENT_SECS = .3
+    Lock.LOCK_RENEWAL_SECS = .1
+    locks = [self._TryAcquire('rn', 'id%d' % i, detect_abandonment=True, release_lock=False) for i in xrange(3)]
+    self.io_loop.add_timeout(timedelta(seconds=.6), self.stop)
+    self.wait()
+    for lock in locks:
+      db_lock = self._RunAsync(Lock.Query, self._client, lock.lock_id, None)
+      self.assertFalse(db_lock.IsAbandoned())
+      self._Release(lock)
+    Lock.ABANDONMENT_SECS = 60
+    Lock.LOCK_RENEWAL_SECS = 30
+
+  def testHandOff(self):
+    """Test handing off a lock to another owner in the same process."""
+    manager = LockManager()
+    lock, status = self._RunAsync(manager.Acquire, self._client, 'ho', 'id0', owner_id='owner1')
+    self.assertEqual(status, Lock.ACQUIRED_LOCK)
+
+    # Wait for the lock, then release it.
+    future = manager.Acquire(self._client, 'ho', 'id0', owner_id='owner2', resource_data='data2', wait_secs=10)
+    self.assertFalse(future.done())
+    self._RunAsync(manager.Release, self._client, lock)
+    self.assertTrue(lock.IsReleased())
+
+    lock2, status = self._RunFuture(future)
+    self.assertEqual(status, Lock.ACQUIRED_LOCK)
+    self.assertTrue(lock2.AmOwner())
+    db_lock = self._RunAsync(Lock.Query, self._client, lock.lock_id, None)
+    self.assertEqual(db_lock.owner_id, 'owner2')
+    self.assertEqual(db_lock.resource_data, 'data2')
+    self.assertEqual(manager.GetAcquireStats()['ho']['handoffs'], 1)
+
+    # With no one waiting, the lock is deleted.
+    self._RunAsync(manager.Release, self._client, lock2)
+    self.assertIsNone(self._RunAsync(Lock.Query, self._client, lock.lock_id, None, must_exist=False))
+
+  def testHandOffAfterAcquireFailure(self):
+    """Test that a lock is not handed off if another agent tried to acquire it."""
+    manager = LockManager()
+    lock, _ = self._RunAsync(manager.Acquire, self._client, 'hf', 'id0', owner_id='owner1')
+    future = manager.Acquire(self._client, 'hf', 'id0', owner_id='owner2', wait_secs=10)
+    self._TryAcquire('hf', 'id0', expected_status=Lock.FAILED_TO_ACQUIRE_LOCK)
+
+    # Lock is released through the database, and the waiter then acquires it there.
+    self._RunAsync(manager.Release, self._client, lock)
+    self.assertEqual(lock.acquire_failures, 1)
+    lock2, status = self._RunFuture(future)
+    self.assertEqual(status, Lock.ACQUIRED_LOCK)
+    self.assertEqual(lock2.owner_id, 'owner2')
+    self.assertIsNone(lock2.acquire_failures)
+    self._RunAsync(manager.Release, self._client, lock2)
+
+  def testWaitTimeout(self):
+    """Test that waiting for a lock held in this process times out."""
+    manager = LockManager()
+    lock, _ = self._RunAsync(manager.Acquire, self._client, 'wt', 'id0', owner_id='owner1')
+    _, status = self._RunAsync(manager.Acquire, self._client, 'wt', 'id0', owner_id='owner2', wait_secs=.1)
+    self.assertEqual(status, Lock.FAILED_TO_ACQUIRE_LOCK)
+
+    stats = manager.GetAcquireStats()['wt']
+    self.assertEqual((stats['acquires'], stats['failures'], stats['handoffs']), (1, 1, 0))
+    self.assertEqual(sum(count for _, count in stats['latency']), 2)
+    self._RunAsync(manager.Release, self._client, lock)
+
+  def testForgetHeld(self):
+    """Test that waiters for a lock whose owner failed without releasing it stop waiting."""
+    manager = LockManager()
+    lock, _ = self._RunAsync(manager.Acquire, self._client, 'fh', 'id0', owner_id='owner1')
+    future = manager.Acquire(self._client, 'fh', 'id0', owner_id='owner2', wait_secs=10)
+    self.assertFalse(future.done())
+
+    # The lock is still held in the database, so the waiter fails to acquire it.
+    manager.ForgetHeld('owner1')
+    _, status = self._RunFuture(future)
+    self.assertEqual(status, Lock.FAILED_TO_ACQUIRE_LOCK)
+
+    # A new acquire does not wait, and the owner can acquire the lock again.
+    _, status = self._RunAsync(manager.Acquire, self._client, 'fh', 'id0', owner_id='owner2', wait_secs=10)
+    self.assertEqual(status, Lock.FAILED_TO_ACQUIRE_LOCK)
+    lock, status = self._RunAsync(manager.Acquire, self._client, 'fh', 'id0', owner_id='owner1')
+    self.assertEqual(status, Lock.ACQUIRED_LOCK)
+    self._RunAsync(manager.Release, self._client, lock)
+
+  def testAbandonedHandler(self):
+    """Test that abandoned locks are passed to the handlers of their resource type."""
+    lock = self._TryAcquire('ab', 'id0', detect_abandonment=True, release_lock=False)
+    self._RunAsync(lock.Abandon, self._client)
+
+    abandoned = []
+    manager = LockManager()
+    manager.RegisterAbandonedHandler('ab', abandoned.append)
+    manager.RegisterAbandonedHandler('xx', lambda lock: self.fail('unexpected abandoned lock'))
+    self.assertEqual(self._RunAsync(manager.ScanAbandoned, self._client), 1)
+    self.assertEqual([lock.lock_id for lock in abandoned], ['ab:id0'])
+
+  def _RunFuture(self, future):
+    self.io_loop.add_future(future, self.stop)
+    return self.wait().result()
+
   def _TryAcquire(self, resource_type, resource_id, expected_status=Lock.ACQUIRED_LOCK,
                   resource_data=None, detect_abandonment=False, release_lock=True, test_hook=None):
     Lock._TryAcquire(self._client, resource_type, resource_id,
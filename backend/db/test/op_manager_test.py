@@ -10,13 +10,14 @@ import time
 
 from base_test import DBBaseTestCase
 from datetime import timedelta
-from tornado import gen
+from tornado import gen, options
 from viewfinder.backend.base.exceptions import CannotWaitError, PermissionError
 from viewfinder.backend.db.base import util
 from viewfinder.backend.db.lock import Lock
 from viewfinder.backend.db.lock_resource_type import LockResourceType
 from viewfinder.backend.db.operation import Operation
 from viewfinder.backend.op.op_manager import OpManager, OpMapEntry
+from viewfinder.backend.op.retry_scheduler import RetryScheduler
 from viewfinder.backend.op.user_op_manager import UserOpManager
 
 
@@ -40,7 +41,7 @@ class OpManagerTestCase(DBBaseTestCase):
     # Restore original values.
     OpManager.SetInstance(self.prev_op_mgr)
     UserOpManager._INITIAL_BACKOFF_SECS = 8.0
-    OpManager._MAX_SCAN_ABANDONED_LOCKS_INTERVAL = timedelta(seconds=60)
+    OpManager._MAX_SCAN_ABANDONED_LOCKS_INTERVAL = timedelta(minutes=5)
     OpManager._MAX_SCAN_FAILED_OPS_INTERVAL = timedelta(hours=6)
     OpManager._SCAN_LIMIT = 10
     super(OpManagerTestCase, self).tearDown()
@@ -143,6 +144,80 @@ class OpManagerTestCase(DBBaseTestCase):
 
     self._RunAsync(op_mgr.Drain)
 
+  def testScheduledRetry(self):
+    """Test that quarantined ops are retried once their backoff ends, without scanning."""
+    def _FlakyOpMethod(client, callback):
+      """Fails 4 times and then succeeds."""
+      self._method_count += 1
+      if self._method_count <= 4:
+        raise Exception('some transient failure')
+      callback()
+      self.io_loop.add_callback(self.stop)
+
+    op_map = {'_FlakyOpMethod': OpMapEntry(_FlakyOpMethod, [])}
+    op_mgr = OpManager(op_map, client=self._client)
+    op = self._CreateTestOp(user_id=1, handler=_FlakyOpMethod)
+    op_mgr.MaybeExecuteOp(self._client, 1, op.operation_id)
+    self.wait()
+    self.assertEqual(self._method_count, 5)
+    self.assertEqual(len(op_mgr.retry_scheduler), 0)
+
+    self._RunAsync(op_mgr.Drain)
+
+  def testScheduledLockRetry(self):
+    """Test that ops for a user locked by another server are retried once that lock expires."""
+    op_map = {'_OpMethod': OpMapEntry(self._OpMethod, [])}
+    op_mgr = OpManager(op_map, client=self._client)
+    lock = self._AcquireOpLock(user_id=1, detect_abandonment=True)
+    op = self._CreateTestOp(user_id=1, handler=self._OpMethod)
+    op_mgr.MaybeExecuteOp(self._client, 1, op.operation_id)
+    self._RunAsync(op_mgr.Drain)
+    self.assertEqual(self._method_count, 0)
+    self.assertEqual(len(op_mgr.retry_scheduler), 1)
+
+    # While the holder is alive, the retry is put off until its lock expires, without trying to
+    # acquire the lock again.
+    op_mgr.retry_scheduler.Schedule(1, op.operation_id, time.time())
+    self._RunAsync(self._WaitForFutureRetry, op_mgr.retry_scheduler, 1, op.operation_id)
+    self.assertEqual(op_mgr.retry_scheduler._deadlines[(1, op.operation_id)], lock.expiration)
+    held_lock = self._RunAsync(Lock.Query, self._client, lock.lock_id, None)
+    self.assertEqual(held_lock.acquire_failures, 1)
+    self.assertEqual(self._method_count, 0)
+
+    # Simulate failure of the lock holder.
+    self._RunAsync(lock.Abandon, self._client)
+    op_mgr.retry_scheduler.Schedule(1, op.operation_id, time.time())
+    self._RunAsync(self._WaitForMethodCount, 1)
+    self._RunAsync(op_mgr.Drain)
+
+  def testRetryScheduler(self):
+    """Test ordering, superseding and cancellation of scheduled retries."""
+    fired = []
+
+    def _OnRetry(user_id, operation_id):
+      fired.append((user_id, operation_id))
+      if len(fired) == 3:
+        self.io_loop.add_callback(self.stop)
+
+    scheduler = RetryScheduler(_OnRetry, max_retries=4)
+    now = time.time()
+    scheduler.Schedule(1, 'a', now + 0.3)
+    scheduler.Schedule(2, 'b', now + 0.1)
+    scheduler.Schedule(4, 'd', now + 0.2)
+    scheduler.Schedule(4, 'd', now + 0.01)
+    scheduler.Schedule(4, 'd', now + 0.5)
+    scheduler.Schedule(3, None, now + 0.15)
+    self.assertEqual(len(scheduler), 4)
+
+    # Too many retries are scheduled, so this one is left to the table scan.
+    scheduler.Schedule(5, 'e', now)
+    scheduler.Cancel(1, 'a')
+    self.assertEqual(len(scheduler), 3)
+
+    self.wait()
+    self.assertEqual(fired, [(4, 'd'), (2, 'b'), (3, None)])
+    self.assertEqual(len(scheduler), 0)
+
   def testSimpleUserOp(self):
     """Test simple operation that completes successfully."""
     self._ExecuteOp(user_id=1, handler=self._OpMethod)
@@ -465,13 +540,119 @@ class OpManagerTestCase(DBBaseTestCase):
 
     self.assertEqual(self._method_count, 9)
 
+  def testParallelOps(self):
+    """Test concurrent execution of non-conflicting ops for the same user."""
+    running = set()
+    history = []
+    max_running = [0]
+
+    @gen.coroutine
+    def _SlowOpMethod(client, key, index):
+      self.assertEqual(Operation.GetCurrent().operation_id, ops[index].operation_id)
+      running.add(index)
+      max_running[0] = max(max_running[0], len(running))
+      history.append(('start', key, index))
+      yield gen.Task(self.io_loop.add_timeout, time.time() + 0.05)
+      running.remove(index)
+      history.append(('end', key, index))
+
+    @gen.coroutine
+    def _ExclusiveOpMethod(client, key, index):
+      yield _SlowOpMethod(client, key, index)
+
+    # Op 4 has no resources hook, so must run on its own.
+    keys = ['a', 'b', 'a', 'c', None, 'b']
+    ops = [self._CreateTestOp(user_id=1, handler=_SlowOpMethod if key else _ExclusiveOpMethod, key=key, index=i)
+           for i, key in enumerate(keys)]
+
+    op_map = {'_SlowOpMethod': OpMapEntry(_SlowOpMethod, [], resources=lambda op_args: [op_args['key']]),
+              '_ExclusiveOpMethod': OpMapEntry(_ExclusiveOpMethod, [])}
+    options.options.max_parallel_user_ops = 3
+    try:
+      UserOpManager(self._client, op_map, 1, self.stop).Execute()
+      self.wait()
+    finally:
+      options.options.max_parallel_user_ops = 1
+
+    # Ops 0, 1 and 3 run together; op 2 waits for op 0, and op 4 runs on its own.
+    self.assertEqual(max_running[0], 3)
+    self.assertEqual([index for event, _, index in history if event == 'start'], [0, 1, 3, 2, 4, 5])
+    self.assertLess(history.index(('end', 'a', 0)), history.index(('start', 'a', 2)))
+    start_excl = history.index(('start', None, 4))
+    self.assertEqual(history[start_excl + 1], ('end', None, 4))
+    self.assertEqual(len([event for event in history[:start_excl] if event[0] == 'start']),
+                     len([event for event in history[:start_excl] if event[0] == 'end']))
+    self.assertEqual(self._RunAsync(Operation.RangeQuery, self._client, 1, None, None, None), [])
+
+  def testParallelRetry(self):
+    """Test that an op waiting out its retry backoff does not hold one of the parallel slots."""
+    running = set()
+    history = []
+    max_running = [0]
+
+    @gen.coroutine
+    def _SlowOpMethod(client, key, index):
+      running.add(index)
+      history.append(('start', index))
+      if index == 0 and history.count(('start', 0)) == 1:
+        running.remove(index)
+        raise Exception('some transient failure')
+      max_running[0] = max(max_running[0], len(running))
+      yield gen.Task(self.io_loop.add_timeout, time.time() + 0.05)
+      running.remove(index)
+      history.append(('end', index))
+
+    # Op 0 fails once and is retried after a backoff, so op 1 must wait for it.
+    keys = ['a', 'a', 'b', 'c', 'd']
+    for i, key in enumerate(keys):
+      self._CreateTestOp(user_id=1, handler=_SlowOpMethod, key=key, index=i)
+
+    op_map = {'_SlowOpMethod': OpMapEntry(_SlowOpMethod, [], resources=lambda op_args: [op_args['key']])}
+    UserOpManager._INITIAL_BACKOFF_SECS = 0.3
+    options.options.max_parallel_user_ops = 2
+    try:
+      UserOpManager(self._client, op_map, 1, self.stop).Execute()
+      self.wait()
+    finally:
+      options.options.max_parallel_user_ops = 1
+
+    # Ops 2, 3 and 4 use both slots while op 0 is backed off.
+    retry_start = len(history) - 1 - history[::-1].index(('start', 0))
+    self.assertEqual(max_running[0], 2)
+    self.assertTrue(all(('end', index) in history[:retry_start] for index in [2, 3, 4]))
+    self.assertLess(history.index(('end', 0)), history.index(('start', 1)))
+    self.assertEqual(self._RunAsync(Operation.RangeQuery, self._client, 1, None, None, None), [])
+
+  def testResourcesHookError(self):
+    """Test that a failing resources hook is an error, rather than making the op exclusive."""
+    def _BadResources(op_args):
+      raise ValueError('bad resources')
+
+    op = self._CreateTestOp(user_id=1, handler=self._OpMethod)
+    op_map = {'_OpMethod': OpMapEntry(self._OpMethod, [], resources=_BadResources)}
+    self.assertRaises(ValueError, UserOpManager(self._client, op_map, 1, None)._GetResources, op)
+
   def _OpMethod(self, client, callback):
     self._method_count += 1
     callback()
 
-  def _AcquireOpLock(self, user_id, operation_id=None):
+  def _WaitForMethodCount(self, count, callback):
+    if self._method_count >= count:
+      callback()
+    else:
+      self.io_loop.add_timeout(time.time() + 0.01, lambda: self._WaitForMethodCount(count, callback))
+
+  def _WaitForFutureRetry(self, retry_scheduler, user_id, operation_id, callback):
+    """Waits until the retry of "operation_id" is scheduled at a deadline that has not passed."""
+    if retry_scheduler._deadlines.get((user_id, operation_id), 0) > time.time():
+      callback()
+    else:
+      self.io_loop.add_timeout(time.time() + 0.01,
+                               lambda: self._WaitForFutureRetry(retry_scheduler, user_id, operation_id, callback))
+
+  def _AcquireOpLock(self, user_id, operation_id=None, detect_abandonment=False):
     Lock.TryAcquire(self._client, LockResourceType.Operation, str(user_id), lambda lock, status: self.stop(lock),
-                    resource_data=operation_id)
+                    resource_data=operation_id, detect_abandonment=detect_abandonment)
     return self.wait()
 
   def _ExecuteOp(self, user_id, handler, wait_for_op=True, **kwargs):
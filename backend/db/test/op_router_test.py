@@ -0,0 +1,160 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests for OpRouter, HashRing and server membership.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import json
+import time
+
+from base_test import DBBaseTestCase
+from tornado import httpserver, testing, web
+from viewfinder.backend.base import counters
+from viewfinder.backend.base.exceptions import PermissionError
+from viewfinder.backend.db.operation import Operation
+from viewfinder.backend.op.op_manager import OpManager, OpMapEntry
+from viewfinder.backend.op.op_router import HashRing, LocalServerMembership, OpRouter, ServerMembership
+from viewfinder.backend.www.internal_rpc import ExecuteOpsHandler
+
+
+class OpRouterTestCase(DBBaseTestCase):
+  def setUp(self):
+    super(OpRouterTestCase, self).setUp()
+    self._method_count = 0
+
+    # Serve forwarded ops for the "remote" owner from this process.
+    sock, port = testing.bind_unused_port()
+    self._http_server = httpserver.HTTPServer(web.Application([(OpRouter.FORWARD_PATH, ExecuteOpsHandler,
+                                                                {'client': self._client})]),
+                                              io_loop=self.io_loop)
+    self._http_server.add_sockets([sock])
+    self._owner_address = 'localhost:%d' % port
+
+    self._prev_op_mgr = OpManager.Instance()
+    self._op_map = {'_OpMethod': OpMapEntry(self._OpMethod, []),
+                    '_FailingOpMethod': OpMapEntry(self._FailingOpMethod, [])}
+    self._owner_op_mgr = OpManager(self._op_map, client=self._client)
+    OpManager.SetInstance(self._owner_op_mgr)
+    self._routers = []
+
+  def tearDown(self):
+    # Stop routers while the IOLoop is still open.
+    for router in self._routers:
+      self._RunAsync(router.Stop)
+    self._http_server.stop()
+    OpManager.SetInstance(self._prev_op_mgr)
+    super(OpRouterTestCase, self).tearDown()
+
+  def testHashRing(self):
+    """Keys are spread over all nodes, and adding a node only moves keys to that node."""
+    ring = HashRing(['a:1', 'b:1', 'c:1'])
+    owners = dict((user_id, ring.GetNode(user_id)) for user_id in xrange(3000))
+    for node in ['a:1', 'b:1', 'c:1']:
+      self.assertGreater(owners.values().count(node), 700)
+
+    ring = HashRing(['a:1', 'b:1', 'c:1', 'd:1'])
+    moved = [user_id for user_id in owners if ring.GetNode(user_id) != owners[user_id]]
+    self.assertTrue(all(ring.GetNode(user_id) == 'd:1' for user_id in moved))
+    self.assertLess(len(moved), 1000)
+
+    self.assertIsNone(HashRing([]).GetNode(1))
+
+  def testServerMembership(self):
+    """Servers whose heartbeat lock is abandoned drop out of the live set."""
+    membership = ServerMembership(self._client)
+    self._RunAsync(membership.Join, 'host1:8090')
+    self._RunAsync(membership.Join, 'host2:8090')
+    self.assertEqual(self._RunAsync(membership.QueryLiveServers), set(['host1:8090', 'host2:8090']))
+
+    # Simulate the loss of host2's heartbeat.
+    self._RunAsync(membership._locks['host2:8090'].Abandon, self._client)
+    self.assertEqual(self._RunAsync(membership.QueryLiveServers), set(['host1:8090']))
+
+    self._RunAsync(membership.Leave, 'host1:8090')
+    self.assertEqual(self._RunAsync(membership.QueryLiveServers), set())
+
+  def testForward(self):
+    """Ops for a user owned by another server are executed by that server."""
+    router = self._StartRouter(self._owner_address)
+    user_id = self._FindUser(router, self._owner_address)
+    local_op_mgr = OpManager(self._op_map, client=self._client, router=router)
+
+    op = self._CreateTestOp(user_id, '_OpMethod')
+    self._ExecuteOp(local_op_mgr, op)
+    self.assertEqual(self._method_count, 1)
+    self._RunAsync(self._owner_op_mgr.Drain)
+    self.assertEqual(self._RunAsync(Operation.RangeQuery, self._client, user_id, None, None, None), [])
+
+  def testForwardError(self):
+    """A synchronous caller sees the error raised by an op executed on the owning server."""
+    router = self._StartRouter(self._owner_address)
+    user_id = self._FindUser(router, self._owner_address)
+    local_op_mgr = OpManager(self._op_map, client=self._client, router=router)
+
+    op = self._CreateTestOp(user_id, '_FailingOpMethod')
+    self.assertRaises(PermissionError, self._ExecuteOp, local_op_mgr, op)
+    self._RunAsync(self._owner_op_mgr.Drain)
+
+  def testFailover(self):
+    """Ops are executed locally once the owner's heartbeat expires, or if it cannot be reached."""
+    sock, unused_port = testing.bind_unused_port()
+    sock.close()
+    dead_address = 'localhost:%d' % unused_port
+    membership = LocalServerMembership()
+    router = self._StartRouter(dead_address, membership=membership)
+    user_id = self._FindUser(router, dead_address)
+    local_op_mgr = OpManager(self._op_map, client=self._client, router=router)
+
+    # Owner cannot be reached, so op is executed locally.
+    op = self._CreateTestOp(user_id, '_OpMethod')
+    self._ExecuteOp(local_op_mgr, op)
+    self.assertEqual(self._method_count, 1)
+
+    # Once the owner's heartbeat expires, the local server owns the user.
+    membership.Expire(dead_address)
+    self._RunAsync(router.Refresh)
+    self.assertTrue(router.IsOwner(user_id))
+    self._RunAsync(local_op_mgr.Drain)
+
+  def testLiveServersCounter(self):
+    """The live servers counter follows the ring, and drops back once the router stops."""
+    live_servers = counters.counters.viewfinder.op_router.live_servers
+    start_total = live_servers.get_total()
+    membership = LocalServerMembership()
+    self._RunAsync(membership.Join, 'host1:8090')
+    router = OpRouter(membership, 'localhost:1')
+    self._RunAsync(router.Start)
+    self.assertEqual(live_servers.get_total(), start_total + 2)
+
+    self._RunAsync(router.Stop)
+    self.assertEqual(live_servers.get_total(), start_total)
+
+  def _StartRouter(self, owner_address, membership=None):
+    membership = membership or LocalServerMembership()
+    self._RunAsync(membership.Join, owner_address)
+    router = OpRouter(membership, 'localhost:1')
+    self._RunAsync(router.Start)
+    self._routers.append(router)
+    return router
+
+  def _FindUser(self, router, address):
+    return next(user_id for user_id in xrange(100, 1000) if router.GetOwner(user_id) == address)
+
+  def _ExecuteOp(self, op_mgr, op):
+    op_mgr.MaybeExecuteOp(self._client, op.user_id, op.operation_id, wait_callback=self.stop)
+    self.wait()
+
+  def _CreateTestOp(self, user_id, method):
+    op = Operation.CreateFromKeywords(user_id=user_id, operation_id=Operation.ConstructOperationId(1, user_id),
+                                      device_id=1, method=method, json=json.dumps({}), timestamp=time.time(),
+                                      attempts=0)
+    self._RunAsync(op.Update, self._client)
+    return op
+
+  def _OpMethod(self, client, callback):
+    self._method_count += 1
+    callback()
+
+  def _FailingOpMethod(self, client, callback):
+    raise PermissionError('Not Authorized')
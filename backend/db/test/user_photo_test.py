@@ -42,3 +42,47 @@ class UserPhotoTestCase(DBBaseTestCase):
       asset_keys=['a/#b', 'a/#f'])
     user_photo.MergeAssetKeys(['a/b#c', 'a/d#c', 'a/e#f'])
     self.assertEqual(user_photo.asset_keys.combine(), set(['a/#b', 'a/#c', 'a/#f']))
+
+  def testFingerprintIndex(self):
+    sha1 = 'e5ad400c2214088928ef8400dcfb87bb3059b742'
+    other_sha1 = '0123456789abcdef0123456789abcdef01234567'
+    self._RunAsync(UserPhoto.CreateNew, self._client, user_id=1, photo_id='p1',
+                   asset_keys=['a/b#N' + sha1])
+    self._RunAsync(UserPhoto.CreateNew, self._client, user_id=1, photo_id='p2',
+                   asset_keys=['a/c#N' + other_sha1, 'a/#asset-key'])
+    self._RunAsync(UserPhoto.CreateNew, self._client, user_id=2, photo_id='p3',
+                   asset_keys=['a/d#N' + sha1])
+
+    index = self._RunAsync(UserPhoto.BuildFingerprintIndex, self._client, 1)
+    self.assertEqual(len(index), 2)
+    self.assertEqual(UserPhoto.FindDuplicates(index, ['a/e#N' + sha1]), [('p1', 0)])
+    self.assertEqual(UserPhoto.FindDuplicates(index, ['a/#asset-key']), [])
+
+  def testCachedFingerprintIndex(self):
+    self.addCleanup(UserPhoto._fingerprint_indexes.clear)
+    sha1 = 'e5ad400c2214088928ef8400dcfb87bb3059b742'
+    other_sha1 = '0123456789abcdef0123456789abcdef01234567'
+    self._RunAsync(UserPhoto.CreateNew, self._client, user_id=1, photo_id='p1',
+                   asset_keys=['a/b#N' + sha1])
+
+    index = self._RunAsync(UserPhoto.GetFingerprintIndex, self._client, 1)
+    self.assertEqual(len(index), 1)
+
+    # Photos added on this server update the cached index.
+    self._RunAsync(UserPhoto.CreateNew, self._client, user_id=1, photo_id='p2',
+                   asset_keys=['a/c#N' + other_sha1])
+    self._RunAsync(UserPhoto.UpdateOperation, self._client,
+                   {'user_id': 1, 'photo_id': 'p3', 'asset_keys': ['a/d#N' + sha1]})
+    self.assertIs(self._RunAsync(UserPhoto.GetFingerprintIndex, self._client, 1), index)
+    self.assertEqual(sorted(UserPhoto.FindDuplicates(index, ['a/e#N' + sha1])), [('p1', 0), ('p3', 0)])
+    self.assertEqual(UserPhoto.FindDuplicates(index, ['a/e#N' + other_sha1]), [('p2', 0)])
+
+    # Invalidated indexes are rebuilt, and still include the user's removed photos.
+    UserPhoto.InvalidateCachedFingerprintIndex(1)
+    rebuilt_index = self._RunAsync(UserPhoto.GetFingerprintIndex, self._client, 1)
+    self.assertIsNot(rebuilt_index, index)
+    self.assertEqual(len(rebuilt_index), 3)
+
+    # Expired indexes are rebuilt.
+    UserPhoto._fingerprint_indexes[1] = (0, rebuilt_index)
+    self.assertIsNot(self._RunAsync(UserPhoto.GetFingerprintIndex, self._client, 1), rebuilt_index)
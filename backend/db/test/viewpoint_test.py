@@ -3,6 +3,9 @@
 
 __author__ = 'ben@emailscrubbed.com (Ben Darnell)'
 
+import mock
+
+from viewfinder.backend.db.activity import Activity
 from viewfinder.backend.db.viewpoint import Viewpoint
 
 from base_test import DBBaseTestCase
@@ -12,3 +15,28 @@ class ViewpointTestCase(DBBaseTestCase):
     vp = Viewpoint.CreateFromKeywords(viewpoint_id='vp1', title='hello')
     self.assertIn('vp1', repr(vp))
     self.assertNotIn('hello', repr(vp))
+
+  @mock.patch.object(Viewpoint, '_ACTIVITY_QUERY_LIMIT', 2)
+  def testQueryActivitiesSince(self):
+    """Verify that activities are queried up to the page that reaches "since_seq", even if some
+    update_seq values have no activity.
+    """
+    # update_seq 3 has no activity.
+    for update_seq in [1, 2, 4, 5, 6]:
+      timestamp = 1000 + update_seq
+      activity = Activity.CreateFromKeywords(viewpoint_id='vp1',
+                                             activity_id=Activity.ConstructActivityId(timestamp, 1, update_seq),
+                                             user_id=1, timestamp=timestamp, update_seq=update_seq,
+                                             name='post_comment', json='{}')
+      self._RunAsync(activity.Update, self._client)
+
+    activities = self._RunAsync(Viewpoint.QueryActivitiesSince, self._client, 'vp1', 1, 6)
+    self.assertEqual([2, 4, 5, 6], [activity.update_seq for activity in activities])
+
+    activities = self._RunAsync(Viewpoint.QueryActivitiesSince, self._client, 'vp1', 6, 6)
+    self.assertEqual([], activities)
+
+    with mock.patch.object(Activity, 'RangeQuery', wraps=Activity.RangeQuery) as range_query:
+      activities = self._RunAsync(Viewpoint.QueryActivitiesSince, self._client, 'vp1', 4, 6)
+      self.assertEqual([5, 6], [activity.update_seq for activity in activities])
+      self.assertEqual(2, range_query.call_count)
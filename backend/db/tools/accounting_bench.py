@@ -0,0 +1,128 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for sharded accounting entries.
+
+Applies --num_ops concurrent accounting updates, each from a different
+operation, to the visible-to entry of a single viewpoint and the visible-to
+entries of --num_followers followers, as a burst of shares into one large
+viewpoint would. Every datastore request is delayed by --latency_ms to model
+the round trip to DynamoDB, so that the query and conditional update of each
+ApplyAccounting interleave with those of other operations. Runs once with
+the entries unsharded and once with --num_shards shards, and reports elapsed
+time, conflict retries per operation and datastore requests per operation,
+followed by the cost of compacting the shards.
+
+Usage:
+python -m viewfinder.backend.db.tools.accounting_bench --num_ops=200 --num_shards=8
+"""
+
+__author__ = 'marc@emailscrubbed.com (Marc Berhault)'
+
+import logging
+import sys
+import time
+
+from functools import partial
+from tornado import gen, options
+from tornado.ioloop import IOLoop
+from viewfinder.backend.base import counters
+from viewfinder.backend.db import vf_schema
+from viewfinder.backend.db.accounting import Accounting, AccountingAccumulator
+from viewfinder.backend.db.local_client import LocalClient
+from viewfinder.backend.db.operation import Operation
+from viewfinder.backend.op.op_context import EnterOpContext
+
+options.define('num_ops', default=200, help='number of concurrent operations')
+options.define('num_followers', default=5, help='number of followers whose visible-to entries are updated')
+options.define('num_shards', default=8, help='number of accounting shards in the sharded run')
+options.define('latency_ms', default=5.0, help='simulated latency of each datastore request')
+
+
+class _DelayingClient(object):
+  """Wraps a datastore client, counting requests and delaying each response by "latency"
+  seconds.
+  """
+  def __init__(self, client, latency):
+    self._client = client
+    self._latency = latency
+    self.requests = 0
+
+  def GetItem(self, table, key, callback, attributes, **kwargs):
+    self.requests += 1
+    self._client.GetItem(table, key, partial(self._Respond, callback), attributes, **kwargs)
+
+  def UpdateItem(self, table, key, callback, **kwargs):
+    self.requests += 1
+    self._client.UpdateItem(table, key, partial(self._Respond, callback), **kwargs)
+
+  def Query(self, table, hash_key, range_operator, callback, attributes, **kwargs):
+    self.requests += 1
+    self._client.Query(table, hash_key, range_operator, partial(self._Respond, callback), attributes, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(self._client, name)
+
+  def _Respond(self, callback, result):
+    IOLoop.current().add_timeout(time.time() + self._latency, partial(callback, result))
+
+
+@gen.coroutine
+def _ApplyShare(client, index):
+  """Applies the accounting of a share of one photo into the viewpoint, as a single operation."""
+  acc_accum = AccountingAccumulator()
+  act = Accounting()
+  act.num_photos = 1
+  act.orig_size = 1000
+  acc_accum.GetViewpointVisibleTo('vp1').IncrementStatsFrom(act)
+  for follower_id in xrange(1, options.options.num_followers + 1):
+    acc_accum.GetUserVisibleTo(follower_id).IncrementStatsFrom(act)
+
+  with EnterOpContext(Operation(1, 'o%d' % index)):
+    yield acc_accum.Apply(client)
+
+
+@gen.coroutine
+def _RunBurst(num_shards, first_index):
+  options.options.accounting_shards = num_shards
+  local_client = LocalClient(vf_schema.SCHEMA)
+  yield gen.Task(vf_schema.SCHEMA.VerifyOrCreate, local_client)
+  client = _DelayingClient(local_client, options.options.latency_ms / 1000.0)
+  conflicts = counters.counters['viewfinder.accounting.apply_conflicts_per_min']
+
+  start_conflicts = conflicts.get_total()
+  start = time.time()
+  yield [_ApplyShare(client, first_index + i) for i in xrange(options.options.num_ops)]
+  elapsed = time.time() - start
+
+  num_ops = options.options.num_ops
+  logging.info('%-10s %8.1f ms total %8.2f conflict retries/op %8.2f requests/op' %
+               ('%d shards' % num_shards, 1000 * elapsed, float(conflicts.get_total() - start_conflicts) / num_ops,
+                float(client.requests) / num_ops))
+
+  total = yield gen.Task(Accounting.QueryViewpointVisibleTo, client, 'vp1')
+  assert total.num_photos == num_ops, (total.num_photos, num_ops)
+
+  if num_shards > 0:
+    client.requests = 0
+    start = time.time()
+    num_compacted = yield Accounting.CompactShards(client, 'vs:vp1', Accounting.VISIBLE_TO)
+    logging.info('compacted %d shards in %.1f ms using %d requests' %
+                 (num_compacted, 1000 * (time.time() - start), client.requests))
+    total = yield gen.Task(Accounting.QueryViewpointVisibleTo, client, 'vp1')
+    assert total.num_photos == num_ops, (total.num_photos, num_ops)
+
+
+@gen.coroutine
+def Run():
+  yield _RunBurst(0, 0)
+  yield _RunBurst(options.options.num_shards, options.options.num_ops)
+
+
+def main():
+  options.parse_command_line()
+  IOLoop.current().run_sync(Run)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -15,6 +15,17 @@ Usage:
 
   # Repair corruptions found in the database during the check phase.
   python dbchk.py --repair=True --viewpoints=vp1,vp2
+
+  # Only check viewpoints in the UpdatedViewpoint feed since the previous incremental run, 20 at a time,
+  # issuing at most 50 reads per second.
+  python dbchk.py --incremental --check_concurrency=20 --max_read_qps=50
+
+In incremental mode, each feed row is deleted once its viewpoint has been checked, and the
+run records the end of the range of feed buckets that it consumed. A run that fails part-way
+through is resumed by the next run, which starts from the end of the previous successful run
+and finds only the rows that were not yet checked. Every successful run, incremental or not,
+then deletes feed rows older than --updated_viewpoint_retention_hours, which no incremental
+run would resume from.
 """
 
 __author__ = 'andy@emailscrubbed.com (Andrew Kimball)'
@@ -30,7 +41,7 @@ from copy import deepcopy
 from functools import partial
 from tornado import gen, options, stack_context
 from tornado.ioloop import IOLoop
-from viewfinder.backend.base import constants, main, util
+from viewfinder.backend.base import constants, main, rate_limiter, util
 from viewfinder.backend.base.dotdict import DotDict
 from viewfinder.backend.db import db_client, vf_schema
 from viewfinder.backend.db.accounting import Accounting
@@ -44,6 +55,7 @@ from viewfinder.backend.db.notification import Notification
 from viewfinder.backend.db.operation import Operation
 from viewfinder.backend.db.photo import Photo
 from viewfinder.backend.db.post import Post
+from viewfinder.backend.db.updated_viewpoint import UpdatedViewpoint
 from viewfinder.backend.db.user_post import UserPost
 from viewfinder.backend.db.viewpoint import Viewpoint
 from viewfinder.backend.op.notification_manager import NotificationManager
@@ -70,6 +82,26 @@ options.define('require_lock', type=bool, default=True,
 options.define('hours_between_runs', type=int, default=0,
                help='minimum time since start of last successful full run (without --viewpoints)')
 
+options.define('compact_accounting', type=bool, default=True,
+               help='fold the shard rows of sharded accounting entries into their entry rows while checking')
+
+options.define('incremental', type=bool, default=False,
+               help='only check viewpoints in the updated viewpoint feed since the last incremental run, '
+                    'resuming any run that did not complete; ignored if --viewpoints is set')
+
+options.define('incremental_lookback_hours', type=int, default=7 * 24,
+               help='hours of the updated viewpoint feed to check if there is no previous incremental run')
+
+options.define('check_concurrency', type=int, default=10,
+               help='maximum number of viewpoints checked at once in incremental mode')
+
+options.define('max_read_qps', type=float, default=50.0,
+               help='maximum datastore reads per second issued by the checker in incremental mode')
+
+options.define('updated_viewpoint_retention_hours', type=int, default=7 * 24,
+               help='hours after which rows of the updated viewpoint feed are deleted, even if unchecked; '
+                    'incremental runs never resume from further back than the last week')
+
 
 _TEST_MODE = False
 """If true, run the checker in test mode."""
@@ -80,6 +112,38 @@ time window).
 """
 
 
+class _ReadBudgetClient(object):
+  """Wraps a datastore client, delaying read requests so that no more than "max_qps" of them
+  are issued per second. Concurrent readers are spaced out by a token bucket rather than each
+  sleeping for a fixed interval. Other requests are passed through.
+  """
+  def __init__(self, client, max_qps):
+    self._client = client
+    self._bucket = rate_limiter.TokenBucket(max_qps)
+
+  def GetItem(self, *args, **kwargs):
+    self._Throttle(self._client.GetItem, args, kwargs)
+
+  def BatchGetItem(self, *args, **kwargs):
+    self._Throttle(self._client.BatchGetItem, args, kwargs)
+
+  def Query(self, *args, **kwargs):
+    self._Throttle(self._client.Query, args, kwargs)
+
+  def Scan(self, *args, **kwargs):
+    self._Throttle(self._client.Scan, args, kwargs)
+
+  def __getattr__(self, name):
+    return getattr(self._client, name)
+
+  def _Throttle(self, func, args, kwargs):
+    delay = self._bucket.Reserve()
+    if delay == 0.0:
+      func(*args, **kwargs)
+    else:
+      IOLoop.current().add_timeout(time.time() + delay, partial(func, *args, **kwargs))
+
+
 class DatabaseChecker(object):
   """Collection of methods that scan the database, looking for instances
   of corruption.
@@ -113,8 +177,12 @@ class DatabaseChecker(object):
 
     self._num_visited_viewpoints = 0
 
-    # Current viewpoint or user being processed, used in failed job message.
-    self._current_viewpoint = ''
+    # Ids of viewpoints already checked by CheckUpdatedViewpoints, which can find the same
+    # viewpoint in several buckets of the feed.
+    self._checked_viewpoint_ids = set()
+
+    # Viewpoint whose check failed and current user being processed, used in failed job message.
+    self._failed_viewpoint = ''
     self._current_user = ''
 
   @gen.engine
@@ -165,13 +233,87 @@ class DatabaseChecker(object):
 
     callback()
 
+  @gen.engine
+  def CheckUpdatedViewpoints(self, start_time, end_time, callback, concurrency=1):
+    """Looks for corruption in each viewpoint of the UpdatedViewpoint feed buckets from the
+    one containing "start_time" up to "end_time" (exclusive), checking up to "concurrency"
+    viewpoints at once. Each feed row is deleted once its viewpoint has been checked.
+    """
+    # Clear email args used for testing.
+    self._email_args = None
+
+    bucket_start = UpdatedViewpoint.GetBucketStart(start_time)
+    while bucket_start < end_time:
+      updated_vps = yield UpdatedViewpoint.QueryBucket(self._client, bucket_start)
+      if updated_vps:
+        logging.info('Checking %d viewpoints updated after %s...' %
+                     (len(updated_vps), time.asctime(time.localtime(bucket_start))))
+      yield util.RunConcurrently(self._CheckUpdatedViewpoint, updated_vps, concurrency)
+      bucket_start += UpdatedViewpoint.BUCKET_SECS
+
+    # Force a check of all visited users, we may have some remaining.
+    yield gen.Task(self._CheckVisitedUsers)
+
+    # Check to see whether a corruption report needs to be emailed.
+    yield gen.Task(self._SendEmail)
+
+    callback()
+
+  @gen.coroutine
+  def _CheckUpdatedViewpoint(self, updated_vp):
+    """Checks the viewpoint of a feed row, unless it has already been checked during this run,
+    and then deletes the row.
+    """
+    if updated_vp.viewpoint_id not in self._checked_viewpoint_ids:
+      self._checked_viewpoint_ids.add(updated_vp.viewpoint_id)
+      viewpoint = yield gen.Task(Viewpoint.Query, self._client, updated_vp.viewpoint_id, None, must_exist=False)
+      if viewpoint is not None:
+        yield gen.Task(self.CheckViewpoint, viewpoint)
+
+    yield gen.Task(updated_vp.Delete, self._client)
+
+  @gen.engine
+  def TrimUpdatedViewpoints(self, cutoff, callback):
+    """Deletes the rows of the UpdatedViewpoint feed in buckets that start before "cutoff",
+    whether or not their viewpoints have been checked. Invokes "callback" with the number of
+    rows deleted.
+    """
+    num_trimmed = [0]
+
+    @gen.engine
+    def _VisitUpdatedViewpoint(updated_vp, callback):
+      if updated_vp.GetRowBucketStart() < cutoff:
+        yield gen.Task(updated_vp.Delete, self._client)
+        num_trimmed[0] += 1
+      callback()
+
+    yield gen.Task(self._ThrottledScan,
+                   UpdatedViewpoint,
+                   visitor=_VisitUpdatedViewpoint,
+                   max_read_units=UpdatedViewpoint._table.read_units)
+    if num_trimmed[0] > 0:
+      logging.info('Trimmed %d rows from the updated viewpoint feed' % num_trimmed[0])
+    callback(num_trimmed[0])
+
   @gen.engine
   def CheckViewpoint(self, viewpoint, callback):
+    """Checks the specified viewpoint for various kinds of corruption. Viewpoints may be checked
+    concurrently, so the viewpoint is remembered for the failed run's message only if its check
+    fails.
+    """
+    try:
+      yield gen.Task(self._CheckViewpoint, viewpoint)
+    except:
+      self._failed_viewpoint = self._failed_viewpoint or viewpoint.viewpoint_id
+      raise
+    callback()
+
+  @gen.engine
+  def _CheckViewpoint(self, viewpoint, callback):
     """Checks the specified viewpoint for various kinds of corruption."""
     # Don't check viewpoints that were modified within last hour, as operation might still be in progress.
     if _TEST_MODE or viewpoint.last_updated <= time.time() - _CHECK_THRESHOLD_TIMESPAN:
       logging.info('Processing viewpoint "%s"...' % viewpoint.viewpoint_id)
-      self._current_viewpoint = viewpoint.viewpoint_id
       self._num_visited_viewpoints += 1
 
       # Gather followers.
@@ -218,16 +360,19 @@ class DatabaseChecker(object):
                            '%s:%s' % (Accounting.VIEWPOINT_SIZE, viewpoint.viewpoint_id),
                            range_desc=None, col_names=None)
       accounting = yield gen.Task(self._CacheQuery, query_func)
+      yield gen.Task(self._MaybeCompactAccounting, accounting)
+      accounting = Accounting.SumShards(accounting)
 
       if viewpoint.IsDefault():
         # Default viewpoint has a viewpoint-level OWNED_BY accounting entry matching exactly
         # the user-level OWNED_BY entry for the viewpoint owner. Look it up now.
-        user_accounting = yield gen.Task(Accounting.Query, self._client,
+        user_accounting = yield gen.Task(Accounting.RangeQuery, self._client,
                                          '%s:%d' % (Accounting.USER_SIZE, viewpoint.user_id),
-                                         Accounting.OWNED_BY, None, must_exist=False)
-        if user_accounting is not None:
+                                         Accounting.GetEntryRange(Accounting.OWNED_BY), None, None)
+        yield gen.Task(self._MaybeCompactAccounting, user_accounting)
+        if user_accounting:
           # Add it to the accounting list. It will be automatically checked in CheckBadViewpointAccounting.
-          accounting.append(user_accounting)
+          accounting.extend(Accounting.SumShards(user_accounting))
       else:
         # Set each follower id in visited_users. We only do this for shared viewpoint as the per-user
         # actions do not process default viewpoint accounting.
@@ -270,7 +415,6 @@ class DatabaseChecker(object):
       logging.info('Skipping viewpoint "%s" because it was modified in the last hour...', viewpoint.viewpoint_id)
 
     # Check users in visited_users if it has grown big enough.
-    self._current_viewpoint = ''
     yield gen.Task(self._MaybeCheckVisitedUsers)
     callback()
 
@@ -746,8 +890,29 @@ class DatabaseChecker(object):
 
     callback()
 
+  @gen.engine
+  def _MaybeCompactAccounting(self, accounting_list, callback):
+    """If --compact_accounting is set, folds the shard rows of any sharded entries in
+    'accounting_list' into their entry rows. Since compaction leaves the sum of each entry and
+    its shards unchanged, the rows in 'accounting_list' can still be summed afterwards.
+    """
+    if options.options.compact_accounting:
+      entry_keys = set()
+      for act in accounting_list:
+        entry_key, index = Accounting.SplitSortKey(act.sort_key)
+        if index is not None and not act.IsZero():
+          entry_keys.add((act.hash_key, entry_key))
+
+      for hash_key, sort_key in sorted(entry_keys):
+        yield Accounting.CompactShards(self._client, hash_key, sort_key)
+
+    callback()
+
   @gen.engine
   def _RepairBadViewpointAccounting(self, action, accounting, callback):
+    # Fold any shards into the entry row first, so that they are zero once the entry row is
+    # overwritten with the correct totals.
+    yield Accounting.CompactShards(self._client, accounting.hash_key, accounting.sort_key)
     if action == 'update':
       # Update wrong accounting entry.
       yield gen.Task(accounting.Update, self._client)
@@ -771,9 +936,10 @@ class DatabaseChecker(object):
   @gen.engine
   def _CheckVisitedUsers(self, callback):
     """Check each user in the visited_users set and clear it. Called after processing all viewpoint."""
-    logging.info('Processing %d visited users' % len(self._visited_users))
-    yield [gen.Task(self._CheckUser, user_id, vp_id) for user_id, vp_id in self._visited_users.iteritems()]
-    self._visited_users.clear()
+    # Take the current set, since viewpoints checked concurrently may add users while these are checked.
+    visited_users, self._visited_users = self._visited_users, {}
+    logging.info('Processing %d visited users' % len(visited_users))
+    yield [gen.Task(self._CheckUser, user_id, vp_id) for user_id, vp_id in visited_users.iteritems()]
 
     callback()
 
@@ -806,7 +972,7 @@ class DatabaseChecker(object):
                              range_desc=None,
                              col_names=None)
         vp_accounting = yield gen.Task(self._CacheQuery, query_func)
-        for act in vp_accounting:
+        for act in Accounting.SumShards(vp_accounting):
           if act.sort_key == vp_sb_sort_key:
             accounting_sb.IncrementStatsFrom(act)
           elif act.sort_key == Accounting.VISIBLE_TO:
@@ -828,11 +994,13 @@ class DatabaseChecker(object):
                        (user_id, n.notification_id, n.viewpoint_id, n.activity_id),
                        None)
 
-    # Now fetch the user's accounting entries.
-    user_sb = yield gen.Task(Accounting.Query, self._client, '%s:%d' % (Accounting.USER_SIZE, user_id),
-                             Accounting.SHARED_BY, None, must_exist=False)
-    user_vt = yield gen.Task(Accounting.Query, self._client, '%s:%d' % (Accounting.USER_SIZE, user_id),
-                             Accounting.VISIBLE_TO, None, must_exist=False)
+    # Now fetch the user's accounting entries, summed over their shards.
+    user_accounting = yield gen.Task(Accounting.RangeQuery, self._client, '%s:%d' % (Accounting.USER_SIZE, user_id),
+                                     None, None, None)
+    yield gen.Task(self._MaybeCompactAccounting, user_accounting)
+    user_entries = dict((act.sort_key, act) for act in Accounting.SumShards(user_accounting))
+    user_sb = user_entries.get(Accounting.SHARED_BY)
+    user_vt = user_entries.get(Accounting.VISIBLE_TO)
 
     # Check users's accounting entries against aggregated viewpoint entries.
     # If the built-up accounting is zero, we do not create missing entries as this both complicates
@@ -1026,10 +1194,32 @@ def RunOnce(client, job, callback):
   We must be called with the job lock held or not require locking.
   """
   assert not options.options.require_lock or job.HasLock() == True
-  checker = DatabaseChecker(client, repair=options.options.repair)
+  incremental = options.options.incremental and not options.options.viewpoints
+  if incremental:
+    checker = DatabaseChecker(_ReadBudgetClient(client, options.options.max_read_qps), repair=options.options.repair)
+  else:
+    checker = DatabaseChecker(client, repair=options.options.repair)
 
   last_scan = None
-  if options.options.smart_scan:
+  if incremental:
+    # Resume from the end of the feed range consumed by the last successful incremental run. Rows of viewpoints
+    # checked by failed runs since then have already been deleted.
+    last_run = yield gen.Task(job.FindLastSuccess, with_payload_key='stats.feed_end')
+    if last_run is None:
+      feed_start = time.time() - options.options.incremental_lookback_hours * constants.SECONDS_PER_HOUR
+      logging.info('No successful incremental run found in the last week; checking the last %d hours of updates.' %
+                   options.options.incremental_lookback_hours)
+    else:
+      feed_start = last_run['stats.feed_end']
+
+    # Only consume buckets whose updates are all old enough to be checked (see CheckViewpoint).
+    if _TEST_MODE:
+      feed_end = UpdatedViewpoint.GetBucketStart(time.time()) + UpdatedViewpoint.BUCKET_SECS
+    else:
+      feed_end = UpdatedViewpoint.GetBucketStart(time.time() - _CHECK_THRESHOLD_TIMESPAN)
+    logging.info('Checking viewpoints updated between %s and %s' %
+                 (time.asctime(time.localtime(feed_start)), time.asctime(time.localtime(feed_end))))
+  elif options.options.smart_scan:
     # Search for successful full-scan run in the last week.
     last_run = yield gen.Task(job.FindLastSuccess, with_payload_key='stats.full_scan', with_payload_value=True)
 
@@ -1054,20 +1244,30 @@ def RunOnce(client, job, callback):
   try:
     if options.options.viewpoints:
       yield gen.Task(checker.CheckViewpointList, options.options.viewpoints)
+    elif incremental:
+      yield gen.Task(checker.CheckUpdatedViewpoints, feed_start, feed_end,
+                     concurrency=options.options.check_concurrency)
     else:
       yield gen.Task(checker.CheckAllViewpoints, last_scan=last_scan)
+
+    # Trim feed rows that no incremental run will ever check.
+    retention_secs = options.options.updated_viewpoint_retention_hours * constants.SECONDS_PER_HOUR
+    num_trimmed = yield gen.Task(checker.TrimUpdatedViewpoints, time.time() - retention_secs)
   except:
     # Failure: log run summary with trace.
     typ, val, tb = sys.exc_info()
-    msg = 'Error while visiting viewpoint=%s or user=%s\n' % (checker._current_viewpoint, checker._current_user)
+    msg = 'Error while visiting viewpoint=%s or user=%s\n' % (checker._failed_viewpoint, checker._current_user)
     msg += ''.join(traceback.format_exception(typ, val, tb))
     logging.info('Registering failed run with message: %s' % msg)
     yield gen.Task(job.RegisterRun, Job.STATUS_FAILURE, failure_msg=msg)
   else:
     # Successful: write run summary.
     stats = DotDict()
-    stats['full_scan'] = len(options.options.viewpoints) == 0
+    stats['full_scan'] = len(options.options.viewpoints) == 0 and not incremental
     stats['dbchk.visited_viewpoints'] = checker._num_visited_viewpoints
+    stats['dbchk.trimmed_feed_rows'] = num_trimmed
+    if incremental:
+      stats['feed_end'] = feed_end
     logging.info('Registering successful run with stats: %r' % stats)
     yield gen.Task(job.RegisterRun, Job.STATUS_SUCCESS, stats=stats)
 
@@ -0,0 +1,205 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for the DynamoDB transport.
+
+Starts a local HTTP stub of DynamoDB in a child process, which answers
+every request with a Query response of --num_items items, each with
+--num_attrs number and string attributes. Sends --num_requests requests
+to it, --concurrency at a time, in two ways:
+
+  shared:    through the shared AsyncHTTPClient, signed by boto's
+             HmacAuthV3HTTPHandler, and decoded by json.loads followed by
+             a second pass that converts each typed value.
+  dedicated: through AsyncDynamoDB.make_request, which uses a dedicated
+             HTTP client of --concurrency connections, a cached
+             RequestSigner, and DecodeDynamoValues to decode in one pass.
+
+Reports the latency of requests, the CPU time used by this process per
+request, and the number of connections that the stub accepted. Use
+--curl (the default, as in production) for connections that are kept
+alive between requests; the simple HTTP client opens a connection for
+each request.
+
+Usage:
+python -m viewfinder.backend.db.tools.dynamodb_transport_bench --num_requests=2000 --concurrency=50
+"""
+
+__author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
+
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import time
+
+from boto.auth import HmacAuthV3HTTPHandler
+from functools import partial
+from tornado import gen, httpclient, httpserver, ioloop, options
+from viewfinder.backend.base.util import ConvertToNumber
+from viewfinder.backend.db.asyncdynamo import AsyncDynamoDB
+from viewfinder.backend.db.dynamodb_client import DecodeDynamoValues
+
+options.define('num_requests', default=2000, help='number of requests to send in each run')
+options.define('concurrency', default=50, help='number of requests in flight at once')
+options.define('num_items', default=20, help='number of items in each response')
+options.define('num_attrs', default=10, help='number of attributes of each item')
+options.define('port', default=8642, help='port on which the stub listens')
+options.define('curl', default=True, help='use the curl HTTP client, as in production')
+
+_HOST = 'localhost'
+_TARGET = 'DynamoDB_20111205.Query'
+_REQUEST_BODY = json.dumps({'TableName': 'Test', 'HashKeyValue': {'S': 'hash-key'}, 'Limit': 100})
+
+
+class _StubServer(httpserver.HTTPServer):
+  """HTTP server that answers every POST with the same Query response, and every GET with the
+  number of connections that it has accepted.
+  """
+  def __init__(self, response_body):
+    super(_StubServer, self).__init__(self._HandleRequest)
+    self._response_body = response_body
+    self._num_connections = 0
+
+  def handle_stream(self, stream, address):
+    self._num_connections += 1
+    super(_StubServer, self).handle_stream(stream, address)
+
+  def _HandleRequest(self, request):
+    body = self._response_body if request.method == 'POST' else str(self._num_connections)
+    request.write('HTTP/1.1 200 OK\r\nContent-Type: application/x-amz-json-1.0\r\n'
+                  'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+    request.finish()
+
+
+def _RunStub(port, ready):
+  """Runs the stub server in the child process until it is terminated."""
+  items = []
+  for i in xrange(options.options.num_items):
+    item = {}
+    for j in xrange(options.options.num_attrs):
+      item['a%d' % j] = {'N': str(i * 1000 + j)} if j % 2 == 0 else {'S': 'value %d of item %d' % (j, i)}
+    items.append(item)
+  response_body = json.dumps({'Count': len(items), 'Items': items, 'ConsumedCapacityUnits': 0.5})
+
+  _StubServer(response_body).listen(port, address=_HOST)
+  ready.set()
+  ioloop.IOLoop.current().start()
+
+
+def _DecodeTwoPass(body):
+  """Decodes a response as AsyncDynamoDB and DynamoDBClient did before DecodeDynamoValues:
+  json.loads, followed by a conversion of the typed values of each item.
+  """
+  response = json.loads(body)
+  items = []
+  for dyn_attrs in response['Items']:
+    attrs = dict()
+    for k, v in dyn_attrs.items():
+      value_type, value = v.items()[0]
+      if value_type == 'N':
+        attrs[k] = ConvertToNumber(value)
+      elif value_type == 'NS':
+        attrs[k] = set([ConvertToNumber(dv) for dv in value])
+      elif value_type == 'SS':
+        attrs[k] = set([dv for dv in value])
+      else:
+        attrs[k] = value
+    items.append(attrs)
+  response['Items'] = items
+  return response
+
+
+def _SendShared(auth_handler, callback):
+  headers = {'X-Amz-Target': _TARGET,
+             'Content-Type': 'application/x-amz-json-1.0',
+             'Content-Length': str(len(_REQUEST_BODY))}
+  request = httpclient.HTTPRequest('http://%s:%d/' % (_HOST, options.options.port), method='POST',
+                                   headers=headers, body=_REQUEST_BODY)
+  request.path = '/'
+  auth_handler.add_auth(request)
+
+  def _OnResponse(response):
+    response.rethrow()
+    callback(_DecodeTwoPass(response.body))
+
+  httpclient.AsyncHTTPClient().fetch(request, _OnResponse)
+
+
+def _SendDedicated(asyncdynamo, callback):
+  asyncdynamo.make_request('Query', _REQUEST_BODY, callback, object_pairs_hook=DecodeDynamoValues)
+
+
+@gen.coroutine
+def _QueryConnections():
+  """Returns the number of connections that the stub has accepted, not counting this query."""
+  http_client = httpclient.AsyncHTTPClient(force_instance=True)
+  response = yield http_client.fetch('http://%s:%d/' % (_HOST, options.options.port))
+  http_client.close()
+  raise gen.Return(int(response.body))
+
+
+@gen.coroutine
+def _RunRequests(name, send):
+  """Sends --num_requests requests using "send", --concurrency at a time, and logs the results."""
+  latencies = []
+
+  @gen.coroutine
+  def _SendSequence(num_requests):
+    for _ in xrange(num_requests):
+      start = time.time()
+      response = yield gen.Task(send)
+      latencies.append(time.time() - start)
+      assert len(response['Items']) == options.options.num_items, response
+
+  start_connections = yield _QueryConnections()
+  start_usage = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.time()
+
+  concurrency = options.options.concurrency
+  num_requests = options.options.num_requests
+  yield [_SendSequence(num_requests / concurrency + (1 if i < num_requests % concurrency else 0))
+         for i in xrange(concurrency)]
+
+  elapsed = time.time() - start
+  end_usage = resource.getrusage(resource.RUSAGE_SELF)
+  cpu_secs = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+  end_connections = yield _QueryConnections()
+
+  latencies.sort()
+  logging.info('%-10s %8.0f req/s  latency %6.2f ms mean %6.2f ms p50 %6.2f ms p99  cpu %6.3f ms/req  '
+               '%d connections' %
+               (name, len(latencies) / elapsed, 1000 * sum(latencies) / len(latencies),
+                1000 * latencies[len(latencies) / 2], 1000 * latencies[len(latencies) * 99 / 100],
+                1000 * cpu_secs / len(latencies), end_connections - start_connections - 1))
+
+
+@gen.coroutine
+def Run():
+  asyncdynamo = AsyncDynamoDB('access-key', 'secret-key', is_secure=False, host=_HOST, port=options.options.port,
+                              session_token='session-token', max_clients=options.options.concurrency)
+  auth_handler = HmacAuthV3HTTPHandler(asyncdynamo.host, None, asyncdynamo.provider)
+
+  yield _RunRequests('shared', partial(_SendShared, auth_handler))
+  yield _RunRequests('dedicated', partial(_SendDedicated, asyncdynamo))
+
+
+def main():
+  options.parse_command_line()
+  if options.options.curl:
+    httpclient.AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+
+  # Start the stub before this process creates its IOLoop, so that the child does not share it.
+  ready = multiprocessing.Event()
+  stub = multiprocessing.Process(target=_RunStub, args=(options.options.port, ready))
+  stub.start()
+  try:
+    ready.wait()
+    ioloop.IOLoop.current().run_sync(Run)
+  finally:
+    stub.terminate()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,102 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for FingerprintIndex.
+
+Indexes --num_fingerprints random 160-bit fingerprints, then issues --num_queries
+queries, half of which are near-duplicates (a random indexed fingerprint with up to
+--max_distance bits flipped). Reports add throughput, query latency and the number of
+distance computations per query, alongside the number of candidates that the 12-bit
+tag bucketing used by find_near_dupes.py would have compared for the same queries.
+
+Usage:
+python -m viewfinder.backend.db.tools.fingerprint_index_bench --num_fingerprints=1000000
+"""
+
+__author__ = 'ben@emailscrubbed.com (Ben Darnell)'
+
+import logging
+import random
+import sys
+import time
+
+from collections import defaultdict
+from tornado import options
+from viewfinder.backend.db.fingerprint_index import FINGERPRINT_BITS, FingerprintIndex
+
+options.define('num_fingerprints', default=1000000, help='number of fingerprints to index')
+options.define('num_queries', default=10000, help='number of queries to run')
+options.define('max_distance', default=12, help='maximum hamming distance of a match')
+options.define('num_chunks', default=7, help='number of multi-index hash tables')
+options.define('seed', default=0, help='random seed')
+
+# Tag widths, in bits, used by find_near_dupes.py and ImageIndex.cc.
+_TAG_BITS = [12] * 12 + [16]
+
+
+def _TagBucketSizes(terms):
+  """Returns a function which computes the number of candidates the tag bucketing scheme
+  would compare against a query term (the sum of the sizes of its 13 tag buckets).
+  """
+  buckets = defaultdict(int)
+  for term in terms:
+    shift = 0
+    for i, width in enumerate(_TAG_BITS):
+      buckets[(i, (term >> shift) & ((1 << width) - 1))] += 1
+      shift += width
+
+  def _Candidates(term):
+    total = 0
+    shift = 0
+    for i, width in enumerate(_TAG_BITS):
+      total += buckets.get((i, (term >> shift) & ((1 << width) - 1)), 0)
+      shift += width
+    return total
+
+  return _Candidates
+
+
+def Run():
+  rand = random.Random(options.options.seed)
+  terms = [rand.getrandbits(FINGERPRINT_BITS) for _ in xrange(options.options.num_fingerprints)]
+
+  index = FingerprintIndex(max_distance=options.options.max_distance, num_chunks=options.options.num_chunks)
+  start = time.time()
+  for i, term in enumerate(terms):
+    index.Add(i, (term,))
+  add_secs = time.time() - start
+  logging.info('indexed %d fingerprints in %.2fs (%.1f us/add)' %
+               (len(terms), add_secs, 1e6 * add_secs / len(terms)))
+
+  queries = []
+  for i in xrange(options.options.num_queries):
+    if i % 2 == 0:
+      term = terms[rand.randrange(len(terms))]
+      for bit in rand.sample(xrange(FINGERPRINT_BITS), rand.randint(0, options.options.max_distance)):
+        term ^= 1 << bit
+    else:
+      term = rand.getrandbits(FINGERPRINT_BITS)
+    queries.append(term)
+
+  num_matches = 0
+  start = time.time()
+  for term in queries:
+    num_matches += len(index.Query((term,)))
+  query_secs = time.time() - start
+  num_candidates = sum(len(index._Candidates((term,))) for term in queries)
+  logging.info('ran %d queries in %.2fs (%.1f us/query), %.1f candidates/query, %d matches' %
+               (len(queries), query_secs, 1e6 * query_secs / len(queries),
+                float(num_candidates) / len(queries), num_matches))
+
+  tag_candidates = _TagBucketSizes(terms)
+  logging.info('12-bit tag bucketing would compare %.1f candidates/query' %
+               (float(sum(tag_candidates(term) for term in queries)) / len(queries)))
+
+
+def main():
+  options.parse_command_line()
+  Run()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
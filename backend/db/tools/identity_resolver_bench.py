@@ -0,0 +1,137 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for IdentityResolver.
+
+Populates a local datastore with --num_identities email identities, a
+--registered_fraction of which are bound to users, and resolves them all using
+both the per-identity Identity.Query/User.Query path previously used by
+ResolveContacts and the batched IdentityResolver (cold, then again with a warm
+negative cache). Every datastore request is delayed by --latency_ms to model
+the round trip to DynamoDB. Reports latency, requests and read units per 1000
+identities for each path.
+
+Usage:
+python -m viewfinder.backend.db.tools.identity_resolver_bench --num_identities=5000
+"""
+
+__author__ = 'ben@emailscrubbed.com (Ben Darnell)'
+
+import logging
+import random
+import sys
+import time
+
+from functools import partial
+from tornado import gen, options
+from tornado.ioloop import IOLoop
+from viewfinder.backend.db import vf_schema
+from viewfinder.backend.db.identity import Identity
+from viewfinder.backend.db.identity_resolver import IdentityResolver
+from viewfinder.backend.db.local_client import LocalClient
+from viewfinder.backend.db.user import User
+
+options.define('num_identities', default=5000, help='number of identities to resolve')
+options.define('registered_fraction', default=0.1, help='fraction of identities bound to a user')
+options.define('latency_ms', default=5.0, help='simulated latency of each datastore request')
+options.define('seed', default=0, help='random seed')
+
+
+class _CountingClient(object):
+  """Wraps a datastore client, counting GetItem and BatchGetItem requests and the read units
+  they consume, and delaying each response by "latency" seconds.
+  """
+  def __init__(self, client, latency):
+    self._client = client
+    self._latency = latency
+    self.Reset()
+
+  def Reset(self):
+    self.requests = 0
+    self.read_units = 0
+
+  def GetItem(self, table, key, callback, attributes, **kwargs):
+    def _OnGet(result):
+      self.read_units += result.read_units if result is not None else 1
+      self._Respond(callback, result)
+
+    self.requests += 1
+    self._client.GetItem(table, key, _OnGet, attributes, **kwargs)
+
+  def BatchGetItem(self, batch_dict, callback, **kwargs):
+    def _OnBatchGet(result):
+      self.read_units += sum(table_result.read_units for table_result in result.itervalues())
+      self._Respond(callback, result)
+
+    self.requests += 1
+    self._client.BatchGetItem(batch_dict, _OnBatchGet, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(self._client, name)
+
+  def _Respond(self, callback, result):
+    IOLoop.current().add_timeout(time.time() + self._latency, partial(callback, result))
+
+
+@gen.coroutine
+def _Populate(client, rand):
+  identity_keys = []
+  user_id = 1
+  for i in xrange(options.options.num_identities):
+    identity_key = 'Email:contact%d@emailscrubbed.com' % i
+    identity_keys.append(identity_key)
+    if rand.random() < options.options.registered_fraction:
+      user = User.CreateFromKeywords(user_id=user_id, name='Contact %d' % i, labels=[User.REGISTERED])
+      yield gen.Task(user.Update, client)
+      identity = Identity.CreateFromKeywords(key=identity_key, user_id=user_id)
+      yield gen.Task(identity.Update, client)
+      user_id += 1
+  raise gen.Return(identity_keys)
+
+
+@gen.coroutine
+def _ResolveOneByOne(client, identity_keys):
+  """The per-identity lookups previously issued by ResolveContacts."""
+  identities = yield [gen.Task(Identity.Query, client, key, None, must_exist=False) for key in identity_keys]
+  users = yield [gen.Task(User.Query, client, ident.user_id, None, must_exist=False)
+                 for ident in identities if ident is not None and ident.user_id is not None]
+  raise gen.Return(users)
+
+
+@gen.coroutine
+def Run():
+  rand = random.Random(options.options.seed)
+  local_client = LocalClient(vf_schema.SCHEMA)
+  yield gen.Task(vf_schema.SCHEMA.VerifyOrCreate, local_client)
+  identity_keys = yield _Populate(local_client, rand)
+  rand.shuffle(identity_keys)
+
+  client = _CountingClient(local_client, options.options.latency_ms / 1000.0)
+  resolver = IdentityResolver()
+
+  def _Report(name, elapsed):
+    per_k = 1000.0 / len(identity_keys)
+    logging.info('%-28s %8.1f ms/1k identities %8.1f requests/1k %8.1f read units/1k' %
+                 (name, 1000 * elapsed * per_k, client.requests * per_k, client.read_units * per_k))
+    client.Reset()
+
+  start = time.time()
+  yield _ResolveOneByOne(client, identity_keys)
+  _Report('one by one', time.time() - start)
+
+  start = time.time()
+  yield resolver.ResolveIdentities(client, identity_keys)
+  _Report('batched, cold cache', time.time() - start)
+
+  start = time.time()
+  yield resolver.ResolveIdentities(client, identity_keys)
+  _Report('batched, warm negative cache', time.time() - start)
+
+
+def main():
+  options.parse_command_line()
+  IOLoop.current().run_sync(Run)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
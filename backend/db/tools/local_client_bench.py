@@ -0,0 +1,116 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for the storage engines of the local datastore.
+
+Loads --num_items items, in random order, into a table with a hash and a
+range key, with --items_per_hash items under each hash key. Then times
+random gets, queries of a page of --page_size items, and scan pages that
+resume from random keys, as a paging scan of a large table does. Each
+engine in --engines runs in a forked child process, so that the growth in
+its resident memory can be measured. Reports load rate, memory per item,
+the time per get, query and scan page, and the size of the table reported
+by DescribeTable.
+
+Usage:
+python -m viewfinder.backend.db.tools.local_client_bench --num_items=1000000
+python -m viewfinder.backend.db.tools.local_client_bench --num_items=10000000 --engines=sorted
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import logging
+import os
+import random
+import resource
+import sys
+import time
+
+from tornado import options
+from viewfinder.backend.db.db_client import DBKey, DBKeySchema, RangeOperator
+from viewfinder.backend.db.local_client import LocalClient
+
+options.define('num_items', default=1000000, help='number of items to load into the table')
+options.define('items_per_hash', default=10, help='number of items with each hash key')
+options.define('engines', default='dict,sorted', help='comma-separated list of storage engines to compare')
+options.define('num_reads', default=10000, help='number of gets and of queries to time')
+options.define('num_scan_pages', default=20, help='number of scan pages to time')
+options.define('page_size', default=100, help='number of items in each query or scan page')
+
+
+def _GetResidentBytes():
+  """Returns the resident memory of this process, in bytes."""
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _Time(func, count):
+  """Calls "func" "count" times, and returns the average time per call, in milliseconds."""
+  start = time.time()
+  for _ in xrange(count):
+    func()
+  return 1000 * (time.time() - start) / count
+
+
+def _RunEngine(engine):
+  """Loads and reads a table using "engine", and returns a line of results."""
+  rand = random.Random(0)
+  client = LocalClient(None, engine=engine)
+  client.CreateTable('bench', DBKeySchema('hk', 'S'), DBKeySchema('rk', 'N'), 10, 10, None)
+  num_hash_keys = max(options.options.num_items // options.options.items_per_hash, 1)
+
+  start_bytes = _GetResidentBytes()
+  start = time.time()
+  hash_keys = ['user:%012d' % i for i in xrange(num_hash_keys)]
+  rand.shuffle(hash_keys)
+  for range_key in xrange(options.options.items_per_hash):
+    for hash_key in hash_keys:
+      client.PutItem('bench', DBKey(hash_key, range_key), None,
+                     {'name': 'name-%s' % hash_key, 'count': range_key, 'labels': ['a', 'b']})
+  load_secs = time.time() - start
+  item_bytes = float(_GetResidentBytes() - start_bytes) / options.options.num_items
+
+  def _Get():
+    client.GetItem('bench', DBKey(rand.choice(hash_keys), rand.randrange(options.options.items_per_hash)), None,
+                   None, must_exist=False)
+
+  def _Query():
+    client.Query('bench', rand.choice(hash_keys), RangeOperator([0], 'GE'), None, None,
+                 limit=options.options.page_size)
+
+  def _ScanPage():
+    client.Scan('bench', None, None, limit=options.options.page_size,
+                excl_start_key=DBKey(rand.choice(hash_keys), 0))
+
+  get_ms = _Time(_Get, options.options.num_reads)
+  query_ms = _Time(_Query, options.options.num_reads)
+  scan_ms = _Time(_ScanPage, options.options.num_scan_pages)
+  describe = client.DescribeTable('bench', None)
+
+  return ('%-8s %10.0f items/s %8.0f bytes/item %8.3f ms/get %8.3f ms/query %10.3f ms/scan page '
+          '%10s table bytes' % (engine, options.options.num_items / load_secs, item_bytes, get_ms, query_ms, scan_ms,
+                                describe.size_bytes))
+
+
+def main():
+  options.parse_command_line()
+  options.options.localdb_dir = ''
+
+  for engine in options.options.engines.split(','):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(read_fd)
+      with os.fdopen(write_fd, 'w') as f:
+        f.write(_RunEngine(engine))
+      os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+      result = f.read()
+    os.waitpid(pid, 0)
+    logging.info(result or '%s: failed' % engine)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
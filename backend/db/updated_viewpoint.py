@@ -0,0 +1,100 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""UpdatedViewpoint relation.
+
+The UpdatedViewpoint relation is a feed of recently updated viewpoints. A
+row is written by NotificationManager._NotifyFollowers each time it updates
+a viewpoint's "last_updated" attribute. Rows are grouped into hourly
+buckets, so that a reader can find every viewpoint updated within a range
+of hours without scanning the Viewpoint table. A viewpoint updated several
+times within the same hour has a single row in that hour's bucket.
+
+All writes for the current hour would otherwise go to a single hash key,
+and therefore to a single DynamoDB partition. Instead, each bucket is spread
+over _NUM_PARTITIONS hash keys of the form "<hour>:<partition>", chosen by
+a hash of the viewpoint id. Readers query every partition of a bucket.
+
+The feed is consumed by dbchk (see tools/dbchk.py), which deletes each row
+once its viewpoint has been checked. Rows are also written when dbchk is not
+run incrementally, so every dbchk run trims rows whose bucket is older than
+--updated_viewpoint_retention_hours, whether or not they were checked.
+
+  UpdatedViewpoint: viewpoint updated within an hourly bucket.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import zlib
+
+from tornado import gen
+from viewfinder.backend.base import constants
+from viewfinder.backend.db import vf_schema
+from viewfinder.backend.db.base import DBObject
+from viewfinder.backend.db.range_base import DBRangeObject
+
+
+@DBObject.map_table_attributes
+class UpdatedViewpoint(DBRangeObject):
+  """Viewfinder updated viewpoint data object."""
+  __slots__ = []
+
+  _table = DBObject._schema.GetTable(vf_schema.UPDATED_VIEWPOINT)
+
+  BUCKET_SECS = constants.SECONDS_PER_HOUR
+  """Width of each bucket of updated viewpoints."""
+
+  _NUM_PARTITIONS = 8
+  """Number of hash keys over which each bucket is spread."""
+
+  _QUERY_LIMIT = 100
+
+  def __init__(self, bucket=None, viewpoint_id=None):
+    super(UpdatedViewpoint, self).__init__()
+    self.bucket = bucket
+    self.viewpoint_id = viewpoint_id
+
+  @classmethod
+  def GetBucketStart(cls, timestamp):
+    """Returns the start time of the bucket that contains "timestamp"."""
+    return int(timestamp) // UpdatedViewpoint.BUCKET_SECS * UpdatedViewpoint.BUCKET_SECS
+
+  def GetRowBucketStart(self):
+    """Returns the start time of the bucket that contains this row."""
+    return int(self.bucket.split(':')[0])
+
+  @classmethod
+  @gen.coroutine
+  def Record(cls, client, viewpoint_id, timestamp):
+    """Adds "viewpoint_id" to the bucket that contains "timestamp"."""
+    partition = (zlib.crc32(viewpoint_id) & 0xffffffff) % UpdatedViewpoint._NUM_PARTITIONS
+    updated_vp = UpdatedViewpoint(UpdatedViewpoint._GetHashKey(UpdatedViewpoint.GetBucketStart(timestamp), partition),
+                                  viewpoint_id)
+    updated_vp.last_updated = timestamp
+    yield gen.Task(updated_vp.Update, client)
+
+  @classmethod
+  @gen.coroutine
+  def QueryBucket(cls, client, bucket_start):
+    """Returns the rows of every viewpoint in the bucket that starts at "bucket_start"."""
+    updated_vps = []
+    for partition in xrange(UpdatedViewpoint._NUM_PARTITIONS):
+      hash_key = UpdatedViewpoint._GetHashKey(bucket_start, partition)
+      excl_start_key = None
+      while True:
+        results = yield gen.Task(UpdatedViewpoint.RangeQuery,
+                                 client,
+                                 hash_key,
+                                 None,
+                                 UpdatedViewpoint._QUERY_LIMIT,
+                                 None,
+                                 excl_start_key=excl_start_key)
+        updated_vps.extend(results)
+        if len(results) < UpdatedViewpoint._QUERY_LIMIT:
+          break
+        excl_start_key = results[-1].GetKey()
+
+    raise gen.Return(updated_vps)
+
+  @classmethod
+  def _GetHashKey(cls, bucket_start, partition):
+    return '%d:%d' % (bucket_start, partition)
@@ -73,7 +73,9 @@ class User(DBHashObject):
   _table = DBObject._schema.GetTable(vf_schema.USER)
 
   _ALLOCATION = 1
-  _allocator = IdAllocator(id_type=_table.hash_key_col.name, allocation=_ALLOCATION)
+  _MAX_ALLOCATION = 31
+  _allocator = IdAllocator(id_type=_table.hash_key_col.name, allocation=_ALLOCATION,
+                           max_allocation=_MAX_ALLOCATION)
 
   _RESERVED_ASSET_ID_COUNT = 1
   """Number of asset ids which are reserved for system use (default vp for now)."""
@@ -343,6 +345,7 @@ class User(DBHashObject):
     identity.user_id = user.user_id
     identity.UpdateFromKeywords(**ident_dict)
     yield gen.Task(identity.Update, client)
+    Identity.NotifyBound(identity.key)
 
     raise gen.Return(user)
 
@@ -1,21 +1,50 @@
 # Copyright 2013 Viewfinder Inc. All Rights Reserved
-"""UserPhoto data object."""
+"""UserPhoto data object.
+
+The asset fingerprints of each user's photos can be searched for duplicates
+with a FingerprintIndex (see fingerprint_index.py). Building the index means
+querying every UserPhoto of the user, so GetFingerprintIndex caches the index
+of recently active users, and the photos that this server adds are added to the
+cached index as they are written. At most
+--fingerprint_index_cache_size indexes are cached (least recently used are
+evicted first), and each is rebuilt after --fingerprint_index_cache_secs, so
+that photos added on other servers are eventually seen. UserPhoto rows are
+never deleted, so the index includes photos that were removed from the user's
+library, and photos that are still in other episodes are not lost. Removing
+photos invalidates the user's cached index, so that it is rebuilt from the
+UserPhoto rows when next needed.
+"""
 
 __author__ = 'ben@emailscrubbed.com (Ben Darnell)'
 
-from tornado import gen
+import time
+
+from collections import OrderedDict
+from tornado import gen, options
 
 from viewfinder.backend.db import vf_schema
 from viewfinder.backend.db.base import DBObject
+from viewfinder.backend.db.fingerprint_index import AssetFingerprintToTerms, FingerprintIndex
 from viewfinder.backend.db.range_base import DBRangeObject
 from viewfinder.backend.db import versions
 
+options.define('fingerprint_index_cache_size', default=1000,
+               help='maximum number of users whose photo fingerprint index is cached for duplicate detection')
+options.define('fingerprint_index_cache_secs', default=3600.0,
+               help='seconds after which a cached photo fingerprint index is rebuilt, in order to see photos '
+               'added on other servers')
+
 @DBObject.map_table_attributes
 class UserPhoto(DBRangeObject):
   __slots__ = []
 
   _table = DBObject._schema.GetTable(vf_schema.USER_PHOTO)
 
+  _FINGERPRINT_QUERY_LIMIT = 100
+
+  # Maps user_id => (expiration time, FingerprintIndex), in least recently used order.
+  _fingerprint_indexes = OrderedDict()
+
   @classmethod
   def AssetKeyToFingerprint(cls, asset_key):
     """Converts an asset key to a fingerprint-only asset key.
@@ -53,6 +82,97 @@ class UserPhoto(DBRangeObject):
         changed = True
     return changed
 
+  def AddToFingerprintIndex(self, index):
+    """Adds each of this photo's asset fingerprints to "index", keyed by photo id."""
+    for asset_fingerprint in self.asset_keys or []:
+      terms = AssetFingerprintToTerms(asset_fingerprint)
+      if terms is not None:
+        index.Add(self.photo_id, terms)
+
+  @classmethod
+  def FindDuplicates(cls, index, asset_keys, max_distance=None):
+    """Returns a list of (photo_id, distance) tuples for the photos in "index" whose asset
+    fingerprints are within "max_distance" of any of the fingerprints in "asset_keys".
+    Each photo id appears once, with its smallest distance.
+    """
+    best = {}
+    for fingerprint in UserPhoto.MakeAssetFingerprintSet(asset_keys):
+      terms = AssetFingerprintToTerms(fingerprint)
+      if terms is not None:
+        for photo_id, distance in index.Query(terms, max_distance=max_distance):
+          if distance < best.get(photo_id, distance + 1):
+            best[photo_id] = distance
+    return sorted(best.items(), key=lambda item: item[1])
+
+  def AddToCachedFingerprintIndex(self):
+    """Adds this photo's asset fingerprints to the user's cached fingerprint index, if there is
+    one. Called once the photo has been written to the database.
+    """
+    entry = UserPhoto._fingerprint_indexes.get(self.user_id)
+    if entry is not None:
+      self.AddToFingerprintIndex(entry[1])
+
+  @classmethod
+  def InvalidateCachedFingerprintIndex(cls, user_id):
+    """Drops the user's cached fingerprint index, if there is one, so that it is rebuilt by the
+    next call to GetFingerprintIndex.
+    """
+    UserPhoto._fingerprint_indexes.pop(user_id, None)
+
+  @classmethod
+  @gen.coroutine
+  def GetFingerprintIndex(cls, client, user_id):
+    """Returns a FingerprintIndex of the asset fingerprints of the user's photos, keyed by photo
+    id. The index is only built if it is not cached, or has expired (see the header). The
+    index is shared, and must not be modified by the caller.
+    """
+    entry = UserPhoto._fingerprint_indexes.pop(user_id, None)
+    if entry is not None and entry[0] > time.time():
+      # Re-insert to mark as most recently used.
+      UserPhoto._fingerprint_indexes[user_id] = entry
+      raise gen.Return(entry[1])
+
+    # Cache the index before it is built, so that photos added while it is being built are not lost.
+    index = FingerprintIndex()
+    UserPhoto._fingerprint_indexes[user_id] = (time.time() + options.options.fingerprint_index_cache_secs, index)
+    while len(UserPhoto._fingerprint_indexes) > options.options.fingerprint_index_cache_size:
+      UserPhoto._fingerprint_indexes.popitem(last=False)
+
+    try:
+      yield UserPhoto.BuildFingerprintIndex(client, user_id, index=index)
+    except:
+      if UserPhoto._fingerprint_indexes.get(user_id, (None, None))[1] is index:
+        del UserPhoto._fingerprint_indexes[user_id]
+      raise
+
+    raise gen.Return(index)
+
+  @classmethod
+  @gen.coroutine
+  def BuildFingerprintIndex(cls, client, user_id, index=None):
+    """Queries all of the user's photos and adds their asset fingerprints, keyed by photo id,
+    to "index", or to a new FingerprintIndex if "index" is None. Returns the index.
+    """
+    if index is None:
+      index = FingerprintIndex()
+    start_key = None
+    while True:
+      user_photos = yield gen.Task(UserPhoto.RangeQuery,
+                                   client,
+                                   user_id,
+                                   range_desc=None,
+                                   limit=UserPhoto._FINGERPRINT_QUERY_LIMIT,
+                                   col_names=None,
+                                   excl_start_key=start_key)
+      for user_photo in user_photos:
+        user_photo.AddToFingerprintIndex(index)
+
+      if len(user_photos) < UserPhoto._FINGERPRINT_QUERY_LIMIT:
+        break
+      start_key = user_photos[-1].photo_id
+
+    raise gen.Return(index)
+
   @classmethod
   @gen.coroutine
   def CreateNew(cls, client, **up_dict):
@@ -60,6 +180,7 @@ class UserPhoto(DBRangeObject):
     up = UserPhoto.CreateFromKeywords(**up_dict)
     up.MergeAssetKeys(asset_keys)
     yield gen.Task(up.Update, client)
+    up.AddToCachedFingerprintIndex()
 
   @classmethod
   @gen.coroutine
@@ -72,3 +193,4 @@ class UserPhoto(DBRangeObject):
       yield gen.Task(versions.Version.MaybeMigrate, client, user_photo, [versions.REMOVE_ASSET_URLS])
     user_photo.MergeAssetKeys(asset_keys)
     yield user_photo.Update(client)
+    user_photo.AddToCachedFingerprintIndex()
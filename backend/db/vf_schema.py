@@ -32,6 +32,7 @@ GUESS = 'Guess'
 HEALTH_REPORT = 'HealthReport'
 ID_ALLOCATOR = 'IdAllocator'
 IDENTITY = 'Identity'
+INBOX = 'Inbox'
 LOCK = 'Lock'
 METRIC = 'Metric'
 NOTIFICATION = 'Notification'
@@ -41,6 +42,7 @@ POST = 'Post'
 SETTINGS = 'Settings'
 SHORT_URL = 'ShortURL'
 SUBSCRIPTION = 'Subscription'
+UPDATED_VIEWPOINT = 'UpdatedViewpoint'
 USER = 'User'
 USER_PHOTO = 'UserPhoto'
 USER_POST = 'UserPost'
@@ -75,7 +77,11 @@ SCHEMA = Schema([
     # operation ids (sometimes suffixed with a viewpoint ID), in the order in which they were
     # applied. We keep a maximum of Accounting._MAX_APPLIED_OP_IDS.
     #
-    # Currently, all columns are used by each accounting category.
+    # Contended entries may be sharded into rows with sort key '<sort_key>#<n>', whose sum
+    # with the entry row is the entry's value (see accounting.py). 'shard_gen' is set only on
+    # shard rows, and counts the times the shard has been folded into its entry row.
+    #
+    # Currently, all other columns are used by each accounting category.
     Table(ACCOUNTING, 'at', read_units=100, write_units=10,
           columns=[HashKeyColumn('hash_key', 'hk', 'S'),
                    RangeKeyColumn('sort_key', 'sk', 'S'),
@@ -84,7 +90,8 @@ SCHEMA = Schema([
                    Column('med_size', 'ms', 'N'),
                    Column('full_size', 'fs', 'N'),
                    Column('orig_size', 'os', 'N'),
-                   Column('op_ids', 'oi', 'S')]),
+                   Column('op_ids', 'oi', 'S'),
+                   Column('shard_gen', 'sg', 'N')]),
 
     # Activities are associated with a viewpoint and contain a record of
     # all high-level operations which have modified the structure of the
@@ -314,7 +321,9 @@ SCHEMA = Schema([
     # list of identities associated with a viewfinder account. The token
     # allows access to external resources associated with the identity.
     # 'last_fetch' specifies the last time that the contacts were
-    # fetched for this identity. 'authority' is one of ('Facebook', 'Google'
+    # fetched for this identity, and 'contacts_digest' is a digest of the
+    # ids of the contacts stored by that fetch, which allows a refresh to
+    # skip unchanged contact lists. 'authority' is one of ('Facebook', 'Google'
     # 'Viewfinder', etc.) and identifies the trusted authentication authority.
     #
     # The complete set of attributes (if any) returned when an
@@ -333,6 +342,7 @@ SCHEMA = Schema([
                           Column('user_id', 'ui', 'N', SecondaryIndexer()),
                           JSONColumn('json_attrs', 'ja'),
                           Column('last_fetch', 'lf', 'N'),
+                          Column('contacts_digest', 'cd', 'S'),
                           Column('authority', 'au', 'S'),
                           Column('access_token', 'at', 'S'),
                           Column('refresh_token', 'rt', 'S'),
@@ -345,6 +355,19 @@ SCHEMA = Schema([
                           Column('token_guesses', 'tg', 'N'),
                           Column('token_guesses_time', 'gt', 'N')]),
 
+    # Key is user id. Materialized first page of the viewpoints followed by
+    # the user, as returned by QueryFollowed. 'page' holds the Followed sort
+    # key and viewpoint metadata of each viewpoint in the page. The page is
+    # current only if 'version' matches the format version in inbox.py and
+    # 'notification_id' is the id of the user's last notification. See
+    # inbox.py.
+    Table(INBOX, 'ib', read_units=100, write_units=10,
+          columns=[HashKeyColumn('user_id', 'ui', 'N'),
+                   Column('version', 've', 'N'),
+                   Column('notification_id', 'ni', 'N'),
+                   Column('page_limit', 'pl', 'N'),
+                   JSONColumn('page', 'pg')]),
+
     # A lock is acquired in order to control concurrent access to
     # a resource. The 'lock_id' is a composite of the type of the
     # resource and its unique id. The 'owner_id' is a string that
@@ -584,6 +607,16 @@ SCHEMA = Schema([
                    JSONColumn('extra_info', 'ei'),
                    Column('renewal_data', 'pd', 'S', read_only=True)]),
 
+    # Feed of recently updated viewpoints, written each time a viewpoint's
+    # 'last_updated' attribute is updated. Hash key is '<hour>:<partition>',
+    # where 'hour' is the start of the hourly bucket containing the update,
+    # and 'partition' spreads the writes of a bucket over several hash keys.
+    # Range key is the viewpoint id. See updated_viewpoint.py.
+    Table(UPDATED_VIEWPOINT, 'uv', read_units=50, write_units=10,
+          columns=[HashKeyColumn('bucket', 'bu', 'S'),
+                   RangeKeyColumn('viewpoint_id', 'vi', 'S'),
+                   Column('last_updated', 'lu', 'N')]),
+
     # Key is user id. 'webapp_dev_id' is assigned on creation, and
     # serves as a unique ID with which to formulate asset IDs in
     # conjunction with the 'asset_id_seq' attribute. This provides a
@@ -37,6 +37,7 @@ __authors__ = ['andy@emailscrubbed.com (Andy Kimball)',
 import json
 
 from tornado import gen
+from viewfinder.backend.base.exceptions import LockFailedError
 from viewfinder.backend.db import db_client, vf_schema
 from viewfinder.backend.db.activity import Activity
 from viewfinder.backend.db.asset_id import IdPrefix, ConstructAssetId, DeconstructAssetId, VerifyAssetId
@@ -46,7 +47,7 @@ from viewfinder.backend.db.hash_base import DBHashObject
 from viewfinder.backend.db.friend import Friend
 from viewfinder.backend.db.followed import Followed
 from viewfinder.backend.db.follower import Follower
-from viewfinder.backend.db.lock import Lock
+from viewfinder.backend.db.lock import Lock, LockManager
 from viewfinder.backend.db.lock_resource_type import LockResourceType
 from viewfinder.backend.db.operation import Operation
 from viewfinder.backend.db.viewpoint_lock_tracker import ViewpointLockTracker
@@ -71,6 +72,9 @@ class Viewpoint(DBHashObject):
   #  to ensure that our clients catch this condition before sending to the server.
   MAX_FOLLOWERS = 150
 
+  _ACTIVITY_QUERY_LIMIT = 50
+  """Number of activities read per query by QueryActivitiesSince."""
+
   # Attributes that are projected for removed viewpoints.
   _IF_REMOVED_ATTRIBUTES = set(['viewpoint_id',
                                 'type',
@@ -80,6 +84,10 @@ class Viewpoint(DBHashObject):
                                 'labels',
                                 'adding_user_id'])
 
+  # Time that an operation waits for a viewpoint lock held by another operation on this server
+  # before giving up.
+  _LOCK_WAIT_SECS = 5.0
+
   def __init__(self, viewpoint_id=None):
     super(Viewpoint, self).__init__()
     self.viewpoint_id = viewpoint_id
@@ -128,18 +136,25 @@ class Viewpoint(DBHashObject):
   @classmethod
   @gen.engine
   def AcquireLock(cls, client, viewpoint_id, callback):
-    """Acquires a persistent global lock on the specified viewpoint."""
+    """Acquires a persistent global lock on the specified viewpoint. If another operation on
+    this server holds the lock, waits for that operation to hand it off.
+    """
     op = Operation.GetCurrent()
-    lock = yield gen.Task(Lock.Acquire, client, LockResourceType.Viewpoint, viewpoint_id,
-                          op.operation_id)
+    lock, status = yield LockManager.Instance().Acquire(client, LockResourceType.Viewpoint, viewpoint_id,
+                                                        owner_id=op.operation_id, wait_secs=Viewpoint._LOCK_WAIT_SECS)
+    if status == Lock.FAILED_TO_ACQUIRE_LOCK:
+      raise LockFailedError('Cannot acquire lock "%s:%s", owner_id "%s" because another agent has acquired it' %
+                            (LockResourceType.Viewpoint, viewpoint_id, op.operation_id))
     ViewpointLockTracker.AddViewpointId(viewpoint_id)
     callback(lock)
 
   @classmethod
   @gen.engine
   def ReleaseLock(cls, client, viewpoint_id, lock, callback):
-    """Releases a previously acquired lock on the specified viewpoint."""
-    yield gen.Task(lock.Release, client)
+    """Releases a previously acquired lock on the specified viewpoint, handing it off to
+    another operation on this server if one is waiting for it.
+    """
+    yield LockManager.Instance().Release(client, lock)
     ViewpointLockTracker.RemoveViewpointId(viewpoint_id)
     callback()
 
@@ -498,6 +513,38 @@ class Viewpoint(DBHashObject):
     Activity.RangeQuery(client, viewpoint_id, range_desc=None, limit=limit, col_names=None,
                         callback=_OnQueryActivities, excl_start_key=excl_start_key)
 
+  @classmethod
+  @gen.coroutine
+  def QueryActivitiesSince(cls, client, viewpoint_id, since_seq, update_seq):
+    """Queries the activities of the viewpoint having an update_seq greater than "since_seq",
+    where "update_seq" is the current update_seq of the viewpoint. Returns the activities in
+    update_seq order. Activities are ordered by timestamp rather than update_seq, so they are
+    queried a page at a time from newest to oldest, stopping after the page that reaches an
+    activity at or before "since_seq". Because an update_seq may have no activity (if an
+    operation restarted after committing it), the number of activities found is not used to
+    decide when to stop.
+    """
+    activities = []
+    if update_seq <= since_seq:
+      raise gen.Return(activities)
+
+    excl_start_key = None
+    while True:
+      results = yield gen.Task(Activity.RangeQuery,
+                               client,
+                               viewpoint_id,
+                               range_desc=None,
+                               limit=Viewpoint._ACTIVITY_QUERY_LIMIT,
+                               col_names=None,
+                               excl_start_key=excl_start_key)
+      activities.extend(activity for activity in results if activity.update_seq > since_seq)
+      if len(results) < Viewpoint._ACTIVITY_QUERY_LIMIT or \
+         any(activity.update_seq <= since_seq for activity in results):
+        break
+      excl_start_key = results[-1].activity_id
+
+    raise gen.Return(sorted(activities, key=lambda activity: activity.update_seq))
+
   @classmethod
   def QueryComments(cls, client, viewpoint_id, callback, excl_start_key=None, limit=None):
     """Queries comments belonging to the viewpoint (up to 'limit' total) for
@@ -118,7 +118,7 @@ def ProcessFiles(merged_store, logs_paths, filenames, callback):
       if module.startswith('user_op_manager:') or module.startswith('operation:'):
         # Found op status line.
         if msg.startswith('SUCCESS'):
-          # Success message. eg: SUCCESS: user: xx, device: xx, op: xx, method: xx.yy in xxs
+          # Success message. eg: SUCCESS: {"user":xx,"device":xx,"op":"xx","method":"xx.yy","elapsed":xx}
           parsed = logs_util.ParseSuccessMsg(msg)
           if not parsed:
             continue
@@ -133,15 +133,17 @@ def ProcessFiles(merged_store, logs_paths, filenames, callback):
                           'ShareExistingOperation.Execute', 'ShareNewOperation.Execute'):
             day_stats.ActiveShare(user)
         elif msg.startswith('EXECUTE'):
-          # Exec message. eg: EXECUTE: user: xx, device: xx, op: xx, method: xx.yy: <req>
+          # Exec message. eg: EXECUTE: {"user":xx,"device":xx,"op":"xx","method":"xx.yy","args":{<req>}}
           parsed = logs_util.ParseExecuteMsg(msg)
           if not parsed:
             continue
           user, device, op, class_name, method_name, request = parsed
           method = '%s.%s' % (class_name, method_name)
           if method in ('Device.UpdateOperation', 'User.RegisterOperation', 'RegisterUserOperation.Execute'):
+            if request is None:
+              continue
             try:
-              req_dict = eval(request)
+              req_dict = request if isinstance(request, dict) else eval(request)
               device_entries.append({'method': method, 'timestamp': timestamp, 'request': req_dict})
             except Exception as e:
               continue
@@ -126,7 +126,8 @@ def ProcessFiles(logs_store, merged_store, logs_paths, filenames, dry_run, callb
     assert instance
     contents = ''
     try:
-      contents = yield gen.Task(logs_store.Get, filename)
+      # GetFileContents gunzips raw logs compressed by the server log persistor ('.gz' keys).
+      contents = yield gen.Task(store_utils.GetFileContents, logs_store, filename)
     except Exception as e:
       logging.error('Error fetching file %s: %r' % (filename, e))
       continue
@@ -8,6 +8,7 @@ IsEC2Instance: return true if instance is an AWS instance name
 
 # Server log contents parsing.
 ParseLogLine: parse a raw log line.
+ParseOpEvent: parse the JSON record of an op event logged by user_op_manager.
 ParseSuccessMsg: parse the message logged by user_op_managed SUCCESS.
 
 # Registry of processed files.
@@ -51,6 +52,8 @@ kTimeRe = r'(\d{2}):(\d{2}):(\d{2}):(\d{3})'
 kLineRe = r'([-0-9]+) ([-:\.0-9]+) (\[pid:\d+\]) (\w+:\d+): ([^\n]+$)'
 # Date from server log file names. Extract (date, time).
 kDateRe = r'(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}:\d{2}.\d+)$'
+# Message part of a log line for a user_op_manager op event in JSON format. Extracts (event, record).
+kOpEventMsgRe = r'([A-Z]+): (\{.*\})$'
 # Message part of a log line for user_op_manager SUCCESS. Extracts (user, device, op, class, method_name).
 kSuccessMsgRe = r'SUCCESS: user: (\d+), device: (\d+), op: ([-_0-9a-zA-Z]+), method: (\w+)\.(\w+) .*$'
 # Message part of a log line for user_op_manager EXECUTE. Extracts (user, device, op, class, method_name, request).
@@ -238,10 +241,39 @@ def ParseLogLine(line):
     return None
 
 
+def ParseOpEvent(msg, event):
+  """Attempt to parse the message for a user_op_manager op event line in JSON format (e.g. "SUCCESS: {...}") and
+  return the record dict. Return None if the message is not a JSON record for "event".
+  """
+  if not msg.startswith(event + ': {'):
+    return None
+  parsed = re.match(kOpEventMsgRe, msg)
+  if not parsed or parsed.group(1) != event:
+    return None
+  try:
+    record = json.loads(parsed.group(2))
+  except ValueError:
+    return None
+  if not isinstance(record, dict) or '.' not in record.get('method', ''):
+    logging.warning('op event "%s" is missing fields' % msg)
+    return None
+  return record
+
+
+def _OpEventFields(record):
+  """Return (user, device, op, class, method) from an op event record, in the same form as the regexps extract them."""
+  class_name, method_name = record['method'].rsplit('.', 1)
+  return (str(record['user']), str(record['device']), record['op'], class_name, method_name)
+
+
 def ParseSuccessMsg(msg):
   """Attempt to parse the message for a user_op_manager SUCCESS line and extract user, device, op, class, and method.
   Return None otherwise.
   """
+  record = ParseOpEvent(msg, 'SUCCESS')
+  if record is not None:
+    return _OpEventFields(record)
+
   parsed = re.match(kSuccessMsgRe, msg)
   if not parsed:
     return None
@@ -254,9 +286,14 @@ def ParseSuccessMsg(msg):
 
 
 def ParseExecuteMsg(msg):
-  """Attempt to parse the message for a user_op_manager EXECUTE line and extract user, device, op, class, and method.
-  Return None otherwise.
+  """Attempt to parse the message for a user_op_manager EXECUTE line and extract user, device, op, class, method,
+  and request. For JSON records, the request is the dict of op args, or None if only a summary of the args was
+  logged. For older log lines, it is the repr of the op args. Return None otherwise.
   """
+  record = ParseOpEvent(msg, 'EXECUTE')
+  if record is not None:
+    return _OpEventFields(record) + (record.get('args'),)
+
   parsed = re.match(kExecuteMsgRe, msg)
   if not parsed:
     return None
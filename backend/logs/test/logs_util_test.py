@@ -138,6 +138,28 @@ class LogsUtilTestCase(BaseTestCase):
                       "u'apns-prod:...scrubbed...', u'version': u'1.3.1.16'}, " \
                       "u'device_id': 4021, u'user_id': 1190}"))
 
+    # Parse JSON op event records.
+    (date, time, module, msg) = logs_util.ParseLogLine(
+      '2013-01-04 00:04:20:624 [pid:3883] user_op_manager:247: SUCCESS: {"user":271,"device":1774,'
+      '"op":"ovVqW7V","method":"Device.UpdateOperation","elapsed":0.104,"exec":0.01}')
+    self.assertEquals(logs_util.ParseSuccessMsg(msg), ('271', '1774', 'ovVqW7V', 'Device', 'UpdateOperation'))
+    self.assertEquals(logs_util.ParseOpEvent(msg, 'SUCCESS')['elapsed'], 0.104)
+    self.assertEquals(logs_util.ParseOpEvent(msg, 'EXECUTE'), None)
+    self.assertEquals(logs_util.ParseExecuteMsg(msg), None)
+
+    msg = ('EXECUTE: {"user":1190,"device":4021,"op":"ohGz88k","method":"Device.UpdateOperation","attempts":0,'
+           '"args":{"device_dict":{"device_id":4021,"name":"...scrubbed 16 bytes..."},"user_id":1190}}')
+    self.assertEquals(logs_util.ParseExecuteMsg(msg),
+                      ('1190', '4021', 'ohGz88k', 'Device', 'UpdateOperation',
+                       {'device_dict': {'device_id': 4021, 'name': '...scrubbed 16 bytes...'}, 'user_id': 1190}))
+
+    msg = ('EXECUTE: {"user":1190,"device":4021,"op":"ohGz88k","method":"UploadContactsOperation.Execute",'
+           '"attempts":0,"arg_summary":{"contacts":"<list:5000>","user_id":1190}}')
+    self.assertEquals(logs_util.ParseExecuteMsg(msg),
+                      ('1190', '4021', 'ohGz88k', 'UploadContactsOperation', 'Execute', None))
+    self.assertEquals(logs_util.ParseExecuteMsg('EXECUTE: {"user":1190,"op":'), None)
+    self.assertEquals(logs_util.ParseExecuteMsg('EXECUTE: {"user":1190,"device":4021,"op":"ohGz88k"}'), None)
+
 
     # Parse message part of a ping log line.
     (date, time, module, msg) = logs_util.ParseLogLine(ping_log_line)
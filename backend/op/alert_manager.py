@@ -40,6 +40,9 @@ class AlertManager(object):
   _MAX_COVER_PHOTO_DIM = 416
   """Number of pixels in the cover photo's maximum dimension."""
 
+  _SEND_CONCURRENCY = 50
+  """Maximum number of followers alerted concurrently by SendFollowerAlerts."""
+
   _SMS_ALERT_LIMIT = 3
   """Maximum number of SMS alerts that will be sent if the user does not click on links. Be
   careful about changing this as it can result in the user getting multiple warnings and/or
@@ -50,18 +53,48 @@ class AlertManager(object):
   @gen.coroutine
   def SendFollowerAlert(cls, client, user_id, badge, viewpoint, follower, settings, activity):
     """Sends an APNS and/or email alert to the given follower according to his alert settings."""
+    yield AlertManager.SendFollowerAlerts(client, viewpoint, activity, [(user_id, badge, follower, settings)])
+
+  @classmethod
+  @gen.coroutine
+  def SendFollowerAlerts(cls, client, viewpoint, activity, recipients, concurrency=_SEND_CONCURRENCY):
+    """Sends alerts about "activity" to each of "recipients", which is a list of
+    (user_id, badge, follower, settings) tuples, according to each follower's alert settings.
+    The push alert text does not depend on the recipient, so it is formatted at most once and
+    shared by all recipients. At most "concurrency" recipients are alerted at once.
+    """
     # Only send add_followers alert to users who were added.
     if activity.name == 'add_followers':
-      args_dict = json.loads(activity.json)
-      if user_id not in args_dict['follower_ids']:
-        return
+      added_ids = set(json.loads(activity.json)['follower_ids'])
+      recipients = [recipient for recipient in recipients if recipient[0] in added_ids]
+
+    # Format the alert text once, when the first recipient needs it.
+    text_futures = []
 
+    def _GetAlertText():
+      if not text_futures:
+        text_futures.append(AlertManager._FormatAlertText(client, viewpoint, activity))
+      return text_futures[0]
+
+    def _SendOne(recipient):
+      user_id, badge, follower, settings = recipient
+      return AlertManager._SendFollowerAlert(client, user_id, badge, viewpoint, follower, settings, activity,
+                                             _GetAlertText)
+
+    yield util.RunConcurrently(_SendOne, recipients, concurrency)
+
+  @classmethod
+  @gen.coroutine
+  def _SendFollowerAlert(cls, client, user_id, badge, viewpoint, follower, settings, activity, get_alert_text):
+    """Sends an APNS, email, and/or SMS alert to a single follower. "get_alert_text" returns a
+    Future for the push alert text.
+    """
     if follower.IsMuted():
       # User has muted this viewpoint, so don't send any alerts.
       return
 
     if settings.push_alerts is not None and settings.push_alerts != AccountSettings.PUSH_NONE:
-      alert_text = yield AlertManager._FormatAlertText(client, viewpoint, activity)
+      alert_text = yield get_alert_text()
       if alert_text is not None:
         # Only alert with sound if this is the first unread activity for the conversation.
         if follower.viewed_seq + 1 >= viewpoint.update_seq:
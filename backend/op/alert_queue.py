@@ -0,0 +1,110 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Background queue for sending alerts.
+
+Formatting and sending alerts to the followers of a large viewpoint can take much longer than
+the rest of an operation, since each alert needs several database queries and a request to
+APNs, email, or SMS. If --defer_follower_alerts is set, the NotificationManager adds these
+alerts to the AlertQueue instead of sending them before the operation completes. The queue
+sends them in the background, with at most --alert_queue_concurrency alert batches in flight.
+
+Alerts are best-effort: failures are logged and not retried, and alerts still in the queue
+are lost if the server fails. If the queue holds --alert_queue_max_size batches, new batches
+are sent immediately by the caller instead, which slows producers down to the rate at which
+alerts can be sent.
+
+  AlertQueue: per-process queue of pending alert batches.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import logging
+
+from collections import deque
+from tornado import gen, options, stack_context
+from tornado.ioloop import IOLoop
+from viewfinder.backend.base import counters
+
+options.define('defer_follower_alerts', default=False,
+               help='send alerts to viewpoint followers from a background queue after the operation completes')
+options.define('alert_queue_concurrency', default=8,
+               help='maximum number of alert batches sent concurrently by the background alert queue')
+options.define('alert_queue_max_size', default=10000,
+               help='maximum number of alert batches waiting in the background alert queue')
+
+_deferred_per_min = counters.define_rate('viewfinder.alert_queue.deferred_per_min',
+                                         'Alert batches added to the background alert queue per minute.', 60)
+_queue_full_per_min = counters.define_rate('viewfinder.alert_queue.queue_full_per_min',
+                                           'Alert batches sent immediately because the alert queue was full.', 60)
+_queue_length = counters.define_total('viewfinder.alert_queue.queue_length',
+                                      'Number of alert batches waiting in the background alert queue.')
+
+
+class AlertQueue(object):
+  """Runs alert-sending coroutines in the background. Access the per-process instance via
+  AlertQueue.Instance().
+  """
+  _instance = None
+
+  def __init__(self, concurrency=None, max_size=None):
+    self._concurrency = concurrency or options.options.alert_queue_concurrency
+    self._max_size = max_size or options.options.alert_queue_max_size
+    self._queue = deque()
+    self._num_running = 0
+    self._drain_callbacks = []
+
+  @staticmethod
+  def Instance():
+    if AlertQueue._instance is None:
+      AlertQueue._instance = AlertQueue()
+    return AlertQueue._instance
+
+  @staticmethod
+  def SetInstance(alert_queue):
+    AlertQueue._instance = alert_queue
+
+  @gen.coroutine
+  def Enqueue(self, send_func):
+    """Adds "send_func", a function which takes no arguments and returns a Future, to the
+    queue. If the queue is full, invokes it right away and waits for it to complete.
+    """
+    if len(self._queue) >= self._max_size:
+      _queue_full_per_min.increment()
+      yield send_func()
+      return
+
+    _deferred_per_min.increment()
+    _queue_length.increment()
+    self._queue.append(send_func)
+    self._MaybeStartNext()
+
+  def Drain(self, callback):
+    """Invokes "callback" once the queue is empty and no alerts are being sent."""
+    if not self._queue and self._num_running == 0:
+      IOLoop.current().add_callback(callback)
+    else:
+      self._drain_callbacks.append(stack_context.wrap(callback))
+
+  def _MaybeStartNext(self):
+    while self._queue and self._num_running < self._concurrency:
+      send_func = self._queue.popleft()
+      _queue_length.decrement()
+      self._num_running += 1
+
+      # Alerts are sent on behalf of the queue, not in the context of the operation that queued them.
+      with stack_context.NullContext():
+        self._Send(send_func)
+
+  @gen.coroutine
+  def _Send(self, send_func):
+    try:
+      yield send_func()
+    except Exception:
+      logging.exception('failed to send queued alerts')
+    finally:
+      self._num_running -= 1
+      self._MaybeStartNext()
+      if not self._queue and self._num_running == 0:
+        callbacks, self._drain_callbacks = self._drain_callbacks, []
+        for callback in callbacks:
+          IOLoop.current().add_callback(callback)
@@ -3,6 +3,12 @@
 """Viewfinder FetchContactsOperation.
 
 This operation fetches contacts information from google or facebook for a user.
+
+Refreshes are incremental where possible. The identity records a digest of the ids of the
+contacts stored by the last complete fetch. If a new fetch produces the same set of contact
+ids, none of the user's stored contacts need to be read or written. For Google, a cheap
+probe using "updated-min" skips even the download if nothing has changed since the last
+fetch. Inserts and deletes are issued in batches of bounded size.
 """
 
 __authors__ = ['mike@emailscrubbed.com (Mike Purtell)']
@@ -15,6 +21,7 @@ import math
 import time
 import urllib
 
+from functools import partial
 from itertools import izip
 from operator import itemgetter
 from tornado import gen, httpclient
@@ -66,6 +73,7 @@ class FetchContactsOperation(ViewfinderOperation):
                          'http://schemas.google.com/g/2005#work_mobile': 'Work Mobile',
                          'http://schemas.google.com/g/2005#work_pager': 'Work Pager'}
 
+  _GOOGLE_UPDATED_MIN_MARGIN = 60 * 10  # 10 minutes
   _MAX_FETCH_COUNT = 100
   _MAX_FETCH_RETRIES = 3
   _MAX_GOOGLE_CONTACTS = 5000
@@ -73,6 +81,8 @@ class FetchContactsOperation(ViewfinderOperation):
 
   _PHOTO_CONNECTION_STRENGTHS = {'from': 1.0, 'tag': 1.0, 'like': 0.05}
 
+  _UPDATE_BATCH_SIZE = 100
+
   # Some tests will set this to skip fetch and update.
   _SKIP_UPDATE_FOR_TEST = False
 
@@ -87,6 +97,12 @@ class FetchContactsOperation(ViewfinderOperation):
     #   This notes the outcome of that decision.
     self._do_fetch_and_update = False
 
+    # Set to True if the contact source reports no changes, or if the fetched contacts match the
+    #   digest recorded by the last fetch.  In that case, existing contacts are neither read nor updated.
+    self._contacts_unchanged = False
+    # Digest of the fetched contact ids, to be recorded in the identity once the update succeeds.
+    self._contacts_digest = None
+
     # Dict of currently known contacts for the contact_source that's being fetched (keyed by contact_id).
     self._existing_contacts_dict = dict()
     # Dict of all contacts fetched (keyed by contact_id).
@@ -136,9 +152,10 @@ class FetchContactsOperation(ViewfinderOperation):
   def _Check(self):
     """Check and prepare for update.
     1) Get Identity record for requested identity.
-    2) Gather all of the existing known contacts for the relevant contact source.
-    3) Fetch the contacts from the relevant contact source (Facebook or GMail).
-    4) Prepare for update be determine which contacts should be Created/Removed/Deleted.
+    2) Fetch the contacts from the relevant contact source (Facebook or GMail).
+    3) If the fetched contacts match the digest of the last fetch, skip the remaining steps.
+    4) Gather all of the existing known contacts for the relevant contact source.
+    5) Prepare for update be determine which contacts should be Created/Removed/Deleted.
     """
     self._identity = yield gen.Task(Identity.Query, self._client, hash_key=self._key, col_names=None)
     assert self._identity.user_id == self._user_id, self
@@ -147,22 +164,33 @@ class FetchContactsOperation(ViewfinderOperation):
                                  not FetchContactsOperation._SKIP_UPDATE_FOR_TEST and
                                  self._identity.authority in ['Facebook', 'Google'])
 
-    # Get existing contacts and fetch contacts for the given identity.
+    # Fetch contacts for the given identity and, unless they have not changed, get existing contacts.
     if self._do_fetch_and_update:
-      yield self._GatherExistingContacts()
-
       if self._identity.authority == 'Facebook':
         assert not self._identity.expires
         yield self._FetchFacebookContacts()
       else:
         assert self._identity.authority == 'Google', self._identity
-        yield self._FetchGoogleContacts()
+        self._contacts_unchanged = yield self._ProbeGoogleContacts()
+        if not self._contacts_unchanged:
+          yield self._FetchGoogleContacts()
+
+      if not self._contacts_unchanged:
+        self._contacts_digest = FetchContactsOperation._CalculateContactsDigest(self._fetched_contacts.iterkeys())
+        self._contacts_unchanged = (self._identity.contacts_digest is not None and
+                                    self._contacts_digest == self._identity.contacts_digest)
+
+      if self._contacts_unchanged:
+        logging.info('%s contacts for user %d are unchanged since last fetch' %
+                     (self._identity.authority, self._user_id))
+      else:
+        yield self._GatherExistingContacts()
 
     if self._op.checkpoint is not None:
       # Recall what we determined last time about removed contacts reset.
       self._removed_contacts_reset = self._op.checkpoint['removed_contacts_reset']
 
-    if self._do_fetch_and_update:
+    if self._do_fetch_and_update and not self._contacts_unchanged:
       # Process everything we know at this point and get it into shape for the update phase.
       self._PrepareFetchedContactsForUpdate()
 
@@ -184,17 +212,27 @@ class FetchContactsOperation(ViewfinderOperation):
       if contact_to_delete is not None:
         yield gen.Task(contact_to_delete.Delete, self._client)
 
-    # Delete superfluous contact rows and 'removed' contacts for removed contacts reset.
-    tasks = [gen.Task(contact_to_delete.Delete, self._client) for contact_to_delete in self._contacts_to_delete]
-    # Insert (and maybe replace) fetched contacts.
-    for contact_to_insert, contact_to_delete in self._create_delete_contacts:
-      tasks.append(_InsertDeleteContact(contact_to_insert, contact_to_delete))
-    yield tasks
-
-    logging.info('successfully imported %d %s contacts for user %d' %
-                 (len(self._fetched_contacts) - self._skipped_contact_create_count,
-                  self._identity.authority,
-                  self._user_id))
+    if not self._contacts_unchanged:
+      # Delete superfluous contact rows and 'removed' contacts for removed contacts reset.
+      updates = [partial(gen.Task, contact_to_delete.Delete, self._client)
+                 for contact_to_delete in self._contacts_to_delete]
+      # Insert (and maybe replace) fetched contacts.
+      for contact_to_insert, contact_to_delete in self._create_delete_contacts:
+        updates.append(partial(_InsertDeleteContact, contact_to_insert, contact_to_delete))
+
+      # Heavy users can have tens of thousands of changes, so don't start them all at once.
+      for i in xrange(0, len(updates), FetchContactsOperation._UPDATE_BATCH_SIZE):
+        yield [update() for update in updates[i:i + FetchContactsOperation._UPDATE_BATCH_SIZE]]
+
+      logging.info('successfully imported %d %s contacts for user %d' %
+                   (len(self._fetched_contacts) - self._skipped_contact_create_count,
+                    self._identity.authority,
+                    self._user_id))
+
+      # Only record the digest if all fetched contacts were stored; otherwise, the next fetch must
+      #   retry the skipped contacts.
+      self._identity.contacts_digest = self._contacts_digest if self._skipped_contact_create_count == 0 else None
+
     self._identity.last_fetch = util.GetCurrentTimestamp()
     yield gen.Task(self._identity.Update, self._client)
 
@@ -210,6 +248,47 @@ class FetchContactsOperation(ViewfinderOperation):
                                                   self._notify_timestamp,
                                                   self._removed_contacts_reset)
 
+  @classmethod
+  def _CalculateContactsDigest(cls, contact_ids):
+    """Calculates a digest of a set of contact ids, independent of their order. Since the contact_id
+    is itself a digest of the contact's attributes, two fetches with the same digest produced the
+    same contacts.
+    """
+    return Contact.CalculateContactEncodedDigest(contact_ids=sorted(set(contact_ids)))
+
+  @gen.coroutine
+  def _ProbeGoogleContacts(self):
+    """Asks Google whether any contacts have been added, modified or deleted since the last fetch,
+    using the "updated-min" query parameter. Returns True if the last fetch is known to still be
+    current, and False if the contacts need to be fetched.
+    """
+    if self._identity.contacts_digest is None or self._identity.last_fetch is None:
+      raise gen.Return(False)
+
+    if self._identity.expires and self._identity.expires < time.time():
+      yield gen.Task(self._identity.RefreshGoogleAccessToken, self._client)
+
+    updated_min = self._identity.last_fetch - FetchContactsOperation._GOOGLE_UPDATED_MIN_MARGIN
+    url = FetchContactsOperation._GOOGLE_CONTACTS_URL + '?' + \
+        urllib.urlencode({'max-results': 1,
+                          'updated-min': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(updated_min)),
+                          'showdeleted': 'true',
+                          'alt': 'json'})
+    http_client = httpclient.AsyncHTTPClient()
+    response = yield gen.Task(http_client.fetch,
+                              url,
+                              method='GET',
+                              headers={'Authorization': 'OAuth %s' % self._identity.access_token,
+                                       'GData-Version': 3.0})
+    try:
+      response_dict = www_util.ParseJSONResponse(response)['feed']
+      num_changed = int(response_dict['openSearch$totalResults']['$t'])
+    except Exception as exc:
+      logging.warning('failed to probe Google contacts for changes: %s' % exc)
+      raise gen.Return(False)
+
+    raise gen.Return(num_changed == 0 and len(response_dict.get('entry', [])) == 0)
+
   @gen.coroutine
   def _FetchGoogleContacts(self):
     """Do GMail specific data gathering and checking.
@@ -65,6 +65,7 @@ class LinkIdentityOperation(ViewfinderOperation):
     self._identity.expires = 0
     self._identity.user_id = self._target_user_id
     yield gen.Task(self._identity.Update, self._client)
+    Identity.NotifyBound(self._identity.key)
 
   @gen.coroutine
   def _Notify(self):
@@ -233,6 +233,7 @@ class MergeAccountsOperation(ViewfinderOperation):
       identity.expires = 0
       identity.user_id = self._target_user_id
       yield gen.Task(identity.Update, self._client)
+      Identity.NotifyBound(identity.key)
 
     # Send notifications for all identities that were re-bound.
     yield NotificationManager.NotifyMergeIdentities(self._client,
@@ -14,6 +14,13 @@
   2. Creates activities for operations that modify viewpoint assets.
 
   3. Sends push alerts to client devices for operations that require them.
+
+  Viewpoints can have hundreds of followers. Rather than issuing a request per follower all at
+  once, which causes DynamoDB throttling, the per-follower Followed updates and notifications
+  are issued with at most --notify_fanout_concurrency requests outstanding at a time. Alerts are
+  sent once all notifications have been created, and if --defer_follower_alerts is set, they
+  are handed to the background AlertQueue (see alert_queue.py) so that the operation can
+  complete without waiting for them.
 """
 
 __authors__ = ['spencer@emailscrubbed.com (Spencer Kimball)',
@@ -22,15 +29,21 @@ __authors__ = ['spencer@emailscrubbed.com (Spencer Kimball)',
 import json
 import logging
 
-from tornado import gen
+from functools import partial
+from tornado import gen, options
 from viewfinder.backend.base import util
 from viewfinder.backend.db.activity import Activity
 from viewfinder.backend.db.contact import Contact
 from viewfinder.backend.db.device import Device
 from viewfinder.backend.db.followed import Followed
+from viewfinder.backend.db.inbox import Inbox
 from viewfinder.backend.db.notification import Notification
 from viewfinder.backend.db.operation import Operation
 from viewfinder.backend.db.settings import AccountSettings
+from viewfinder.backend.db.updated_viewpoint import UpdatedViewpoint
+
+options.define('notify_fanout_concurrency', default=50,
+               help='maximum number of followers whose Followed rows or notifications are written concurrently')
 
 
 class NotificationManager(object):
@@ -695,23 +708,35 @@ class NotificationManager(object):
     2. In parallel:
        a. Update update_seq in the viewpoint.
        b. Update viewed_seq in the sending follower.
+       c. Add the viewpoint to the feed of updated viewpoints read by dbchk.
+
+    3. For each follower, create a notification, and update the follower's materialized inbox
+       (see inbox.py).
+
+    4. Send alerts to the followers, or queue them to be sent in the background.
 
-    3. In parallel:
-       a. For each follower:
-          i. Create notification
-          ii. Send alert
+    Steps 1b and 3 are pipelined, with at most --notify_fanout_concurrency followers in
+    progress at once.
     """
     from viewfinder.backend.db.viewpoint import Viewpoint
     from viewfinder.backend.op.alert_manager import AlertManager
+    from viewfinder.backend.op.alert_queue import AlertQueue
+
+    concurrency = options.options.notify_fanout_concurrency
 
     # Get the current operation, which provides the calling user and the op timestamp.
     operation = NotificationManager._GetOperation()
 
     @gen.coroutine
     def _NotifyOneFollower(viewpoint, seq_num_pair, activity, follower, follower_settings):
-      """Creates a notification for the follower and sends an alert if configured to do so."""
-      # If follower has been removed, do not send notifications or alerts to it.
+      """Creates a notification for the follower. Returns the (user_id, badge, follower,
+      settings) tuple with which to alert the follower, or None if no alert should be sent.
+      """
+      # If follower has been removed, do not send notifications or alerts to it. Its Followed record
+      # was still updated, so its materialized inbox can no longer be kept current.
       if follower.IsRemoved() and not always_notify:
+        if options.options.materialize_inbox:
+          yield Inbox.Invalidate(client, follower.user_id)
         return
 
       # Get the invalidate dict.
@@ -736,14 +761,12 @@ class NotificationManager(object):
                                                       seq_num_pair=seq_num_pair,
                                                       inc_badge=inc_badge and not is_sending_user)
 
+      # Bring the follower's materialized inbox up-to-date with the notification.
+      if options.options.materialize_inbox:
+        yield Inbox.ApplyNotification(client, follower.user_id, notification.notification_id, viewpoint, follower)
+
       if not is_sending_user:
-        yield AlertManager.SendFollowerAlert(client,
-                                             follower.user_id,
-                                             notification.badge,
-                                             viewpoint,
-                                             follower,
-                                             follower_settings,
-                                             activity)
+        raise gen.Return((follower.user_id, notification.badge, follower, follower_settings))
 
     # We want a locked viewpoint while updating its sequence numbers and the corresponding Followed rows.
     # Locking also prevents race conditions where new followers are added during iteration.
@@ -770,13 +793,14 @@ class NotificationManager(object):
     settings_task = gen.Task(AccountSettings.BatchQuery, client, follower_keys, None, must_exist=False)
 
     # Update all Followed records.
-    followed_task = gen.Multi([gen.Task(Followed.UpdateDateUpdated,
-                                        client,
-                                        follower.user_id,
-                                        viewpoint_id,
-                                        viewpoint.last_updated,
-                                        operation.timestamp)
-                               for follower in followers])
+    followed_task = util.RunConcurrently(lambda follower: gen.Task(Followed.UpdateDateUpdated,
+                                                                   client,
+                                                                   follower.user_id,
+                                                                   viewpoint_id,
+                                                                   viewpoint.last_updated,
+                                                                   operation.timestamp),
+                                         followers,
+                                         concurrency)
 
     activity, all_follower_settings, _ = yield [activity_task, settings_task, followed_task]
 
@@ -786,13 +810,25 @@ class NotificationManager(object):
     if operation.timestamp > viewpoint.last_updated:
       viewpoint.last_updated = operation.timestamp
 
-    # Commit changes to update_seq and the sending follower's viewed_seq.
+    # Commit changes to update_seq and the sending follower's viewed_seq, and record the update in the
+    # UpdatedViewpoint feed.
     yield [gen.Task(viewpoint.Update, client),
-           gen.Task(sending_follower.Update, client) if sending_follower is not None else util.GenConstant(None)]
-
-    # Visit each follower and generate notifications and alerts for it.
-    yield [_NotifyOneFollower(viewpoint, seq_num_pair, activity, follower, follower_settings)
-           for follower, follower_settings in zip(followers, all_follower_settings)]
+           gen.Task(sending_follower.Update, client) if sending_follower is not None else util.GenConstant(None),
+           UpdatedViewpoint.Record(client, viewpoint_id, viewpoint.last_updated)]
+
+    # Visit each follower and generate notifications for it.
+    recipients = yield util.RunConcurrently(lambda pair: _NotifyOneFollower(viewpoint, seq_num_pair, activity, *pair),
+                                            zip(followers, all_follower_settings),
+                                            concurrency)
+    recipients = [recipient for recipient in recipients if recipient is not None]
+
+    # Send alerts to the notified followers.
+    if recipients:
+      send_func = partial(AlertManager.SendFollowerAlerts, client, viewpoint, activity, recipients)
+      if options.options.defer_follower_alerts:
+        yield AlertQueue.Instance().Enqueue(send_func)
+      else:
+        yield send_func()
 
   @classmethod
   @gen.coroutine
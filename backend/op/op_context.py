@@ -36,7 +36,9 @@ class OpContext(ContextLocal):
       ...
 
   Note that this usage of Enter establishes a static scope (i.e. a stack context is not used).
-  It is intended to be used in concert with Tornado gen.
+  It is intended to be used in concert with Tornado gen. Several ops may be executing at once
+  (see UserOpManager), each within its own OpContext; the op-specific log only captures
+  messages logged while its own OpContext is current.
   """
   def __init__(self):
     super(OpContext, self).__init__()
@@ -60,6 +62,7 @@ class OpContext(ContextLocal):
       if op.method is not None:
         log_handler = UserOperationLogHandler(op)
         log_handler.setLevel(logging.INFO)
+        log_handler.addFilter(_OpLogFilter(self))
         log_context = log_handler.LoggingContext()
         log_context.__enter__()
       yield
@@ -71,6 +74,18 @@ class OpContext(ContextLocal):
       self.executing_op = None
 
 
+class _OpLogFilter(logging.Filter):
+  """Passes only log records that are emitted while "op_context" is the current OpContext, so
+  that the logs of ops that are executing concurrently are not mixed together.
+  """
+  def __init__(self, op_context):
+    logging.Filter.__init__(self)
+    self._op_context = op_context
+
+  def filter(self, record):
+    return OpContext.current() is self._op_context
+
+
 def EnterOpContext(op):
   """Returns a StackContext that when entered, puts the given operation into scope in a new
   OpContext.
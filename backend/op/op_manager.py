@@ -28,6 +28,17 @@ be saved in the database for later developer inspection and repair. The quaranti
 useful because without it, a failed operation would retain the operation lock and prevent all
 future operations for that user from executing. This would result in total user lockout.
 
+When this server quarantines an operation, or fails to acquire a user's lock because another
+server holds it, the UserOpManager registers the time at which the operation's backoff ends or
+the lock can be abandoned with the OpManager's RetryScheduler (see retry_scheduler.py), so that
+the user's operations are retried at that time. A retry only goes ahead if no live server holds
+the user's lock; otherwise it is put off until that lock next expires. The periodic table scans are then only a safety
+net for operations and locks left behind by servers that have failed, and run infrequently.
+
+Any server can accept an operation, but if --op_routing is enabled, the OpManager forwards each
+user's operations to the server that owns that user (see op_router.py), so that the user's
+devices do not cause servers to contend for the operation lock.
+
   OpManager: one instance per server; processes user ops which have fallen through the cracks
 """
 
@@ -42,10 +53,20 @@ from datetime import timedelta
 from functools import partial
 from tornado import gen, stack_context
 from tornado.ioloop import IOLoop
-from viewfinder.backend.base import message, util
+from viewfinder.backend.base import counters, message, util
 from viewfinder.backend.db import db_client
 from viewfinder.backend.db.lock import Lock
 from viewfinder.backend.db.lock_resource_type import LockResourceType
+from viewfinder.backend.op.retry_scheduler import RetryScheduler
+
+_scan_requests = counters.define_rate('viewfinder.operation.scan_requests_per_min',
+                                      'Scan requests issued for failed operations and abandoned locks per minute.',
+                                      60)
+_retries_deferred = counters.define_rate('viewfinder.operation.retries_deferred_per_min',
+                                         'Scheduled retries put off because a live server holds the lock per minute.',
+                                         60)
+_scanned_items = counters.define_rate('viewfinder.operation.scanned_items_per_min',
+                                      'Failed operations and abandoned locks returned by scans per minute.', 60)
 
 
 class OpManager(object):
@@ -54,10 +75,11 @@ class OpManager(object):
   the queue of operations is actually managed and executed by an instance of the UserOpManager
   class.
 
-  Periodically scans the database for abandoned locks and failed operations. Each abandoned
-  lock is associated with user operations that have stalled and need to be restarted. Each
-  failed operation needs to be periodically retried in order to see if the underlying issue
-  has been fixed.
+  Retries failed operations and takes over abandoned locks at the deadlines registered with its
+  RetryScheduler. As a safety net, also periodically scans the database for abandoned locks and
+  failed operations. Each abandoned lock is associated with user operations that have stalled
+  and need to be restarted. Each failed operation needs to be periodically retried in order to
+  see if the underlying issue has been fixed.
 
   On startup, a random time offset is chosen before initiating the first scan. This is meant
   to avoid multiple servers scanning the same data.
@@ -73,21 +95,30 @@ class OpManager(object):
   (i.e. after filtering).
   """
 
-  _MAX_SCAN_ABANDONED_LOCKS_INTERVAL = timedelta(seconds=60)
-  """Time between scans for abandoned locks."""
+  _MAX_SCAN_ABANDONED_LOCKS_INTERVAL = timedelta(minutes=5)
+  """Time between scans for abandoned locks. Locks held by other servers that this server has
+  tried to acquire are retried by the RetryScheduler, so the scan only needs to find locks left
+  behind by failed servers that no live server knows about.
+  """
 
   _MAX_SCAN_FAILED_OPS_INTERVAL = timedelta(hours=6)
   """Time between scans for failed operations to retry."""
 
-  def __init__(self, op_map, client=None, scan_ops=False):
+  _user_changed_hooks = []
+  """Functions invoked with the id of each user changed by a completed operation."""
+
+  def __init__(self, op_map, client=None, scan_ops=False, router=None):
     """Initializes the operation map, which is a dictionary mapping from operation method str
     to an instance of OpMapEntry. Also initializes maps for active users (map from user id to
-    an instance of UserOpManager).
+    an instance of UserOpManager). If "router" (an OpRouter) is given, operations for users
+    owned by other servers are forwarded to those servers.
     """
     self.op_map = op_map
     self._client = client or db_client.Instance()
+    self._router = router
     self._active_users = dict()
     self._drain_callback = None
+    self.retry_scheduler = RetryScheduler(self._OnRetry)
     if scan_ops:
       self._ScanAbandonedLocks()
       self._ScanFailedOps()
@@ -113,23 +144,63 @@ class OpManager(object):
   def MaybeExecuteOp(self, client, user_id, operation_id, wait_callback=None):
     """Adds the op's user to the queue and attempts to begin processing the operation. If the
     user is already locked by another server, or if this server is already executing operations
-    for this user, then the operation is merely queued for later execution.
+    for this user, then the operation is merely queued for later execution. If an OpRouter is
+    configured and another server owns the user, the operation is forwarded to that server.
 
     If the "wait_callback" function is specified, then it is called once the operation has
     completed execution (or an error has occurred). This is useful for testing. The callback
     should have the form:
       OnExecution(value=None, type=None, tb=None)
     """
+    if self._router is not None and not self._router.IsOwner(user_id):
+      self._ForwardOp(client, user_id, operation_id, wait_callback)
+    else:
+      self.ExecuteLocally(client, user_id, operation_id, wait_callback)
+
+  def ExecuteLocally(self, client, user_id, operation_id, wait_callback=None):
+    """Same as MaybeExecuteOp, but always executes the operation on this server."""
     from viewfinder.backend.op.user_op_manager import UserOpManager
 
     user_op_mgr = self._active_users.get(user_id, None)
     if user_op_mgr is None:
       user_op_mgr = UserOpManager(client, self.op_map, user_id,
-                                  partial(self._OnCompletedOp, user_id))
+                                  partial(self._OnCompletedOp, user_id),
+                                  retry_scheduler=self.retry_scheduler)
       self._active_users[user_id] = user_op_mgr
 
     user_op_mgr.Execute(operation_id, wait_callback)
 
+  @gen.engine
+  def _ForwardOp(self, client, user_id, operation_id, wait_callback):
+    """Forwards the operation to the server that owns "user_id". If that server cannot be
+    reached, executes the operation locally instead.
+    """
+    forwarded = yield self._router.Forward(user_id, operation_id, wait=wait_callback is not None)
+    if not forwarded:
+      self.ExecuteLocally(client, user_id, operation_id, wait_callback)
+    elif wait_callback is not None:
+      wait_callback()
+
+  @gen.engine
+  def _OnRetry(self, user_id, operation_id):
+    """Invoked by the RetryScheduler once a failed operation's backoff has ended or a lock held
+    by another server may have been abandoned. If another server still holds the user's lock and
+    has kept renewing it, then that server is alive and will execute the user's operations, and
+    a retry would only fail to acquire the lock and make the holder re-query. In that case, the
+    retry is put off until the holder's lock next expires.
+    """
+    if user_id not in self._active_users:
+      lock_id = Lock.ConstructLockId(LockResourceType.Operation, str(user_id))
+      lock = yield gen.Task(Lock.Query, self._client, lock_id, None, must_exist=False, consistent_read=True)
+      if lock is not None and not lock.IsAbandoned():
+        _retries_deferred.increment()
+        if lock.expiration is not None:
+          self.retry_scheduler.Schedule(user_id, operation_id, lock.expiration)
+        return
+
+    logging.info('retrying operations for user %d, starting with "%s"' % (user_id, operation_id))
+    self.MaybeExecuteOp(self._client, user_id, operation_id)
+
   def _OnCompletedOp(self, user_id):
     """Removes the user from the list of active users, since all of that user's operations have
     been executed.
@@ -159,6 +230,8 @@ class OpManager(object):
                                            self._client,
                                            limit=limit,
                                            excl_start_key=last_key)
+            _scan_requests.increment()
+            _scanned_items.increment(len(ops))
 
             # Add each operation to the queue for the owning user.
             for op in ops:
@@ -202,6 +275,8 @@ class OpManager(object):
                                              self._client,
                                              limit=limit,
                                              excl_start_key=last_key)
+            _scan_requests.increment()
+            _scanned_items.increment(len(locks))
 
             for lock in locks:
               resource_type, resource_id = Lock.DeconstructLockId(lock.lock_id)
@@ -226,6 +301,24 @@ class OpManager(object):
       logging.debug('next scan in %.2fs' % timeout_secs)
       yield gen.Task(IOLoop.current().add_timeout, timeout_time)
 
+  @staticmethod
+  def AddUserChangedHook(hook):
+    """Registers "hook" to be invoked with a user id each time an operation that changes or
+    terminates that user completes on this server (see OpMapEntry.changed_users).
+    """
+    OpManager._user_changed_hooks.append(hook)
+
+  @property
+  def router(self):
+    """The OpRouter to which operations of users owned by other servers are forwarded, or None."""
+    return self._router
+
+  @staticmethod
+  def NotifyUserChanged(user_id):
+    """Invokes the hooks registered with AddUserChangedHook for "user_id"."""
+    for hook in OpManager._user_changed_hooks:
+      hook(user_id)
+
   @staticmethod
   def SetInstance(op_manager):
     """Sets the per-process instance of the OpManager class."""
@@ -246,9 +339,21 @@ class OpMapEntry(object):
 
     handler: Method to invoke in order to execute the operation.
     migrators: Message version migrators for the method args.
-    scrubber: Scrubs personal info from operation args before logging.
+    scrubber: Returns a copy of the operation args with personal info scrubbed, for logging.
+              Must not modify the args it is given.
+    changed_users: Returns the ids of users whose User object is changed by the operation,
+                   given the operation args. Hooks registered with
+                   OpManager.AddUserChangedHook are invoked for each id once the
+                   operation completes.
+    resources: Returns the keys of the viewpoints and episodes that the operation locks,
+               reads or changes, given the operation args. When --max_parallel_user_ops
+               is greater than one, operations for the same user whose keys do not
+               intersect may be executed concurrently. If None, the operation is always
+               executed on its own.
   """
-  def __init__(self, handler, migrators=[], scrubber=None):
+  def __init__(self, handler, migrators=[], scrubber=None, changed_users=None, resources=None):
     self.handler = handler
     self.migrators = sorted(message.REQUIRED_MIGRATORS + migrators)
     self.scrubber = scrubber
+    self.changed_users = changed_users
+    self.resources = resources
@@ -0,0 +1,299 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Routes each user's operations to a single owning server.
+
+Operations are executed by whichever server holds the user's operation lock (see
+user_op_manager.py). When a user's devices talk to several servers at once, those servers
+contend for the same lock: all but one fail to acquire it, synchronous callers get a
+CannotWaitError, and the lock owner must re-query the Operation table each time another
+server reports an acquire failure.
+
+The OpRouter avoids this contention by giving each user an "owner" server. Live servers are
+placed on a consistent hash ring, and a user's operations are forwarded over an internal RPC
+(see www/internal_rpc.py) to the server that owns the user id on the ring. Servers that join
+or leave only move the users that hash to them. The operation lock is still acquired by the
+owner, so correctness never depends on every server having the same view of the ring.
+
+Ring membership is kept in the Lock table: each server holds a lock of resource type
+LockResourceType.Server with abandonment detection, and the lock's periodic renewal serves as
+the server's heartbeat. A server whose heartbeat expires (i.e. whose lock is abandoned) drops
+out of the ring at the next refresh, and its users fail over to the remaining servers. If the
+owner cannot be reached, the operation is simply executed locally.
+
+  HashRing: consistent hash ring of server addresses.
+  ServerMembership: live servers, kept in the Lock table.
+  LocalServerMembership: in-process stand-in for ServerMembership, for tests and --localdb.
+  OpRouter: finds the owner of a user and forwards operations to it.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import bisect
+import hashlib
+import json
+import logging
+import socket
+import time
+
+from tornado import gen, httpclient, options
+from tornado.ioloop import IOLoop
+from viewfinder.backend.base import counters, exceptions
+from viewfinder.backend.db import db_client
+from viewfinder.backend.db.lock import Lock
+from viewfinder.backend.db.lock_resource_type import LockResourceType
+
+options.define('op_routing', default=False,
+               help='forward each user\'s operations to the server that owns the user on the hash ring')
+options.define('op_routing_host', default=None,
+               help='host name by which other servers reach this server\'s internal RPC port; defaults to the '
+                    'machine\'s host name')
+options.define('op_routing_port', default=8090,
+               help='internal RPC port on which operations forwarded by other servers are accepted; this port '
+                    'must not be reachable from outside the cluster')
+options.define('op_routing_refresh_secs', default=10.0,
+               help='seconds between refreshes of the set of live servers on the op routing ring')
+options.define('op_routing_timeout_secs', default=60.0,
+               help='timeout for forwarding an operation, including time spent waiting for it to complete')
+
+_forwarded_ops = counters.define_rate('viewfinder.op_router.forwarded_per_min',
+                                      'Operations forwarded to the owning server per minute.', 60)
+_forward_failures = counters.define_rate('viewfinder.op_router.forward_failures_per_min',
+                                         'Operations executed locally because the owner was unreachable.', 60)
+_ring_changes = counters.define_rate('viewfinder.op_router.ring_changes_per_min',
+                                     'Changes to the set of live servers on the op routing ring per minute.', 60)
+_live_servers = counters.define_total('viewfinder.op_router.live_servers',
+                                      'Number of live servers on the op routing ring.')
+
+
+def _Hash(value):
+  """Returns a stable 64-bit hash of the string "value"."""
+  return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+  """Consistent hash ring. Each node is placed at "replicas" points on the ring, and a key is
+  owned by the first node point that follows the key's hash, which spreads keys evenly and
+  moves only ~1/N of the keys when a node joins or leaves.
+  """
+  _DEFAULT_REPLICAS = 100
+
+  def __init__(self, nodes, replicas=_DEFAULT_REPLICAS):
+    points = sorted((_Hash('%s#%d' % (node, i)), node) for node in nodes for i in xrange(replicas))
+    self.nodes = frozenset(nodes)
+    self._hashes = [point_hash for point_hash, _ in points]
+    self._points = [node for _, node in points]
+
+  def GetNode(self, key):
+    """Returns the node that owns "key", or None if the ring is empty."""
+    if not self._points:
+      return None
+    index = bisect.bisect(self._hashes, _Hash(str(key))) % len(self._points)
+    return self._points[index]
+
+
+class ServerMembership(object):
+  """Tracks the set of live servers using the Lock table. A server joins by acquiring a lock
+  with abandonment detection whose resource data is the server's RPC address. The lock is
+  renewed every Lock.LOCK_RENEWAL_SECS, and is abandoned (and the server considered dead)
+  Lock.ABANDONMENT_SECS after the last renewal.
+  """
+  def __init__(self, client):
+    self._client = client
+    self._locks = {}
+
+  @gen.coroutine
+  def Join(self, address):
+    """Adds the server at "address" to the set of live servers. If a previous incarnation of
+    the server still holds its lock, keeps trying until that lock is abandoned.
+    """
+    while True:
+      results = yield gen.Task(Lock.TryAcquire,
+                               self._client,
+                               LockResourceType.Server,
+                               ServerMembership._GetResourceId(address),
+                               resource_data=address,
+                               detect_abandonment=True)
+      lock, status = results.args
+      if status != Lock.FAILED_TO_ACQUIRE_LOCK:
+        self._locks[address] = lock
+        break
+
+      logging.warning('server lock for "%s" is held by a previous process; will retry' % address)
+      yield gen.Task(IOLoop.current().add_timeout, time.time() + Lock.LOCK_RENEWAL_SECS)
+
+  @gen.coroutine
+  def Leave(self, address):
+    """Removes the server at "address" from the set of live servers."""
+    lock = self._locks.pop(address, None)
+    if lock is not None:
+      yield lock.Release(self._client)
+
+  @gen.coroutine
+  def QueryLiveServers(self):
+    """Returns the set of addresses of servers whose heartbeat has not expired."""
+    addresses = set()
+    last_key = None
+    while True:
+      locks, last_key = yield gen.Task(Lock.Scan,
+                                       self._client,
+                                       None,
+                                       limit=100,
+                                       excl_start_key=last_key,
+                                       scan_filter={'expiration': db_client.ScanFilter([time.time()], 'GT')})
+      for lock in locks:
+        resource_type, _ = Lock.DeconstructLockId(lock.lock_id)
+        if resource_type == LockResourceType.Server and lock.resource_data is not None:
+          addresses.add(lock.resource_data)
+
+      if last_key is None:
+        raise gen.Return(addresses)
+
+  @staticmethod
+  def _GetResourceId(address):
+    # Lock resource ids cannot contain a colon.
+    return address.replace(':', '_')
+
+
+class LocalServerMembership(object):
+  """In-process stand-in for ServerMembership. Servers are live from the time they join until
+  they leave or until "Expire" is called to simulate the loss of their heartbeat.
+  """
+  def __init__(self):
+    self._addresses = set()
+
+  @gen.coroutine
+  def Join(self, address):
+    self._addresses.add(address)
+
+  @gen.coroutine
+  def Leave(self, address):
+    self._addresses.discard(address)
+
+  def Expire(self, address):
+    self._addresses.discard(address)
+
+  @gen.coroutine
+  def QueryLiveServers(self):
+    raise gen.Return(set(self._addresses))
+
+
+class OpRouter(object):
+  """Finds the server that owns each user's operations and forwards operations to it. The
+  OpManager consults the router, if one is configured, before executing operations locally.
+  """
+  FORWARD_PATH = '/internal/execute_ops'
+
+  def __init__(self, membership, address, http_client=None):
+    self._membership = membership
+    self._address = address
+    self._http_client = http_client or httpclient.AsyncHTTPClient()
+    self._ring = HashRing([address])
+    self._refresh_timeout = None
+    _live_servers.increment()
+
+  @property
+  def address(self):
+    return self._address
+
+  @staticmethod
+  def GetLocalAddress():
+    """Returns the address at which other servers reach this server's internal RPC port."""
+    return '%s:%d' % (options.options.op_routing_host or socket.gethostname(), options.options.op_routing_port)
+
+  @gen.coroutine
+  def Start(self):
+    """Joins the ring and begins periodically refreshing the set of live servers."""
+    yield self._membership.Join(self._address)
+    yield self.Refresh()
+    self._ScheduleRefresh()
+
+  @gen.coroutine
+  def Stop(self):
+    """Stops refreshing and leaves the ring. The router may not be started again."""
+    if self._refresh_timeout is not None:
+      IOLoop.current().remove_timeout(self._refresh_timeout)
+      self._refresh_timeout = None
+    _live_servers.decrement(len(self._ring.nodes))
+    yield self._membership.Leave(self._address)
+
+  @gen.coroutine
+  def Refresh(self):
+    """Rebuilds the ring from the current set of live servers. This server is always on its
+    own ring, even if its heartbeat is late.
+    """
+    addresses = yield self._membership.QueryLiveServers()
+    addresses.add(self._address)
+    if addresses != self._ring.nodes:
+      logging.info('op routing ring changed from %s to %s' % (sorted(self._ring.nodes), sorted(addresses)))
+      _ring_changes.increment()
+      _live_servers.increment(len(addresses) - len(self._ring.nodes))
+      self._ring = HashRing(addresses)
+
+  def GetOwner(self, user_id):
+    """Returns the address of the server that owns the operations of "user_id"."""
+    return self._ring.GetNode(user_id)
+
+  def IsOwner(self, user_id):
+    """Returns true if this server owns the operations of "user_id"."""
+    return self.GetOwner(user_id) == self._address
+
+  @gen.coroutine
+  def Forward(self, user_id, operation_id, wait):
+    """Asks the owner of "user_id" to execute the user's operations, starting with
+    "operation_id". If "wait" is true, the owner responds only once that operation has
+    completed, and if it failed, the failure is re-raised here. Returns False if the owner
+    could not be reached, in which case the caller should execute the operations itself.
+    """
+    owner = self.GetOwner(user_id)
+    body = json.dumps({'user_id': user_id, 'operation_id': operation_id, 'wait': wait})
+    request = httpclient.HTTPRequest('http://%s%s' % (owner, OpRouter.FORWARD_PATH),
+                                     method='POST',
+                                     body=body,
+                                     headers={'Content-Type': 'application/json'},
+                                     request_timeout=options.options.op_routing_timeout_secs)
+    response = yield gen.Task(self._http_client.fetch, request)
+    if response.error is not None:
+      logging.warning('cannot forward op "%s" for user %d to %s: %s' % (operation_id, user_id, owner, response.error))
+      _forward_failures.increment()
+      raise gen.Return(False)
+
+    _forwarded_ops.increment()
+    error = json.loads(response.body).get('error')
+    if error is not None:
+      raise OpRouter._MakeException(error)
+    raise gen.Return(True)
+
+  @staticmethod
+  def MakeErrorDict(value):
+    """Returns a JSON-serializable description of an operation failure, which can be turned
+    back into an exception by _MakeException.
+    """
+    return {'type': type(value).__name__, 'message': str(value), 'id': getattr(value, 'id', None)}
+
+  @staticmethod
+  def _MakeException(error):
+    """Re-creates an exception described by MakeErrorDict. Viewfinder errors keep their type
+    and error id so that the client gets the same response as if the op had run locally.
+    """
+    exc_type = getattr(exceptions, error['type'], None)
+    if isinstance(exc_type, type) and issubclass(exc_type, exceptions.ViewfinderError):
+      try:
+        value = exc_type(error['message'])
+        value.id = error['id']
+        return value
+      except Exception:
+        pass
+    return Exception('%s: %s' % (error['type'], error['message']))
+
+  def _ScheduleRefresh(self):
+    @gen.coroutine
+    def _OnRefreshTimeout():
+      self._refresh_timeout = None
+      try:
+        yield self.Refresh()
+      except Exception:
+        logging.exception('failed to refresh op routing ring')
+      self._ScheduleRefresh()
+
+    self._refresh_timeout = IOLoop.current().add_timeout(time.time() + options.options.op_routing_refresh_secs,
+                                                         _OnRefreshTimeout)
@@ -87,71 +87,136 @@ def _ScrubItem(dict, item_name):
     dict[item_name] = '...scrubbed %s bytes...' % len(dict[item_name])
 
 
-def _ScrubForClass(cls, message):
-  for key in message:
+def _ScrubForClass(cls, op_args, item_name):
+  """Returns a copy of "op_args" in which the columns of op_args[item_name] that "cls" says
+  should be scrubbed are replaced. Only the containing dicts are copied; op_args is unchanged.
+  """
+  message = dict(op_args[item_name])
+  for key in op_args[item_name]:
     if cls.ShouldScrubColumn(key):
       _ScrubItem(message, key)
+  return dict(op_args, **{item_name: message})
 
 
 def _ScrubPostComment(op_args):
   """Scrub the comment message from the logs."""
-  _ScrubForClass(Comment, op_args['comment'])
+  return _ScrubForClass(Comment, op_args, 'comment')
 
 
 def _ScrubRegisterUser(op_args):
-  _ScrubForClass(Identity, op_args['ident_dict'])
+  return _ScrubForClass(Identity, op_args, 'ident_dict')
 
 
 def _ScrubShareNew(op_args):
   """Scrub the viewpoint title from the logs."""
-  _ScrubForClass(Viewpoint, op_args['viewpoint'])
+  return _ScrubForClass(Viewpoint, op_args, 'viewpoint')
 
 
 def _ScrubUpdateDevice(op_args):
   """Scrub the device name from the logs."""
-  _ScrubForClass(Device, op_args['device_dict'])
+  return _ScrubForClass(Device, op_args, 'device_dict')
 
 
 def _ScrubUpdateUser(op_args):
   """Scrub the pwd_hash and salt from the logs."""
-  _ScrubForClass(User, op_args['user_dict'])
+  return _ScrubForClass(User, op_args, 'user_dict')
 
 
 def _ScrubUpdateViewpoint(op_args):
   """Scrub the viewpoint title from the logs."""
-  _ScrubForClass(Viewpoint, op_args['vp_dict'])
+  return _ScrubForClass(Viewpoint, op_args, 'vp_dict')
+
+
+_PRIVATE_VIEWPOINT_KEY = 'vp:private'
+"""Resource key for the user's own private viewpoint, which is not named by operation args."""
+
+
+def _EpisodeKeys(ep_dicts):
+  """Returns resource keys for the episodes that are read or written by an operation."""
+  keys = []
+  for ep_dict in ep_dicts:
+    for name in ('episode_id', 'existing_episode_id', 'new_episode_id'):
+      if name in ep_dict:
+        keys.append('ep:%s' % ep_dict[name])
+  return keys
+
+
+def _ViewpointKeys(*viewpoint_ids):
+  return ['vp:%s' % viewpoint_id for viewpoint_id in viewpoint_ids]
+
+
+# Resources touched by operations that can be run concurrently with other operations for the same
+# user (see OpMapEntry.resources). Viewpoint keys cover the viewpoint locks the operation acquires.
+# Episode keys order an operation that creates an episode before later operations that read it.
+# SavePhotos and UpdateEpisode lock viewpoints that can only be found by querying the source
+# episodes, RemoveFollowers and RemoveViewpoint can revoke access needed by later operations, and
+# Unshare touches arbitrary viewpoints, so those operations (along with those not listed here)
+# always run on their own.
+def _AddFollowersResources(op_args):
+  return _ViewpointKeys(op_args['viewpoint_id'])
+
+
+def _HideOrRemovePhotosResources(op_args):
+  return [_PRIVATE_VIEWPOINT_KEY] + _EpisodeKeys(op_args['episodes'])
+
+
+def _PostCommentResources(op_args):
+  return _ViewpointKeys(op_args['comment']['viewpoint_id'])
+
+
+def _ShareExistingResources(op_args):
+  return _ViewpointKeys(op_args['viewpoint_id']) + _EpisodeKeys(op_args['episodes'])
+
+
+def _ShareNewResources(op_args):
+  return _ViewpointKeys(op_args['viewpoint']['viewpoint_id']) + _EpisodeKeys(op_args['episodes'])
+
+
+def _UpdateFollowerResources(op_args):
+  return _ViewpointKeys(op_args['follower']['viewpoint_id'])
+
+
+def _UpdateViewpointResources(op_args):
+  return _ViewpointKeys(op_args['viewpoint']['viewpoint_id'])
+
+
+def _UploadEpisodeResources(op_args):
+  return [_PRIVATE_VIEWPOINT_KEY] + _EpisodeKeys([op_args['episode']])
 
 
 DB_OPERATION_MAP = _CreateDbOperationMap([
-  OpMapEntry(AddFollowersOperation.Execute),
+  OpMapEntry(AddFollowersOperation.Execute, resources=_AddFollowersResources),
   OpMapEntry(BuildArchiveOperation.Execute),
   OpMapEntry(CreateProspectiveOperation.Execute),
   OpMapEntry(Device.UpdateOperation, scrubber=_ScrubUpdateDevice),
   OpMapEntry(FetchContactsOperation.Execute),
   OpMapEntry(Friend.UpdateOperation),
-  OpMapEntry(HidePhotosOperation.Execute),
-  OpMapEntry(Identity.UnlinkIdentityOperation),
-  OpMapEntry(LinkIdentityOperation.Execute),
-  OpMapEntry(MergeAccountsOperation.Execute),
+  OpMapEntry(HidePhotosOperation.Execute, resources=_HideOrRemovePhotosResources),
+  OpMapEntry(Identity.UnlinkIdentityOperation, changed_users=lambda op_args: [op_args['user_id']]),
+  OpMapEntry(LinkIdentityOperation.Execute, changed_users=lambda op_args: [op_args['target_user_id']]),
+  OpMapEntry(MergeAccountsOperation.Execute,
+             changed_users=lambda op_args: [op_args['target_user_id'], op_args['source_user_id']]),
   OpMapEntry(Photo.UpdateOperation),
-  OpMapEntry(PostCommentOperation.Execute, scrubber=_ScrubPostComment),
-  OpMapEntry(RegisterUserOperation.Execute, scrubber=_ScrubRegisterUser),
+  OpMapEntry(PostCommentOperation.Execute, scrubber=_ScrubPostComment, resources=_PostCommentResources),
+  OpMapEntry(RegisterUserOperation.Execute, scrubber=_ScrubRegisterUser,
+             changed_users=lambda op_args: [op_args['user_dict']['user_id']]),
   OpMapEntry(RemoveContactsOperation.Execute),
   OpMapEntry(RemoveFollowersOperation.Execute),
-  OpMapEntry(RemovePhotosOperation.Execute),
+  OpMapEntry(RemovePhotosOperation.Execute, resources=_HideOrRemovePhotosResources),
   OpMapEntry(RemoveViewpointOperation.Execute),
   OpMapEntry(SavePhotosOperation.Execute),
-  OpMapEntry(ShareExistingOperation.Execute),
-  OpMapEntry(ShareNewOperation.Execute),
+  OpMapEntry(ShareExistingOperation.Execute, resources=_ShareExistingResources),
+  OpMapEntry(ShareNewOperation.Execute, resources=_ShareNewResources),
   OpMapEntry(Subscription.RecordITunesTransactionOperation),
   OpMapEntry(UnshareOperation.Execute),
   OpMapEntry(UpdateEpisodeOperation.Execute),
-  OpMapEntry(UpdateFollowerOperation.Execute),
-  OpMapEntry(UpdateViewpointOperation.Execute),
+  OpMapEntry(UpdateFollowerOperation.Execute, resources=_UpdateFollowerResources),
+  OpMapEntry(UpdateViewpointOperation.Execute, resources=_UpdateViewpointResources),
   OpMapEntry(UploadContactsOperation.Execute),
-  OpMapEntry(UploadEpisodeOperation.Execute),
-  OpMapEntry(User.UpdateOperation, scrubber=_ScrubUpdateUser),
-  OpMapEntry(User.TerminateAccountOperation),
+  OpMapEntry(UploadEpisodeOperation.Execute, resources=_UploadEpisodeResources),
+  OpMapEntry(User.UpdateOperation, scrubber=_ScrubUpdateUser,
+             changed_users=lambda op_args: [op_args['user_dict']['user_id']]),
+  OpMapEntry(User.TerminateAccountOperation, changed_users=lambda op_args: [op_args['user_id']]),
   OpMapEntry(UserPhoto.UpdateOperation),
   OpMapEntry(Viewpoint.UpdateOperation, scrubber=_ScrubUpdateViewpoint),
   ])
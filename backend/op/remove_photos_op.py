@@ -18,6 +18,7 @@ from viewfinder.backend.db.db_client import DBKey
 from viewfinder.backend.db.operation import Operation
 from viewfinder.backend.db.post import Post
 from viewfinder.backend.db.user import User
+from viewfinder.backend.db.user_photo import UserPhoto
 from viewfinder.backend.db.viewpoint import Viewpoint
 from viewfinder.backend.op.notification_manager import NotificationManager
 from viewfinder.backend.op.viewfinder_op import ViewfinderOperation
@@ -96,12 +97,15 @@ class RemovePhotosOperation(ViewfinderOperation):
   def _Update(self):
     """Updates the database:
        1. Add the REMOVED label to the post.
+       2. Invalidates the user's cached fingerprint index.
     """
     for episode, posts in self._ep_posts_list:
       for post in posts:
         post.labels.add(Post.REMOVED)
         yield gen.Task(post.Update, self._client)
 
+    UserPhoto.InvalidateCachedFingerprintIndex(self._user.user_id)
+
   @gen.coroutine
   def _Account(self):
     """Makes accounting changes:
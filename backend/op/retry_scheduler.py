@@ -0,0 +1,148 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Schedules retries of user operations at known deadlines.
+
+A user's operations can stall in two ways that the UserOpManager knows about ahead of time:
+
+  - An operation fails repeatedly and is put into quarantine. Its "backoff" attribute holds the
+    earliest time at which it should be retried.
+  - Another server holds the user's operation lock. If that server fails, it stops renewing the
+    lock, which is abandoned no more than Lock.ABANDONMENT_SECS later. This server can then take
+    it over.
+
+Rather than waiting for the OpManager's periodic table scans to find these operations, the
+UserOpManager registers each deadline with the RetryScheduler, which keeps them in a priority
+queue and arms a single IOLoop timeout for the earliest one. When a deadline passes, the
+scheduler invokes its callback with the user id and operation id, and the OpManager executes
+the user's operations. Each (user id, operation id) pair is scheduled at most once, at its
+earliest deadline.
+
+Deadlines are held in memory, so they are lost if the server fails. The OpManager's table scans
+remain as a safety net for that case, and for operations that failed on other servers.
+
+  RetryScheduler: priority queue of operation retry deadlines.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import heapq
+import logging
+import time
+
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+from viewfinder.backend.base import counters, util
+
+_retries_scheduled = counters.define_rate('viewfinder.operation.retries_scheduled_per_min',
+                                          'Operation retries scheduled at a known deadline per minute.', 60)
+_retries_fired = counters.define_rate('viewfinder.operation.retries_fired_per_min',
+                                      'Scheduled operation retries executed per minute.', 60)
+_retry_latency = counters.define_average('viewfinder.operation.avg_retry_latency',
+                                         'Average delay in seconds between a retry deadline and its execution.')
+_retries_pending = counters.define_total('viewfinder.operation.retries_pending',
+                                         'Number of users with a scheduled operation retry.')
+
+
+class RetryScheduler(object):
+  """Invokes "callback(user_id, operation_id)" once the deadline registered with "Schedule"
+  has passed. At most "max_retries" retries can be scheduled at once; deadlines beyond that are
+  dropped and left to the table scans.
+  """
+  _MAX_RETRIES = 100000
+
+  def __init__(self, callback, max_retries=_MAX_RETRIES):
+    self._callback = callback
+    self._max_retries = max_retries
+    self._heap = []
+    # Maps (user_id, operation_id) => earliest deadline scheduled for that retry. Heap entries
+    # that do not match this map have been superseded or cancelled, and are skipped.
+    self._deadlines = {}
+    self._timeout = None
+    self._timeout_deadline = None
+
+  def __len__(self):
+    return len(self._deadlines)
+
+  def Schedule(self, user_id, operation_id, deadline):
+    """Schedules the operations of "user_id" to be executed at "deadline", starting with
+    "operation_id" (which may be None). If the same retry is already scheduled at an earlier
+    deadline, this call has no effect.
+    """
+    key = (user_id, operation_id)
+    existing = self._deadlines.get(key)
+    if existing is not None and existing <= deadline:
+      return
+
+    if existing is None:
+      if len(self._deadlines) >= self._max_retries:
+        logging.warning('too many scheduled retries; leaving retry of user %d to the table scan' % user_id)
+        return
+      _retries_pending.increment()
+
+    _retries_scheduled.increment()
+    self._deadlines[key] = deadline
+    heapq.heappush(self._heap, (deadline, user_id, operation_id))
+    self._Arm()
+
+  def Cancel(self, user_id, operation_id):
+    """Removes the retry of "operation_id" for "user_id", if it is scheduled."""
+    if self._deadlines.pop((user_id, operation_id), None) is not None:
+      _retries_pending.decrement()
+
+  def Stop(self):
+    """Removes all scheduled deadlines."""
+    if self._timeout is not None:
+      IOLoop.current().remove_timeout(self._timeout)
+      self._timeout = None
+      self._timeout_deadline = None
+    _retries_pending.decrement(len(self._deadlines))
+    self._deadlines.clear()
+    self._heap = []
+
+  def _Arm(self):
+    """Ensures that the IOLoop timeout is set for the earliest live deadline."""
+    self._Prune()
+    if not self._heap:
+      return
+
+    deadline = self._heap[0][0]
+    if self._timeout is not None:
+      if self._timeout_deadline <= deadline:
+        return
+      IOLoop.current().remove_timeout(self._timeout)
+
+    # The timer belongs to the scheduler rather than to whichever caller happened to arm it.
+    with stack_context.NullContext():
+      self._timeout = IOLoop.current().add_timeout(deadline, self._OnTimeout)
+    self._timeout_deadline = deadline
+
+  def _Prune(self):
+    """Pops superseded entries from the top of the heap."""
+    while self._heap:
+      deadline, user_id, operation_id = self._heap[0]
+      if self._deadlines.get((user_id, operation_id)) == deadline:
+        break
+      heapq.heappop(self._heap)
+
+  def _OnTimeout(self):
+    self._timeout = None
+    self._timeout_deadline = None
+
+    now = time.time()
+    due = []
+    while True:
+      self._Prune()
+      if not self._heap or self._heap[0][0] > now:
+        break
+      deadline, user_id, operation_id = heapq.heappop(self._heap)
+      del self._deadlines[(user_id, operation_id)]
+      due.append((deadline, user_id, operation_id))
+
+    _retries_pending.decrement(len(due))
+    for deadline, user_id, operation_id in due:
+      _retries_fired.increment()
+      _retry_latency.add(now - deadline)
+      with util.ExceptionBarrier(util.LogExceptionCallback):
+        self._callback(user_id, operation_id)
+
+    self._Arm()
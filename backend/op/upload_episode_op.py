@@ -11,7 +11,7 @@ __authors__ = ['andy@emailscrubbed.com (Andy Kimball)']
 import json
 import logging
 
-from tornado import gen
+from tornado import gen, options
 from viewfinder.backend.base import util
 from viewfinder.backend.base.exceptions import InvalidRequestError, PermissionError
 from viewfinder.backend.db.accounting import AccountingAccumulator
@@ -27,6 +27,10 @@ from viewfinder.backend.db.user_photo import UserPhoto
 from viewfinder.backend.db.viewpoint import Viewpoint
 from viewfinder.backend.op.notification_manager import NotificationManager
 from viewfinder.backend.op.viewfinder_op import ViewfinderOperation
+from viewfinder.backend.services.geocoder import Geocoder
+
+options.define('detect_duplicate_uploads', default=False,
+               help='log uploaded photos whose asset fingerprints match photos the user already has')
 
 
 class UploadEpisodeOperation(ViewfinderOperation):
@@ -113,6 +117,9 @@ class UploadEpisodeOperation(ViewfinderOperation):
         elif photo.episode_id != self._episode_id:
           raise InvalidRequestError('Cannot upload photo "%s" into multiple episodes.' % ph_dict['photo_id'])
 
+      if options.options.detect_duplicate_uploads:
+        yield self._DetectDuplicates()
+
       # Determine whether episode location/placemark needs to be set.
       self._set_location = self._episode is None or self._episode.location is None
       self._set_placemark = self._episode is None or self._episode.placemark is None
@@ -131,6 +138,37 @@ class UploadEpisodeOperation(ViewfinderOperation):
       self._set_location = self._op.checkpoint['location']
       self._set_placemark = self._op.checkpoint['placemark']
 
+  @gen.coroutine
+  def _DetectDuplicates(self):
+    """Logs new photos whose asset fingerprints duplicate (or nearly duplicate) photos that the
+    user has already uploaded.
+    """
+    new_ph_dicts = [ph_dict for ph_dict in self._ph_dicts
+                    if ph_dict['photo_id'] in self._new_ids and ph_dict.get('asset_keys')]
+    if not new_ph_dicts:
+      return
+
+    index = yield UserPhoto.GetFingerprintIndex(self._client, self._user.user_id)
+    for ph_dict in new_ph_dicts:
+      matches = [(photo_id, distance)
+                 for photo_id, distance in UserPhoto.FindDuplicates(index, ph_dict['asset_keys'])
+                 if photo_id != ph_dict['photo_id']]
+      if matches:
+        logging.info('photo "%s" uploaded by user %d duplicates existing photos: %r' %
+                     (ph_dict['photo_id'], self._user.user_id, matches))
+
+  def _ReverseGeocodePhotos(self, geocoder):
+    """Sets the placemark of each new photo that has a location but no placemark to that of the
+    nearest place known to the geocoder. The same placemarks are chosen if the operation is
+    retried.
+    """
+    for ph_dict in self._ph_dicts:
+      if ph_dict['photo_id'] in self._new_ids and 'location' in ph_dict and 'placemark' not in ph_dict:
+        location = ph_dict['location']
+        placemark = geocoder.ReverseGeocode(location['latitude'], location['longitude'])
+        if placemark is not None:
+          ph_dict['placemark'] = placemark
+
   @gen.coroutine
   def _Update(self):
     """Updates the database:
@@ -139,6 +177,10 @@ class UploadEpisodeOperation(ViewfinderOperation):
        3. Creates photos that did not previously exist.
        4. Updates photo MD5 values if they were given in a re-upload.
     """
+    geocoder = Geocoder.Instance()
+    if geocoder is not None:
+      self._ReverseGeocodePhotos(geocoder)
+
     # Set episode location/placemark.
     if self._set_location or self._set_placemark:
       for ph_dict in self._ph_dicts:
@@ -24,6 +24,15 @@ operation lock when it's released. Server B would have incremented this value wh
 failed to acquire the lock. This tells server A it needs to re-query the Operations table for
 any additional operations that have been added for user #1. This process may repeat many times
 for a busy user.
+
+By default, operations are executed strictly one at a time, in order. If --max_parallel_user_ops
+is greater than one, the UserOpManager instead queries the user's pending operations once, and
+starts each operation as soon as no earlier pending or running operation shares a resource with
+it (see OpMapEntry.resources), up to the given number of concurrent operations. Operations on the
+same viewpoint are therefore still run in order, and operations that do not declare their
+resources run on their own. Each concurrent operation is executed within its own OpContext and
+with its own OpMgrDBClient. The operation lock's "resource_data" attribute is kept set to the
+earliest running operation, which is where a server that takes over an abandoned lock starts.
 """
 
 __authors__ = ['spencer@emailscrubbed.com (Spencer Kimball)',
@@ -31,22 +40,24 @@ __authors__ = ['spencer@emailscrubbed.com (Spencer Kimball)',
 
 import json
 import logging
-import pprint
+import random
 import sys
 import time
 import traceback
 
 from collections import defaultdict
-from copy import deepcopy
 from functools import partial
-from tornado import gen, stack_context
+from tornado import gen, options, stack_context
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 from viewfinder.backend.base import counters, message, util
 from viewfinder.backend.base.exceptions import FailpointError, InvalidRequestError, LimitExceededError, PermissionError
 from viewfinder.backend.base.exceptions import CannotWaitError, NotFoundError, LockFailedError, StopOperationError
-from viewfinder.backend.db.lock import Lock
+from viewfinder.backend.db.followed import Followed
+from viewfinder.backend.db.lock import Lock, LockManager
 from viewfinder.backend.db.lock_resource_type import LockResourceType
 from viewfinder.backend.db.operation import Operation
+from viewfinder.backend.op.op_manager import OpManager
 from viewfinder.backend.op.op_mgr_db_client import OpMgrDBClient
 from viewfinder.backend.op.op_context import OpContext
 
@@ -58,6 +69,23 @@ _avg_op_time = counters.define_average('viewfinder.operation.avg_op_time', 'Aver
 _ops_per_min = counters.define_rate('viewfinder.operation.ops_per_min', 'Operations attempted per minute.', 60)
 _retries_per_min = counters.define_rate('viewfinder.operation.retries_per_min', 'Operation retries attempted per minute.', 60)
 _aborts_per_min = counters.define_rate('viewfinder.operation.aborts_per_min', 'Operations aborted per minute.', 60)
+_avg_parallel_ops = counters.define_average('viewfinder.operation.avg_parallel_ops',
+                                            'Average number of operations running for a user as another starts.')
+_lock_failures_per_min = counters.define_rate('viewfinder.operation.lock_failures_per_min',
+                                              'Failures to acquire a user\'s operation lock per minute.', 60)
+_requeries_per_min = counters.define_rate('viewfinder.operation.requeries_per_min',
+                                          'Requeries of the Operation table because other servers tried to '
+                                          'acquire the operation lock, per minute.', 60)
+_conflict_waits_per_min = counters.define_rate('viewfinder.operation.conflict_waits_per_min',
+                                               'Operations held back by an earlier conflicting operation.', 60)
+
+options.define('max_parallel_user_ops', default=1,
+               help='maximum number of non-conflicting operations executed concurrently for a single user')
+options.define('op_log_max_args_bytes', default=1024,
+               help='operations whose JSON args are no larger than this have their full (scrubbed) args logged; '
+                    'larger operations log only a summary of their args')
+options.define('op_log_args_sample_rate', default=0.0,
+               help='fraction of large operations whose full (scrubbed) args are logged anyway')
 
 # Tuple of exceptions for which we will abort an operation (not retry).
 # Any exception base class included here qualifies all of its subclasses.
@@ -73,6 +101,31 @@ _SMALLER_RETRY_EXCEPTIONS = (
   LockFailedError,
   )
 
+def _FormatOpEvent(event, op, **fields):
+  """Formats an op event log message as the event name followed by a compact JSON record with
+  the op's user, device, id and method, plus "fields". logs_util.ParseOpEvent parses these
+  messages.
+  """
+  record = {'user': op.user_id, 'device': op.device_id, 'op': op.operation_id, 'method': op.method}
+  record.update(fields)
+  return '%s: %s' % (event, json.dumps(record, separators=(',', ':'), default=repr))
+
+
+def _SummarizeArgs(args):
+  """Returns a summary of the op args dict that is cheap to build and to log: scalars are kept,
+  short strings are kept, and lists, dicts, and long strings are replaced by their size.
+  """
+  summary = {}
+  for key, value in args.iteritems():
+    if value is None or isinstance(value, (bool, int, long, float)):
+      summary[key] = value
+    elif isinstance(value, basestring) and len(value) <= 64:
+      summary[key] = value
+    else:
+      summary[key] = '<%s:%d>' % (type(value).__name__, len(value) if hasattr(value, '__len__') else 0)
+  return summary
+
+
 class UserOpManager(object):
   """Create an instance of the UserOpManager to execute operations for a particular user.
   Operations can be scheduled for execution using the "Execute" method, which will try to
@@ -86,21 +139,33 @@ class UserOpManager(object):
   _SMALL_INITIAL_BACKOFF_SECS = 2.0  # this value is increased exponentially
   _MAX_BACKOFF_STEPS = 10  # this implies a maximum backoff of ~34 minutes and 2.3 hr for small and normal backoffs.
 
+  # Outcomes of a single execution of an operation, as returned by _ExecuteOp.
+  _OP_FINISHED = 'finished'  # the op completed, was aborted, or was put into quarantine
+  _OP_RETRY = 'retry'  # the op failed, and will be retried before any conflicting op is run
+  _OP_STOPPED = 'stopped'  # the op was stopped in order to run a nested op
+
+  _QUERY_LIMIT = 50  # number of ops queried at a time when executing ops concurrently
+
   # Stack traces will be truncated if the operation exceeds this limit.  DynamoDB has a limit of 64KB per
   # record; we use 64 * 1000 instead of 64 * 1024 to allow for overhead and fields not explicitly measured.
   _MAX_OPERATION_SIZE = 64000
 
-  def __init__(self, client, op_map, user_id, callback):
+  def __init__(self, client, op_map, user_id, callback, retry_scheduler=None):
     """Construct a new UserOpManager in order to execute operations for the specified user.
     Each time that no more operations can be executed for the user, "callback" is invoked.
     This can happen when the operation lock cannot be acquired or when all operations have
-    been executed, blocked, or quarantined.
+    been executed, blocked, or quarantined. If "retry_scheduler" is given, quarantined
+    operations and locks held by other servers are registered with it, so that they are
+    retried once their backoff ends or the lock can be taken over.
     """
     # Wrap the DBClient so that we can detect db modifications during the
     #   operation and validate that aborts are happening without db modification.
+    self._db_client = client
     self._client = OpMgrDBClient(client)
     self._op_map = op_map
+    self._max_parallel = options.options.max_parallel_user_ops
     self._user_id = user_id
+    self._retry_scheduler = retry_scheduler
     self._sync_cb_map = defaultdict(list)
     self._callback = stack_context.wrap(callback)
     self._is_executing = False
@@ -183,6 +248,14 @@ class UserOpManager(object):
     self._lock, status = results.args
 
     if status == Lock.FAILED_TO_ACQUIRE_LOCK:
+      _lock_failures_per_min.increment()
+
+      # If the server that holds the lock fails, it stops renewing the lock, which can then be
+      # taken over no later than ABANDONMENT_SECS from now. The OpManager only retries then if
+      # the holder has in fact stopped renewing the lock.
+      if self._retry_scheduler is not None:
+        self._retry_scheduler.Schedule(self._user_id, operation_id, time.time() + Lock.ABANDONMENT_SECS)
+
       # Another server has the lock, so can't wait synchronously for the operations to complete.
       # TODO(Andy): We could poll the operations table if we want to support this.
       for operation_id in self._sync_cb_map.keys():
@@ -206,40 +279,10 @@ class UserOpManager(object):
                             consistent_read=True)
         next_ops = [op]
 
-      last_op_id = None
-      while True:
-        if next_ops is None:
-          # Get 10 ops at a time, looking for one that is not in quarantine.
-          # Use consistent reads, in order to avoid reading already deleted operations. We've
-          # seen cases where an op runs, then deletes itself, but then an inconsistent read
-          # gets an old version that hasn't yet been deleted and re-runs it.
-          next_ops = yield gen.Task(Operation.RangeQuery,
-                                    self._client,
-                                    self._user_id,
-                                    range_desc=None,
-                                    limit=10,
-                                    col_names=None,
-                                    excl_start_key=last_op_id,
-                                    consistent_read=True)
-          if len(next_ops) == 0:
-            # No more operations to process.
-            break
-
-        for op in next_ops:
-          # Run the op if it is not in quarantine or if it's no longer in backoff.
-          if not op.quarantine or not op.IsBackedOff():
-            yield self._ExecuteOp(op)
-
-            # Look for next op to run; always run earliest op possible.
-            last_op_id = None
-            break
-          else:
-            # Skip quarantined operation.
-            logging.info('queried quarantined operation "%s", user %d backed off for %.2fs; skipping...' %
-                         (op.operation_id, op.user_id, op.backoff - time.time()))
-            last_op_id = op.operation_id
-
-        next_ops = None
+      if self._max_parallel > 1:
+        yield self._ExecuteParallel(next_ops)
+      else:
+        yield self._ExecuteSerial(next_ops)
     finally:
       # Release the operation lock.
       yield gen.Task(self._lock.Release, self._client)
@@ -247,18 +290,258 @@ class UserOpManager(object):
       if self._lock.acquire_failures is not None:
         # Another caller tried to acquire the lock, so there may be more operations available.
         logging.info('other servers tried to acquire lock "%s"; there may be more operations pending' % self._lock)
+        _requeries_per_min.increment()
         self._requery = True
 
   @gen.coroutine
-  def _ExecuteOp(self, op):
+  def _ExecuteSerial(self, next_ops):
+    """Executes operations one at a time, starting with "next_ops" if it is not None. After each
+    operation, re-queries the Operation table in order to always run the earliest operation.
+    """
+    last_op_id = None
+    while True:
+      if next_ops is None:
+        # Get 10 ops at a time, looking for one that is not in quarantine.
+        # Use consistent reads, in order to avoid reading already deleted operations. We've
+        # seen cases where an op runs, then deletes itself, but then an inconsistent read
+        # gets an old version that hasn't yet been deleted and re-runs it.
+        next_ops = yield gen.Task(Operation.RangeQuery,
+                                  self._client,
+                                  self._user_id,
+                                  range_desc=None,
+                                  limit=10,
+                                  col_names=None,
+                                  excl_start_key=last_op_id,
+                                  consistent_read=True)
+        if len(next_ops) == 0:
+          # No more operations to process.
+          break
+
+      for op in next_ops:
+        # Run the op if it is not in quarantine or if it's no longer in backoff.
+        if not op.quarantine or not op.IsBackedOff():
+          yield self._ExecuteOp(op)
+
+          # Look for next op to run; always run earliest op possible.
+          last_op_id = None
+          break
+        else:
+          # Skip quarantined operation.
+          logging.info('queried quarantined operation "%s", user %d backed off for %.2fs; skipping...' %
+                       (op.operation_id, op.user_id, op.backoff - time.time()))
+          last_op_id = op.operation_id
+
+      next_ops = None
+
+  @gen.coroutine
+  def _ExecuteParallel(self, first_ops):
+    """Executes operations concurrently, as long as they do not conflict with one another (see
+    the header). If "first_ops" is not None, those operations are run to completion before any
+    other is started. The pending operations are queried once up-front, and then again only if
+    an operation is stopped in order to run a nested operation.
+    """
+    if first_ops is not None:
+      for op in first_ops:
+        if op is not None:
+          yield self._ExecuteOp(op)
+
+    # Maps operation id => resource keys for each running operation (None if the operation must
+    # run on its own).
+    self._running = {}
+    self._finished = []
+    self._finished_future = None
+    try:
+      pending = yield self._QueryPendingOps()
+      requery = False
+      while True:
+        if requery and not self._running:
+          # The nested op (which sorts before its parent) has been created, so query again.
+          pending = yield self._QueryPendingOps()
+          requery = False
+
+        backoff = None
+        if not requery:
+          pending, backoff = yield self._StartRunnableOps(pending)
+
+        if not self._running and backoff is None:
+          break
+
+        # Wait for at least one running operation to finish, or for the earliest backed-off
+        # operation to become runnable.
+        if not self._finished:
+          self._finished_future = Future()
+          timeout = IOLoop.current().add_timeout(backoff, self._WakeUp) if backoff is not None else None
+          yield self._finished_future
+          if timeout is not None:
+            IOLoop.current().remove_timeout(timeout)
+
+        # Remove the whole batch from the running set before looking at any outcome, so that if
+        # an op failed, the finally clause below does not wait for ops that are already done.
+        finished, self._finished = self._finished, []
+        for op, _ in finished:
+          del self._running[op.operation_id]
+
+        for op, future in finished:
+          outcome = future.result()
+          if outcome == UserOpManager._OP_RETRY:
+            # Put the op back in order, so that later conflicting ops keep waiting for it.
+            pending = sorted(pending + [op], key=lambda op: op.operation_id)
+          elif outcome == UserOpManager._OP_STOPPED:
+            requery = True
+    finally:
+      # Do not release the operation lock while any operation is still running.
+      while True:
+        for op, future in self._finished:
+          del self._running[op.operation_id]
+          if future.exception() is not None:
+            logging.error('operation %s failed' % op.operation_id, exc_info=future.exc_info())
+        self._finished = []
+        if not self._running:
+          break
+        self._finished_future = Future()
+        yield self._finished_future
+
+  @gen.coroutine
+  def _QueryPendingOps(self):
+    """Returns all of the user's operations that are not already running, in order. Uses
+    consistent reads for the same reason as _ExecuteSerial.
+    """
+    ops = []
+    last_op_id = None
+    while True:
+      next_ops = yield gen.Task(Operation.RangeQuery,
+                                self._client,
+                                self._user_id,
+                                range_desc=None,
+                                limit=UserOpManager._QUERY_LIMIT,
+                                col_names=None,
+                                excl_start_key=last_op_id,
+                                consistent_read=True)
+      ops.extend(op for op in next_ops if op.operation_id not in self._running)
+      if len(next_ops) < UserOpManager._QUERY_LIMIT:
+        raise gen.Return(ops)
+      last_op_id = next_ops[-1].operation_id
+
+  @gen.coroutine
+  def _StartRunnableOps(self, pending):
+    """Starts each operation in "pending", in order, that does not conflict with any running
+    operation or with any earlier pending operation, as long as fewer than
+    --max_parallel_user_ops operations are running. Quarantined operations that are still backed
+    off are dropped. Other backed-off operations (those being retried) are not started until
+    their back-off expires, so that they do not hold a slot while waiting, but later conflicting
+    operations still wait for them. Returns a tuple of the operations that were not started, and
+    the time at which the earliest backed-off operation can be started (or None).
+    """
+    blocked = set()
+    exclusive = False
+    for resources in self._running.itervalues():
+      if resources is None:
+        exclusive = True
+      else:
+        blocked.update(resources)
+
+    now = time.time()
+    backoff = None
+    to_start = []
+    remaining = []
+    for op in pending:
+      if op.quarantine and op.IsBackedOff():
+        logging.info('queried quarantined operation "%s", user %d backed off for %.2fs; skipping...' %
+                     (op.operation_id, op.user_id, op.backoff - time.time()))
+        continue
+
+      if exclusive or len(self._running) + len(to_start) >= self._max_parallel:
+        remaining.append(op)
+        continue
+
+      resources = self._GetResources(op)
+      if op.backoff is not None and op.backoff > now:
+        remaining.append(op)
+        backoff = op.backoff if backoff is None else min(backoff, op.backoff)
+        if resources is None:
+          exclusive = True
+        else:
+          blocked.update(resources)
+      elif resources is None:
+        # The op must run on its own, and no later op may start before it.
+        if not self._running and not to_start:
+          to_start.append((op, None))
+        else:
+          remaining.append(op)
+          _conflict_waits_per_min.increment()
+        exclusive = True
+      elif resources & blocked:
+        remaining.append(op)
+        _conflict_waits_per_min.increment()
+        blocked.update(resources)
+      else:
+        to_start.append((op, resources))
+        blocked.update(resources)
+
+    if to_start:
+      # Remember the earliest running op, which is where a server that takes over an abandoned
+      # lock will start. Earlier ops are all finished, and later running ops do not conflict.
+      earliest_op_id = min([op_id for op_id in self._running] + [op.operation_id for op, _ in to_start])
+      if self._lock.resource_data != earliest_op_id:
+        self._lock.resource_data = earliest_op_id
+        yield gen.Task(self._lock.Update, self._client)
+
+      for op, resources in to_start:
+        _avg_parallel_ops.add(len(self._running))
+        self._running[op.operation_id] = resources
+        IOLoop.current().add_future(self._StartOp(op), partial(self._OnOpFinished, op))
+
+    raise gen.Return((remaining, backoff))
+
+  def _StartOp(self, op):
+    """Starts executing "op" within its own OpContext, and with its own OpMgrDBClient so that
+    database modifications are tracked separately for each running op. Returns a future that
+    resolves to the outcome of the execution.
+    """
+    with stack_context.StackContext(OpContext()):
+      return self._ExecuteOp(op, client=OpMgrDBClient(self._db_client), update_lock=False)
+
+  def _OnOpFinished(self, op, future):
+    """Called when an op started by _StartOp has finished executing."""
+    self._finished.append((op, future))
+    self._WakeUp()
+
+  def _WakeUp(self):
+    """Resumes _ExecuteParallel if it is waiting for an op to finish or for a back-off to expire."""
+    if self._finished_future is not None and not self._finished_future.done():
+      self._finished_future.set_result(None)
+
+  def _GetResources(self, op):
+    """Returns the set of resource keys for "op", or None if it must run on its own."""
+    if op.operation_id.startswith('+'):
+      # Nested ops always run on their own, before their parent op is resumed.
+      return None
+
+    op_entry = self._op_map.get(op.method)
+    if op_entry is None or op_entry.resources is None:
+      return None
+
+    # A hook that fails is a bug in the hook, so do not mistake it for an exclusive op.
+    return frozenset(op_entry.resources(json.loads(op.json)))
+
+  @gen.coroutine
+  def _ExecuteOp(self, op, client=None, update_lock=True):
     """Executes the operation by marshalling the JSON-encoded op data as arguments to the
     operation method. The execution of the operation is wrapped in an execution scope, which
-    will capture all logging during the execution of this operation.
+    will capture all logging during the execution of this operation. "client" defaults to the
+    UserOpManager's OpMgrDBClient. If "update_lock" is False, the caller is responsible for
+    keeping the lock's resource_data up-to-date. Returns one of the _OP_* outcomes.
     """
+    if client is None:
+      client = self._client
+
     # If necessary, wait until back-off has expired before execution begins.
     if op.backoff is not None:
       yield gen.Task(IOLoop.current().add_timeout, op.backoff)
 
+    if self._retry_scheduler is not None:
+      self._retry_scheduler.Cancel(op.user_id, op.operation_id)
+
     # Enter execution scope for this operation, so that it can be accessed in OpContext, and so that op-specific
     # logging will be started.
     with OpContext.current().Enter(op):
@@ -267,7 +550,7 @@ class UserOpManager(object):
 
       # If not already done, update the lock to remember the id of the op that is being run. In
       # case of server failure, the server that takes over this lock will know where to start.
-      if self._lock.resource_data != op.operation_id:
+      if update_lock and self._lock.resource_data != op.operation_id:
         self._lock.resource_data = op.operation_id
         yield gen.Task(self._lock.Update, self._client)
 
@@ -276,7 +559,7 @@ class UserOpManager(object):
       # expected argument to the method.
       op_message = message.Message(op_args)
       yield gen.Task(op_message.Migrate,
-                     self._client,
+                     client,
                      migrate_version=message.MAX_MESSAGE_VERSION,
                      migrators=op_entry.migrators)
 
@@ -286,13 +569,17 @@ class UserOpManager(object):
         # Scrub the op args for logging in order to minimize personal information in the logs.
         scrubbed_op_args = op_args
         if op_entry.scrubber is not None:
-          scrubbed_op_args = deepcopy(op_args)
-          op_entry.scrubber(scrubbed_op_args)
-        args_str = pprint.pformat(scrubbed_op_args)
-
-        logging.info('EXECUTE: user: %d, device: %d, op: %s, method: %s:%s%s' %
-                     (op.user_id, op.device_id, op.operation_id, op.method,
-                      ('\n' if args_str.find('\n') != -1 else ' '), args_str))
+          scrubbed_op_args = op_entry.scrubber(op_args)
+
+        # Log the full args only for small ops, unless debugging or sampled, since large ops such as
+        # UploadContacts can have megabytes of args.
+        if (len(op.json) <= options.options.op_log_max_args_bytes or
+            logging.getLogger().isEnabledFor(logging.DEBUG) or
+            random.random() < options.options.op_log_args_sample_rate):
+          logging.info(_FormatOpEvent('EXECUTE', op, attempts=op.attempts, args=scrubbed_op_args))
+        else:
+          logging.info(_FormatOpEvent('EXECUTE', op, attempts=op.attempts,
+                                      arg_summary=_SummarizeArgs(scrubbed_op_args)))
 
         _ops_per_min.increment()
         if op.attempts > 0:
@@ -300,60 +587,77 @@ class UserOpManager(object):
 
         # Starting operation from beginning, so reset modified db state in the
         # OpMgrDBClient wrapper so we'll know if any modifications happened before an abort.
-        self._client.ResetDBModified()
+        client.ResetDBModified()
 
         # Actually execute the operation by invoking its handler method.
-        results = yield gen.Task(op_entry.handler, self._client, **op_args)
+        start_time = time.time()
+        with Followed.CoalesceUpdates(op.operation_id):
+          results = yield gen.Task(op_entry.handler, client, **op_args)
 
         # Invokes synchronous callback if applicable.
-        elapsed_secs = time.time() - op.timestamp
-        logging.info('SUCCESS: user: %d, device: %d, op: %s, method: %s in %.3fs%s' %
-                     (op.user_id, op.device_id, op.operation_id, op.method, elapsed_secs,
-                      (': %s' % pprint.pformat(results) if results else '')))
+        now = time.time()
+        elapsed_secs = now - op.timestamp
+        fields = {'elapsed': round(elapsed_secs, 3), 'exec': round(now - start_time, 3)}
+        if results:
+          fields['results'] = _SummarizeArgs(results) if isinstance(results, dict) else str(results)
+        logging.info(_FormatOpEvent('SUCCESS', op, **fields))
         _avg_op_time.add(elapsed_secs)
 
+        # Let interested parties (e.g. the user session cache) know which users were changed.
+        if op_entry.changed_users is not None:
+          for user_id in op_entry.changed_users(op_args):
+            OpManager.NotifyUserChanged(user_id)
+
         # Notify any waiting for op to finish that it's now complete.
         self._InvokeSyncCallbacks(op.operation_id)
 
         # Delete the op, now that it's been successfully executed.
-        yield self._DeleteOp(op)
+        yield self._DeleteOp(op, client)
       except StopOperationError:
         # Stop the current operation in order to run a nested operation.
-        pass
+        raise gen.Return(UserOpManager._OP_STOPPED)
       except FailpointError:
         # Retry immediately if the operation is retried due to a failpoint.
         type, value, tb = sys.exc_info()
         logging.warning('restarting op due to failpoint: %s (%d)', value.filename, value.lineno)
+        raise gen.Return(UserOpManager._OP_RETRY)
       except Exception:
         type, value, tb = sys.exc_info()
 
+        # Operations on this server must not wait for locks that the failed op never released.
+        LockManager.Instance().ForgetHeld(op.operation_id)
+
         # Notify any waiting for op to finish that it failed (don't even wait for retries).
         self._InvokeSyncCallbacks(op.operation_id, type, value, tb)
 
         # Check for abortable exceptions, but only on 1st attempt.
         if op.attempts == 0 and issubclass(type, _ABORTABLE_EXCEPTIONS):
-          yield self._AbortOp(op, type, value, tb)
+          outcome = yield self._AbortOp(op, client, type, value, tb)
         else:
           initial_backoff = UserOpManager._INITIAL_BACKOFF_SECS
           if issubclass(type, _SMALLER_RETRY_EXCEPTIONS):
             initial_backoff = UserOpManager._SMALL_INITIAL_BACKOFF_SECS
-          yield self._FailOp(op, type, value, tb, initial_backoff_secs=initial_backoff)
+          outcome = yield self._FailOp(op, client, type, value, tb, initial_backoff_secs=initial_backoff)
+        raise gen.Return(outcome)
+
+    raise gen.Return(UserOpManager._OP_FINISHED)
 
   @gen.coroutine
-  def _AbortOp(self, op, type, value, tb):
+  def _AbortOp(self, op, client, type, value, tb):
     """The given operation has failed in such a way that we know it will never succeed so we
     will abort it.  If it modified the DB before the failure, we log an error with callstack
     of db modification and call retry logic so that it sticks around in operation table for
-    analysis.
+    analysis. Returns the outcome of the execution.
     """
     # Did we make any modifications to the db before hitting an abortable error?
-    if self._client.HasDBBeenModified():
+    if client.HasDBBeenModified():
       # If so, let's dump some information into the log about where this happened.
-      stackDumpLines = ''.join(traceback.format_list(self._client.GetModifiedDBStack()))
+      stackDumpLines = ''.join(traceback.format_list(client.GetModifiedDBStack()))
       logging.error('Database modified before abortable exception was raised: %s' % stackDumpLines)
 
       # Now, go to the failure logic.
-      yield self._FailOp(op, type, value, tb)
+      outcome = yield self._FailOp(op, client, type, value, tb)
+      raise gen.Return(outcome)
     else:
       elapsed_secs = time.time() - op.timestamp
       logging.warning('ABORT: user: %d, device: %d, op: %s, method: %s in %.3fs, %s' %
@@ -362,10 +666,11 @@ class UserOpManager(object):
       _aborts_per_min.increment()
 
       # Fully abort the op, with no possibility of retry.
-      yield self._DeleteOp(op)
+      yield self._DeleteOp(op, client)
+      raise gen.Return(UserOpManager._OP_FINISHED)
 
   @gen.coroutine
-  def _FailOp(self, op, type, value, tb, initial_backoff_secs=_INITIAL_BACKOFF_SECS):
+  def _FailOp(self, op, client, type, value, tb, initial_backoff_secs=_INITIAL_BACKOFF_SECS):
     """Writes the failure to the log and puts the operation to sleep in the database with
     a backoff. The operation will get re-run once the backoff expires. If the operation has
     failed less than 3 times, then the next operation will *not* be run until this operation
@@ -415,14 +720,19 @@ class UserOpManager(object):
       self._last_op_id = op.operation_id
       op.quarantine = 1
 
-    yield gen.Task(op.Update, self._client)
+    yield gen.Task(op.Update, client)
+
+    if op.quarantine and self._retry_scheduler is not None:
+      self._retry_scheduler.Schedule(op.user_id, op.operation_id, op.backoff)
+
+    raise gen.Return(UserOpManager._OP_FINISHED if op.quarantine else UserOpManager._OP_RETRY)
 
   @gen.coroutine
-  def _DeleteOp(self, op):
+  def _DeleteOp(self, op, client):
     """Deletes the given operation and invokes the callback when that is complete."""
     self._last_op_id = op.operation_id
     try:
-      yield gen.Task(op.Delete, self._client)
+      yield gen.Task(op.Delete, client)
     except Exception:
       logging.warning('op %s (%s) was not deleted; assuming already deleted.' %
                       (op.method, op.operation_id), exc_info=True)
@@ -9,6 +9,14 @@ The SSL handshake and connection can be tested on the command line via:
 
 % openssl s_client -connect gateway.sandbox.push.apple.com:2195 -cert ~/.ssh/apns_sandbox_cert.pem -debug
 
+Notifications are not written to APNs as soon as they are pushed. A burst of activity (e.g. a
+flurry of comments on a viewpoint) produces one push per activity to each follower's devices,
+most of which only update the badge. Pushes to the same device token are therefore held for
+--apns_coalesce_secs and collapsed into a single notification: the latest badge wins, and alert
+text is merged. Once the window closes, all pending notifications are written to the stream in
+large batched writes, and are tracked by identifier until they can no longer be rejected, so
+that the notifications following one that APNs rejects can be re-sent.
+
   TestService: mock version of APNs cloud service for testing
   APNS: APNs client
 """
@@ -16,16 +24,29 @@ The SSL handshake and connection can be tested on the command line via:
 __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
 import ctypes
+import itertools
 import logging
 import socket
 import struct
 import time
 
-from collections import deque
+from collections import deque, OrderedDict
+from tornado import escape, options, stack_context
 from tornado.ioloop import IOLoop
-from tornado.iostream import SSLIOStream
-from viewfinder.backend.base import secrets
-from viewfinder.backend.services.apns_util import TokenFromBinary, CreateMessage, ParseResponse
+from tornado.iostream import IOStream, SSLIOStream
+from viewfinder.backend.base import counters, secrets
+from viewfinder.backend.services.apns_util import TokenFromBinary, CreateMessage, ParseResponse, ValidateToken
+
+options.define('apns_coalesce_secs', default=0.05,
+               help='seconds for which notifications to an APNs device token are held so that they can be '
+                    'collapsed with later notifications to the same device')
+
+_pushes = counters.define_rate('viewfinder.apns.pushes_per_min', 'Notifications written to APNs per minute.', 60)
+_collapsed = counters.define_rate('viewfinder.apns.collapsed_per_min',
+                                  'Notifications collapsed into a pending notification to the same device per minute.',
+                                  60)
+_resends = counters.define_rate('viewfinder.apns.resends_per_min',
+                                'Notifications re-sent because APNs rejected an earlier notification per minute.', 60)
 
 
 class _BaseSSLService(object):
@@ -39,6 +60,7 @@ class _BaseSSLService(object):
     self._settings = settings
     self._host = settings[host_key]
     self._retries = 0
+    self._cert_missing = False
     self._io_loop = IOLoop.current()
     self._ResetBackoff()
     self._Connect()
@@ -51,12 +73,19 @@ class _BaseSSLService(object):
 
   def _Connect(self):
     try:
-      ssl_options = {'certfile': secrets.GetSecretFile(self._settings['certfile'])}
-      self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-      self._stream = SSLIOStream(self._sock, io_loop=self._io_loop, ssl_options=ssl_options)
+      # The 'ssl' setting is disabled only in order to test against a local fake APNs server.
+      if self._settings.get('ssl', True):
+        ssl_options = {'certfile': secrets.GetSecretFile(self._settings['certfile'])}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self._stream = SSLIOStream(self._sock, io_loop=self._io_loop, ssl_options=ssl_options)
+      else:
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self._stream = IOStream(self._sock, io_loop=self._io_loop)
       self._stream.set_close_callback(self._OnClose)
       self._stream.connect(self._host, self._OnConnect)
     except KeyError:
+      self._stream = None
+      self._cert_missing = True
       logging.warning('failed to initialize connection to APN service at %s:%d '
                       'whose certificate is missing from secrets/%s' %
                       (self._host[0], self._host[1], self._settings['certfile']))
@@ -127,10 +156,20 @@ class _APNService(_BaseSSLService):
   """
   MESSAGE_SIZE = 6
 
+  _MAX_WRITE_BYTES = 64 * 1024
+  """Maximum number of bytes of messages written to the stream at once."""
+
+  _MAX_IN_FLIGHT = 10000
+  """Maximum number of written messages that are kept in case they must be re-sent."""
+
   def __init__(self, settings, feedback_handler):
     self._feedback_handler = feedback_handler
+    # Maps token => notification parameters for notifications that have not been written yet.
+    self._pending = OrderedDict()
+    self._flush_timeout = None
     self._write_queue = deque()
-    self._recent = None
+    # Maps identifier => message for messages written on the current connection, in write order.
+    self._in_flight = OrderedDict()
     self._ready = False
     self._generation = ctypes.c_uint32(0)
     super(_APNService, self).__init__(settings, 'apns_host')
@@ -139,45 +178,110 @@ class _APNService(_BaseSSLService):
     """Best guess at whether we've dispatched all work. Due to the lack of response on successful
     requests, we can't actually be 100% sure.
     """
-    return len(self._write_queue) == 0 and (self._stream is None or not self._stream.writing())
+    return (len(self._pending) == 0 and len(self._write_queue) == 0 and
+            (self._stream is None or not self._stream.writing()))
 
   def Push(self, token, alert=None, badge=None, sound=None, expiry=None, extra=None, timestamp=None):
-    """Creates a binary message from input parameters and adds it to the
-    outgoing write queue.
+    """Adds a notification to the pending notifications. If a notification to the same token
+    is already pending, the two are collapsed into one (see _Collapse). Pending notifications
+    are written to APNs once --apns_coalesce_secs have passed.
     """
-    self._generation.value += 1
-    identifier = self._generation.value
+    ValidateToken(token)
+    if (alert is not None) and (not isinstance(alert, (basestring, dict))):
+      raise ValueError, u'Alert message must be a string or a dictionary.'
+    if self._cert_missing:
+      # No connection will ever be made, so fail now rather than holding the notification forever.
+      raise IOError('cannot push to APN service at %s:%d without a certificate' % (self._host[0], self._host[1]))
     logging.debug('pushing notification to APNs for token %s, badge %r, alert %s' %
                   (token, badge, alert))
-    msg = CreateMessage(token, alert=alert, badge=badge, sound=sound,
-                        identifier=identifier, expiry=expiry, extra=extra)
 
-    self._write_queue.append(dict(identifier=identifier, token=token, msg=msg))
-    self._io_loop.add_callback(self._PushOne)
+    pending = self._pending.get(token)
+    if pending is not None:
+      _APNService._Collapse(pending, alert=alert, badge=badge, sound=sound, expiry=expiry, extra=extra)
+      _collapsed.increment()
+      return
+
+    self._pending[token] = dict(alert=alert, badge=badge, sound=sound, expiry=expiry, extra=extra)
+    if self._flush_timeout is None:
+      # The timer belongs to the service rather than to whichever caller happened to push first.
+      with stack_context.NullContext():
+        self._flush_timeout = self._io_loop.add_timeout(time.time() + options.options.apns_coalesce_secs,
+                                                        self._Flush)
+
+  @staticmethod
+  def _Collapse(pending, alert, badge, sound, expiry, extra):
+    """Collapses a notification into the "pending" notification to the same token. The latest
+    badge, sound and expiry win. Alert text is merged, one line per alert, if both alerts have
+    the same extra data (e.g. they are about the same viewpoint); otherwise the latest alert and
+    its extra data win.
+    """
+    if badge is not None:
+      pending['badge'] = badge
+    if sound is not None:
+      pending['sound'] = sound
+    if expiry is not None:
+      pending['expiry'] = expiry
+
+    if alert is None:
+      if pending['alert'] is None and extra is not None:
+        pending['extra'] = extra
+    elif isinstance(alert, basestring) and isinstance(pending['alert'], basestring) and pending['extra'] == extra:
+      if alert != pending['alert']:
+        pending['alert'] = escape.utf8(pending['alert']) + '\n' + escape.utf8(alert)
+    else:
+      pending['alert'] = alert
+      pending['extra'] = extra
+
+  def _Flush(self):
+    """Creates messages for all pending notifications and writes them to the stream."""
+    self._flush_timeout = None
+    pending = self._pending
+    self._pending = OrderedDict()
+    for token, params in pending.iteritems():
+      self._generation.value += 1
+      identifier = self._generation.value
+      try:
+        msg = CreateMessage(token, identifier=identifier, **params)
+      except Exception:
+        logging.exception('failed to create APNs message for token %s' % token)
+        continue
+      self._write_queue.append(dict(identifier=identifier, token=token, msg=msg))
+      _pushes.increment()
+
+    self._WriteQueue()
 
-  def _PushOne(self):
+  def _WriteQueue(self):
+    """Writes as much of the write queue as possible, in writes of up to _MAX_WRITE_BYTES."""
     # IsValid means the IOStream exists; _ready means it's connected
     # and hasn't been invalidated by an error.
-    if len(self._write_queue) and self.IsValid() and self._ready:
-      msg = self._write_queue.popleft()
+    while len(self._write_queue) and self.IsValid() and self._ready:
+      batch = []
+      num_bytes = 0
+      while len(self._write_queue) and num_bytes < _APNService._MAX_WRITE_BYTES:
+        msg = self._write_queue.popleft()
+        batch.append(msg)
+        num_bytes += len(msg['msg'])
+
       try:
-        self._stream.write(msg['msg'])
+        self._stream.write(''.join(msg['msg'] for msg in batch))
       except Exception:
-        self._write_queue.appendleft(msg)
-        return False
-      self._recent.append(msg)
+        self._write_queue.extendleft(reversed(batch))
+        return
+
+      for msg in batch:
+        self._in_flight[msg['identifier']] = msg
+      while len(self._in_flight) > _APNService._MAX_IN_FLIGHT:
+        self._in_flight.popitem(last=False)
+
       # Since data was successfully written, we reset backoff.
       self._ResetBackoff()
-      return True
-    return False
 
   def _OnConnect(self):
     """On connection, immediately process all enqueued push notifications."""
     _BaseSSLService._OnConnect(self)
-    self._recent = deque(maxlen=100)
+    self._in_flight = OrderedDict()
     self._ready = True
-    while self._PushOne():
-      pass
+    self._WriteQueue()
     self._stream.read_bytes(_APNService.MESSAGE_SIZE, self._OnRead)
 
   def _OnRead(self, data):
@@ -196,20 +300,21 @@ class _APNService(_BaseSSLService):
 
       logging.warning('error pushing notification: %d %d %s' % (status, identifier, err_string))
       self._ready = False
-      found = None
-      recent = list(self._recent)  # deques don't support slicing
-      for i, msg in enumerate(recent):
-        if msg['identifier'] == identifier:
-          found = i
-          break
-      if found is not None:
-        # We got an error on one message; anything later must be re-sent.
-        for msg in recent[found + 1:]:
-          self._write_queue.appendleft(msg)
+      msg = self._in_flight.get(identifier)
+      if msg is not None:
+        # We got an error on one message; anything later must be re-sent, ahead of anything
+        # that has not been written yet.
+        later = list(itertools.dropwhile(lambda m: m['identifier'] != identifier, self._in_flight.itervalues()))[1:]
         if status == 8:  # "bad token"
-          token = msg['token']
-          if self._feedback_handler:
-            self._feedback_handler(self._FormatPushToken(token))
+          # Drop every other notification to the token, whether written, queued or still pending.
+          later = [m for m in later if m['token'] != msg['token']]
+          self._write_queue = deque(m for m in self._write_queue if m['token'] != msg['token'])
+          self._pending.pop(msg['token'], None)
+        self._write_queue.extendleft(reversed(later))
+        self._in_flight = OrderedDict()
+        _resends.increment(len(later))
+        if status == 8 and self._feedback_handler:
+          self._feedback_handler(self._FormatPushToken(msg['token']))
       # Since data was successfully read, we reset backoff.
       self._ResetBackoff()
     except:
@@ -6,6 +6,7 @@
 Original copyright for this code: https://github.com/jayridge/apnstornado
 
   TokenToBinary(): converts a hex-encoded token into a binary value
+  ValidateToken(): converts a token into a binary value, verifying its length
   CreateMessage(): formats a binary APNs message from parameters
   ParseResponse(): parses APNs binary response for status & identifier
   ErrorStatusToString(): converts error status to error message
@@ -35,11 +36,15 @@ def TokenToBinary(token):
 def TokenFromBinary(bin_token):
   return base64.b64encode(bin_token)
 
-def CreateMessage(token, alert=None, badge=None, sound=None,
-                  identifier=0, expiry=None, extra=None, allow_truncate=True):
+def ValidateToken(token):
   token = TokenToBinary(token)
   if len(token) != 32:
     raise ValueError, u'Token must be a 32-byte binary string.'
+  return token
+
+def CreateMessage(token, alert=None, badge=None, sound=None,
+                  identifier=0, expiry=None, extra=None, allow_truncate=True):
+  token = ValidateToken(token)
   if (alert is not None) and (not isinstance(alert, (basestring, dict))):
     raise ValueError, u'Alert message must be a string or a dictionary.'
   if expiry is None:
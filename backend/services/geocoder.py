@@ -0,0 +1,54 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Viewfinder reverse geocoder.
+
+Maps photo locations to placemarks using the memory-mapped geodata index
+written by resources/geodata/geoprocessor.py. The index named by --geoindex
+is mapped the first time the geocoder is used, so processes that never
+reverse geocode never touch it.
+
+Example::
+
+  geocoder = Geocoder.Instance()
+  if geocoder is not None:
+    placemark = geocoder.ReverseGeocode(37.78, -122.41)
+"""
+
+__author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
+
+from tornado import options
+from viewfinder.resources.geodata.geoindex import GeoIndex
+
+options.define('geoindex', default=None,
+               help='path of a geodata index written by resources/geodata/geoprocessor.py; if set, uploaded photos '
+               'that have a location but no placemark are given the placemark of the nearest place')
+
+
+class Geocoder(object):
+  """Reverse geocodes locations against a geodata index."""
+  _instance = None
+
+  def __init__(self, path):
+    self._path = path
+    self._index = None
+
+  def ReverseGeocode(self, latitude, longitude):
+    """Returns a dict of placemark fields for the place nearest to the location, or None if
+    there is no nearby place. The index is read-only, so the same location always maps to
+    the same placemark.
+    """
+    if self._index is None:
+      self._index = GeoIndex.GetIndex(self._path)
+    return self._index.ReverseGeocode(latitude, longitude)
+
+  @staticmethod
+  def Instance():
+    """Returns the geocoder for --geoindex, or None if no index is configured."""
+    if Geocoder._instance is None and options.options.geoindex:
+      Geocoder._instance = Geocoder(options.options.geoindex)
+    return Geocoder._instance
+
+  @staticmethod
+  def SetInstance(geocoder):
+    """Sets a new instance for testing."""
+    Geocoder._instance = geocoder
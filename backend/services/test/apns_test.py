@@ -9,16 +9,21 @@ __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 import base64
 import json
 import os
+import struct
+import time
 import unittest
 
-from collections import deque
+from collections import defaultdict, deque
+from functools import partial
 from tornado import escape, options
-from viewfinder.backend.services.apns import APNS
+from tornado.netutil import bind_sockets
+from tornado.tcpserver import TCPServer
+from viewfinder.backend.services.apns import APNS, _APNService
 from viewfinder.backend.base import base_options  # imported for option defs
 from viewfinder.backend.base import secrets
 from viewfinder.backend.base.testing import async_test_timeout, BaseTestCase
 from viewfinder.backend.base.testing import async_test
-from viewfinder.backend.services.apns_util import CreateMessage
+from viewfinder.backend.services.apns_util import CreateMessage, TokenFromBinary
 
 
 @unittest.skip("needs apns credentials")
@@ -44,6 +49,40 @@ class _FeedbackHandler(object):
       self._waiters.append(callback)
 
 
+class _FakeAPNsServer(TCPServer):
+  """Local stand-in for the APNs gateway. Parses binary notification messages and records the
+  payload of each by token. A notification to a bad token gets a "bad token" error response,
+  after which the connection is closed, as APNs does.
+  """
+  _HEADER_FMT = '!bIIH32sH'
+
+  def __init__(self):
+    super(_FakeAPNsServer, self).__init__()
+    self.notifications = defaultdict(list)
+    self.bad_tokens = set()
+    self.num_connections = 0
+    self.num_notifications = 0
+
+  def handle_stream(self, stream, address):
+    self.num_connections += 1
+    header_size = struct.calcsize(_FakeAPNsServer._HEADER_FMT)
+
+    def _OnHeader(data):
+      command, identifier, expiry, token_len, token, payload_len = struct.unpack(_FakeAPNsServer._HEADER_FMT, data)
+      assert command == 1 and token_len == 32, (command, token_len)
+      stream.read_bytes(payload_len, partial(_OnPayload, identifier, TokenFromBinary(token)))
+
+    def _OnPayload(identifier, token, data):
+      if token in self.bad_tokens:
+        stream.write(struct.pack('!bbI', 8, 8, identifier), stream.close)
+        return
+      self.notifications[token].append(json.loads(data))
+      self.num_notifications += 1
+      stream.read_bytes(header_size, _OnHeader)
+
+    stream.read_bytes(header_size, _OnHeader)
+
+
 class APNSTestCase(BaseTestCase):
   def setUp(self):
     super(APNSTestCase, self).setUp()
@@ -144,3 +183,93 @@ class APNSTestCase(BaseTestCase):
 
     # Test errors.
     self.assertRaises(AssertionError, _TruncateAlert, 'a', 0)
+
+
+class APNServiceTestCase(BaseTestCase):
+  """Tests coalescing, batching and re-sending of notifications against a local fake APNs server."""
+  def setUp(self):
+    super(APNServiceTestCase, self).setUp()
+    sock = bind_sockets(0, '127.0.0.1')[0]
+    self._server = _FakeAPNsServer()
+    self._server.add_sockets([sock])
+    self._bad_tokens = []
+    settings = {'token-prefix': 'apns-fake',
+                'apns_host': sock.getsockname(),
+                'reconnect_lag': 0.01,
+                'ssl': False}
+    self._service = _APNService(settings, self._bad_tokens.append)
+
+  def tearDown(self):
+    self._server.stop()
+    super(APNServiceTestCase, self).tearDown()
+
+  def testCollapse(self):
+    """Notifications to the same device are collapsed into one."""
+    token = self._MakeToken(1)
+    other_token = self._MakeToken(2)
+    self._service.Push(token, alert='a', badge=1, sound='default', extra={'v': 'v1'})
+    self._service.Push(token, badge=2)
+    self._service.Push(token, alert='b', badge=3, extra={'v': 'v1'})
+    self._service.Push(other_token, alert='c', badge=1, extra={'v': 'v1'})
+    self._service.Push(other_token, alert='d', badge=2, extra={'v': 'v2'})
+    self._WaitForNotifications(2)
+
+    self.assertEqual(self._server.notifications[token],
+                     [{'aps': {'alert': 'a\nb', 'badge': 3, 'sound': 'default', 'content-available': 1}, 'v': 'v1'}])
+    self.assertEqual(self._server.notifications[other_token],
+                     [{'aps': {'alert': 'd', 'badge': 2, 'content-available': 1}, 'v': 'v2'}])
+    self.assertTrue(self._service.IsIdle())
+
+  def testHighQPS(self):
+    """Pushes many notifications to many devices, which are written over a single connection."""
+    num_tokens = 5000
+    tokens = [self._MakeToken(i) for i in xrange(num_tokens)]
+    for badge in xrange(1, 4):
+      for token in tokens:
+        self._service.Push(token, alert='alert %d' % badge, badge=badge)
+    self._WaitForNotifications(num_tokens)
+
+    self.assertEqual(self._server.num_connections, 1)
+    for token in tokens:
+      notifications = self._server.notifications[token]
+      self.assertEqual(len(notifications), 1)
+      self.assertEqual(notifications[0]['aps']['badge'], 3)
+      self.assertEqual(notifications[0]['aps']['alert'], 'alert 1\nalert 2\nalert 3')
+
+  def testResend(self):
+    """Notifications written after one that APNs rejects are re-sent on a new connection."""
+    tokens = [self._MakeToken(i) for i in xrange(100)]
+    self._server.bad_tokens.add(tokens[10])
+    for token in tokens:
+      self._service.Push(token, badge=1)
+    self._WaitForNotifications(99)
+
+    self.assertEqual(self._bad_tokens, ['apns-fake:%s' % tokens[10]])
+    self.assertEqual(self._server.num_connections, 2)
+    self.assertNotIn(tokens[10], self._server.notifications)
+    for token in tokens[:10] + tokens[11:]:
+      self.assertEqual(len(self._server.notifications[token]), 1)
+
+  def testMissingCertificate(self):
+    """Pushes fail at once if there is no certificate with which to connect to APNs."""
+    service = _APNService({'token-prefix': 'apns-fake',
+                           'certfile': 'missing_cert.pem',
+                           'apns_host': ('127.0.0.1', 1),
+                           'reconnect_lag': 0.01},
+                          self._bad_tokens.append)
+    self.assertRaises(IOError, service.Push, self._MakeToken(1), badge=1)
+    self.assertTrue(service.IsIdle())
+
+  def _MakeToken(self, index):
+    return base64.b64encode(struct.pack('!I', index) * 8)
+
+  def _WaitForNotifications(self, count):
+    """Waits until the fake server has received "count" notifications."""
+    def _Check():
+      if self._server.num_notifications >= count:
+        self.stop()
+      else:
+        self.io_loop.add_timeout(time.time() + 0.01, _Check)
+
+    _Check()
+    self.wait(timeout=30)
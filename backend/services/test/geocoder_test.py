@@ -0,0 +1,47 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Geocoder service testing.
+"""
+
+__author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
+
+import os
+import shutil
+import tempfile
+
+from tornado import options
+from viewfinder.backend.base.testing import BaseTestCase
+from viewfinder.backend.services.geocoder import Geocoder
+from viewfinder.resources.geodata.geoindex import GeoIndex, GeoPlace, WriteGeoIndex
+
+
+class GeocoderTestCase(BaseTestCase):
+  def setUp(self):
+    super(GeocoderTestCase, self).setUp()
+    self._dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._dir, 'geoindex.bin')
+    WriteGeoIndex([GeoPlace('Paris', 48.853, 2.349, 'FR', 'France', None, None, 2138551)], self._path)
+    Geocoder.SetInstance(None)
+
+  def tearDown(self):
+    Geocoder.SetInstance(None)
+    options.options.geoindex = None
+    index = GeoIndex._cache.pop(self._path, None)
+    if index is not None:
+      index.close()
+    shutil.rmtree(self._dir)
+    super(GeocoderTestCase, self).tearDown()
+
+  def testInstance(self):
+    """The geocoder is configured by --geoindex and maps the index on first use."""
+    self.assertIsNone(Geocoder.Instance())
+
+    options.options.geoindex = self._path
+    geocoder = Geocoder.Instance()
+    self.assertIs(Geocoder.Instance(), geocoder)
+    self.assertNotIn(self._path, GeoIndex._cache)
+
+    self.assertEqual(geocoder.ReverseGeocode(48.86, 2.35),
+                     {'iso_country_code': 'FR', 'country': 'France', 'locality': 'Paris'})
+    self.assertIn(self._path, GeoIndex._cache)
+    self.assertIsNone(geocoder.ReverseGeocode(0.0, -30.0))
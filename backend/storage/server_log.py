@@ -4,18 +4,25 @@
 
  - ServerLogHandler: buffers server logs up to a maximum buffer size or
      outstanding time before sending to the server log object store.
+ - LogMemoryBudget: process-wide cap on log bytes held in memory, shared by
+     all handlers and the persistor.
+ - LogBatchPersistor: compresses, coalesces and uploads completed batches,
+     spilling to a local backup directory when the object store is unavailable.
 """
 
 __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
 import datetime
+import gzip
 import logging
 import os
+import random
 import socket
 import sys
 import time
 
 from collections import deque
+from concurrent import futures
 from contextlib import contextmanager
 from functools import partial
 from logging import Filter, Handler
@@ -33,25 +40,142 @@ options.define('error_log_flush_interval_secs', 2 * 60,
                help='seconds between log flushes')
 options.define('server_log_backup_dir', '~/local/server_log_backup',
                help='backup location in case object store is down')
+options.define('server_log_max_total_buffer_bytes', 64 << 20,
+               help='maximum log bytes held in memory across all handlers and in-flight uploads')
+options.define('server_log_overflow_policy', 'drop',
+               help='what to do with sub-WARNING records once the memory budget is exhausted: '
+                    '"drop" discards them, "sample" keeps a fraction given by server_log_overflow_sample_rate')
+options.define('server_log_overflow_sample_rate', 0.1,
+               help='fraction of sub-WARNING records kept under the "sample" overflow policy')
+options.define('server_log_compress', True,
+               help='gzip log batches before uploading them to the object store')
+options.define('server_log_compress_min_bytes', 4 << 10,
+               help='log batches smaller than this are uploaded uncompressed')
+options.define('server_log_coalesce_max_bytes', 64 << 10,
+               help='per-user log batches smaller than this are coalesced into multi-part objects')
+options.define('server_log_coalesce_interval_secs', 60.0,
+               help='maximum seconds a small per-user log batch waits to be coalesced')
 
 
 # Performance counters for warnings and errors.
 _warning_count = counters.define_delta('viewfinder.errors.warning', 'Count of logged warnings during sample period.')
 _error_count = counters.define_delta('viewfinder.errors.error', 'Count of logged errors during sample period.')
 
+# Performance counters for log buffering and upload.
+_bytes_buffered = counters.define_total('viewfinder.server_log.bytes_buffered',
+                                        'Log bytes currently held in memory by handlers and the persistor.')
+_bytes_dropped = counters.define_delta('viewfinder.server_log.bytes_dropped',
+                                       'Log bytes dropped or sampled away because the memory budget was exhausted.')
+_bytes_spilled = counters.define_delta('viewfinder.server_log.bytes_spilled',
+                                       'Log bytes written to local backup instead of uploaded due to back-pressure.')
+_bytes_uploaded = counters.define_delta('viewfinder.server_log.bytes_uploaded',
+                                        'Log bytes successfully uploaded to the object store.')
+_batches_coalesced = counters.define_delta('viewfinder.server_log.batches_coalesced',
+                                           'Small log batches coalesced into multi-part objects.')
+
+_GZIP_MAGIC = '\x1f\x8b'
+_MULTIPART_HEADER = '=== log part: '
+_MULTIPART_CATEGORY = 'multi'
+
+
+def _GzipBuffer(buffer):
+  """Returns the gzip-compressed contents of "buffer". Runs on the compression thread pool."""
+  out = StringIO()
+  with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+    gz.write(buffer)
+  return out.getvalue()
+
+
+def GunzipLogBuffer(buffer):
+  """Returns the uncompressed contents of a log batch buffer, which may or may not have been
+  compressed by the persistor.
+  """
+  if not buffer.startswith(_GZIP_MAGIC):
+    return buffer
+  with gzip.GzipFile(fileobj=StringIO(buffer), mode='rb') as gz:
+    return gz.read()
+
+
+class LogMemoryBudget(object):
+  """Tracks the total number of log bytes held in memory by all batching handlers and by
+  the persistor (batches waiting to be compressed, coalesced or uploaded). Once the budget
+  is exhausted, handlers drop or sample sub-WARNING records according to
+  --server_log_overflow_policy, and the persistor spills new batches to the local backup
+  directory rather than queueing more uploads. Records of level WARNING and above are
+  always admitted.
+  """
+  def __init__(self, max_bytes=None, policy=None, sample_rate=None):
+    self._max_bytes = max_bytes or options.options.server_log_max_total_buffer_bytes
+    self._policy = policy or options.options.server_log_overflow_policy
+    self._sample_rate = sample_rate if sample_rate is not None else options.options.server_log_overflow_sample_rate
+    assert self._policy in ('drop', 'sample'), self._policy
+    self._bytes = 0
+
+  @property
+  def bytes_buffered(self):
+    return self._bytes
+
+  def IsExhausted(self):
+    """Returns true if the budget has been used up."""
+    return self._bytes >= self._max_bytes
+
+  def Admit(self, record):
+    """Returns true if the given log record should be buffered. If not, the record is counted
+    as dropped.
+    """
+    if record.levelno >= logging.WARNING or not self.IsExhausted():
+      return True
+    if self._policy == 'sample' and random.random() < self._sample_rate:
+      return True
+
+    try:
+      _bytes_dropped.increment(len(record.getMessage()))
+    except Exception:
+      pass
+    return False
+
+  def Reserve(self, num_bytes):
+    """Accounts for "num_bytes" additional bytes held in memory."""
+    self._bytes += num_bytes
+    _bytes_buffered.increment(num_bytes)
+
+  def Release(self, num_bytes):
+    """Accounts for "num_bytes" bytes no longer held in memory."""
+    self._bytes -= num_bytes
+    _bytes_buffered.decrement(num_bytes)
+
+  @staticmethod
+  def Instance():
+    if not hasattr(LogMemoryBudget, '_instance'):
+      LogMemoryBudget._instance = LogMemoryBudget()
+    return LogMemoryBudget._instance
+
+  @staticmethod
+  def SetInstance(budget):
+    """Sets a new instance for testing."""
+    LogMemoryBudget._instance = budget
+
 
 class LogBatch(object):
   """A log batch is simply a buffer of log records associated with an object
   store and a key.  Log batches may be sent to different object stores depending
   on the context from which they are collected.
   """
-  def __init__(self, buffer, store_name, *keyparts):
+  def __init__(self, buffer, store_name, *keyparts, **kwargs):
     """Create a new batch for the given buffer which will be saved in the object
     store with the given name.  They key within the object store will be synthesized
     using any additional positional arguments.
+
+    If the "coalesce_key" keyword argument is given, small batches sharing the same
+    store and coalesce key may be combined by the persistor into a single multi-part
+    object (see LogBatch.SplitMultiPart). If "compress" is False, the batch is never
+    gzip-compressed, so that it is always stored under its plain key.
     """
     self.buffer = buffer
     self.store_name = store_name
+    self.coalesce_key = kwargs.pop('coalesce_key', None)
+    self.compressible = kwargs.pop('compress', True)
+    assert not kwargs, 'Unexpected keyword arguments: %r' % kwargs
     assert len(keyparts) > 0, 'Must provide at least one parameter to create a batch key.'
     keyparts = [str(part) for part in keyparts]
     for part in keyparts:
@@ -59,18 +183,52 @@ class LogBatch(object):
       assert '/' not in keyparts
 
     self.keyparts = keyparts
+    self.compressed = False
+    self.reserved_bytes = 0
 
   def Key(self):
     """Synthesize a string key for this batch which will be used to identify this batch
-    in the object store.
+    in the object store. Compressed batches have a '.gz' suffix.
     """
-    return '/'.join(self.keyparts)
+    return '/'.join(self.keyparts) + ('.gz' if self.compressed else '')
 
   def FileSystemKey(self):
     """Synthesize a string key for this batch which will be used to identify this batch
     in a local file system, which may have different character requirements.
     """
-    return '_'.join(self.keyparts)
+    return '_'.join(self.keyparts) + ('.gz' if self.compressed else '')
+
+  @classmethod
+  def MakeMultiPart(cls, batches, *keyparts):
+    """Combines a list of uncompressed batches destined for the same object store into a
+    single batch with the given key parts. Each part is preceded by a header line giving
+    its original key and length.
+    """
+    assert len(set(b.store_name for b in batches)) == 1, batches
+    parts = []
+    for batch in batches:
+      assert not batch.compressed, batch.Key()
+      parts.append('%s%s %d\n' % (_MULTIPART_HEADER, batch.Key(), len(batch.buffer)))
+      parts.append(batch.buffer)
+    return LogBatch(''.join(parts), batches[0].store_name, *keyparts)
+
+  @classmethod
+  def SplitMultiPart(cls, buffer):
+    """Splits the (uncompressed) contents of a multi-part batch created by MakeMultiPart.
+    Returns a list of (key, buffer) tuples in their original order.
+    """
+    parts = []
+    offset = 0
+    while offset < len(buffer):
+      header_end = buffer.index('\n', offset)
+      header = buffer[offset:header_end]
+      assert header.startswith(_MULTIPART_HEADER), header
+      key, length = header[len(_MULTIPART_HEADER):].rsplit(' ', 1)
+      start = header_end + 1
+      end = start + int(length)
+      parts.append((key, buffer[start:end]))
+      offset = end
+    return parts
 
   @classmethod
   def DecodeKey(cls, key):
@@ -83,6 +241,20 @@ class LogBatch(object):
     return key.split('_')
 
 
+class _LogBuffer(StringIO):
+  """In-memory log buffer which counts the UTF-8 encoded size of everything written to it,
+  since that is the size of the batch that is eventually persisted. Once unicode has been
+  written, StringIO.tell() counts characters rather than bytes.
+  """
+  def __init__(self):
+    StringIO.__init__(self)
+    self.num_bytes = 0
+
+  def write(self, s):
+    StringIO.write(self, s)
+    self.num_bytes += len(s.encode('utf-8') if type(s) is unicode else s)
+
+
 class BatchingLogHandler(Handler):
   """A log handler which maintains buffers bytes over a flush interval, after
   which the data is sent to the server log object store.  The exact object store
@@ -132,11 +304,17 @@ class BatchingLogHandler(Handler):
     if self._closing:
       return
 
+    budget = self._persistor.budget
+    if not budget.Admit(record):
+      return
+
     if self._buffer is None:
       self._NewBatch()
 
+    start_bytes = self._buffer.num_bytes
     self._inner_handler.emit(record)
-    if self._buffer.tell() >= self._max_buffer_bytes:
+    budget.Reserve(self._buffer.num_bytes - start_bytes)
+    if self._buffer.num_bytes >= self._max_buffer_bytes:
       self.flush()
     elif not self._flush_timeout:
       deadline = self._start_timestamp + self._flush_interval_secs
@@ -197,6 +375,9 @@ class BatchingLogHandler(Handler):
         logging.exception('Failure to generate log batch!')
         pass
 
+      # The batch's bytes are now owned by the persistor, which does its own accounting.
+      self._persistor.budget.Release(self._buffer.num_bytes)
+
       if batch:
         try:
           self._persistor.PersistLogBatch(batch)
@@ -210,7 +391,7 @@ class BatchingLogHandler(Handler):
 
   def _NewBatch(self):
     """Begins a new log batch."""
-    self._buffer = StringIO()
+    self._buffer = _LogBuffer()
     self._inner_handler = logging.StreamHandler(self._buffer)
     self._inner_handler.setLevel(logging.INFO)
     self._inner_handler.setFormatter(logging_utils.FORMATTER)
@@ -299,12 +480,15 @@ class UserRequestLogHandler(BatchingLogHandler):
   def MakeBatch(self, buffer):
     return LogBatch(buffer, ObjectStore.USER_LOG,
                     self._user_id, self._FormattedDate(), 'req', self._request_type,
-                    self._FormattedTime())
+                    self._FormattedTime(), coalesce_key=self._user_id)
 
 
 class UserOperationLogHandler(BatchingLogHandler):
   """Subclass of BatchingLogHandler designed to capture logs for a specific user operation.
   Log key format is [userId]/[date]/op/[opId]/[retry-num].
+
+  Operation log batches are neither coalesced nor compressed, since their keys are constructed
+  by logs/server_log_metrics.py and parsed by the user_logs admin page.
   """
   def __init__(self, operation, *args, **kwargs):
     super(UserOperationLogHandler, self).__init__(*args, **kwargs)
@@ -317,7 +501,7 @@ class UserOperationLogHandler(BatchingLogHandler):
   def MakeBatch(self, buffer):
     return LogBatch(buffer, ObjectStore.USER_LOG,
                     self._user_id, self._FormattedDate(self._op_timestamp), 'op',
-                    self._op_method, self._op_id, self._op_retry)
+                    self._op_method, self._op_id, self._op_retry, compress=False)
 
 class LogBatchPersistor(object):
   """ Class which persists log batches to object storage in a reliable fashion.  A completed batch of
@@ -326,6 +510,12 @@ class LogBatchPersistor(object):
   This class will immediately attempt to upload the log batch to the object store indicated in
   the batch - if this attempt fails, the log will instead be saved to the local filesystem.
   This class will attempt to re-upload log batches from the local filesystem every ten minutes.
+
+  Before uploading, large batches are gzip-compressed on a background thread so that the IOLoop
+  is not blocked, and small batches which carry a coalesce key (per-user request logs) are held
+  for up to --server_log_coalesce_interval_secs and combined into a single multi-part object. All batches held by the persistor are charged against the LogMemoryBudget;
+  when the budget is exhausted (e.g. during an object store slowdown), new batches are written
+  straight to the local backup directory instead of being queued in memory.
   """
 
   _CLOSE_TIMEOUT_SECS = 5
@@ -337,24 +527,50 @@ class LogBatchPersistor(object):
   which failed to be written to the object store.
   """
 
-  def __init__(self, backup_dir=None):
+  _compress_executor = None
+  """Thread pool shared by all persistors for compressing log batches off the IOLoop."""
+
+  def __init__(self, backup_dir=None, budget=None):
     """'backup_dir' is augmented using the process name (as taken from sys.argv[0])."""
     self._proc_name = os.path.basename(sys.argv[0])
     self._backup_dir = os.path.join(backup_dir or os.path.expanduser(options.options.server_log_backup_dir),
                                     self._proc_name)
+    self._budget = budget or LogMemoryBudget.Instance()
     self._in_flight = {}
+    self._coalescing = {}
     self._handlers = []
     self._wait_callbacks = deque()
     self._restore_timeout = None
     self._closing = False
     self._SetRestoreTimeout(0)
 
+  @property
+  def budget(self):
+    """The memory budget charged for batches held by this persistor and by its handlers."""
+    return self._budget
+
   def PersistLogBatch(self, batch):
     """Relibably persists the given LogBatch to object storage.  If the batch cannot immediately
     be uploaded to object storage, it is instead persisted to the local filesystem and will be
     uploaded to storage at a later time.
     """
-    self._PersistToObjStore(batch)
+    if IOLoop.current() is None or self._closing:
+      self._PersistToObjStore(batch)
+      return
+
+    if self._budget.IsExhausted():
+      # Back-pressure: don't queue more batches in memory behind a slow object store.
+      _bytes_spilled.increment(len(batch.buffer))
+      self._PersistToBackup(batch)
+      return
+
+    self._ReserveBatch(batch)
+    if batch.coalesce_key is not None and len(batch.buffer) < options.options.server_log_coalesce_max_bytes:
+      self._CoalesceBatch(batch)
+    elif self._ShouldCompress(batch):
+      self._CompressAndPersist(batch)
+    else:
+      self._PersistToObjStore(batch)
 
   def AddHandler(self, handler):
     """Add a handler to the list of handlers registered with this persistor."""
@@ -381,6 +597,7 @@ class LogBatchPersistor(object):
         logging.warning('unflushed server log buffers; writing to backup dir')
         for batch in self._in_flight.values():
           self._PersistToBackup(batch)
+          self._ReleaseBatch(batch)
       self._in_flight.clear()
       if callback:
         callback()
@@ -395,6 +612,10 @@ class LogBatchPersistor(object):
       for h in self._handlers:
         h.close()
 
+      # Don't wait out the coalescing interval for any small batches still being held.
+      for coalesce_id in self._coalescing.keys():
+        self._FlushCoalesced(coalesce_id)
+
       # Begin countdown for log persisting.
       deadline = time.time() + self._CLOSE_TIMEOUT_SECS
       timeout = IOLoop.current().add_timeout(deadline, _OnFlush)
@@ -417,6 +638,121 @@ class LogBatchPersistor(object):
     else:
       callback()
 
+  def _ReserveBatch(self, batch):
+    """Charges the batch's buffer against the memory budget."""
+    assert batch.reserved_bytes == 0, batch.Key()
+    batch.reserved_bytes = len(batch.buffer)
+    self._budget.Reserve(batch.reserved_bytes)
+
+  def _ReleaseBatch(self, batch):
+    """Returns the batch's charge to the memory budget. Safe to call more than once."""
+    self._budget.Release(batch.reserved_bytes)
+    batch.reserved_bytes = 0
+
+  def _RemoveInFlight(self, batch_key):
+    """Removes the given key from the 'in-flight' collection. If this was the last in-flight
+    log batch, invokes any callbacks waiting on the persistor to finish.
+    """
+    del self._in_flight[batch_key]
+    if not self._in_flight:
+      while self._wait_callbacks:
+        self._wait_callbacks.popleft()()
+
+  def _ShouldCompress(self, batch):
+    return (options.options.server_log_compress and batch.compressible and not batch.compressed and
+            len(batch.buffer) >= options.options.server_log_compress_min_bytes)
+
+  def _CompressAndPersist(self, batch):
+    """Compresses the batch on the shared compression thread pool, then persists it to the
+    object store from the IOLoop. The batch remains 'in-flight' while it is being compressed,
+    so a concurrent close() will write it to backup uncompressed.
+    """
+    if LogBatchPersistor._compress_executor is None:
+      LogBatchPersistor._compress_executor = futures.ThreadPoolExecutor(max_workers=1)
+
+    pending_key = batch.Key()
+    self._in_flight[pending_key] = batch
+
+    def _OnCompressed(future):
+      if self._in_flight.get(pending_key) is not batch:
+        # Already written to backup by close().
+        return
+
+      try:
+        compressed = future.result()
+      except Exception:
+        logging.exception('Failed to compress log batch %s; uploading uncompressed' % pending_key)
+      else:
+        self._ReleaseBatch(batch)
+        batch.buffer = compressed
+        batch.compressed = True
+        self._ReserveBatch(batch)
+
+      # Re-registers the batch under its final key before the compression entry is removed,
+      # so that Wait() callbacks don't fire in between. If compression failed, the key is
+      # unchanged, and the entry is removed once the put completes.
+      self._PersistToObjStore(batch)
+      if batch.Key() != pending_key:
+        self._RemoveInFlight(pending_key)
+
+    IOLoop.current().add_future(LogBatchPersistor._compress_executor.submit(_GzipBuffer, batch.buffer),
+                                _OnCompressed)
+
+  def _CoalesceBatch(self, batch):
+    """Holds a small batch until it can be combined with other batches from the same store and
+    coalesce key. The group is flushed once it exceeds --server_log_coalesce_max_bytes or after
+    --server_log_coalesce_interval_secs.
+    """
+    coalesce_id = (batch.store_name, batch.coalesce_key)
+    group = self._coalescing.get(coalesce_id)
+    if group is None:
+      deadline = time.time() + options.options.server_log_coalesce_interval_secs
+      with stack_context.NullContext():
+        timeout = IOLoop.current().add_timeout(deadline, partial(self._FlushCoalesced, coalesce_id))
+      group = self._coalescing[coalesce_id] = (timeout, [])
+
+    # Coalescing batches are 'in-flight' so that close() persists them if they can't be flushed.
+    self._in_flight[batch.Key()] = batch
+    group[1].append(batch)
+    if sum(len(b.buffer) for b in group[1]) >= options.options.server_log_coalesce_max_bytes:
+      self._FlushCoalesced(coalesce_id)
+
+  def _FlushCoalesced(self, coalesce_id):
+    """Combines all batches held for "coalesce_id" into a single multi-part batch and persists it.
+    A group containing a single batch is persisted as-is.
+    """
+    timeout, batches = self._coalescing.pop(coalesce_id, (None, []))
+    if timeout is not None:
+      IOLoop.current().remove_timeout(timeout)
+
+    # Skip any batches already written to backup by close().
+    batches = [b for b in batches if self._in_flight.get(b.Key()) is b]
+    if not batches:
+      return
+
+    if len(batches) == 1:
+      batch = batches[0]
+    else:
+      store_name, coalesce_key = coalesce_id
+      now = time.time()
+      batch = LogBatch.MakeMultiPart(batches, coalesce_key, datetime.date.fromtimestamp(now).isoformat(),
+                                     _MULTIPART_CATEGORY, datetime.datetime.fromtimestamp(now).isoformat(),
+                                     os.getpid())
+      self._ReserveBatch(batch)
+      _batches_coalesced.increment(len(batches))
+
+    # Hand off the batch before removing the parts, so that Wait() callbacks don't fire in between.
+    batch.coalesce_key = None
+    if self._ShouldCompress(batch):
+      self._CompressAndPersist(batch)
+    else:
+      self._PersistToObjStore(batch)
+
+    if len(batches) > 1:
+      for part in batches:
+        self._ReleaseBatch(part)
+        self._RemoveInFlight(part.Key())
+
   def _PersistToObjStore(self, batch, restore=False):
     """Writes the given log batch to the object store. The 'restore'
     parameter indicates that this is an attempt to restore the log, in
@@ -432,13 +768,12 @@ class LogBatchPersistor(object):
       # If this was the last currently uploading ('in-flight') log batch,
       # invokes any callbacks waiting on the persistor to finish.  This functionality
       # is only intended for testing.
-      del self._in_flight[batch_key]
-      if not self._in_flight:
-        while self._wait_callbacks:
-          self._wait_callbacks.popleft()()
+      self._ReleaseBatch(batch)
+      self._RemoveInFlight(batch_key)
 
     def _OnPut():
       logging.info('Successfully persisted log batch %s to object store' % batch_key)
+      _bytes_uploaded.increment(len(batch.buffer))
       # Delete the local backup file if this was a restore attempt.
       if restore:
         os.unlink(self._BackupFileName(batch))
@@ -462,6 +797,7 @@ class LogBatchPersistor(object):
         ObjectStore.GetInstance(batch.store_name).Put(batch_key, batch.buffer, callback=b.Callback())
     else:
       self._PersistToBackup(batch)
+      self._ReleaseBatch(batch)
 
   def _PersistToBackup(self, batch):
     """Writes a batch to the local filesystem."""
@@ -484,7 +820,9 @@ class LogBatchPersistor(object):
 
   def _RestoreBackups(self):
     """Restores all server logs which are currently persisted to the
-    backup directory. Each is sent in turn to the object store.
+    backup directory. Each is sent in turn to the object store. Restoration
+    stops once the memory budget is exhausted; the remaining files are
+    retried at the next restore interval.
     """
     # Reset timeout.
     if self._restore_timeout:
@@ -505,10 +843,16 @@ class LogBatchPersistor(object):
         if files:
           logging.info('restoring %d server log(s) from store %s' % (len(files), store_name))
           for file in files:
+            if self._budget.IsExhausted():
+              logging.warning('log memory budget exhausted; deferring restore of remaining server logs')
+              self._SetRestoreTimeout()
+              return
+
             filepath = os.path.join(store_name_dir, file)
             with open(filepath, 'r') as f:
               batch = LogBatch(f.read(), store_name, *LogBatch.DecodeFileSystemKey(file))
 
+            self._ReserveBatch(batch)
             self._PersistToObjStore(batch, restore=True)
         else:
           # Remove empty store directory.
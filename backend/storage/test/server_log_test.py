@@ -6,6 +6,7 @@
 __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 
 import logging
+import mock
 import os
 import re
 import sys
@@ -17,6 +18,8 @@ from tornado import options, testing
 from viewfinder.backend.storage.object_store import ObjectStore, InitObjectStore
 from viewfinder.backend.storage.file_object_store import FileObjectStore
 from viewfinder.backend.storage.server_log import BatchingLogHandler, LogBatch, LogBatchPersistor, InitServerLog, FinishServerLog
+from viewfinder.backend.storage.server_log import GunzipLogBuffer, LogMemoryBudget
+from viewfinder.backend.storage.server_log import UserOperationLogHandler
 from viewfinder.backend.base import util, counters
 from viewfinder.backend.base.testing import async_test, BaseTestCase
 
@@ -48,6 +51,10 @@ class _FakePersistor(object):
   def PersistLogBatch(self, batch):
     self.batches[batch.Key()] = batch
 
+  @property
+  def budget(self):
+    return LogMemoryBudget.Instance()
+
   def AddHandler(self, handler):
     """Add a handler to the list of handlers registered with this persistor."""
     if not handler in self._handlers:
@@ -82,8 +89,12 @@ class LogBatchPersistorTestCase(BaseTestCase, testing.LogTrapTestCase):
     options.options.fileobjstore = True
     super(LogBatchPersistorTestCase, self).setUp()
     InitObjectStore(temporary=True)
+    self._coalesce_interval_secs = options.options.server_log_coalesce_interval_secs
+    LogMemoryBudget.SetInstance(LogMemoryBudget())
 
   def tearDown(self):
+    options.options.server_log_coalesce_interval_secs = self._coalesce_interval_secs
+    LogMemoryBudget.SetInstance(LogMemoryBudget())
     super(LogBatchPersistorTestCase, self).tearDown()
 
   def testPersistor(self):
@@ -167,6 +178,92 @@ class LogBatchPersistorTestCase(BaseTestCase, testing.LogTrapTestCase):
     self._RunAsync(self.io_loop.add_timeout, time.time() + 0.200)
     self._RunAsync(self._VerifyObjStoreBatches, batches)
 
+  def testCompression(self):
+    """Verifies that large batches are gzipped before upload and small ones are not."""
+    backup_dir = tempfile.mkdtemp()
+    persistor = LogBatchPersistor(backup_dir=backup_dir)
+    large_buffer = 'Large log batch buffer\n' * 1000
+    batches = [LogBatch(large_buffer, ObjectStore.SERVER_LOG, 'test1', 'keyA'),
+               LogBatch('Small log batch buffer', ObjectStore.SERVER_LOG, 'test2', 'keyB')]
+
+    for batch in batches:
+      persistor.PersistLogBatch(batch)
+    self._RunAsync(persistor.Wait)
+
+    self.assertTrue(batches[0].compressed)
+    self.assertEqual('test1/keyA.gz', batches[0].Key())
+    self.assertEqual(large_buffer, GunzipLogBuffer(batches[0].buffer))
+    self.assertFalse(batches[1].compressed)
+    self._RunAsync(self._VerifyObjStoreBatches, batches)
+    self.assertEqual(0, LogMemoryBudget.Instance().bytes_buffered)
+
+  def testCompressionFailure(self):
+    """Verifies that a batch which fails to compress is uploaded uncompressed."""
+    backup_dir = tempfile.mkdtemp()
+    persistor = LogBatchPersistor(backup_dir=backup_dir)
+    batch = LogBatch('Large log batch buffer\n' * 1000, ObjectStore.SERVER_LOG, 'test1', 'keyA')
+
+    with mock.patch('viewfinder.backend.storage.server_log._GzipBuffer', side_effect=Exception('gzip failed')):
+      persistor.PersistLogBatch(batch)
+      self._RunAsync(persistor.Wait)
+
+    self.assertFalse(batch.compressed)
+    self.assertEqual({}, persistor._in_flight)
+    self._RunAsync(self._VerifyObjStoreBatches, [batch])
+    self.assertEqual(0, LogMemoryBudget.Instance().bytes_buffered)
+
+  def testOperationLogs(self):
+    """Verifies that operation log batches are neither coalesced nor compressed."""
+    operation = mock.Mock(user_id=1, operation_id='o1', timestamp=time.time(), attempts=0, method='UploadEpisode')
+    handler = UserOperationLogHandler(operation, persistor=_FakePersistor())
+    batch = handler.MakeBatch('Large log batch buffer\n' * 1000)
+    self.assertIsNone(batch.coalesce_key)
+
+    persistor = LogBatchPersistor(backup_dir=tempfile.mkdtemp())
+    persistor.PersistLogBatch(batch)
+    self._RunAsync(persistor.Wait)
+    self.assertFalse(batch.compressed)
+    self._RunAsync(self._VerifyObjStoreBatches, [batch])
+
+  def testCoalescing(self):
+    """Verifies that small per-user batches are combined into a single multi-part object."""
+    options.options.server_log_coalesce_interval_secs = 0.100
+    backup_dir = tempfile.mkdtemp()
+    persistor = LogBatchPersistor(backup_dir=backup_dir)
+    batches = [LogBatch('Log batch buffer %d' % i, ObjectStore.USER_LOG, '1', 'op', 'key%d' % i,
+                        coalesce_key='1') for i in xrange(3)]
+
+    for batch in batches:
+      persistor.PersistLogBatch(batch)
+    self._RunAsync(persistor.Wait)
+
+    store = ObjectStore.GetInstance(ObjectStore.USER_LOG)
+    keys = self._RunAsync(store.ListKeys)
+    self.assertEqual(1, len(keys))
+    self.assertEqual('multi', LogBatch.DecodeKey(keys[0])[2])
+    parts = LogBatch.SplitMultiPart(self._RunAsync(store.Get, keys[0]))
+    self.assertEqual([(b.Key(), b.buffer) for b in batches], parts)
+    self.assertEqual(0, LogMemoryBudget.Instance().bytes_buffered)
+
+  def testBackPressure(self):
+    """Verifies that batches are spilled to the backup directory once the memory budget is exhausted."""
+    LogMemoryBudget.SetInstance(LogMemoryBudget(max_bytes=30))
+    backup_dir = tempfile.mkdtemp()
+    persistor = LogBatchPersistor(backup_dir=backup_dir)
+    batches = [LogBatch('Log batch buffer 1A', ObjectStore.SERVER_LOG, 'test1', 'keyA'),
+               LogBatch('Log batch buffer 2B', ObjectStore.SERVER_LOG, 'test2', 'keyB'),
+               LogBatch('Log batch buffer 3C', ObjectStore.SERVER_LOG, 'test3', 'keyC')]
+
+    ObjectStore.SetInstance(ObjectStore.SERVER_LOG,
+                            _BadObjectStore(ObjectStore.SERVER_LOG_BUCKET,
+                                            temporary=True, fail_fast=False))
+
+    # The first two batches are queued behind the stalled object store; the third is spilled.
+    for batch in batches:
+      persistor.PersistLogBatch(batch)
+    self.assertEqual(2, len(persistor._in_flight))
+    self._VerifyBackupBatches(backup_dir, batches[2:])
+
   def _SortBatchesByStore(self, batches):
     batches_by_store = {}
     for batch in batches:
@@ -220,6 +317,11 @@ class BatchingLogHandlerTestCase(BaseTestCase, testing.LogTrapTestCase):
     super(BatchingLogHandlerTestCase, self).setUp()
     self._persistor = _FakePersistor()
     LogBatchPersistor.SetInstance(self._persistor)
+    LogMemoryBudget.SetInstance(LogMemoryBudget())
+
+  def tearDown(self):
+    LogMemoryBudget.SetInstance(LogMemoryBudget())
+    super(BatchingLogHandlerTestCase, self).tearDown()
 
   def testBatching(self):
     """Tests that the server log writes to object store."""
@@ -263,6 +365,30 @@ class BatchingLogHandlerTestCase(BaseTestCase, testing.LogTrapTestCase):
     self._RunAsync(self.io_loop.add_timeout, time.time() + 0.150)
     self._RunAsync(self._VerifyLog, ['test'])
 
+  def testMemoryBudget(self):
+    """Tests that sub-WARNING records are dropped once the memory budget is exhausted."""
+    LogMemoryBudget.SetInstance(LogMemoryBudget(max_bytes=1, policy='drop'))
+    basic_log = _BasicLogHandler()
+    for level, msg in [(logging.INFO, 'info1'), (logging.INFO, 'info2'), (logging.WARNING, 'warning1')]:
+      basic_log.emit(logging.makeLogRecord({'levelno': level, 'msg': msg}))
+    self.assertGreater(LogMemoryBudget.Instance().bytes_buffered, 0)
+    basic_log.flush()
+    self.assertEqual(0, LogMemoryBudget.Instance().bytes_buffered)
+
+    value = self._persistor.batches.values()[0].buffer
+    self.assertIn('info1', value)
+    self.assertNotIn('info2', value)
+    self.assertIn('warning1', value)
+
+  def testMemoryBudgetUnicode(self):
+    """Tests that the memory budget is charged for the encoded size of unicode records."""
+    basic_log = _BasicLogHandler()
+    basic_log.emit(logging.makeLogRecord({'levelno': logging.INFO, 'msg': u'caf\u00e9 \u2603'}))
+    bytes_buffered = LogMemoryBudget.Instance().bytes_buffered
+    basic_log.flush()
+    self.assertEqual(len(self._persistor.batches.values()[0].buffer), bytes_buffered)
+    self.assertEqual(0, LogMemoryBudget.Instance().bytes_buffered)
+
   def testFinishServerLog(self):
     """Verify that 'close()' is called on the server handler when the persistor
     is closed.
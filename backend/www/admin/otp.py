@@ -16,8 +16,8 @@ import sys
 import time
 import validictory
 
-from tornado import httputil, template, web
-from viewfinder.backend.base import otp, secrets
+from tornado import gen, httputil, template, web
+from viewfinder.backend.base import handler, otp, secrets
 from viewfinder.backend.www import basic_auth, json_schema
 from viewfinder.backend.www.admin import admin, admin_schema
 
@@ -37,13 +37,14 @@ class OTPEntryHandler(admin.AdminHandler):
     return json.dumps((user, long(timestamp) + basic_auth.COOKIE_EXPIRATION))
 
   @classmethod
+  @gen.coroutine
   def _ValidateCredentials(cls, user, pwd, otp_entry):
     """Validates username / password in conjunction with
     OTP entry. Returns otp_admin cookie value on success.
     """
-    otp.VerifyPassword(user, pwd)
+    yield otp.VerifyPasswordAsync(user, pwd)
     otp.VerifyOTP(user, otp_entry)
-    return OTPEntryHandler._CreateCookie(user, time.time())
+    raise gen.Return(OTPEntryHandler._CreateCookie(user, time.time()))
 
   # Do not require permissions on OTP.
   def get(self):
@@ -55,6 +56,8 @@ class OTPEntryHandler(admin.AdminHandler):
         auth_credentials=self._auth_credentials)
 
   # Do not require permissions on OTP.
+  @handler.asynchronous()
+  @gen.engine
   def post(self):
     """Verifies the OTP parameter of the POST. On success, sends
     the user a secure expiration cookie and redirects to the
@@ -68,9 +71,8 @@ class OTPEntryHandler(admin.AdminHandler):
         user = self.get_argument('username', '')
         pwd = self.get_argument('password', '')
         otp_entry = self.get_argument('otp', '')
-        self.set_secure_cookie(basic_auth.COOKIE_NAME,
-                               self._ValidateCredentials(user, pwd, otp_entry),
-                               path='/admin', expires_days=1)
+        cookie = yield self._ValidateCredentials(user, pwd, otp_entry)
+        self.set_secure_cookie(basic_auth.COOKIE_NAME, cookie, path='/admin', expires_days=1)
         logging.info('admin web authentication: %s' % user)
         self.redirect(self.get_argument('next', '/admin'))
       except Exception as ex_msg:
@@ -83,11 +85,10 @@ class OTPEntryHandler(admin.AdminHandler):
         # TODO(ben): refactor BaseHandler so we can use _LoadJSONRequest here.
         request_dict = json.loads(self.request.body)
         validictory.validate(request_dict, admin_schema.AUTHENTICATE_REQUEST)
-        self.set_secure_cookie(basic_auth.COOKIE_NAME,
-                               self._ValidateCredentials(request_dict['username'],
-                                                         request_dict['password'],
-                                                         str(request_dict['otp'])),
-                               path='/admin', expires_days=1)
+        cookie = yield self._ValidateCredentials(request_dict['username'],
+                                                 request_dict['password'],
+                                                 str(request_dict['otp']))
+        self.set_secure_cookie(basic_auth.COOKIE_NAME, cookie, path='/admin', expires_days=1)
         response_dict = {}
         validictory.validate(response_dict, admin_schema.AUTHENTICATE_RESPONSE)
         self.set_status(200)
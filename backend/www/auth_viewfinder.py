@@ -113,7 +113,7 @@ class AuthViewfinderHandler(AuthHandler):
       password = self._request_message.dict['auth_info'].get('password', None)
       if password is not None:
         # Generate password hash and salt.
-        pwd_hash, salt = password_util.GeneratePasswordHash(password)
+        pwd_hash, salt = yield password_util.GeneratePasswordHash(password)
         user_dict['pwd_hash'] = pwd_hash
         user_dict['salt'] = salt
 
@@ -645,8 +645,7 @@ class VerifyIdWebHandler(VerifyIdBaseHandler):
       pwd_hash = kwargs['user_dict']['pwd_hash']
     else:
       user = yield gen.Task(User.Query, self._client, identity.user_id, None)
-      salt = user.salt.Decrypt()
-      pwd_hash = user.pwd_hash.Decrypt()
+      salt, pwd_hash = yield [user.salt.DecryptAsync(), user.pwd_hash.DecryptAsync()]
 
     yield password_util.ValidatePassword(self._client,
                                          identity.user_id,
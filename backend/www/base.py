@@ -16,6 +16,7 @@ __author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
 import binascii
 import json
 import logging
+import random
 import sys
 import time
 import toro
@@ -31,7 +32,9 @@ from viewfinder.backend.base import environ, message, util
 from viewfinder.backend.base.context_local import ContextLocal
 from viewfinder.backend.db.db_client import DBClient
 from viewfinder.backend.db.user import User
+from viewfinder.backend.op.op_manager import OpManager
 from viewfinder.backend.www import json_schema, www_util
+from viewfinder.backend.www.user_session_cache import UserSessionCache
 
 _ERROR_MAP = {
   400: 'We could not understand your request.',
@@ -46,6 +49,13 @@ _ERROR_MAP = {
 _USER_COOKIE_NAME = 'user'
 _USER_COOKIE_EXPIRES_DAYS = 365
 
+options.define('validate_response_sample_rate', default=1.0,
+               help='fraction of service responses that are validated against their schema; extra '
+               'fields are removed from every response regardless')
+
+# Drop the cached sessions of users that are changed or terminated by operations on this server.
+OpManager.AddUserChangedHook(lambda user_id: UserSessionCache.Instance().Invalidate(user_id))
+
 
 class ViewfinderContext(ContextLocal):
   """Provides a context local object for storing information about a viewfinder request.
@@ -359,6 +369,16 @@ class BaseHandler(web.RequestHandler):
     if user_id is None or device_id is None:
       _ClearCookie('no user_id or device_id')
 
+    # The cookie signature distinguishes sessions of the same user. Sessions without a raw cookie
+    # are not cached.
+    raw_cookie = self.get_cookie(_USER_COOKIE_NAME)
+    signature = raw_cookie.rsplit('|', 1)[-1] if raw_cookie is not None else None
+    session_cache = UserSessionCache.Instance()
+    if signature is not None:
+      user = session_cache.Get(user_id, signature)
+      if user is not None:
+        raise gen.Return((user_cookie_dict, user))
+
     user = yield gen.Task(User.Query, client, user_id, None, must_exist=False)
 
     # If "user" does not exist, logs an error and clears the cookie.
@@ -367,6 +387,8 @@ class BaseHandler(web.RequestHandler):
     elif user.IsTerminated():
       _ClearCookie('user account terminated')
 
+    if signature is not None:
+      session_cache.Add(user_id, signature, user)
     raise gen.Return((user_cookie_dict, user))
 
   def _GetCurrentUserName(self):
@@ -454,8 +476,12 @@ class BaseHandler(web.RequestHandler):
     # Validate schema before migrating to response version, since the schema is
     # with respect to the server message version rather than the response version.
     response_message = message.Message(response_dict)
-    response_message.Validate(response_schema, allow_extra_fields=True)
-    response_message.Sanitize()
+    sample_rate = options.options.validate_response_sample_rate
+    if sample_rate >= 1.0 or random.random() < sample_rate:
+      response_message.ValidateAndSanitize(response_schema)
+    else:
+      response_message.schema = response_schema
+      response_message.Sanitize()
     response_message.Migrate(client, migrate_version=response_version,
                              callback=callback, migrators=migrators)
 
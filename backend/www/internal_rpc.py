@@ -0,0 +1,57 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Handlers for RPCs between Viewfinder servers.
+
+These handlers are served on a separate port (--op_routing_port) that is only reachable from
+within the cluster; they perform no authentication of their own.
+
+  ExecuteOpsHandler: executes a user's operations on behalf of another server.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import json
+import logging
+
+from tornado import gen, stack_context, web
+from viewfinder.backend.base import util
+from viewfinder.backend.db import db_client
+from viewfinder.backend.op.op_manager import OpManager
+from viewfinder.backend.op.op_router import OpRouter
+
+
+class ExecuteOpsHandler(web.RequestHandler):
+  """Executes the operations of a user owned by this server, which were submitted to another
+  server (see OpRouter.Forward). If the request asks to wait, responds once the operation has
+  completed, with a description of the error if it failed.
+  """
+  def initialize(self, client=None):
+    self._client = client or db_client.DBClient.Instance()
+
+  @gen.coroutine
+  def post(self):
+    request = json.loads(self.request.body)
+    user_id = request['user_id']
+    operation_id = request['operation_id']
+    client = self._client
+
+    if request['wait']:
+      def _Execute(callback):
+        OpManager.Instance().ExecuteLocally(client, user_id, operation_id, callback)
+
+      try:
+        yield gen.Task(_Execute)
+      except Exception as e:
+        logging.warning('forwarded op "%s" for user %d failed: %s' % (operation_id, user_id, e))
+        self.write({'error': OpRouter.MakeErrorDict(e)})
+        return
+    else:
+      # Execute the ops in a clean context, since the request does not wait for them.
+      with stack_context.NullContext():
+        with util.ExceptionBarrier(util.LogExceptionCallback):
+          OpManager.Instance().ExecuteLocally(client, user_id, operation_id)
+
+    self.write({})
+
+
+INTERNAL_HANDLERS = [(OpRouter.FORWARD_PATH, ExecuteOpsHandler)]
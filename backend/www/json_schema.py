@@ -2341,6 +2341,84 @@ SHARE_NEW_RESPONSE = {
   }
 
 
+# Query changes to viewpoints since the update_seq already synced by the device.
+#
+# /service/sync_viewpoints
+
+SYNC_VIEWPOINTS_REQUEST = {
+  'description': 'query the changes to each viewpoint since "update_seq", which is the '
+  'viewpoint update_seq up to which the device has already synced',
+  'type': 'object',
+  'properties': {
+    'headers': HEADERS,
+    'viewpoints': {
+      'type': 'array',
+      'items': {
+        'type': 'object',
+        'properties': {
+          'viewpoint_id': {'type': 'string'},
+          'update_seq': {'type': 'integer'},
+          },
+        },
+      },
+    'limit': {
+      'description': 'maximum number of activities to return for each viewpoint',
+      'type': 'integer', 'minimum': 1, 'required': False,
+      },
+    },
+  }
+
+SYNC_VIEWPOINTS_RESPONSE = {
+  'description': 'the metadata of each requested viewpoint, and the activities with a '
+  'greater update_seq, along with the followers, episodes and comments they added or changed',
+  'type': 'object',
+  'properties': {
+    'headers': HEADERS,
+    'viewpoints': {
+      'description': 'viewpoint sync responses',
+      'type': 'array',
+      'items': {
+        'type': 'object',
+        'properties': {
+          'sync_seq': {
+            'description': 'update_seq up to which the viewpoint is synced by this response; '
+            'if less than the viewpoint update_seq, supply with the next invocation of '
+            'SYNC_VIEWPOINTS to continue',
+            'type': 'integer',
+            },
+          'followers': {
+            'description': 'followers added or changed by the activities',
+            'type': 'array', 'required': False,
+            'items': FRIEND_FOLLOWER_METADATA,
+            },
+          'activities': {
+            'description': 'activities in update_seq order',
+            'type': 'array', 'required': False,
+            'items': ACTIVITY_METADATA,
+            },
+          'episodes': {
+            'description': 'episodes added or changed by the activities',
+            'type': 'array', 'required': False,
+            'items': EPISODE_METADATA,
+            },
+          'comments': {
+            'description': 'comments posted by the activities',
+            'type': 'array', 'required': False,
+            'items': COMMENT_METADATA,
+            },
+          },
+        },
+      },
+    },
+  }
+_CopyProperties(target_dict=SYNC_VIEWPOINTS_RESPONSE['properties']['viewpoints']['items'],
+                source_dict=VIEWPOINT_METADATA)
+
+# Removed followers are only returned some of the viewpoint attributes.
+_MakeOptional(SYNC_VIEWPOINTS_RESPONSE['properties']['viewpoints']['items']['properties'],
+              lambda key: key not in ('viewpoint_id', 'sync_seq'))
+
+
 # Terminate user account.
 #
 # /service/terminate_account
@@ -13,6 +13,7 @@ import os
 from Crypto.Hash import HMAC, SHA512
 from Crypto.Protocol.KDF import PBKDF2
 from tornado import escape, gen, web
+from viewfinder.backend.base import crypto_executor
 from viewfinder.backend.base.exceptions import InvalidRequestError, PermissionError
 from viewfinder.backend.db.guess import Guess
 from viewfinder.backend.db.identity import TOO_MANY_GUESSES_ERROR
@@ -34,8 +35,10 @@ def HashPassword(password, salt):
   return base64.b64encode(PBKDF2(escape.utf8(password), base64.b64decode(salt), count=1000, prf=prf))
 
 
+@gen.coroutine
 def GeneratePasswordHash(password):
-  """Generates a password hash from the given password str, using a newly generated salt.
+  """Generates a password hash from the given password str, using a newly generated salt. The
+  hash is computed on the crypto executor so that it does not block the IOLoop.
 
   Returns a tuple: (pwd_hash, salt).
   """
@@ -48,8 +51,8 @@ def GeneratePasswordHash(password):
   salt = base64.b64encode(os.urandom(16))
 
   # Generate the password hash and return it + the salt.
-  pwd_hash = HashPassword(password, salt)
-  return (pwd_hash, salt)
+  pwd_hash = yield crypto_executor.Run(HashPassword, password, salt)
+  raise gen.Return((pwd_hash, salt))
 
 
 @gen.coroutine
@@ -63,8 +66,7 @@ def ValidateUserPassword(client, user, password):
 
   # Salt must already exist.
   assert user.salt, user
-  user_salt = user.salt.Decrypt()
-  user_pwd_hash = user.pwd_hash.Decrypt()
+  user_salt, user_pwd_hash = yield [user.salt.DecryptAsync(), user.pwd_hash.DecryptAsync()]
 
   yield ValidatePassword(client, user.user_id, password, user_salt, user_pwd_hash)
 
@@ -75,7 +77,7 @@ def ValidatePassword(client, user_id, password, salt, expected_hash):
   expected hash. Also ensures that the maximum incorrect guess count has not been exceeded.
   Raises a PermissionError if validation fails.
   """
-  actual_hash = HashPassword(password, salt)
+  actual_hash = yield crypto_executor.Run(HashPassword, password, salt)
 
   # Limit the number of incorrect password guesses.
   guess_id = Guess.ConstructGuessId('pw', user_id)
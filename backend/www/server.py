@@ -30,11 +30,13 @@ from tornado import gen, httpserver, options, stack_context, web
 from viewfinder.backend.base import secrets
 from viewfinder.backend.base.environ import ServerEnvironment
 from viewfinder.backend.db import metric, db_client
+from viewfinder.backend.db.id_allocator import IdAllocator
+from viewfinder.backend.op.op_manager import OpManager
 from viewfinder.backend.resources.resources_mgr import ResourcesManager
 from viewfinder.backend.storage.object_store import ObjectStore
 from viewfinder.backend.storage import file_object_store
 from viewfinder.backend.www import base, auth, basic_auth, auth_facebook, auth_google
-from viewfinder.backend.www import index, photo_store, service_health, unsubscribe, ping
+from viewfinder.backend.www import index, photo_store, service_health, unsubscribe, ping, internal_rpc
 from viewfinder.backend.www import view, auth_prospective, auth_viewfinder, uimodules, test_hook
 from viewfinder.backend.www.admin import admin, db, find_user_id, logs, metrics, otp, user_logs
 from viewfinder.backend.www.admin import counters, logs_counters, staging_users, profile
@@ -243,6 +245,12 @@ def StartServer(serve_webapp=True, serve_static_web=True, serve_admin=True):
     with stack_context.NullContext():
       redirect_server.listen(options.options.insecure_port)
 
+  # Setup internal RPC server, on which other servers forward ops for users owned by this server.
+  if serve_webapp and options.options.op_routing:
+    internal_server = httpserver.HTTPServer(web.Application(internal_rpc.INTERNAL_HANDLERS))
+    with stack_context.NullContext():
+      internal_server.listen(options.options.op_routing_port)
+
   # Ensure that system users have been created if running with a local db (needs server to be running).
   if options.options.localdb:
     yield CreateSystemUsers(client)
@@ -254,4 +262,9 @@ def StartServer(serve_webapp=True, serve_static_web=True, serve_admin=True):
 @gen.coroutine
 def ShutdownServer():
   """Server-specific shutdown steps."""
-  pass
+  # Leave the op routing ring, so that other servers stop forwarding operations to this one.
+  router = OpManager.Instance().router
+  if router is not None:
+    yield router.Stop()
+
+  IdAllocator.ShutdownAll()
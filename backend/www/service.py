@@ -17,9 +17,9 @@ import validictory
 
 from copy import deepcopy
 from functools import partial
-from tornado import gen, web
+from tornado import gen, options, web
 from tornado.ioloop import IOLoop
-from viewfinder.backend.base import constants, counters, handler, secrets, util
+from viewfinder.backend.base import constants, counters, handler, schema_compiler, secrets, util
 from viewfinder.backend.base.message import Message, MIN_SUPPORTED_MESSAGE_VERSION, MAX_SUPPORTED_MESSAGE_VERSION
 from viewfinder.backend.base.message import REQUIRED_MIGRATORS, INLINE_INVALIDATIONS, INLINE_COMMENTS
 from viewfinder.backend.base.message import EXTRACT_FILE_SIZES, EXTRACT_ASSET_KEYS, SPLIT_NAMES, EXPLICIT_SHARE_ORDER
@@ -38,6 +38,8 @@ from viewfinder.backend.db.episode import Episode
 from viewfinder.backend.db.followed import Followed
 from viewfinder.backend.db.follower import Follower
 from viewfinder.backend.db.identity import Identity
+from viewfinder.backend.db.identity_resolver import IdentityResolver
+from viewfinder.backend.db.inbox import Inbox
 from viewfinder.backend.db.operation import Operation
 from viewfinder.backend.db.photo import Photo
 from viewfinder.backend.db.post import Post
@@ -506,38 +508,55 @@ def QueryEpisodes(client, obj_store, user_id, device_id, request, callback):
 @gen.coroutine
 def QueryFollowed(client, obj_store, user_id, device_id, request):
   """Queries all viewpoints followed by the current user. Supports a limit and a start key
-  for pagination.
+  for pagination. If --materialize_inbox is set, then the first page is served from the user's
+  inbox if it is current, and otherwise the inbox is rebuilt from the queried page.
   """
   start_key = request.get('start_key', None)
   limit = request.get('limit', None)
 
-  followed = yield gen.Task(Followed.RangeQuery,
-                            client,
-                            hash_key=user_id,
-                            range_desc=None,
-                            limit=limit,
-                            col_names=['viewpoint_id'],
-                            excl_start_key=start_key)
+  inbox = None
+  if options.options.materialize_inbox and start_key is None:
+    inbox, last_notification_id = yield Inbox.QueryCurrent(client, user_id, limit)
 
-  # Get the viewpoint associated with each follower object.
-  last_key = followed[-1].sort_key if len(followed) > 0 else None
-
-  viewpoint_keys = [db_client.DBKey(f.viewpoint_id, None) for f in followed]
-  follower_keys = [db_client.DBKey(user_id, f.viewpoint_id) for f in followed]
-  viewpoints, followers = yield [gen.Task(Viewpoint.BatchQuery, client, viewpoint_keys, None, must_exist=False),
-                                 gen.Task(Follower.BatchQuery, client, follower_keys, None, must_exist=False)]
+  if inbox is not None:
+    entries = inbox.GetEntries()
+    last_key = entries[-1][0] if len(entries) > 0 else None
+    vp_dicts = [metadata_dict for _, metadata_dict in entries]
+  else:
+    followed = yield gen.Task(Followed.RangeQuery,
+                              client,
+                              hash_key=user_id,
+                              range_desc=None,
+                              limit=limit,
+                              col_names=['viewpoint_id'],
+                              excl_start_key=start_key)
+
+    # Get the viewpoint associated with each follower object.
+    last_key = followed[-1].sort_key if len(followed) > 0 else None
+
+    viewpoint_keys = [db_client.DBKey(f.viewpoint_id, None) for f in followed]
+    follower_keys = [db_client.DBKey(user_id, f.viewpoint_id) for f in followed]
+    viewpoints, followers = yield [gen.Task(Viewpoint.BatchQuery, client, viewpoint_keys, None, must_exist=False),
+                                   gen.Task(Follower.BatchQuery, client, follower_keys, None, must_exist=False)]
+
+    # Maintaining the inbox is best-effort, and must not fail the query.
+    if options.options.materialize_inbox and start_key is None:
+      try:
+        yield Inbox.Build(client, user_id, last_notification_id, limit, followed, viewpoints, followers)
+      except Exception:
+        logging.exception('failed to build inbox of user %d', user_id)
+
+    vp_dicts = [v.MakeMetadataDict(f) for v, f in zip(viewpoints, followers) if v is not None]
 
   # Formulate the viewpoints list into a dict for JSON output.
   # NOTE: If we ever add content to the viewpoint data being returned here, filtering out that content
   #       if the requester doesn't have view access to it should be considered.
-  response = {'viewpoints': [_MakeViewpointMetadataDict(v, f, obj_store)
-                             for v, f in zip(viewpoints, followers)
-                             if v is not None]}
+  response = {'viewpoints': [_AddViewpointPhotoUrls(vp_dict, obj_store) for vp_dict in vp_dicts]}
   util.SetIfNotNone(response, 'last_key', last_key)
 
-  logging.info('QUERY FOLLOWED: user: %d, device: %d, %d viewpoints, start key %s, last key %s' %
+  logging.info('QUERY FOLLOWED: user: %d, device: %d, %d viewpoints, start key %s, last key %s%s' %
                (user_id, device_id, len(response['viewpoints']), start_key,
-                response.get('last_key', 'None')))
+                response.get('last_key', 'None'), ' (inbox)' if inbox is not None else ''))
 
   raise gen.Return(response)
 
@@ -954,7 +973,7 @@ def RemoveViewpoint(client, obj_store, user_id, device_id, request):
 @gen.coroutine
 def ResolveContacts(client, obj_store, user_id, device_id, request):
   """Resolves contact identities to user ids."""
-  ident_tasks = []
+  resolve_keys = []
   for ident in request['identities']:
     # Validate identity key.
     Identity.ValidateKey(ident)
@@ -963,24 +982,16 @@ def ResolveContacts(client, obj_store, user_id, device_id, request):
       # Only allow email addresses and phone numbers to be resolved through this interface.  Other
       # identity types (e.g. FacebookGraph) are denser and could be exhaustively enumerated, and
       # there is little use in allowing users to enter them directly.
-      ident_tasks.append(gen.Task(Identity.Query, client, ident, None, must_exist=False))
-    else:
-      ident_tasks.append(util.GenConstant(None))
-
-  ident_results = yield ident_tasks
-
-  user_tasks = []
-  for ident in ident_results:
-    if ident is not None and ident.user_id is not None:
-      user_tasks.append(gen.Task(User.Query, client, ident.user_id, None, must_exist=False))
-    else:
-      user_tasks.append(util.GenConstant(None))
+      resolve_keys.append(ident)
 
-  user_results = yield user_tasks
+  # Address books can be large, so resolve all identities, and then all users, in batches.
+  resolved = yield IdentityResolver.Instance().ResolveIdentities(client, resolve_keys)
+  resolved_map = dict(zip(resolve_keys, resolved))
 
   results = []
-  for request_ident, ident, user in zip(request['identities'], ident_results, user_results):
+  for request_ident in request['identities']:
     result_contact = {'identity': request_ident}
+    ident, user = resolved_map.get(request_ident, (None, None))
     if user is not None:
       assert ident is not None and user.user_id == ident.user_id
       assert ident.key == request_ident
@@ -1083,6 +1094,84 @@ def ShareNew(client, obj_store, user_id, device_id, request):
   raise gen.Return({})
 
 
+@gen.coroutine
+def SyncViewpoints(client, obj_store, user_id, device_id, request):
+  """Queries the changes to each viewpoint since the "update_seq" up to which the device has
+  already synced. Returns the viewpoint metadata, the activities with a greater update_seq, and
+  the followers, episodes and comments that those activities added or changed. Unlike the
+  query_viewpoints re-query that follows a viewpoint invalidation, collections are not
+  re-read in full. At most "limit" activities are returned for each viewpoint; "sync_seq" is
+  the update_seq up to which the response brings the device.
+  """
+  @gen.coroutine
+  def _SyncViewpoint(vp_dict, viewpoint, follower):
+    """Returns the response dict for the viewpoint, or None if the user does not follow it."""
+    if follower is None:
+      raise gen.Return(None)
+
+    response_vp_dict = {'viewpoint_id': viewpoint.viewpoint_id, 'sync_seq': viewpoint.update_seq}
+    response_vp_dict.update(_MakeViewpointMetadataDict(viewpoint, follower, obj_store))
+    if not _CanViewViewpointContent(viewpoint, follower) or vp_dict['update_seq'] >= viewpoint.update_seq:
+      raise gen.Return(response_vp_dict)
+
+    activities = yield Viewpoint.QueryActivitiesSince(client,
+                                                      viewpoint.viewpoint_id,
+                                                      vp_dict['update_seq'],
+                                                      viewpoint.update_seq)
+    if limit is not None and len(activities) > limit:
+      activities = activities[:limit]
+      response_vp_dict['sync_seq'] = activities[-1].update_seq
+
+    # Gather the ids of the assets that the activities added or changed.
+    comment_ids = set()
+    episode_ids = set()
+    follower_ids = set()
+    for activity in activities:
+      args_dict = json.loads(activity.json)
+      if 'comment_id' in args_dict:
+        comment_ids.add(args_dict['comment_id'])
+      if 'episode_id' in args_dict:
+        episode_ids.add(args_dict['episode_id'])
+      episode_ids.update(ep_dict['episode_id'] for ep_dict in args_dict.get('episodes', []))
+      follower_ids.update(args_dict.get('follower_ids', []))
+      if 'target_user_id' in args_dict:
+        follower_ids.add(args_dict['target_user_id'])
+
+    comment_keys = [db_client.DBKey(viewpoint.viewpoint_id, comment_id) for comment_id in sorted(comment_ids)]
+    episode_keys = [db_client.DBKey(episode_id, None) for episode_id in sorted(episode_ids)]
+    follower_keys = [db_client.DBKey(follower_id, viewpoint.viewpoint_id) for follower_id in sorted(follower_ids)]
+    comments, episodes, followers = yield [gen.Task(Comment.BatchQuery, client, comment_keys, None, must_exist=False),
+                                           gen.Task(Episode.BatchQuery, client, episode_keys, None, must_exist=False),
+                                           gen.Task(Follower.BatchQuery, client, follower_keys, None, must_exist=False)]
+
+    response_vp_dict['activities'] = [act.MakeMetadataDict() for act in activities]
+    response_vp_dict['comments'] = [co._asdict() for co in comments if co is not None]
+    response_vp_dict['episodes'] = [ep._asdict() for ep in episodes if ep is not None]
+
+    # Only return followers if the follower is not removed.
+    if not follower.IsRemoved():
+      response_vp_dict['followers'] = [foll.MakeFriendMetadataDict() for foll in followers if foll is not None]
+
+    raise gen.Return(response_vp_dict)
+
+  limit = request.get('limit', None)
+  viewpoint_keys = [db_client.DBKey(vp_dict['viewpoint_id'], None) for vp_dict in request['viewpoints']]
+  follower_keys = [db_client.DBKey(user_id, vp_dict['viewpoint_id']) for vp_dict in request['viewpoints']]
+
+  viewpoints, followers = yield [gen.Task(Viewpoint.BatchQuery, client, viewpoint_keys, None, must_exist=False),
+                                 gen.Task(Follower.BatchQuery, client, follower_keys, None, must_exist=False)]
+
+  response_vp_dicts = yield [_SyncViewpoint(vp_dict, viewpoint, follower)
+                             for vp_dict, viewpoint, follower in zip(request['viewpoints'], viewpoints, followers)]
+  response_vp_dicts = [response_vp_dict for response_vp_dict in response_vp_dicts if response_vp_dict is not None]
+
+  logging.info('SYNC VIEWPOINTS: user: %d, device: %d, %d viewpoints, %d activities' %
+               (user_id, device_id, len(response_vp_dicts),
+                sum(len(response_vp_dict.get('activities', [])) for response_vp_dict in response_vp_dicts)))
+
+  raise gen.Return({'viewpoints': response_vp_dicts})
+
+
 @gen.coroutine
 def TerminateAccount(client, obj_store, user_id, device_id, request):
   """Terminate the calling user's account. Unlink all identities from the
@@ -1289,7 +1378,7 @@ def UpdateUser(client, obj_store, user_id, device_id, request):
         yield password_util.ValidateUserPassword(client, user, old_password)
 
     # Replace password with generated hash and salt.
-    pwd_hash, salt = password_util.GeneratePasswordHash(password)
+    pwd_hash, salt = yield password_util.GeneratePasswordHash(password)
     request['pwd_hash'] = pwd_hash
     request['salt'] = salt
 
@@ -1542,7 +1631,13 @@ def _MakeViewpointMetadataDict(viewpoint, follower, obj_store):
   """Returns a viewpoint metadata dictionary appropriate for a service query response.
   The response dictionary contains valid photo urls for the viewpoints cover photo.
   """
-  metadata_dict = viewpoint.MakeMetadataDict(follower)
+  return _AddViewpointPhotoUrls(viewpoint.MakeMetadataDict(follower), obj_store)
+
+
+def _AddViewpointPhotoUrls(metadata_dict, obj_store):
+  """Adds photo urls to the cover photo of a viewpoint metadata dictionary, and returns the
+  dictionary.
+  """
   if 'cover_photo' in metadata_dict:
     _AddPhotoUrls(obj_store, metadata_dict['cover_photo'])
 
@@ -1580,6 +1675,10 @@ class ServiceHandler(base.BaseHandler):
       self.request_migrators = sorted(REQUIRED_MIGRATORS + request_migrators)
       self.response_migrators = sorted(REQUIRED_MIGRATORS + response_migrators)
 
+      # Compile the schemas now, rather than on first use.
+      schema_compiler.CompileSchema(request, schema_compiler.REJECT_EXTRA_FIELDS)
+      schema_compiler.CompileSchema(response, schema_compiler.REMOVE_EXTRA_FIELDS)
+
   # Map from service name to Method instance.
   SERVICE_MAP = {
     'add_followers': Method(request=json_schema.ADD_FOLLOWERS_REQUEST,
@@ -1686,6 +1785,11 @@ class ServiceHandler(base.BaseHandler):
                         request_migrators=[EXPLICIT_SHARE_ORDER, SUPPRESS_BLANK_COVER_PHOTO, SUPPRESS_COPY_TIMESTAMP],
                         min_supported_version=Message.EXTRACT_MD5_HASHES,
                         handler=ShareNew),
+    'sync_viewpoints': Method(request=json_schema.SYNC_VIEWPOINTS_REQUEST,
+                              response=json_schema.SYNC_VIEWPOINTS_RESPONSE,
+                              min_supported_version=Message.SUPPRESS_EMPTY_TITLE,
+                              handler=SyncViewpoints,
+                              allow_prospective=True),
     'terminate_account': Method(request=json_schema.TERMINATE_ACCOUNT_REQUEST,
                                 response=json_schema.TERMINATE_ACCOUNT_RESPONSE,
                                 min_supported_version=Message.EXTRACT_MD5_HASHES,
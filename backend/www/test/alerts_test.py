@@ -22,6 +22,7 @@ from viewfinder.backend.db.photo import Photo
 from viewfinder.backend.db.user import User
 from viewfinder.backend.db.viewpoint import Viewpoint
 from viewfinder.backend.op.alert_manager import AlertManager
+from viewfinder.backend.op.alert_queue import AlertQueue
 from viewfinder.backend.services import sms_util
 from viewfinder.backend.services.apns import TestService
 from viewfinder.backend.services.email_mgr import EmailManager, TestEmailManager
@@ -103,6 +104,24 @@ class AlertsTestCase(service_base_test.ServiceBaseTestCase):
                                     'extra': None,
                                     'alert': 'Andy Kimball has joined Viewfinder'})
 
+  def testDeferredAlerts(self):
+    """Test that alerts are sent from the background alert queue if --defer_follower_alerts is set."""
+    options.options.defer_follower_alerts = True
+    try:
+      vp_id, ep_ids = self._tester.ShareNew(self._cookie,
+                                            [(self._episode_id, self._photo_ids)],
+                                            [self._user2.user_id])
+      self._RunAsync(AlertQueue.Instance().Drain)
+    finally:
+      options.options.defer_follower_alerts = False
+
+    notification = TestService.Instance().GetNotifications('device2')[0]
+    self.assertEqual(notification, {'sound': 'default',
+                                    'expiry': None,
+                                    'badge': 1,
+                                    'extra': {'v': vp_id},
+                                    'alert': u'user1 shared 2 photos'})
+
   def testAlertEmail(self):
     """Verify the alert email for various activity types."""
     def _Test(client_id, timestamp, vp_dict, episode_id, ph_dict):
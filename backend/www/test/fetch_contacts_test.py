@@ -236,6 +236,39 @@ class FetchContactsTestCase(service_base_test.ServiceBaseTestCase):
                             self._CreateGoogleContactFeed([{'emails': [('rachel@emailscrubbed.com', None)],
                                                             'name': 'Rachel Kimball'}]))
 
+  def testUnchangedContacts(self):
+    """Test that existing contacts are not read when the fetched contacts have not changed."""
+    people_dict = {'data': [{'id': 200, 'name': 'Rachel Kimball'}, {'id': 300, 'name': 'Mike Purtell'}]}
+    self._TestFetchContacts(self._andy_facebook, self._andy_user.user_id, people_dict)
+
+    with mock.patch.object(FetchContactsOperation, '_GatherExistingContacts') as mock_gather:
+      self._TestFetchContacts(self._andy_facebook, self._andy_user.user_id, people_dict)
+      self.assertFalse(mock_gather.called)
+
+    # A change in the fetched contacts requires a full update.
+    self._TestFetchContacts(self._andy_facebook, self._andy_user.user_id,
+                            {'data': [{'id': 200, 'name': 'Rachel Kimball'}]})
+
+  def testGoogleUpdatedMin(self):
+    """Test that Google contacts are not downloaded if nothing has changed since the last fetch."""
+    feed = self._CreateGoogleContactFeed([{'emails': [('rachel@emailscrubbed.com', None)],
+                                           'name': 'Rachel Kimball'}])
+    self._TestFetchContacts(self._andy_google, self._andy_user.user_id, feed)
+
+    with mock.patch('tornado.httpclient.AsyncHTTPClient', MockAsyncHTTPClient()) as mock_client:
+      self._AddMockJSONResponse(mock_client,
+                                r'https://www.google.com/m8/feeds/contacts/default/full.*updated-min',
+                                self._CreateGoogleContactFeed([]))
+      with mock.patch.object(FetchContactsOperation, '_FetchGoogleContacts') as mock_fetch:
+        self._RunFetchContactsOperation(self._andy_google, self._andy_user.user_id)
+        self.assertFalse(mock_fetch.called)
+
+    # If the probe reports a change, all contacts are fetched.
+    util._TEST_TIME += 1
+    self._TestFetchContacts(self._andy_google, self._andy_user.user_id,
+                            self._CreateGoogleContactFeed([{'emails': [('mike@emailscrubbed.com', None)],
+                                                            'name': 'Mike Purtell'}]))
+
   def testRenamedContacts(self):
     """Test fetching contacts, then same contacts with new names."""
     contacts = self._TestFetchContacts(self._andy_facebook, self._andy_user.user_id,
@@ -765,8 +798,12 @@ class FetchContactsTestCase(service_base_test.ServiceBaseTestCase):
     # Validate all contacts that should have been created.
     contacts = self._ValidateContacts(identity_key, user_id, people_dict)
 
-    # Validate that last_fetch was set in identity.
-    self._validator.ValidateUpdateDBObject(Identity, key=identity_key, last_fetch=util._TEST_TIME)
+    # Validate that last_fetch and contacts_digest were set in identity.
+    contacts_digest = FetchContactsOperation._CalculateContactsDigest(c.contact_id for c in contacts)
+    self._validator.ValidateUpdateDBObject(Identity,
+                                           key=identity_key,
+                                           last_fetch=util._TEST_TIME,
+                                           contacts_digest=contacts_digest)
 
     # Increment time so that subsequent contacts will use later time.
     util._TEST_TIME += 1
@@ -0,0 +1,34 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests that every service schema compiles, and that the compiled schemas agree with
+validictory on randomly generated messages.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import unittest
+
+from viewfinder.backend.base import schema_compiler
+from viewfinder.backend.base.test.schema_compiler_test import SchemaFuzzer
+from viewfinder.backend.www import json_schema
+
+
+class JsonSchemaTestCase(unittest.TestCase):
+  def _GetSchemas(self):
+    """Returns (name, schema) for every top-level schema defined in json_schema."""
+    return [(name, value) for name, value in sorted(vars(json_schema).iteritems())
+            if name.isupper() and isinstance(value, dict) and 'type' in value]
+
+  def testCompile(self):
+    """All service schemas can be compiled."""
+    for name, schema in self._GetSchemas():
+      for extra_fields in (schema_compiler.ALLOW_EXTRA_FIELDS,
+                           schema_compiler.REJECT_EXTRA_FIELDS,
+                           schema_compiler.REMOVE_EXTRA_FIELDS):
+        self.assertIsNotNone(schema_compiler.CompileSchema(schema, extra_fields), name)
+
+  def testParity(self):
+    """Compiled service schemas accept and sanitize the same messages as validictory."""
+    fuzzer = SchemaFuzzer(seed=1)
+    for name, schema in self._GetSchemas():
+      fuzzer.CheckSchema(self, schema, num_messages=50)
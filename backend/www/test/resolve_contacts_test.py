@@ -3,7 +3,10 @@
 
 __author__ = 'ben@emailscrubbed.com (Ben Darnell)'
 
+import time
+
 from viewfinder.backend.db.identity import Identity
+from viewfinder.backend.db.identity_resolver import IdentityResolver
 from viewfinder.backend.db.user import User
 from viewfinder.backend.www.test import service_base_test
 
@@ -117,3 +120,33 @@ class ResolveContactsTestCase(service_base_test.ServiceBaseTestCase):
     self.assertEqual(users, [{'user_id': new_user.user_id,
                               'identity': 'Email:prospective@emailscrubbed.com',
                               'labels': [User.REGISTERED]}])
+
+  def testManyIdentities(self):
+    """Resolve more identities than fit in a single batch query, including duplicates."""
+    identities = ['Email:nobody%d@emailscrubbed.com' % i for i in xrange(250)]
+    identities += ['Phone:+14241234567', 'Email:nobody0@emailscrubbed.com', 'Phone:+14241234567']
+    users = self._Resolve(identities)
+    self.assertEqual(len(users), len(identities))
+    self.assertEqual(users[0], {'identity': 'Email:nobody0@emailscrubbed.com'})
+    self.assertEqual(users[249], {'identity': 'Email:nobody249@emailscrubbed.com'})
+    self.assertEqual(users[250], users[252])
+    self.assertEqual(users[250]['user_id'], self.phone_user_id)
+    self.assertEqual(users[251], users[0])
+
+  def testNegativeCache(self):
+    """Unregistered identities are remembered until they are bound to a user."""
+    identity_key = 'Email:prospective@emailscrubbed.com'
+    self.assertEqual(self._Resolve([identity_key]), [{'identity': identity_key}])
+    self.assertTrue(IdentityResolver.Instance()._IsNegative(identity_key, time.time()))
+
+    # Sharing with the identity binds it to a prospective user, which invalidates the cache entry.
+    self._CreateSimpleTestAssets()
+    new_user, _, _ = self._CreateProspectiveUser()
+    self.assertFalse(IdentityResolver.Instance()._IsNegative(identity_key, time.time()))
+    users = self._Resolve([identity_key])
+    self.assertEqual(users, [{'identity': identity_key, 'user_id': new_user.user_id, 'labels': []}])
+
+    # Expired entries are queried again.
+    resolver = IdentityResolver(negative_ttl=0.01)
+    resolver._AddNegative(identity_key, time.time() - 1)
+    self.assertFalse(resolver._IsNegative(identity_key, time.time()))
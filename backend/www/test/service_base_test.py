@@ -27,6 +27,7 @@ from viewfinder.backend.db.episode import Episode
 from viewfinder.backend.db.follower import Follower
 from viewfinder.backend.db.id_allocator import IdAllocator
 from viewfinder.backend.db.identity import Identity
+from viewfinder.backend.db.identity_resolver import IdentityResolver
 from viewfinder.backend.db.photo import Photo
 from viewfinder.backend.db.settings import AccountSettings
 from viewfinder.backend.db.user import User
@@ -42,6 +43,7 @@ from viewfinder.backend.services import email_mgr, sms_mgr
 from viewfinder.backend.storage import file_object_store, object_store, server_log
 from viewfinder.backend.www import auth, auth_viewfinder, basic_auth, server, uimodules
 from viewfinder.backend.www.test.service_tester import ServiceTester
+from viewfinder.backend.www.user_session_cache import UserSessionCache
 
 
 ClientLogRecord = namedtuple('ClientLogRecord', ['timestamp', 'client_id', 'contents'])
@@ -67,6 +69,8 @@ class ServiceBaseTestCase(BaseTestCase, testing.AsyncHTTPTestCase):
                                   feedback_handler=Device.FeedbackHandler(self._client)))
     self._apns = TestService.Instance()
     IdAllocator.ResetState()
+    IdentityResolver.SetInstance(IdentityResolver())
+    UserSessionCache.SetInstance(UserSessionCache())
 
     # Do not freeze new account creation during testing (dy default).
     options.options.freeze_new_accounts = False
@@ -456,6 +460,10 @@ class ServiceBaseTestCase(BaseTestCase, testing.AsyncHTTPTestCase):
     o.Update(self._client, self.stop)
     self.wait()
     self._validator.AddModelObject(o)
+
+    # Users modified directly in the DB must not be served from the session cache.
+    if cls is User:
+      UserSessionCache.Instance().Invalidate(o.user_id)
     return o
 
   def _MakeSystemViewpoint(self, viewpoint_id):
@@ -0,0 +1,89 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests sync_viewpoints method.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+from viewfinder.backend.db.viewpoint import Viewpoint
+from viewfinder.backend.www.test import service_base_test
+
+
+class SyncViewpointsTestCase(service_base_test.ServiceBaseTestCase):
+  def setUp(self):
+    super(SyncViewpointsTestCase, self).setUp()
+    self._CreateSimpleTestAssets()
+    self._vp_id, self._ep_ids = self._tester.ShareNew(self._cookie,
+                                                      [(self._episode_id, self._photo_ids)],
+                                                      [self._user2.user_id],
+                                                      **self._CreateViewpointDict(self._cookie))
+
+  def testSyncViewpoints(self):
+    """Sync the changes made by comments and added followers."""
+    since_seq = self._GetUpdateSeq()
+    comment_id = self._tester.PostComment(self._cookie, self._vp_id, message='first')
+    self._tester.PostComment(self._cookie2, self._vp_id, message='second')
+    self._tester.AddFollowers(self._cookie, self._vp_id, [self._user3.user_id])
+
+    vp_dict = self._SyncViewpoint(self._cookie2, since_seq)
+    self.assertEqual(vp_dict['sync_seq'], self._GetUpdateSeq())
+    self.assertEqual(vp_dict['update_seq'], self._GetUpdateSeq())
+    self.assertEqual([act_dict['update_seq'] for act_dict in vp_dict['activities']],
+                     range(since_seq + 1, since_seq + 4))
+    self.assertIn('post_comment', vp_dict['activities'][0])
+    self.assertIn('add_followers', vp_dict['activities'][2])
+    self.assertEqual(len(vp_dict['comments']), 2)
+    self.assertIn(comment_id, [co_dict['comment_id'] for co_dict in vp_dict['comments']])
+    self.assertEqual([foll_dict['follower_id'] for foll_dict in vp_dict['followers']], [self._user3.user_id])
+    self.assertEqual(vp_dict['episodes'], [])
+
+    # Device that is already synced receives only the viewpoint metadata.
+    vp_dict = self._SyncViewpoint(self._cookie2, self._GetUpdateSeq())
+    self.assertNotIn('activities', vp_dict)
+
+  def testSyncShare(self):
+    """Sync the episodes added by a share."""
+    since_seq = self._GetUpdateSeq()
+    self._tester.ShareExisting(self._cookie, self._vp_id, [(self._episode_id2, self._photo_ids2)])
+
+    vp_dict = self._SyncViewpoint(self._cookie2, since_seq)
+    self.assertEqual(len(vp_dict['activities']), 1)
+    self.assertEqual([ep_dict['episode_id'] for ep_dict in vp_dict['episodes']],
+                     [vp_dict['activities'][0]['share_existing']['episodes'][0]['episode_id']])
+
+  def testLimit(self):
+    """Sync in several calls, using the returned sync_seq."""
+    since_seq = self._GetUpdateSeq()
+    for i in xrange(3):
+      self._tester.PostComment(self._cookie, self._vp_id, message='comment %d' % i)
+
+    vp_dict = self._SyncViewpoint(self._cookie2, since_seq, limit=2)
+    self.assertEqual(vp_dict['sync_seq'], since_seq + 2)
+    self.assertEqual(len(vp_dict['comments']), 2)
+
+    vp_dict = self._SyncViewpoint(self._cookie2, vp_dict['sync_seq'], limit=2)
+    self.assertEqual(vp_dict['sync_seq'], since_seq + 3)
+    self.assertEqual(len(vp_dict['comments']), 1)
+
+  def testInvalidLimit(self):
+    """ERROR: Try to sync with a limit that is not a positive integer."""
+    for limit in [0, 1.5]:
+      self.assertRaisesHttpError(400, self._SyncViewpoint, self._cookie2, 0, limit=limit)
+
+  def testNotFollower(self):
+    """Sync a viewpoint that the user does not follow."""
+    response_dict = self._tester.SendRequest('sync_viewpoints', self._cookie3,
+                                             {'viewpoints': [{'viewpoint_id': self._vp_id, 'update_seq': 0}]})
+    self.assertEqual(response_dict['viewpoints'], [])
+
+  def _GetUpdateSeq(self):
+    viewpoint = self._RunAsync(Viewpoint.Query, self._client, self._vp_id, None)
+    return viewpoint.update_seq
+
+  def _SyncViewpoint(self, user_cookie, update_seq, limit=None):
+    request_dict = {'viewpoints': [{'viewpoint_id': self._vp_id, 'update_seq': update_seq}]}
+    if limit is not None:
+      request_dict['limit'] = limit
+    response_dict = self._tester.SendRequest('sync_viewpoints', user_cookie, request_dict)
+    self.assertEqual(len(response_dict['viewpoints']), 1)
+    return response_dict['viewpoints'][0]
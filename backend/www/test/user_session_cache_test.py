@@ -0,0 +1,74 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Tests for UserSessionCache.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import time
+import unittest
+
+from viewfinder.backend.db.user import User
+from viewfinder.backend.www.user_session_cache import UserSessionCache
+
+
+class UserSessionCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self._users = dict((user_id, User.CreateFromKeywords(user_id=user_id, labels=[User.REGISTERED]))
+                       for user_id in [1, 2, 3])
+
+  def testGetAdd(self):
+    """Sessions are cached by user id and signature."""
+    cache = UserSessionCache(ttl=60, max_size=10)
+    self.assertIsNone(cache.Get(1, 'sig1'))
+    cache.Add(1, 'sig1', self._users[1])
+    self.assertEqual(cache.Get(1, 'sig1').user_id, 1)
+    self.assertIsNone(cache.Get(1, 'sig2'))
+    self.assertIsNone(cache.Get(2, 'sig1'))
+
+  def testInvalidate(self):
+    """Invalidating a user removes all of its sessions, but no others."""
+    cache = UserSessionCache(ttl=60, max_size=10)
+    cache.Add(1, 'sig1', self._users[1])
+    cache.Add(1, 'sig2', self._users[1])
+    cache.Add(2, 'sig3', self._users[2])
+    cache.Invalidate(1)
+    self.assertIsNone(cache.Get(1, 'sig1'))
+    self.assertIsNone(cache.Get(1, 'sig2'))
+    self.assertEqual(cache.Get(2, 'sig3').user_id, 2)
+    cache.Invalidate(3)
+
+  def testExpire(self):
+    """Sessions expire after the TTL."""
+    cache = UserSessionCache(ttl=0.01, max_size=10)
+    cache.Add(1, 'sig1', self._users[1])
+    time.sleep(0.02)
+    self.assertIsNone(cache.Get(1, 'sig1'))
+
+    # Caching is disabled with a zero TTL.
+    cache = UserSessionCache(ttl=0, max_size=10)
+    cache.Add(1, 'sig1', self._users[1])
+    self.assertIsNone(cache.Get(1, 'sig1'))
+
+  def testEvict(self):
+    """Least recently used sessions are evicted once the cache is full."""
+    cache = UserSessionCache(ttl=60, max_size=2)
+    cache.Add(1, 'sig1', self._users[1])
+    cache.Add(2, 'sig2', self._users[2])
+    cache.Get(1, 'sig1')
+    cache.Add(3, 'sig3', self._users[3])
+    self.assertEqual(cache.Get(1, 'sig1').user_id, 1)
+    self.assertIsNone(cache.Get(2, 'sig2'))
+    self.assertEqual(cache.Get(3, 'sig3').user_id, 3)
+    self.assertEqual(sorted(cache._user_sessions.keys()), [1, 3])
+
+  def testCopy(self):
+    """Modifying a cached user does not affect the cache."""
+    cache = UserSessionCache(ttl=60, max_size=10)
+    cache.Add(1, 'sig1', self._users[1])
+    self._users[1].name = 'Added'
+
+    user = cache.Get(1, 'sig1')
+    self.assertIsNone(user.name)
+    user.labels.add(User.TERMINATED)
+    self.assertEqual(cache.Get(1, 'sig1').labels.combine(), set([User.REGISTERED]))
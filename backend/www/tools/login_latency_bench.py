@@ -0,0 +1,88 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for IOLoop latency under concurrent login load.
+
+Simulates --num_logins password logins arriving --concurrency at a time. Each
+login hashes a password with password_util.HashPassword, either inline on the
+IOLoop (as before) or on the crypto executor. Meanwhile, a probe callback is
+scheduled every --probe_ms milliseconds and records how late it runs, which is
+the delay that any other request on the server would see. Reports login
+throughput and probe lateness percentiles for both modes.
+
+Usage:
+python -m viewfinder.backend.www.tools.login_latency_bench --num_logins=200 --concurrency=20
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import base64
+import logging
+import os
+import sys
+import time
+
+from tornado import gen, options
+from tornado.ioloop import IOLoop
+from viewfinder.backend.base import crypto_executor
+from viewfinder.backend.www import password_util
+
+options.define('num_logins', default=200, help='total number of logins to simulate')
+options.define('concurrency', default=20, help='number of logins in progress at once')
+options.define('probe_ms', default=5.0, help='interval between IOLoop latency probes')
+
+
+def _Percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+@gen.coroutine
+def _RunLogins(use_executor):
+  salt = base64.b64encode(os.urandom(16))
+  io_loop = IOLoop.current()
+  lateness = []
+  done = [False]
+
+  def _Probe(expected):
+    lateness.append(max(0.0, time.time() - expected))
+    if not done[0]:
+      next_time = time.time() + options.options.probe_ms / 1000.0
+      io_loop.add_timeout(next_time, lambda: _Probe(next_time))
+
+  @gen.coroutine
+  def _Login(i):
+    # Yield once so that each login is dispatched from the IOLoop, as a request would be.
+    yield gen.Task(io_loop.add_callback)
+    if use_executor:
+      yield crypto_executor.Run(password_util.HashPassword, 'password%d' % i, salt)
+    else:
+      password_util.HashPassword('password%d' % i, salt)
+
+  start = time.time()
+  _Probe(start)
+  for i in xrange(0, options.options.num_logins, options.options.concurrency):
+    batch = xrange(i, min(i + options.options.concurrency, options.options.num_logins))
+    yield [_Login(j) for j in batch]
+  elapsed = time.time() - start
+  done[0] = True
+
+  logging.info('%-14s %6.1f logins/sec  probe lateness ms: p50 %6.1f  p99 %6.1f  max %6.1f' %
+               ('executor' if use_executor else 'inline', options.options.num_logins / elapsed,
+                1000 * _Percentile(lateness, 0.5), 1000 * _Percentile(lateness, 0.99),
+                1000 * max(lateness)))
+
+
+@gen.coroutine
+def Run():
+  yield _RunLogins(use_executor=False)
+  yield _RunLogins(use_executor=True)
+
+
+def main():
+  options.parse_command_line()
+  IOLoop.current().run_sync(Run)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
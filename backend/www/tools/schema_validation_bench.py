@@ -0,0 +1,101 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for compiled response schema validation.
+
+Builds a large query_episodes response (--num_episodes episodes with
+--photos_per_episode photos each, every optional field populated) and times
+the previous validation path (validictory.validate followed by a separate
+walk to remove extra fields) against the compiled single-pass
+Message.ValidateAndSanitize, over --iterations runs.
+
+Usage:
+python -m viewfinder.backend.www.tools.schema_validation_bench --num_episodes=100 --photos_per_episode=50
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import logging
+import sys
+import time
+import validictory
+
+from copy import deepcopy
+from tornado import options
+from viewfinder.backend.base.message import Message
+from viewfinder.backend.www import json_schema
+
+options.define('num_episodes', default=100, help='number of episodes in the response')
+options.define('photos_per_episode', default=50, help='number of photos in each episode')
+options.define('iterations', default=10, help='number of times each validation path is run')
+
+
+def _Generate(schema, array_len):
+  """Returns a valid value for "schema" with every property present and "array_len" items in
+  every array.
+  """
+  if 'enum' in schema:
+    return schema['enum'][0]
+  schema_type = schema.get('type', 'any')
+  if isinstance(schema_type, list):
+    schema_type = [t for t in schema_type if t != 'null'][0]
+  if schema_type == 'object':
+    return dict((name, _Generate(prop_schema, array_len))
+                for name, prop_schema in schema.get('properties', {}).iteritems())
+  elif schema_type == 'array':
+    items = schema.get('items', {})
+    if schema.get('uniqueItems', False):
+      return [_Generate(items, array_len) for _ in xrange(1)]
+    return [_Generate(items, array_len) for _ in xrange(array_len)]
+  elif schema_type == 'string':
+    return 'abcdef'
+  elif schema_type in ('integer', 'number'):
+    return 1
+  elif schema_type == 'boolean':
+    return True
+  return None
+
+
+def _BuildResponse():
+  episode_schema = json_schema.QUERY_EPISODES_RESPONSE['properties']['episodes']['items']
+  response_dict = _Generate(json_schema.QUERY_EPISODES_RESPONSE, 1)
+  response_dict['episodes'] = []
+  for _ in xrange(options.options.num_episodes):
+    episode_dict = _Generate(episode_schema, options.options.photos_per_episode)
+    episode_dict['extra_field'] = 'removed by sanitize'
+    response_dict['episodes'].append(episode_dict)
+  return response_dict
+
+
+def _Time(name, response_dict, validate):
+  messages = [Message(deepcopy(response_dict)) for _ in xrange(options.options.iterations)]
+  start = time.time()
+  for message in messages:
+    validate(message)
+  elapsed = time.time() - start
+  logging.info('%-24s %8.2f ms/response' % (name, 1000 * elapsed / options.options.iterations))
+  return messages[0].dict
+
+
+def _Interpreted(message):
+  schema = json_schema.QUERY_EPISODES_RESPONSE
+  validictory.validate(message.dict, schema)
+  message._FindExtraFields(message.dict, schema, False)
+
+
+def _Compiled(message):
+  message.ValidateAndSanitize(json_schema.QUERY_EPISODES_RESPONSE)
+
+
+def main():
+  options.parse_command_line()
+  response_dict = _BuildResponse()
+  logging.info('query_episodes response with %d episodes of %d photos' %
+               (options.options.num_episodes, options.options.photos_per_episode))
+  interpreted = _Time('validictory + sanitize', response_dict, _Interpreted)
+  compiled = _Time('compiled', response_dict, _Compiled)
+  assert interpreted == compiled, 'validation paths produced different responses'
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
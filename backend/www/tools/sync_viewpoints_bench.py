@@ -0,0 +1,180 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Benchmark for sync_viewpoints.
+
+Creates a viewpoint with --num_followers followers, --num_episodes shared
+episodes and --num_comments comments in the local datastore, each recorded
+by an activity, and then shares --num_changes more episodes into it. Brings
+a device that had synced the viewpoint before those shares up-to-date in
+two ways: by the query_viewpoints re-query of the full viewpoint
+invalidation that the shares notify, and by sync_viewpoints from the
+device's update_seq. Reports the datastore requests, items read and
+response bytes of each.
+
+Usage:
+python -m viewfinder.backend.www.tools.sync_viewpoints_bench --num_comments=500 --num_changes=5
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import json
+import logging
+import sys
+
+from functools import partial
+from tornado import gen, options, stack_context
+from tornado.ioloop import IOLoop
+from viewfinder.backend.base import util
+from viewfinder.backend.db import vf_schema
+from viewfinder.backend.db.activity import Activity
+from viewfinder.backend.db.comment import Comment
+from viewfinder.backend.db.episode import Episode
+from viewfinder.backend.db.follower import Follower
+from viewfinder.backend.db.local_client import LocalClient
+from viewfinder.backend.db.viewpoint import Viewpoint
+from viewfinder.backend.op.notification_manager import NotificationManager
+from viewfinder.backend.www import base, service
+
+options.define('num_followers', default=20, help='number of followers of the viewpoint')
+options.define('num_episodes', default=50, help='number of episodes shared into the viewpoint before the sync')
+options.define('num_comments', default=500, help='number of comments posted to the viewpoint before the sync')
+options.define('num_changes', default=5, help='number of episodes shared into the viewpoint since the sync')
+
+_VIEWPOINT_ID = 'vp1'
+
+
+class _CountingClient(object):
+  """Wraps a datastore client, counting requests and the items that they read."""
+  def __init__(self, client):
+    self._client = client
+    self.requests = 0
+    self.items = 0
+
+  def GetItem(self, table, key, callback, attributes, **kwargs):
+    self.requests += 1
+    self._client.GetItem(table, key, partial(self._CountGet, callback), attributes, **kwargs)
+
+  def BatchGetItem(self, batch_dict, callback, **kwargs):
+    self.requests += 1
+    self._client.BatchGetItem(batch_dict, partial(self._CountBatchGet, callback), **kwargs)
+
+  def Query(self, table, hash_key, range_operator, callback, attributes, **kwargs):
+    self.requests += 1
+    self._client.Query(table, hash_key, range_operator, partial(self._CountQuery, callback), attributes, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(self._client, name)
+
+  def _CountGet(self, callback, result):
+    if result is not None:
+      self.items += 1
+    callback(result)
+
+  def _CountBatchGet(self, callback, result):
+    self.items += sum(len([item for item in batch_result.items if item is not None])
+                      for batch_result in result.values())
+    callback(result)
+
+  def _CountQuery(self, callback, result):
+    self.items += len(result.items)
+    callback(result)
+
+
+@gen.coroutine
+def _CreateViewpoint(client):
+  """Creates the viewpoint and its followers, episodes, comments and activities. Returns the
+  update_seq of the viewpoint before the last --num_changes shares.
+  """
+  timestamp = util.GetCurrentTimestamp()
+  num_followers = options.options.num_followers
+  num_episodes = options.options.num_episodes + options.options.num_changes
+  num_comments = options.options.num_comments
+  uniquifier = iter(xrange(1, 1 << 30))
+  activities = []
+
+  def _AddActivity(name, args_dict):
+    activity = Activity(_VIEWPOINT_ID, Activity.ConstructActivityId(timestamp, 1, next(uniquifier)))
+    activity.user_id = 1
+    activity.timestamp = timestamp
+    activity.update_seq = len(activities) + 1
+    activity.name = name
+    activity.json = json.dumps(args_dict)
+    activities.append(activity)
+
+  followers = []
+  for follower_id in xrange(1, num_followers + 1):
+    follower = Follower(follower_id, _VIEWPOINT_ID)
+    follower.timestamp = timestamp
+    follower.labels = [Follower.CONTRIBUTE]
+    follower.viewed_seq = 0
+    followers.append(follower)
+  _AddActivity('add_followers', {'follower_ids': range(2, num_followers + 1)})
+
+  comments = []
+  for i in xrange(num_comments):
+    comment = Comment(_VIEWPOINT_ID, Comment.ConstructCommentId(timestamp, 1, next(uniquifier)))
+    comment.user_id = 1
+    comment.timestamp = timestamp
+    comment.message = 'comment %d' % i
+    comments.append(comment)
+    _AddActivity('post_comment', {'comment_id': comment.comment_id})
+
+  # Episodes are shared last, so that the final --num_changes shares are the changes to sync.
+  episodes = []
+  for i in xrange(num_episodes):
+    episode = Episode(Episode.ConstructEpisodeId(timestamp, 1, next(uniquifier)))
+    episode.user_id = 1
+    episode.viewpoint_id = _VIEWPOINT_ID
+    episode.timestamp = timestamp
+    episode.publish_timestamp = timestamp
+    episodes.append(episode)
+    _AddActivity('share_existing', {'episodes': [{'episode_id': episode.episode_id, 'photo_ids': []}]})
+
+  viewpoint = Viewpoint(_VIEWPOINT_ID)
+  viewpoint.user_id = 1
+  viewpoint.timestamp = timestamp
+  viewpoint.last_updated = timestamp
+  viewpoint.type = Viewpoint.EVENT
+  viewpoint.title = 'benchmark'
+  viewpoint.update_seq = len(activities)
+
+  yield [gen.Task(obj.Update, client) for obj in [viewpoint] + followers + comments + episodes + activities]
+  raise gen.Return(viewpoint.update_seq - options.options.num_changes)
+
+
+def _CallService(handler, client, request, callback):
+  """Calls the service "handler" for user 1 within a ViewfinderContext, as a service request
+  would be.
+  """
+  with stack_context.StackContext(base.ViewfinderContext(None)):
+    handler(client, None, 1, 1, request).add_done_callback(lambda future: callback(future.result()))
+
+
+@gen.coroutine
+def _RunSync(local_client, name, handler, request):
+  client = _CountingClient(local_client)
+  response = yield gen.Task(_CallService, handler, client, request)
+  logging.info('%-18s %6d requests %8d items read %10d response bytes' %
+               (name, client.requests, client.items, len(json.dumps(response))))
+
+
+@gen.coroutine
+def Run():
+  local_client = LocalClient(vf_schema.SCHEMA)
+  yield gen.Task(vf_schema.SCHEMA.VerifyOrCreate, local_client)
+  synced_seq = yield _CreateViewpoint(local_client)
+
+  yield _RunSync(local_client, 'query_viewpoints', service.QueryViewpoints,
+                 {'viewpoints': [NotificationManager._CreateViewpointInvalidation(_VIEWPOINT_ID)]})
+  yield _RunSync(local_client, 'sync_viewpoints', service.SyncViewpoints,
+                 {'viewpoints': [{'viewpoint_id': _VIEWPOINT_ID, 'update_seq': synced_seq}]})
+
+
+def main():
+  options.parse_command_line()
+  IOLoop.current().run_sync(Run)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,102 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Per-process cache of the users behind authenticated sessions.
+
+Every authenticated request decodes the user cookie and then queries the
+User in order to check that it still exists and has not been terminated.
+UserSessionCache remembers the result for a short time, keyed by user id and
+the signature of the cookie, so that repeated requests made with the same
+cookie (including notification long-poll wakeups) skip the query.
+
+Entries expire after --user_session_cache_secs, and at most
+--user_session_cache_size sessions are remembered (least recently used are
+evicted first). All sessions of a user are invalidated when an operation that
+changes or terminates the user completes on this server; changes made on other
+servers are seen once the entry expires.
+
+  UserSessionCache: maps (user_id, cookie signature) to a User.
+"""
+
+__author__ = 'andy@emailscrubbed.com (Andy Kimball)'
+
+import time
+
+from collections import OrderedDict
+from tornado import options
+from viewfinder.backend.base import counters
+
+options.define('user_session_cache_secs', default=10.0,
+               help='seconds for which the user behind an authenticated session is cached')
+options.define('user_session_cache_size', default=10000,
+               help='maximum number of authenticated sessions cached')
+
+_cache_hits = counters.define_rate('viewfinder.service.user_session_cache_hits_per_min',
+                                   'Authenticated requests whose user was found in the session cache per minute.', 60)
+_cache_misses = counters.define_rate('viewfinder.service.user_session_cache_misses_per_min',
+                                     'Authenticated requests whose user was queried from the database per minute.', 60)
+
+
+class UserSessionCache(object):
+  """Bounded, expiring map from (user_id, cookie signature) to the User object that was
+  queried for that session. Each request gets its own copy of the cached user, so that
+  requests cannot see each other's modifications.
+  """
+  _instance = None
+
+  def __init__(self, ttl=None, max_size=None):
+    self._ttl = options.options.user_session_cache_secs if ttl is None else ttl
+    self._max_size = options.options.user_session_cache_size if max_size is None else max_size
+    # Maps (user_id, signature) => (expiration time, user), in least recently used order.
+    self._sessions = OrderedDict()
+    # Maps user_id => set of signatures cached for that user.
+    self._user_sessions = {}
+
+  @staticmethod
+  def Instance():
+    if UserSessionCache._instance is None:
+      UserSessionCache._instance = UserSessionCache()
+    return UserSessionCache._instance
+
+  @staticmethod
+  def SetInstance(cache):
+    UserSessionCache._instance = cache
+
+  def Get(self, user_id, signature):
+    """Returns the cached user for the session, or None if it is not cached or has expired."""
+    key = (user_id, signature)
+    entry = self._sessions.pop(key, None)
+    if entry is None or entry[0] <= time.time():
+      if entry is not None:
+        self._RemoveSignature(user_id, signature)
+      _cache_misses.increment()
+      return None
+
+    # Re-insert to mark as most recently used.
+    self._sessions[key] = entry
+    _cache_hits.increment()
+    return entry[1]._Clone()
+
+  def Add(self, user_id, signature, user):
+    """Caches "user" as the user for the session."""
+    if self._ttl <= 0 or self._max_size <= 0:
+      return
+    key = (user_id, signature)
+    self._sessions.pop(key, None)
+    self._sessions[key] = (time.time() + self._ttl, user._Clone())
+    self._user_sessions.setdefault(user_id, set()).add(signature)
+
+    while len(self._sessions) > self._max_size:
+      (evict_user_id, evict_signature), _ = self._sessions.popitem(last=False)
+      self._RemoveSignature(evict_user_id, evict_signature)
+
+  def Invalidate(self, user_id):
+    """Removes all cached sessions for the given user."""
+    for signature in self._user_sessions.pop(user_id, ()):
+      self._sessions.pop((user_id, signature), None)
+
+  def _RemoveSignature(self, user_id, signature):
+    signatures = self._user_sessions.get(user_id)
+    if signatures is not None:
+      signatures.discard(signature)
+      if not signatures:
+        del self._user_sessions[user_id]
@@ -21,6 +21,7 @@ from viewfinder.backend.base.environ import ServerEnvironment
 from viewfinder.backend.db import db_client
 from viewfinder.backend.db.device import Device
 from viewfinder.backend.op.op_manager import OpManager
+from viewfinder.backend.op.op_router import LocalServerMembership, OpRouter, ServerMembership
 from viewfinder.backend.op.operation_map import DB_OPERATION_MAP
 from viewfinder.backend.services.apns import APNS
 from viewfinder.backend.services.email_mgr import EmailManager, SendGridEmailManager, LoggingEmailManager
@@ -60,13 +61,22 @@ def _StartWWW(run_callback, scan_ops):
     for store_name in (ObjectStore.PHOTO, ObjectStore.USER_LOG, ObjectStore.USER_ZIPS):
       ObjectStore.GetInstance(store_name).SetUrlFmtString(url_fmt_string % store_name)
 
-  OpManager.SetInstance(OpManager(op_map=DB_OPERATION_MAP, client=client, scan_ops=scan_ops))
+  http_client = AsyncHTTPClient()
+
+  # Route each user's ops to a single server, if enabled. A local datastore is not shared with
+  # other servers, so neither is ring membership in that case.
+  router = None
+  if options.options.op_routing:
+    membership = LocalServerMembership() if options.options.localdb else ServerMembership(client)
+    router = OpRouter(membership, OpRouter.GetLocalAddress(), http_client=http_client)
+    yield router.Start()
+
+  OpManager.SetInstance(OpManager(op_map=DB_OPERATION_MAP, client=client, scan_ops=scan_ops, router=router))
 
   apns_feedback_handler = Device.FeedbackHandler(client)
   APNS.SetInstance('dev', APNS(environment='dev', feedback_handler=apns_feedback_handler))
   APNS.SetInstance('ent', APNS(environment='ent', feedback_handler=apns_feedback_handler))
   APNS.SetInstance('prod', APNS(environment='prod', feedback_handler=apns_feedback_handler))
-  http_client = AsyncHTTPClient()
   ITunesStoreClient.SetInstance('dev', ITunesStoreClient(environment='dev', http_client=http_client))
   ITunesStoreClient.SetInstance('prod', ITunesStoreClient(environment='prod', http_client=http_client))
 
@@ -0,0 +1,288 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+
+"""Compact, memory-mapped geodata index.
+
+The geoprocessor parses the full geonames and US postal text files into
+Python objects, which is far too slow and memory hungry to do in a server
+process. WriteGeoIndex() instead serializes the processed places once into a
+single binary file which GeoIndex maps into memory and queries in place:
+only the pages touched by a lookup are ever read, and nothing is loaded onto
+the Python heap up front.
+
+File layout (all integers little-endian):
+
+  header        : magic, version, num_places, grid cell size and section offsets
+  places        : num_places fixed-size records, sorted by normalized name:
+                    lat and lng in microdegrees (int32), population (uint32),
+                    offset and length of the place's strings (uint32, uint16)
+  name offsets  : num_places + 1 uint32 offsets into the names section
+  names         : normalized (lowercased, utf-8) place names, concatenated in
+                  record order; together with the offsets this is a flattened
+                  prefix trie, whose prefix ranges are found by bisection
+  grid offsets  : one uint32 per lat/lng grid cell, plus one, into grid entries
+  grid entries  : place record ids, grouped by grid cell
+  strings       : utf-8 'name TAB country code TAB country TAB state TAB county' per place
+
+  GeoIndex.GetIndex: shared, lazily opened GeoIndex for a path.
+  GeoIndex.PrefixLookup: most populous places whose name starts with a prefix.
+  GeoIndex.Nearest: closest place to a lat/lng, searching outward ring by ring.
+  GeoIndex.ReverseGeocode: Placemark-style dict for the nearest place, for
+    local placemark normalization and PlacemarkIndexer term generation. Used
+    by upload_episode to fill in missing photo placemarks, through the
+    Geocoder service (see --geoindex).
+"""
+
+__author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
+
+import bisect
+import heapq
+import math
+import mmap
+import os
+import struct
+
+from collections import namedtuple
+
+GeoPlace = namedtuple('GeoPlace', ['name', 'lat', 'lon', 'cc', 'country', 'state', 'county', 'pop'])
+
+_MAGIC = 'VFGI'
+_VERSION = 2
+_HEADER = struct.Struct('<4sIIdIIIIII')
+_PLACE = struct.Struct('<iiIIH')
+_UINT32 = struct.Struct('<I')
+
+_EARTH_RADIUS_KM = 6371.0
+
+DEFAULT_CELL_DEGREES = 1.0
+
+
+def NormalizeName(name):
+  """Returns the normalized (lowercased, utf-8 encoded) form of a place name, as used
+  for prefix lookups.
+  """
+  if isinstance(name, str):
+    name = name.decode('utf-8')
+  return name.strip().lower().encode('utf-8')
+
+
+def DistanceKm(lat1, lon1, lat2, lon2):
+  """Returns the great circle distance in kilometers between two lat/lng points."""
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+  return 2 * _EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class _Grid(object):
+  """Maps lat/lng to cells of a fixed number of degrees on a side."""
+  def __init__(self, cell_degrees):
+    self.cell_degrees = cell_degrees
+    self.rows = int(math.ceil(180.0 / cell_degrees))
+    self.cols = int(math.ceil(360.0 / cell_degrees))
+
+  def Row(self, lat):
+    return min(self.rows - 1, max(0, int((lat + 90.0) / self.cell_degrees)))
+
+  def Col(self, lon):
+    return int((lon + 180.0) / self.cell_degrees) % self.cols
+
+  def Cell(self, row, col):
+    return row * self.cols + col % self.cols
+
+
+def WriteGeoIndex(places, path, cell_degrees=DEFAULT_CELL_DEGREES, country_names=None):
+  """Writes a geodata index for "places", a sequence of objects with name, lat, lon,
+  cc, state, county and pop attributes (e.g. the geoprocessor's GeoDatum tuples),
+  to "path". The country name of each place is taken from its "country" attribute if it
+  has one, else from "country_names", a dict from country code to country name. The file
+  is written to a temporary name and then renamed, so that readers never map a partial
+  index.
+  """
+  country_names = country_names or {}
+  grid = _Grid(cell_degrees)
+  records = sorted(places, key=lambda p: (NormalizeName(p.name), -(p.pop or 0)))
+
+  names = []
+  name_offsets = [0]
+  strings = []
+  string_offset = 0
+  place_data = []
+  cells = [[] for _ in xrange(grid.rows * grid.cols)]
+  for record_id, place in enumerate(records):
+    name = NormalizeName(place.name)
+    names.append(name)
+    name_offsets.append(name_offsets[-1] + len(name))
+
+    country = getattr(place, 'country', None) or country_names.get(place.cc)
+    fields = [place.name, place.cc, country, place.state, place.county]
+    value = u'\t'.join(f.decode('utf-8') if isinstance(f, str) else (f or u'') for f in fields).encode('utf-8')
+    strings.append(value)
+    place_data.append(_PLACE.pack(int(round(place.lat * 1e6)), int(round(place.lon * 1e6)),
+                                  min(place.pop or 0, 0xffffffff), string_offset, len(value)))
+    string_offset += len(value)
+    cells[grid.Cell(grid.Row(place.lat), grid.Col(place.lon))].append(record_id)
+
+  grid_offsets = [0]
+  for cell in cells:
+    grid_offsets.append(grid_offsets[-1] + len(cell))
+
+  sections = [''.join(place_data),
+              ''.join(_UINT32.pack(o) for o in name_offsets),
+              ''.join(names),
+              ''.join(_UINT32.pack(o) for o in grid_offsets),
+              ''.join(_UINT32.pack(record_id) for cell in cells for record_id in cell),
+              ''.join(strings)]
+  offsets = []
+  offset = _HEADER.size
+  for section in sections:
+    offsets.append(offset)
+    offset += len(section)
+
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(_HEADER.pack(_MAGIC, _VERSION, len(records), cell_degrees, *offsets))
+    for section in sections:
+      f.write(section)
+  os.rename(tmp_path, path)
+
+
+class _SortedNames(object):
+  """Sequence of the normalized names of an index, in record order, which decodes each
+  name only when it is accessed. This lets the bisect module search the names in place.
+  """
+  def __init__(self, index):
+    self._index = index
+
+  def __len__(self):
+    return len(self._index)
+
+  def __getitem__(self, record_id):
+    return self._index._Name(record_id)
+
+
+class GeoIndex(object):
+  """Read-only view of an index written by WriteGeoIndex, backed by a memory map of
+  the file. Instances are safe to share within a process.
+  """
+  _cache = dict()
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, self._num_places, cell_degrees, self._places_off, self._name_offsets_off,
+     self._names_off, self._grid_offsets_off, self._grid_entries_off, self._strings_off) = \
+        _HEADER.unpack_from(self._map, 0)
+    assert magic == _MAGIC, 'not a geodata index: %s' % path
+    assert version == _VERSION, 'unsupported geodata index version %d' % version
+    self._grid = _Grid(cell_degrees)
+    self._names = _SortedNames(self)
+
+  @classmethod
+  def GetIndex(cls, path):
+    """Returns the GeoIndex for "path", mapping the file on first use."""
+    if path not in GeoIndex._cache:
+      GeoIndex._cache[path] = GeoIndex(path)
+    return GeoIndex._cache[path]
+
+  def __len__(self):
+    return self._num_places
+
+  def close(self):
+    self._map.close()
+
+  def GetPlace(self, record_id):
+    """Returns the GeoPlace with the given record id."""
+    lat, lon, pop, string_offset, string_length = \
+        _PLACE.unpack_from(self._map, self._places_off + record_id * _PLACE.size)
+    start = self._strings_off + string_offset
+    name, cc, country, state, county = self._map[start:start + string_length].decode('utf-8').split(u'\t')
+    return GeoPlace(name, lat / 1e6, lon / 1e6, cc, country or None, state or None, county or None, pop)
+
+  def PrefixLookup(self, prefix, limit=10):
+    """Returns up to "limit" GeoPlaces whose normalized name starts with "prefix",
+    most populous first.
+    """
+    prefix = NormalizeName(prefix)
+
+    # Names that start with "prefix" sort between it and "prefix" followed by the largest
+    # byte, which never occurs in utf-8.
+    start = bisect.bisect_left(self._names, prefix)
+    end = bisect.bisect_left(self._names, prefix + '\xff', start)
+    record_ids = heapq.nlargest(limit, xrange(start, end),
+                                key=lambda record_id: (self._Population(record_id), -record_id))
+    return [self.GetPlace(record_id) for record_id in record_ids]
+
+  def Nearest(self, lat, lon, max_km=None):
+    """Returns (GeoPlace, distance in km) for the place nearest to lat/lon, or None if
+    there is no place within "max_km". Grid cells are searched in rings of increasing
+    size until no unsearched cell can contain a closer place.
+    """
+    grid = self._grid
+    row, col = grid.Row(lat), grid.Col(lon)
+    best = None
+    cell_km = math.radians(grid.cell_degrees) * _EARTH_RADIUS_KM
+    max_ring = max(grid.rows, grid.cols // 2)
+    for ring in xrange(max_ring + 1):
+      # Any place in this ring is at least (ring - 1) cells away. Longitude cells shrink toward
+      # the poles, so use the narrowest cell width this ring can reach.
+      max_lat = min(89.0, abs(lat) + ring * grid.cell_degrees)
+      min_ring_km = (ring - 1) * cell_km * max(math.cos(math.radians(max_lat)), 0.01)
+      if best is not None and min_ring_km > best[1]:
+        break
+      if max_km is not None and min_ring_km > max_km:
+        break
+      for record_id in self._RingRecords(row, col, ring):
+        place_lat, place_lon = self._LatLng(record_id)
+        dist = DistanceKm(lat, lon, place_lat, place_lon)
+        if best is None or dist < best[1]:
+          best = (record_id, dist)
+
+    if best is None or (max_km is not None and best[1] > max_km):
+      return None
+    return self.GetPlace(best[0]), best[1]
+
+  def ReverseGeocode(self, lat, lon, max_km=50):
+    """Returns a dict of Placemark fields (iso_country_code, country, state, locality) for
+    the place nearest to lat/lon, or None if there is none within "max_km".
+    """
+    nearest = self.Nearest(lat, lon, max_km=max_km)
+    if nearest is None:
+      return None
+    place = nearest[0]
+    placemark = {'iso_country_code': place.cc, 'locality': place.name}
+    if place.country:
+      placemark['country'] = place.country
+    if place.state:
+      placemark['state'] = place.state
+    return placemark
+
+  def _Name(self, record_id):
+    start, end = struct.unpack_from('<II', self._map, self._name_offsets_off + record_id * _UINT32.size)
+    return self._map[self._names_off + start:self._names_off + end]
+
+  def _Population(self, record_id):
+    return _PLACE.unpack_from(self._map, self._places_off + record_id * _PLACE.size)[2]
+
+  def _LatLng(self, record_id):
+    lat, lon = struct.unpack_from('<ii', self._map, self._places_off + record_id * _PLACE.size)
+    return lat / 1e6, lon / 1e6
+
+  def _RingRecords(self, row, col, ring):
+    """Yields the record ids in the cells exactly "ring" cells away from (row, col)."""
+    grid = self._grid
+    if ring == 0:
+      cells = [(row, col)]
+    else:
+      cells = set()
+      for d in xrange(-ring, ring + 1):
+        cells.update([(row - ring, col + d), (row + ring, col + d), (row + d, col - ring), (row + d, col + ring)])
+    seen = set()
+    for r, c in cells:
+      if r < 0 or r >= grid.rows:
+        continue
+      cell = grid.Cell(r, c)
+      if cell in seen:
+        continue
+      seen.add(cell)
+      start, end = struct.unpack_from('<II', self._map, self._grid_offsets_off + cell * _UINT32.size)
+      for i in xrange(start, end):
+        yield _UINT32.unpack_from(self._map, self._grid_entries_off + i * _UINT32.size)[0]
@@ -29,6 +29,11 @@ particular range of placename prefixes.
 Output is written to files of the format %d.%d in an output
 subdirectory specified via --output_dir.
 
+With --create_index (the default), all places are also written to a
+compact binary index (geoindex.bin) which can be memory-mapped and
+queried in-process for name prefix and nearest-city lookups; see
+geoindex.py.
+
 For a list of world cities with overweight inclusion of US cities, use:
 
 % python geoprocessor.py --pop_filter=500000 --user_city_boost=5
@@ -74,9 +79,12 @@ from collections import namedtuple
 from functools import partial
 from operator import attrgetter
 from tornado import options
+from viewfinder.resources.geodata.geoindex import WriteGeoIndex
 
 options.define('cityfile', default='cities1000.txt', help='geonames datafile to parse')
 options.define('uspostalfile', default='US_postal.txt', help='geonames datafile of US postal info')
+options.define('countryfile', default='countryInfo.txt', help='geonames datafile of country info, used for the '
+               'country names in the binary index')
 options.define('output_dir', default='geodb/', help='subdirectory for geoname database output files')
 options.define('datafile_size', default=1000, help='approximate number of places in a datafile')
 options.define('ascii_names', default=False, help='include ascii names if normal name is non-ascii')
@@ -87,6 +95,9 @@ options.define('create_recursive_data_files', default=False, help='create recurs
                'of city name / lat / long files, ordered lexicographically and by population')
 options.define('filter_top_cities', default=True, help='create a file of the top world cities by population; '
                'output file is written to "output_dir/top_cities.txt"')
+options.define('create_index', default=True, help='create a memory-mappable binary index of all places for '
+               'prefix and nearest-city lookups; output file is written to "output_dir/geoindex.bin" '
+               '(see geoindex.py)')
 
 GeoDatum = namedtuple('GeoDatum', ['id', 'name', 'lat', 'lon', 'cc', 'state', 'county', 'pop'])
 
@@ -177,10 +188,30 @@ class GeoProcessor(object):
       for c in cities_sorted:
         f.write('%s,%s,%s,%f,%f\n' % (c.name, c.state or '', c.cc, c.lat, c.lon))
 
+  def WriteIndex(self):
+    """Writes the binary geodata index of all places to the output directory."""
+    path = os.path.join(options.options.output_dir, 'geoindex.bin')
+    WriteGeoIndex(self._data, path, country_names=self._ParseCountries(options.options.countryfile))
+    logging.info('wrote geodata index of %d places to %s' % (len(self._data), path))
+
   def _CleanName(self, name):
     """Strips illegal characters from place name and returns new name."""
     return name.strip(string.whitespace + string.punctuation)
 
+  def _ParseCountries(self, datafile):
+    """Loads and parses the provided datafile into a dict from ISO-3166 2-letter country
+    code to country name.
+    """
+    country_names = {}
+    with open(datafile, 'r') as f:
+      for line in f.readlines():
+        if line.startswith('#'):
+          continue
+        fields = line.split('\t')
+        country_names[fields[0]] = fields[4].decode('utf-8')
+    logging.info('parsed %d countries from country info database' % len(country_names))
+    return country_names
+
   def _ParseUSPostal(self, datafile):
     """Loads and parses the provided datafile into an array of placename
     information.
@@ -260,6 +291,8 @@ def main():
     geoproc.RecursivelyCreateDataFile()
   if options.options.filter_top_cities:
     geoproc.FilterTopCities()
+  if options.options.create_index:
+    geoproc.WriteIndex()
 
 
 if __name__ == '__main__':
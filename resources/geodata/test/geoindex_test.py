@@ -0,0 +1,98 @@
+# Copyright 2013 Viewfinder Inc. All Rights Reserved.
+# -*- coding: utf-8 -*-
+
+"""Tests for the memory-mapped geodata index.
+"""
+
+__author__ = 'spencer@emailscrubbed.com (Spencer Kimball)'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from viewfinder.resources.geodata.geoindex import GeoIndex, GeoPlace, WriteGeoIndex
+
+_PLACES = [GeoPlace('San Francisco', 37.775, -122.419, 'US', 'United States', 'CA', 'San Francisco', 805235),
+           GeoPlace('San Jose', 37.339, -121.895, 'US', 'United States', 'CA', 'Santa Clara', 945942),
+           GeoPlace('Santa Clara', 37.354, -121.955, 'US', 'United States', 'CA', 'Santa Clara', 116468),
+           GeoPlace('Oakland', 37.804, -122.271, 'US', 'United States', 'CA', 'Alameda', 390724),
+           GeoPlace('New York', 40.714, -74.006, 'US', 'United States', 'NY', None, 8175133),
+           GeoPlace('Paris', 48.853, 2.349, 'FR', 'France', None, None, 2138551),
+           GeoPlace(u'São Paulo', -23.548, -46.636, 'BR', 'Brazil', u'São Paulo', None, 10021295),
+           GeoPlace('Suva', -18.142, 178.441, 'FJ', 'Fiji', None, None, 77366),
+           GeoPlace('Apia', -13.833, -171.767, 'WS', 'Samoa', None, None, 40407)]
+
+
+class GeoIndexTestCase(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._dir, 'geoindex.bin')
+    WriteGeoIndex(_PLACES, self._path)
+    self._index = GeoIndex(self._path)
+
+  def tearDown(self):
+    self._index.close()
+    shutil.rmtree(self._dir)
+
+  def testPrefixLookup(self):
+    """Places are matched by normalized name prefix, most populous first."""
+    self.assertEqual([place.name for place in self._index.PrefixLookup('san')],
+                     ['San Jose', 'San Francisco', 'Santa Clara'])
+    self.assertEqual([place.name for place in self._index.PrefixLookup('san f')], ['San Francisco'])
+    self.assertEqual([place.name for place in self._index.PrefixLookup('SA', limit=2)],
+                     ['San Jose', 'San Francisco'])
+    self.assertEqual([place.name for place in self._index.PrefixLookup('s')],
+                     [u'São Paulo', 'San Jose', 'San Francisco', 'Santa Clara', 'Suva'])
+    self.assertEqual([place.name for place in self._index.PrefixLookup(u'são')], [u'São Paulo'])
+    self.assertEqual(self._index.PrefixLookup('zz'), [])
+    self.assertEqual(self._index.PrefixLookup('paris, france'), [])
+    self.assertEqual(len(self._index.PrefixLookup('', limit=100)), len(_PLACES))
+
+  def testGetPlace(self):
+    """Places round-trip through the index, with missing fields as None."""
+    place = self._index.PrefixLookup('new york')[0]
+    self.assertEqual(place, _PLACES[4])
+    place = self._index.PrefixLookup('paris')[0]
+    self.assertIsNone(place.state)
+    self.assertIsNone(place.county)
+
+  def testNearest(self):
+    """The nearest place is found, including across the antimeridian."""
+    place, distance = self._index.Nearest(37.78, -122.41)
+    self.assertEqual(place.name, 'San Francisco')
+    self.assertLess(distance, 2)
+    self.assertEqual(self._index.Nearest(37.35, -121.94)[0].name, 'Santa Clara')
+    self.assertEqual(self._index.Nearest(-14.0, 179.9)[0].name, 'Suva')
+    self.assertEqual(self._index.Nearest(-14.0, -179.9)[0].name, 'Suva')
+    self.assertIsNone(self._index.Nearest(0.0, -30.0, max_km=100))
+
+  def testReverseGeocode(self):
+    """Placemark fields are returned for the nearest place."""
+    self.assertEqual(self._index.ReverseGeocode(40.7, -74.0),
+                     {'iso_country_code': 'US', 'country': 'United States', 'state': 'NY', 'locality': 'New York'})
+    self.assertEqual(self._index.ReverseGeocode(48.86, 2.35),
+                     {'iso_country_code': 'FR', 'country': 'France', 'locality': 'Paris'})
+    self.assertIsNone(self._index.ReverseGeocode(0.0, -30.0))
+
+  def testCountryNames(self):
+    """Country names are looked up by country code for places that have none."""
+    path = os.path.join(self._dir, 'countries.bin')
+    WriteGeoIndex([place._replace(country=None) for place in _PLACES], path, country_names={'FR': u'France'})
+    index = GeoIndex(path)
+    try:
+      self.assertEqual(index.PrefixLookup('paris')[0].country, 'France')
+      self.assertIsNone(index.PrefixLookup('suva')[0].country)
+      self.assertEqual(index.ReverseGeocode(-18.1, 178.4), {'iso_country_code': 'FJ', 'locality': 'Suva'})
+    finally:
+      index.close()
+
+  def testGetIndex(self):
+    """Indexes are opened once per path."""
+    index = GeoIndex.GetIndex(self._path)
+    try:
+      self.assertIs(GeoIndex.GetIndex(self._path), index)
+      self.assertEqual(len(index), len(_PLACES))
+    finally:
+      del GeoIndex._cache[self._path]
+      index.close()